@@ -5,6 +5,7 @@
 """Primary side of Primary <-> Replica protocol."""
 
 import base64
+import hashlib
 import logging
 
 from google.appengine.api import app_identity
@@ -26,6 +27,9 @@ PUSH_STATUS_SUCCESS = 0
 PUSH_STATUS_TRANSIENT_ERROR = 1
 PUSH_STATUS_FATAL_ERROR = 2
 
+# Oldest components.auth.version.__version__ of a replica accepting AuthDBDelta.
+DELTA_MIN_AUTH_CODE_VERSION = (1, 1, 3)
+
 
 class ReplicationTriggerError(Exception):
   """Failed to trigger a replication task."""
@@ -43,6 +47,10 @@ class FatalReplicaUpdateError(ReplicaUpdateError):
   """Failed to update a replica, update must not be retried."""
 
 
+class BaseRevisionMismatchError(FatalReplicaUpdateError):
+  """Replica is not at the base revision of a delta, push an entire AuthDB."""
+
+
 class AuthReplicaState(ndb.Model, datastore_utils.SerializableModelMixin):
   """Last known state of a Replica as known by Primary.
 
@@ -79,6 +87,17 @@ class AuthReplicaState(ndb.Model, datastore_utils.SerializableModelMixin):
   push_error = ndb.StringProperty(indexed=False)
 
 
+class AuthDBDigest(ndb.Model):
+  """Hashes of groups and IP whitelists of some revision of AuthDB.
+
+  Used to compute the changes between this revision and the current one when
+  pushing AuthDBDelta to a replica. Key id is the revision. It's a root entity,
+  to not add writes to replicas_root_key() entity group.
+  """
+  # {'groups': {name: hash}, 'ip_whitelists': {name: hash}}.
+  digest = ndb.JsonProperty(compressed=True)
+
+
 def replicas_root_key():
   """Root key for AuthReplicaState entities. Entity itself doesn't exist."""
   # It' intentionally not under model.root_key(). It has nothing to do with core
@@ -86,6 +105,11 @@ def replicas_root_key():
   return ndb.Key('AuthReplicaStateRoot', 'root')
 
 
+def auth_db_digest_key(auth_db_rev):
+  """Key of AuthDBDigest entity for a given revision."""
+  return ndb.Key(AuthDBDigest, auth_db_rev)
+
+
 def configure_as_primary():
   """Switches current service to Primary mode.
 
@@ -137,6 +161,9 @@ def trigger_replication(auth_db_rev=None, transactional=False):
 def update_replicas_task(auth_db_rev):
   """Packs AuthDB and pushes it to all out-of-date Replicas.
 
+  Replicas at a revision pushed before get an AuthDBDelta with the changes since
+  that revision, others get an entire AuthDB.
+
   Called via /internal/taskqueue/replication/<auth_db_rev> task (see
   backend/handlers.py) enqueued by 'trigger_replication'.
 
@@ -155,22 +182,49 @@ def update_replicas_task(auth_db_rev):
     return True
 
   # Grab last known replicas state and push only to replicas that are behind.
+  replicas = AuthReplicaState.query(ancestor=replicas_root_key()).fetch()
   stale_replicas = [
-    entity for entity in AuthReplicaState.query(ancestor=replicas_root_key())
+    entity for entity in replicas
     if entity.auth_db_rev is None or entity.auth_db_rev < auth_db_rev
   ]
   if not stale_replicas:
     logging.info('All replicas are up-to-date.')
     return True
 
-  # Pack an entire AuthDB into a blob to be pushed to Replicas.
-  auth_db_blob, key_name, sig = pack_auth_db()
+  # Grab the snapshot, remember its digest to build deltas from it later. Delete
+  # digests of revisions no replica is at anymore.
+  state, auth_db = get_auth_db_proto()
+  digest = get_auth_db_digest(auth_db)
+  _put_auth_db_digest(
+      state.auth_db_rev, digest,
+      min(replica.auth_db_rev or 0 for replica in replicas))
+
+  # Replicas that are at a revision with a known digest receive only the changes
+  # since their revision. Pack one delta per such revision.
+  base_revs = sorted(set(
+    replica.auth_db_rev for replica in stale_replicas
+    if replica.auth_db_rev and _supports_delta(replica.auth_code_version)
+  ))
+  digests = ndb.get_multi([auth_db_digest_key(rev) for rev in base_revs])
+  deltas = {
+    ent.key.id(): pack_auth_db_delta(
+        state, auth_db, digest, ent.key.id(), ent.digest)
+    for ent in digests if ent
+  }
+
+  # The entire AuthDB is packed into a blob only if some replica needs it.
+  packed = []
+  def pack_full():
+    if not packed:
+      packed.append(pack_auth_db(state, auth_db))
+    return packed[0]
 
-  # Push the blob to all out-of-date replicas, in parallel.
+  # Push blobs to all out-of-date replicas, in parallel.
   push_started_ts = utils.utcnow()
   futures = {
-    push_to_replica(
-        replica.replica_url, auth_db_blob, key_name, sig): replica
+    push_delta_to_replica(
+        replica.replica_url, deltas.get(replica.auth_db_rev), pack_full):
+      replica
     for replica in stale_replicas
   }
 
@@ -240,30 +294,115 @@ def update_replicas_task(auth_db_rev):
   return not retry
 
 
-def pack_auth_db():
+def get_auth_db_proto():
+  """Returns tuple (AuthReplicationState, replication_pb2.AuthDB) of AuthDB."""
+  state, snapshot = replication.new_auth_db_snapshot()
+  return state, replication.auth_db_snapshot_to_proto(snapshot)
+
+
+def get_auth_db_digest(auth_db):
+  """Returns hashes of groups and IP whitelists of replication_pb2.AuthDB.
+
+  Returns:
+    {'groups': {name: hash}, 'ip_whitelists': {name: hash}}.
+  """
+  def hashes(messages):
+    return {
+      msg.name: hashlib.sha1(msg.SerializeToString()).hexdigest()[:16]
+      for msg in messages
+    }
+  return {
+    'groups': hashes(auth_db.groups),
+    'ip_whitelists': hashes(auth_db.ip_whitelists),
+  }
+
+
+def pack_auth_db(state, auth_db):
   """Packs an entire AuthDB into a blob, signing it using app's private key.
 
+  Args:
+    state: AuthReplicationState of |auth_db|.
+    auth_db: replication_pb2.AuthDB to push.
+
   Returns:
     Tuple (blob, name of a key used to sign it, base64 encoded signature).
   """
-  # Grab the snapshot.
-  state, snapshot = replication.new_auth_db_snapshot()
+  req = _new_push_request(state)
+  req.auth_db.CopyFrom(auth_db)
+  return _sign_push_request(req)
 
-  # Serialize to binary proto message.
-  req = replication_pb2.ReplicationPushRequest()
-  req.revision.primary_id = app_identity.get_application_id()
-  req.revision.auth_db_rev = state.auth_db_rev
-  req.revision.modified_ts = utils.datetime_to_timestamp(state.modified_ts)
-  replication.auth_db_snapshot_to_proto(snapshot, req.auth_db)
-  req.auth_code_version = version.__version__
-  auth_db_blob = req.SerializeToString()
 
-  # Sign it using primary's private keys.
-  key_name, sig = signature.sign_blob(auth_db_blob)
-  sig = base64.b64encode(sig)
+def pack_auth_db_delta(state, auth_db, digest, base_auth_db_rev, base_digest):
+  """Packs the changes of AuthDB since some revision into a signed blob.
 
-  logging.debug('AuthDB blob size is %d bytes', len(auth_db_blob))
-  return auth_db_blob, key_name, sig
+  Args:
+    state: AuthReplicationState of |auth_db|.
+    auth_db: replication_pb2.AuthDB with the current AuthDB.
+    digest: digest of |auth_db| as returned by get_auth_db_digest().
+    base_auth_db_rev: revision the replica is at.
+    base_digest: digest of |base_auth_db_rev| as returned by
+        get_auth_db_digest().
+
+  Returns:
+    Tuple (blob, name of a key used to sign it, base64 encoded signature).
+  """
+  req = _new_push_request(state)
+  delta = req.auth_db_delta
+  delta.base_auth_db_rev = base_auth_db_rev
+
+  # The config, secrets and IP whitelist assignments are small, send them all.
+  delta.auth_db.oauth_client_id = auth_db.oauth_client_id
+  delta.auth_db.oauth_client_secret = auth_db.oauth_client_secret
+  delta.auth_db.oauth_additional_client_ids.extend(
+      auth_db.oauth_additional_client_ids)
+  for msg in auth_db.secrets:
+    delta.auth_db.secrets.add().CopyFrom(msg)
+  for msg in auth_db.ip_whitelist_assignments:
+    delta.auth_db.ip_whitelist_assignments.add().CopyFrom(msg)
+
+  # Only send new or changed groups and IP whitelists.
+  for msg in auth_db.groups:
+    if base_digest['groups'].get(msg.name) != digest['groups'][msg.name]:
+      delta.auth_db.groups.add().CopyFrom(msg)
+  for msg in auth_db.ip_whitelists:
+    old = base_digest['ip_whitelists'].get(msg.name)
+    if old != digest['ip_whitelists'][msg.name]:
+      delta.auth_db.ip_whitelists.add().CopyFrom(msg)
+  delta.deleted_groups.extend(
+      sorted(set(base_digest['groups']) - set(digest['groups'])))
+  delta.deleted_ip_whitelists.extend(
+      sorted(set(base_digest['ip_whitelists']) - set(digest['ip_whitelists'])))
+
+  logging.debug(
+      'AuthDB delta from rev %d: %d groups, %d IP whitelists changed',
+      base_auth_db_rev, len(delta.auth_db.groups),
+      len(delta.auth_db.ip_whitelists))
+  return _sign_push_request(req)
+
+
+@ndb.tasklet
+def push_delta_to_replica(replica_url, delta, pack_full):
+  """Pushes a delta to a replica, or an entire AuthDB if it is rejected.
+
+  Args:
+    replica_url: root URL of a replica (i.e. https://<host>).
+    delta: tuple (blob, key_name, sig) as returned by pack_auth_db_delta(), or
+        None to push an entire AuthDB.
+    pack_full: callable returning (blob, key_name, sig) for an entire AuthDB.
+
+  Returns:
+    Same as push_to_replica.
+  """
+  if delta:
+    try:
+      result = yield push_to_replica(replica_url, *delta)
+      raise ndb.Return(result)
+    except FatalReplicaUpdateError as exc:
+      logging.warning(
+          'Replica %s rejected the delta (%s), pushing entire AuthDB',
+          replica_url, exc)
+  result = yield push_to_replica(replica_url, *pack_full())
+  raise ndb.Return(result)
 
 
 @ndb.tasklet
@@ -327,6 +466,9 @@ def push_to_replica(replica_url, auth_db_blob, key_name, sig):
     raise FatalReplicaUpdateError('Incomplete response, status is missing')
 
   # Convert errors to exceptions.
+  if (response.status == cls.TRANSIENT_ERROR and
+      response.error_code == cls.BASE_REVISION_MISMATCH):
+    raise BaseRevisionMismatchError('Replica is not at the base revision.')
   if response.status == cls.TRANSIENT_ERROR:
     raise TransientReplicaUpdateError(
         'Transient error (error code %d).' % response.error_code)
@@ -427,3 +569,52 @@ def _update_state_on_fail(key, started_ts, finished_ts, old_auth_db_rev, exc):
   state.put()
 
   return state.auth_db_rev
+
+
+def _supports_delta(auth_code_version):
+  """True if a replica with given auth component version accepts AuthDBDelta."""
+  try:
+    parsed = tuple(int(x) for x in (auth_code_version or '').split('.'))
+  except ValueError:
+    return False
+  return parsed >= DELTA_MIN_AUTH_CODE_VERSION
+
+
+def _put_auth_db_digest(auth_db_rev, digest, min_auth_db_rev):
+  """Stores AuthDBDigest of a revision and deletes those older than
+  |min_auth_db_rev|, which no replica can use anymore.
+
+  Failures are logged and ignored, replicas get an entire AuthDB instead.
+  """
+  try:
+    old_keys = AuthDBDigest.query(
+        AuthDBDigest.key < auth_db_digest_key(min_auth_db_rev)).fetch(
+            keys_only=True)
+    ndb.delete_multi(old_keys)
+    AuthDBDigest(key=auth_db_digest_key(auth_db_rev), digest=digest).put()
+  except datastore_errors.Error as exc:
+    logging.error(
+        'Failed to store AuthDB digest for rev %d: %s', auth_db_rev, exc)
+
+
+def _new_push_request(state):
+  """Returns ReplicationPushRequest for AuthReplicationState without AuthDB."""
+  req = replication_pb2.ReplicationPushRequest()
+  req.revision.primary_id = app_identity.get_application_id()
+  req.revision.auth_db_rev = state.auth_db_rev
+  req.revision.modified_ts = utils.datetime_to_timestamp(state.modified_ts)
+  req.auth_code_version = version.__version__
+  return req
+
+
+def _sign_push_request(req):
+  """Serializes ReplicationPushRequest, signing it using app's private key.
+
+  Returns:
+    Tuple (blob, name of a key used to sign it, base64 encoded signature).
+  """
+  auth_db_blob = req.SerializeToString()
+  key_name, sig = signature.sign_blob(auth_db_blob)
+  sig = base64.b64encode(sig)
+  logging.debug('AuthDB blob size is %d bytes', len(auth_db_blob))
+  return auth_db_blob, key_name, sig
@@ -15,12 +15,16 @@ generally should not be used outside of Auth components implementation.
 # pylint: disable=E1120
 
 import collections
+import fnmatch
 import functools
 import logging
 import os
+import re
 import threading
 import time
+import zlib
 
+from google.appengine.api import memcache
 from google.appengine.api import oauth
 from google.appengine.api import users
 from google.appengine.ext import ndb
@@ -71,6 +75,19 @@ _auth_db_fetching_thread = None
 # Thread local storage for RequestCache (see 'get_request_cache').
 _thread_local = threading.local()
 
+# Memcache namespace of the AuthDB snapshots shared by all instances, keyed by
+# entity group version (see 'fetch_auth_db').
+_SNAPSHOT_NAMESPACE = 'auth_db_snapshot_v1'
+# Memcache values are limited to 1MB, larger snapshots are split in chunks.
+_SNAPSHOT_CHUNK_SIZE = 1000 * 1000
+# How long a snapshot stays in memcache, sec.
+_SNAPSHOT_EXPIRATION_SEC = 3600
+# How long an instance can take to build a snapshot before another one tries.
+_SNAPSHOT_LOCK_SEC = 30
+# How long an instance without any AuthDB waits for the snapshot being built by
+# another instance, before fetching AuthDB from Datastore itself.
+_SNAPSHOT_WAIT_SEC = 2.
+
 
 ################################################################################
 ## Exception classes.
@@ -103,6 +120,31 @@ class UninitializedError(Error):
 SecretKey = collections.namedtuple('SecretKey', ['name', 'scope'])
 
 
+def _compile_globs(globs):
+  """Returns {identity kind: compiled regexp} matching any of the IdentityGlob.
+
+  Equivalent to IdentityGlob.match() for each glob, but in one regexp match.
+  """
+  patterns = collections.defaultdict(list)
+  for glob in globs:
+    patterns[glob.kind].append('(?:%s)' % fnmatch.translate(glob.pattern))
+  return {kind: re.compile('|'.join(p)) for kind, p in patterns.iteritems()}
+
+
+def _compile_subnets(name, subnets):
+  """Returns ipaddr.SubnetSet of the subnet strings of IP whitelist |name|.
+
+  Invalid subnets are skipped, they match nothing.
+  """
+  parsed = []
+  for subnet in subnets:
+    try:
+      parsed.append(ipaddr.subnet_from_string(subnet))
+    except ValueError:
+      logging.error('Invalid subnet in IP whitelist %s: %s', name, subnet)
+  return ipaddr.SubnetSet(parsed)
+
+
 class AuthDB(object):
   """A read only in-memory database of auth configuration of a service.
 
@@ -146,45 +188,88 @@ class AuthDB(object):
       assert secret.key.string_id() not in self.secrets[scope], secret.key
       self.secrets[scope][secret.key.string_id()] = secret
 
+    # Index of the groups used by is_group_member(). It is built once since
+    # AuthDB is read only; the groups must not be modified afterward.
+    # Group name -> frozenset of member Identity.
+    self._members = {
+      name: frozenset(g.members) for name, g in self.groups.iteritems()
+    }
+    # Group name -> {identity kind: compiled regexp matching all the globs}.
+    self._globs = {
+      name: _compile_globs(g.globs) for name, g in self.groups.iteritems()
+    }
+    # Group name -> tuple of the group names it includes, itself included.
+    # Filled lazily by _get_group_closure().
+    self._closures = {}
+
+    # Index of the IP whitelists used by verify_ip_whitelisted().
+    # IP whitelist name -> ipaddr.SubnetSet.
+    self._ip_whitelist_subnets = {
+      name: _compile_subnets(name, e.subnets)
+      for name, e in self.ip_whitelists.iteritems()
+    }
+    # Identity -> name of the IP whitelist assigned to it. The first assignment
+    # wins.
+    self._ip_whitelist_assigned = {}
+    for assignment in self.ip_whitelist_assignments.assignments:
+      self._ip_whitelist_assigned.setdefault(
+          assignment.identity, assignment.ip_whitelist)
+
+  def _get_group_closure(self, group_name):
+    """Returns a tuple with |group_name| and all its nested groups, recursively.
+
+    Unknown groups are skipped. GROUP_ALL is kept, since it includes everyone.
+    The result is memoized.
+    """
+    closure = self._closures.get(group_name)
+    if closure is not None:
+      return closure
+
+    out = []
+    visited = set()
+    # While the code to add groups refuses to add cycle, this code ensures that
+    # it doesn't go in a cycle by keeping track of the groups being visited in
+    # |path|.
+    def visit(name, path):
+      if name in path:
+        logging.error('Cycle in a group graph\nInfo: %s, %s', name, path)
+        return
+      if name in visited:
+        return
+      if name != model.GROUP_ALL and name not in self.groups:
+        # An unknown group is empty.
+        return
+      visited.add(name)
+      out.append(name)
+      if name == model.GROUP_ALL:
+        return
+      path.append(name)
+      for nested in self.groups[name].nested:
+        visit(nested, path)
+      path.pop()
+
+    visit(group_name, [])
+    closure = tuple(out)
+    # Races between threads are harmless, they compute the same value.
+    self._closures[group_name] = closure
+    return closure
+
   def is_group_member(self, group_name, identity):
     """Returns True if |identity| belongs to group |group_name|.
 
     Unknown groups are considered empty.
     """
-    # While the code to add groups refuses to add cycle, this code ensures that
-    # it doesn't go in a cycle by keeping track of the groups visited in |seen|.
-    seen = set()
-
-    def is_group_member_internal(group_name, identity):
+    for name in self._get_group_closure(group_name):
       # Wildcard group that matches all identities (including anonymous!).
-      if group_name == model.GROUP_ALL:
+      if name == model.GROUP_ALL:
         return True
-
-      # An unknown group is empty.
-      group_obj = self.groups.get(group_name)
-      if not group_obj:
-        return False
-
-      # Use |seen| to detect and avoid cycles in group nesting graph.
-      if group_name in seen:
-        logging.error('Cycle in a group graph\nInfo: %s, %s', group_name, seen)
-        return False
-      seen.add(group_name)
-
-      # Globs first, there's usually a higher chance to find identity there.
-      if any(glob.match(identity) for glob in group_obj.globs):
+      # Explicit member list, it's a hash lookup.
+      if identity in self._members[name]:
         return True
-
-      # Explicit member list, it's fast.
-      if any(identity == m for m in group_obj.members):
+      glob = self._globs[name].get(identity.kind)
+      if glob and glob.match(identity.name):
         return True
-
-      # Slowest nested group check last.
-      return any(
-          is_group_member_internal(nested, identity)
-          for nested in group_obj.nested)
-
-    return is_group_member_internal(group_name, identity)
+    return False
 
   def list_group(self, group_name, recursive=True):
     """Returns a set of all identities in a group.
@@ -197,31 +282,11 @@ class AuthDB(object):
       Set of Identity objects. Unknown groups are considered empty.
     """
     if not recursive:
-      group_obj = self.groups.get(group_name)
-      return set(group_obj.members) if group_obj else set()
-
-    # While the code to add groups refuses to add cycle, this code ensures that
-    # it doesn't go in a cycle by keeping track of the groups visited in |seen|.
-    seen = set()
-
-    def list_group_internal(group_name):
-      # An unknown group is empty.
-      group_obj = self.groups.get(group_name)
-      if not group_obj:
-        return set()
-
-      # Use |seen| to detect and avoid cycles in group nesting graph.
-      if group_name in seen:
-        logging.error('Cycle in a group graph\nInfo: %s, %s', group_name, seen)
-        return set()
-      seen.add(group_name)
-
-      members = set(group_obj.members)
-      for nested in group_obj.nested:
-        members.update(list_group_internal(nested))
-      return members
-
-    return list_group_internal(group_name)
+      return set(self._members.get(group_name, ()))
+    members = set()
+    for name in self._get_group_closure(group_name):
+      members.update(self._members.get(name, ()))
+    return members
 
   def get_secret(self, secret_key):
     """Returns list of strings with last known values of a secret.
@@ -257,27 +322,24 @@ class AuthDB(object):
 
     # Check bots whitelist to authenticate anonymous request as coming from bot.
     if identity.is_anonymous:
-      whitelist = self.ip_whitelists.get(model.BOTS_IP_WHITELIST)
-      if whitelist and whitelist.is_ip_whitelisted(ip):
+      subnets = self._ip_whitelist_subnets.get(model.BOTS_IP_WHITELIST)
+      if subnets and ip in subnets:
         addr_str = ipaddr.ip_to_string(ip)
         return model.Identity(model.IDENTITY_BOT, addr_str.replace(':', '-'))
 
     # Find IP whitelist name in the assignment entity (if any).
-    for assignment in self.ip_whitelist_assignments.assignments:
-      if assignment.identity == identity:
-        whitelist_id = assignment.ip_whitelist
-        break
-    else:
+    whitelist_id = self._ip_whitelist_assigned.get(identity)
+    if whitelist_id is None:
       return identity
 
     # IP whitelist MUST be there. But if it's missing, choose a safer
     # alternative: reject the request.
-    whitelist = self.ip_whitelists.get(whitelist_id)
-    if not whitelist:
+    subnets = self._ip_whitelist_subnets.get(whitelist_id)
+    if subnets is None:
       logging.error('Unknown IP whitelist: %s', whitelist_id)
       raise AuthorizationError('IP is not whitelisted')
 
-    if not whitelist.is_ip_whitelisted(ip):
+    if ip not in subnets:
       logging.error(
           'IP is not whitelisted.\nIdentity: %s\nIP: %s\nWhitelist: %s',
           identity.to_bytes(), ipaddr.ip_to_string(ip), whitelist_id)
@@ -448,6 +510,7 @@ def get_request_cache():
   return request_cache
 
 
+@ndb.non_transactional
 def fetch_auth_db(known_version=None):
   """Returns instance of AuthDB.
 
@@ -459,8 +522,15 @@ def fetch_auth_db(known_version=None):
   (meaning that there's no need to refetch AuthDB), otherwise it will fetch
   a fresh copy of AuthDB and return it.
 
-  Runs in transaction to guarantee consistency of fetched data. Effectively it
-  fetches momentary snapshot of subset of root_key() entity group.
+  Fetches from Datastore in transaction to guarantee consistency of fetched
+  data. Effectively it fetches momentary snapshot of subset of root_key() entity
+  group.
+
+  The snapshot is shared with the other instances via memcache, keyed by the
+  entity group version. Only one instance fetches a new version from Datastore.
+  Meanwhile, the other instances that already have an AuthDB get None, i.e.
+  keep using their stale copy, and the ones without any wait a bit for it.
+  Looking up and waiting for the snapshot is done outside of the transaction.
   """
   # Entity group root. To reduce amount of typing.
   root_key = model.root_key()
@@ -480,17 +550,7 @@ def fetch_auth_db(known_version=None):
 
   @ndb.transactional(propagation=ndb.TransactionOptions.INDEPENDENT)
   def fetch():
-    # Don't fetch anything if |known_version| is up to date. On dev server
-    # metadata.get_entity_group_version() always returns None, so on dev server
-    # this optimization is effectively disabled.
     current_version = metadata.get_entity_group_version(root_key)
-    if known_version is not None and current_version == known_version:
-      return None
-
-    # TODO(vadimsh): Add memcache keyed at |current_version| so only one
-    # frontend instance have to pay the cost of fetching AuthDB from Datastore
-    # via multiple RPCs. All other instances will fetch it via single
-    # memcache 'get'.
 
     # Fetch all stuff in parallel. Fetch ALL groups and ALL secrets.
     global_config_future = root_key.get_async()
@@ -512,7 +572,145 @@ def fetch_auth_db(known_version=None):
         entity_group_version=current_version)
 
   bootstrap()
-  return fetch()
+
+  # Don't fetch anything if |known_version| is up to date. On dev server
+  # metadata.get_entity_group_version() always returns None, so on dev server
+  # this optimization is effectively disabled.
+  current_version = metadata.get_entity_group_version(root_key)
+  if known_version is not None and current_version == known_version:
+    return None
+
+  # Only one frontend instance has to pay the cost of fetching AuthDB from
+  # Datastore via multiple RPCs. All other instances fetch the snapshot it
+  # stored in memcache. Local secrets are not part of the snapshot, since
+  # replication_pb2.AuthDB only holds global ones. This is done outside of the
+  # transaction, which is only needed to fetch from Datastore.
+  locked = False
+  if current_version is not None:
+    snapshot = _get_auth_db_snapshot(current_version)
+    if not snapshot:
+      locked = _lock_auth_db_snapshot(current_version)
+      if not locked:
+        if known_version is not None:
+          # Keep using the stale copy, the snapshot will be there next time.
+          logging.info(
+              'AuthDB v%s is being fetched by another instance',
+              current_version)
+          return None
+        snapshot = _wait_auth_db_snapshot(current_version)
+    if snapshot:
+      local_secrets = model.AuthSecret.query(
+          ancestor=model.secret_scope_key('local')).fetch()
+      return AuthDB(
+          global_config=snapshot.global_config,
+          groups=snapshot.groups,
+          secrets=snapshot.secrets + local_secrets,
+          ip_whitelists=snapshot.ip_whitelists,
+          ip_whitelist_assignments=snapshot.ip_whitelist_assignments,
+          entity_group_version=current_version)
+
+  try:
+    auth_db = fetch()
+    # The entity group may have been modified in the meantime, only the locked
+    # version can be stored.
+    if locked and auth_db.entity_group_version == current_version:
+      _put_auth_db_snapshot(auth_db)
+  finally:
+    if locked:
+      # Let another instance build the snapshot if this one failed to.
+      _unlock_auth_db_snapshot(current_version)
+  return auth_db
+
+
+def _get_auth_db_snapshot(version):
+  """Returns replication.AuthDBSnapshot of AuthDB |version| from memcache.
+
+  Returns None if it is not in memcache.
+  """
+  # Imported here to break the import cycle replication -> tokens -> api.
+  from . import replication
+  from .proto import replication_pb2
+  chunk_count = memcache.get(str(version), namespace=_SNAPSHOT_NAMESPACE)
+  if not chunk_count:
+    return None
+  keys = ['%s:%d' % (version, i) for i in xrange(chunk_count)]
+  chunks = memcache.get_multi(keys, namespace=_SNAPSHOT_NAMESPACE)
+  if len(chunks) != chunk_count:
+    logging.warning('AuthDB v%s snapshot was partially evicted', version)
+    return None
+  try:
+    auth_db_proto = replication_pb2.AuthDB()
+    auth_db_proto.ParseFromString(
+        zlib.decompress(''.join(chunks[k] for k in keys)))
+    return replication.proto_to_auth_db_snapshot(auth_db_proto)
+  except Exception:
+    logging.exception('Failed to load AuthDB v%s snapshot', version)
+    return None
+
+
+def _put_auth_db_snapshot(auth_db):
+  """Stores the replicated subset of |auth_db| in memcache.
+
+  The global secrets are included, the local ones are not.
+  """
+  from . import replication
+  version = auth_db.entity_group_version
+  try:
+    snapshot = replication.AuthDBSnapshot(
+        auth_db.global_config,
+        auth_db.groups.values(),
+        auth_db.secrets['global'].values(),
+        auth_db.ip_whitelists.values(),
+        auth_db.ip_whitelist_assignments)
+    blob = zlib.compress(
+        replication.auth_db_snapshot_to_proto(snapshot).SerializeToString())
+  except Exception:
+    logging.exception('Failed to serialize AuthDB v%s', version)
+    return
+  chunks = {
+    '%s:%d' % (version, i / _SNAPSHOT_CHUNK_SIZE):
+        blob[i:i+_SNAPSHOT_CHUNK_SIZE]
+    for i in xrange(0, len(blob), _SNAPSHOT_CHUNK_SIZE)
+  }
+  # Store the chunks first, so a snapshot is never visible partially.
+  failed = memcache.set_multi(
+      chunks, time=_SNAPSHOT_EXPIRATION_SEC, namespace=_SNAPSHOT_NAMESPACE)
+  if failed:
+    logging.warning('Failed to store AuthDB v%s snapshot', version)
+    return
+  memcache.set(
+      str(version), len(chunks), time=_SNAPSHOT_EXPIRATION_SEC,
+      namespace=_SNAPSHOT_NAMESPACE)
+  logging.info(
+      'Stored AuthDB v%s snapshot: %d bytes in %d chunks', version, len(blob),
+      len(chunks))
+
+
+def _lock_auth_db_snapshot(version):
+  """Returns True if this instance is the one to build the snapshot."""
+  return memcache.add(
+      'lock:%s' % version, True, time=_SNAPSHOT_LOCK_SEC,
+      namespace=_SNAPSHOT_NAMESPACE)
+
+
+def _unlock_auth_db_snapshot(version):
+  """Releases the lock taken by _lock_auth_db_snapshot()."""
+  memcache.delete('lock:%s' % version, namespace=_SNAPSHOT_NAMESPACE)
+
+
+def _wait_auth_db_snapshot(version):
+  """Waits a bit for the snapshot being built by another instance.
+
+  Returns None if it is still not there after _SNAPSHOT_WAIT_SEC.
+  """
+  deadline = time.time() + _SNAPSHOT_WAIT_SEC
+  while time.time() < deadline:
+    time.sleep(0.1)
+    snapshot = _get_auth_db_snapshot(version)
+    if snapshot:
+      return snapshot
+  logging.warning('Timed out waiting for AuthDB v%s snapshot', version)
+  return None
 
 
 def reset_local_state():
@@ -127,6 +127,50 @@ class AuthDBTest(test_case.TestCase):
         auth_db.is_group_member('Group1', model.Anonymous))
     self.assertEqual(1, len(errors))
 
+  def test_nested_groups_diamond(self):
+    # Group1 includes Group4 twice, via Group2 and Group3. It is not a cycle.
+    joe = model.Identity(model.IDENTITY_USER, 'joe@example.com')
+    groups = [
+      model.AuthGroup(id='Group1', nested=['Group2', 'Group3']),
+      model.AuthGroup(id='Group2', nested=['Group4']),
+      model.AuthGroup(id='Group3', nested=['Group4', 'Missing']),
+      model.AuthGroup(id='Group4', members=[joe]),
+    ]
+
+    errors = []
+    self.mock(api.logging, 'error', lambda *args: errors.append(args))
+
+    auth_db = api.AuthDB(groups=groups)
+    self.assertTrue(auth_db.is_group_member('Group1', joe))
+    self.assertFalse(auth_db.is_group_member('Group1', model.Anonymous))
+    self.assertEqual(
+        ('Group1', 'Group2', 'Group4', 'Group3'),
+        auth_db._get_group_closure('Group1'))
+    self.assertEqual([], errors)
+
+  def test_is_group_member_globs(self):
+    groups = [
+      model.AuthGroup(
+          id='Globs',
+          globs=[
+            model.IdentityGlob(model.IDENTITY_USER, '*@example.com'),
+            model.IdentityGlob(model.IDENTITY_USER, 'joe@*'),
+            model.IdentityGlob(model.IDENTITY_BOT, 'bot-?'),
+          ]),
+      model.AuthGroup(id='Nested', nested=['Globs']),
+    ]
+    auth_db = api.AuthDB(groups=groups)
+    is_member = lambda kind, name: auth_db.is_group_member(
+        'Nested', model.Identity(kind, name))
+    self.assertTrue(is_member(model.IDENTITY_USER, 'a@example.com'))
+    self.assertTrue(is_member(model.IDENTITY_USER, 'joe@other.com'))
+    self.assertFalse(is_member(model.IDENTITY_USER, 'a@example.com.evil'))
+    self.assertTrue(is_member(model.IDENTITY_BOT, 'bot-1'))
+    self.assertFalse(is_member(model.IDENTITY_BOT, 'bot-12'))
+    # The kind must match too.
+    self.assertFalse(is_member(model.IDENTITY_BOT, 'a@example.com'))
+    self.assertFalse(is_member(model.IDENTITY_SERVICE, 'bot-1'))
+
   def test_is_allowed_oauth_client_id(self):
     global_config = model.AuthGlobalConfig(
         oauth_client_id='1',
@@ -211,6 +255,60 @@ class AuthDBTest(test_case.TestCase):
         {'bots': bots_ip_whitelist, 'some ip whitelist': some_ip_whitelist},
         auth_db.ip_whitelists)
 
+  def test_fetch_auth_db_snapshot(self):
+    self.mock(api.metadata, 'get_entity_group_version', lambda _: 123)
+    joe = model.Identity(model.IDENTITY_USER, 'joe@example.com')
+    model.bootstrap_group('Group A', [joe])
+    model.bootstrap_group('Group B', [])
+    local_secret = model.AuthSecret.bootstrap('local', 'local')
+    global_secret = model.AuthSecret.bootstrap('global', 'global')
+
+    # The first instance fetches from Datastore and stores the snapshot.
+    auth_db = api.fetch_auth_db()
+    self.assertEqual(123, auth_db.entity_group_version)
+    self.assertEqual(
+        1, api.memcache.get('123', namespace=api._SNAPSHOT_NAMESPACE))
+
+    # The other ones use the snapshot. Datastore is only queried for the local
+    # secrets, which are not part of it.
+    model.group_key('Group B').delete()
+    local_secret.values = ['new']
+    local_secret.put()
+    auth_db = api.fetch_auth_db()
+    self.assertEqual(123, auth_db.entity_group_version)
+    self.assertEqual(set(['Group A', 'Group B']), set(auth_db.groups))
+    self.assertTrue(auth_db.is_group_member('Group A', joe))
+    self.assertEqual(['new'], auth_db.secrets['local']['local'].values)
+    self.assertEqual(
+        global_secret.values, auth_db.secrets['global']['global'].values)
+
+  def test_fetch_auth_db_snapshot_locked(self):
+    self.mock(api.metadata, 'get_entity_group_version', lambda _: 123)
+    self.mock(api, '_SNAPSHOT_WAIT_SEC', 0)
+    model.bootstrap_group('Group A', [])
+    # Another instance is fetching AuthDB.
+    self.assertTrue(api._lock_auth_db_snapshot(123))
+
+    # An instance with a stale copy keeps it.
+    self.assertIsNone(api.fetch_auth_db(known_version=122))
+    # An instance without any copy fetches it from Datastore.
+    auth_db = api.fetch_auth_db()
+    self.assertEqual(set(['Group A']), set(auth_db.groups))
+    self.assertIsNone(
+        api.memcache.get('123', namespace=api._SNAPSHOT_NAMESPACE))
+
+  def test_fetch_auth_db_snapshot_put_failure(self):
+    self.mock(api.metadata, 'get_entity_group_version', lambda _: 123)
+    self.mock(api.memcache, 'set_multi', lambda mapping, **_: mapping.keys())
+    self.mock(api.logging, 'warning', lambda *_: None)
+    model.bootstrap_group('Group A', [])
+    auth_db = api.fetch_auth_db()
+    self.assertEqual(set(['Group A']), set(auth_db.groups))
+    self.assertIsNone(
+        api.memcache.get('123', namespace=api._SNAPSHOT_NAMESPACE))
+    # The lock is released, so another instance can try to store it.
+    self.assertTrue(api._lock_auth_db_snapshot(123))
+
   def test_get_secret(self):
     # Make AuthDB with two secrets.
     local_secret = model.AuthSecret.bootstrap('local_secret', 'local')
@@ -295,6 +393,21 @@ class AuthDBTest(test_case.TestCase):
     self.assertEqual(
         model.Identity(model.IDENTITY_BOT, '0-0-0-0-0-0-0-1'), result)
 
+  def test_verify_ip_whitelisted_bot_many_subnets(self):
+    auth_db = api.AuthDB(
+      ip_whitelists=[
+        model.AuthIPWhitelist(
+          key=model.ip_whitelist_key('bots'),
+          subnets=['10.%d.%d.0/24' % (i / 256, i % 256) for i in xrange(5000)],
+        ),
+      ])
+    result = auth_db.verify_ip_whitelisted(
+        model.Anonymous, ipaddr.ip_from_string('10.19.135.7'))
+    self.assertEqual(model.Identity(model.IDENTITY_BOT, '10.19.135.7'), result)
+    result = auth_db.verify_ip_whitelisted(
+        model.Anonymous, ipaddr.ip_from_string('10.19.136.7'))
+    self.assertEqual(model.Anonymous, result)
+
   def test_verify_ip_whitelisted_not_assigned(self):
     # Should not raise: whitelist is not required for another_user@example.com.
     ident = model.Identity(model.IDENTITY_USER, 'another_user@example.com')
@@ -4,6 +4,7 @@
 
 """Utilities for working with IPv4 and IPv6 addresses."""
 
+import bisect
 import collections
 
 
@@ -18,6 +19,7 @@ __all__ = [
   'Subnet',
   'subnet_from_string',
   'subnet_to_string',
+  'SubnetSet',
 ]
 
 
@@ -152,3 +154,42 @@ def normalize_subnet(subnet_str):
 def is_in_subnet(ip, subnet):
   """True if given IP instance belongs to Subnet."""
   return ip.bits == subnet.bits and (ip.value & subnet.mask) == subnet.base
+
+
+class SubnetSet(object):
+  """Set of subnets compiled to answer is_in_subnet() for all of them at once.
+
+  Each subnet is a range of IPs. Overlapping and adjacent ranges are merged and
+  kept sorted, so a lookup is a binary search, O(log n). Immutable.
+  """
+
+  def __init__(self, subnets):
+    """Args:
+      subnets: iterable of Subnet instances.
+    """
+    ranges = collections.defaultdict(list)
+    for subnet in subnets:
+      full = (1 << subnet.bits) - 1
+      ranges[subnet.bits].append(
+          (subnet.base, subnet.base | (full & ~subnet.mask)))
+    # bits -> tuple(sorted list of range starts, list of matching range ends).
+    self._ranges = {}
+    for bits, items in ranges.iteritems():
+      starts = []
+      ends = []
+      for start, end in sorted(items):
+        if ends and start <= ends[-1] + 1:
+          ends[-1] = max(ends[-1], end)
+        else:
+          starts.append(start)
+          ends.append(end)
+      self._ranges[bits] = (starts, ends)
+
+  def __contains__(self, ip):
+    """True if given IP instance belongs to one of the subnets."""
+    ranges = self._ranges.get(ip.bits)
+    if not ranges:
+      return False
+    starts, ends = ranges
+    i = bisect.bisect_right(starts, ip.value) - 1
+    return i >= 0 and ip.value <= ends[i]
@@ -185,6 +185,47 @@ class IpAddrTest(test_case.TestCase):
     self.assertFalse(call('0:0:0:0:0:0:0:0', '0.0.0.0/32'))
 
 
+  def test_subnet_set(self):
+    subnets = ipaddr.SubnetSet(
+        ipaddr.subnet_from_string(s) for s in (
+          '192.168.0.0/24',
+          # Overlaps and is adjacent to the previous one.
+          '192.168.0.128/25',
+          '192.168.1.0/24',
+          '10.0.0.1',
+          'ffff:fffe:fffd:fffc:fffb:fffa:fff0:0/112',
+        ))
+    contains = lambda ip: ipaddr.ip_from_string(ip) in subnets
+
+    self.assertTrue(contains('192.168.0.0'))
+    self.assertTrue(contains('192.168.0.200'))
+    self.assertTrue(contains('192.168.1.255'))
+    self.assertFalse(contains('192.168.2.0'))
+    self.assertFalse(contains('192.167.255.255'))
+    self.assertTrue(contains('10.0.0.1'))
+    self.assertFalse(contains('10.0.0.0'))
+    self.assertFalse(contains('10.0.0.2'))
+    self.assertFalse(contains('0.0.0.0'))
+    self.assertFalse(contains('255.255.255.255'))
+
+    self.assertTrue(contains('ffff:fffe:fffd:fffc:fffb:fffa:fff0:1234'))
+    self.assertFalse(contains('ffff:fffe:fffd:fffc:fffb:fffa:fff1:0'))
+    # The IP version must match too.
+    self.assertFalse(contains('0:0:0:0:0:0:c0a8:1'))
+
+    self.assertFalse(
+        ipaddr.ip_from_string('127.0.0.1') in ipaddr.SubnetSet([]))
+
+  def test_subnet_set_many(self):
+    # Every other /24 in 10.0.0.0/8.
+    subnets = ipaddr.SubnetSet(
+        ipaddr.subnet_from_string('10.%d.%d.0/24' % (i / 256, i % 256))
+        for i in xrange(0, 65536, 2))
+    for i in xrange(0, 65536, 37):
+      ip = ipaddr.IP(32, (10 << 24) + i * 256 + 1)
+      self.assertEqual(not i % 2, ip in subnets, i)
+
+
 if __name__ == '__main__':
   if '-v' in sys.argv:
     unittest.TestCase.maxDiff = None
@@ -796,9 +796,12 @@ class AuthIPWhitelist(ndb.Model, datastore_utils.SerializableModelMixin):
   modified_by = IdentityProperty()
 
   def is_ip_whitelisted(self, ip):
-    """Returns True if ipaddr.IP is in the whitelist."""
-    # TODO(vadimsh): If number of subnets to check grows it makes sense to add
-    # an internal cache to 'subnet_from_string' (sort of like in re.compile).
+    """Returns True if ipaddr.IP is in the whitelist.
+
+    It parses all the subnets on each call. AuthDB keeps them compiled in an
+    ipaddr.SubnetSet instead, use AuthDB.verify_ip_whitelisted() for frequent
+    checks.
+    """
     return any(
         ipaddr.is_in_subnet(ip, ipaddr.subnet_from_string(net))
         for net in self.subnets)
@@ -364,6 +364,82 @@ def replace_auth_db(auth_db_rev, modified_ts, snapshot):
   return update_auth_db()
 
 
+@ndb.transactional
+def apply_auth_db_delta(
+    auth_db_rev, modified_ts, base_auth_db_rev, snapshot, deleted_keys):
+  """Applies changes of AuthDB made since |base_auth_db_rev|.
+
+  Unlike replace_auth_db, doesn't read all groups and IP whitelists: |snapshot|
+  has only the ones that changed.
+
+  Args:
+    auth_db_rev: revision number of AuthDB after the changes.
+    modified_ts: datetime timestamp of when |auth_db_rev| was created.
+    base_auth_db_rev: revision the changes apply to.
+    snapshot: AuthDBSnapshot with the global config, all global secrets, all
+        IP whitelist assignments and new or changed groups and IP whitelists.
+    deleted_keys: keys of deleted groups and IP whitelists.
+
+  Returns:
+    Tuple (True if update was applied, current AuthReplicationState value).
+    Nothing is applied if the replica is not at |base_auth_db_rev|.
+  """
+  assert model.is_replica()
+  assert all(
+      secret.key.parent() == model.secret_scope_key('global')
+      for secret in snapshot.secrets), 'Only global secrets can be replaced'
+
+  # Start fetching stuff in parallel. Only small entities are fetched.
+  state_future = model.replication_state_key().get_async()
+  config_future = model.root_key().get_async()
+  ips_future = model.ip_whitelist_assignments_key().get_async()
+  secrets_future = model.AuthSecret.query(
+      ancestor=model.secret_scope_key('global')).fetch_async()
+
+  state = state_future.get_result()
+  if state.auth_db_rev != base_auth_db_rev:
+    return False, state
+
+  # Update auth_db_rev in AuthReplicationState.
+  state.auth_db_rev = auth_db_rev
+  state.modified_ts = modified_ts
+
+  # Entities that needs to be updated or created. All groups and IP whitelists
+  # in the snapshot are changed ones.
+  entites_to_put = [state]
+  config = config_future.get_result()
+  if not config or snapshot.global_config.to_dict() != config.to_dict():
+    entites_to_put.append(snapshot.global_config)
+  secrets = secrets_future.get_result()
+  entites_to_put.extend(get_changed_entities(snapshot.secrets, secrets))
+  ips = ips_future.get_result()
+  new_ips = snapshot.ip_whitelist_assignments
+  if not ips or new_ips.to_dict() != ips.to_dict():
+    entites_to_put.append(new_ips)
+  entites_to_put.extend(snapshot.groups)
+  entites_to_put.extend(snapshot.ip_whitelists)
+
+  # Keys of entities that needs to be removed.
+  keys_to_delete = list(deleted_keys)
+  keys_to_delete.extend(get_deleted_keys(snapshot.secrets, secrets))
+
+  # Apply changes.
+  futures = []
+  futures.extend(ndb.put_multi_async(entites_to_put))
+  futures.extend(ndb.delete_multi_async(keys_to_delete))
+
+  # Wait for all pending futures to complete. Aborting the transaction with
+  # outstanding futures is a bad idea (ndb complains in log about that).
+  ndb.Future.wait_all(futures)
+
+  # Raise an exception, if any.
+  for future in futures:
+    future.check_success()
+
+  # Success.
+  return True, state
+
+
 def is_signed_by_primary(blob, key_name, sig):
   """Verifies that |blob| was signed by Primary."""
   # Assert that running on Replica.
@@ -410,3 +486,40 @@ def push_auth_db(revision, auth_db):
 
     # Need to retry. Try until success or deadline.
     assert current_state.auth_db_rev < revision.auth_db_rev
+
+
+def push_auth_db_delta(revision, auth_db_delta):
+  """Accepts AuthDB delta push from Primary and applies it to replica.
+
+  Args:
+    revision: replication_pb2.AuthDBRevision describing revision of pushed DB.
+    auth_db_delta: replication_pb2.AuthDBDelta with the changes.
+
+  Returns:
+    Tuple (True if update was applied, stored or updated AuthReplicationState).
+    If the update is not applied and the returned state is still older than
+    |revision|, the replica is not at the base revision of the delta and
+    Primary must push an entire AuthDB instead.
+  """
+  # Already up-to-date? Check it first before doing heavy calls.
+  state = model.get_replication_state()
+  if (state.primary_id == revision.primary_id and
+      state.auth_db_rev >= revision.auth_db_rev):
+    return False, state
+  if state.auth_db_rev != auth_db_delta.base_auth_db_rev:
+    return False, state
+
+  # Retries on transaction collisions are done by ndb.transactional. Once
+  # another task applied some update, the delta doesn't apply anymore.
+  deleted_keys = [
+    model.group_key(name) for name in auth_db_delta.deleted_groups
+  ]
+  deleted_keys.extend(
+      model.ip_whitelist_key(name)
+      for name in auth_db_delta.deleted_ip_whitelists)
+  return apply_auth_db_delta(
+      revision.auth_db_rev,
+      utils.timestamp_to_datetime(revision.modified_ts),
+      auth_db_delta.base_auth_db_rev,
+      proto_to_auth_db_snapshot(auth_db_delta.auth_db),
+      deleted_keys)
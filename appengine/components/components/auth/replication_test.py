@@ -15,6 +15,7 @@ from google.appengine.ext import ndb
 from components import utils
 from components.auth import model
 from components.auth import replication
+from components.auth.proto import replication_pb2
 from test_support import test_case
 
 
@@ -597,6 +598,124 @@ class ReplaceAuthDbTest(test_case.TestCase):
     self.assertEqual(expected_state, state.to_dict())
 
 
+class ApplyAuthDbDeltaTest(test_case.TestCase):
+  """Tests for apply_auth_db_delta and push_auth_db_delta functions."""
+
+  @staticmethod
+  def configure_as_replica(auth_db_rev=0, modified_ts=None):
+    model.AuthReplicationState(
+         key=model.replication_state_key(),
+         primary_id='primary',
+         primary_url='https://primary',
+         auth_db_rev=auth_db_rev,
+         modified_ts=modified_ts).put()
+
+  @staticmethod
+  def group(name, **kwargs):
+    return model.AuthGroup(key=model.group_key(name), **kwargs)
+
+  @staticmethod
+  def ip_whitelist(name, **kwargs):
+    return model.AuthIPWhitelist(key=model.ip_whitelist_key(name), **kwargs)
+
+  def test_works(self):
+    self.mock_now(datetime.datetime(2014, 1, 1, 1, 1, 1))
+    self.configure_as_replica(10)
+    self.group('Modify').put()
+    self.group('Delete').put()
+    self.group('Keep', description='keep').put()
+    self.ip_whitelist('delete').put()
+    self.ip_whitelist('keep').put()
+    model.AuthSecret(
+        id='delete', parent=model.secret_scope_key('global')).put()
+
+    snapshot = make_snapshot_obj(
+        global_config=model.AuthGlobalConfig(
+            key=model.root_key(), oauth_client_id='oauth_client_id'),
+        groups=[
+          self.group('New'),
+          self.group('Modify', description='blah'),
+        ],
+        secrets=[
+          model.AuthSecret(
+              id='new', parent=model.secret_scope_key('global'),
+              values=['1234']),
+        ],
+        ip_whitelists=[self.ip_whitelist('new', subnets=['1.1.1.1/32'])])
+    updated, state = replication.apply_auth_db_delta(
+        auth_db_rev=12,
+        modified_ts=datetime.datetime(2014, 1, 1, 1, 1, 1),
+        base_auth_db_rev=10,
+        snapshot=snapshot,
+        deleted_keys=[
+          model.group_key('Delete'), model.ip_whitelist_key('delete'),
+        ])
+    self.assertTrue(updated)
+    self.assertEqual(12, state.auth_db_rev)
+    self.assertEqual(12, model.get_replication_state().auth_db_rev)
+
+    _, current = replication.new_auth_db_snapshot()
+    self.assertEqual('oauth_client_id', current.global_config.oauth_client_id)
+    self.assertEqual(
+        {'Keep': 'keep', 'Modify': 'blah', 'New': ''},
+        {g.key.id(): g.description for g in current.groups})
+    self.assertEqual(
+        ['keep', 'new'], [l.key.id() for l in current.ip_whitelists])
+    self.assertEqual(['new'], [s.key.id() for s in current.secrets])
+
+  def test_base_rev_mismatch(self):
+    self.configure_as_replica(9, datetime.datetime(2000, 1, 1, 1, 1, 1))
+    self.group('Keep').put()
+    updated, state = replication.apply_auth_db_delta(
+        auth_db_rev=12,
+        modified_ts=datetime.datetime(2014, 1, 1, 1, 1, 1),
+        base_auth_db_rev=10,
+        snapshot=make_snapshot_obj(groups=[self.group('New')]),
+        deleted_keys=[model.group_key('Keep')])
+    self.assertFalse(updated)
+    self.assertEqual(9, state.auth_db_rev)
+    self.assertEqual(
+        ['Keep'], [g.key.id() for g in model.AuthGroup.query().fetch()])
+
+  def test_push_auth_db_delta(self):
+    self.mock_now(datetime.datetime(2014, 1, 1, 1, 1, 1))
+    self.configure_as_replica(10)
+    self.group('Delete').put()
+    delta = replication_pb2.AuthDBDelta()
+    delta.base_auth_db_rev = 10
+    replication.auth_db_snapshot_to_proto(
+        make_snapshot_obj(groups=[
+          self.group(
+              'New',
+              created_ts=datetime.datetime(2014, 1, 1, 1, 1, 1),
+              created_by=model.Anonymous,
+              modified_ts=datetime.datetime(2014, 1, 1, 1, 1, 1),
+              modified_by=model.Anonymous),
+        ]),
+        delta.auth_db)
+    delta.deleted_groups.append('Delete')
+    revision = replication_pb2.AuthDBRevision(
+        primary_id='primary', auth_db_rev=11, modified_ts=1388538061000000)
+
+    updated, state = replication.push_auth_db_delta(revision, delta)
+    self.assertTrue(updated)
+    self.assertEqual(11, state.auth_db_rev)
+    self.assertEqual(
+        ['New'], [g.key.id() for g in model.AuthGroup.query().fetch()])
+
+    # Pushing it again is skipped.
+    updated, state = replication.push_auth_db_delta(revision, delta)
+    self.assertFalse(updated)
+    self.assertEqual(11, state.auth_db_rev)
+
+    # A delta based on another revision is not applied.
+    revision.auth_db_rev = 13
+    delta.base_auth_db_rev = 12
+    updated, state = replication.push_auth_db_delta(revision, delta)
+    self.assertFalse(updated)
+    self.assertEqual(11, state.auth_db_rev)
+
+
 if __name__ == '__main__':
   if '-v' in sys.argv:
     unittest.TestCase.maxDiff = None
@@ -5,9 +5,11 @@
 """Functions to generate and validate tokens signed with MAC tags."""
 
 import base64
+import collections
 import hashlib
 import hmac
 import json
+import threading
 
 from components import utils
 
@@ -17,6 +19,7 @@ from . import api
 __all__ = [
   'InvalidTokenError',
   'TokenKind',
+  'get_token_cache_stats',
 ]
 
 
@@ -29,6 +32,12 @@ MAC_ALGOS = {
 # How much clock drift between machines we can tolerate, in seconds.
 ALLOWED_CLOCK_DRIFT_SEC = 30
 
+# How many HMAC objects keyed with a secret are kept per process.
+MAC_CACHE_SIZE = 64
+
+# How many recently validated tokens are kept per process.
+VALIDATED_TOKENS_CACHE_SIZE = 1000
+
 
 class InvalidTokenError(ValueError):
   """Token validation failed."""
@@ -136,6 +145,20 @@ class TokenKind(object):
     secret = api.get_secret(cls.secret_key)
     assert secret
 
+    # Same tokens are usually validated many times in a row, e.g. an upload
+    # ticket for each request of an upload. Skip decoding a token validated
+    # recently with same values of the secret, but recheck its timestamps.
+    now = utils.time_time() * 1000
+    cache_key = (cls, token, tuple(message))
+    cached = _validated_tokens_cache.get(cache_key)
+    if cached and cached[0] == tuple(secret):
+      _, issued_ts, expiration_ts, embedded = cached
+      if (issued_ts <= now + ALLOWED_CLOCK_DRIFT_SEC * 1000 and
+          now <= expiration_ts):
+        _count_cache('validated_tokens', True)
+        return embedded.copy()
+    _count_cache('validated_tokens', False)
+
     # Decode token, use any recent value of secret to validate MAC.
     version, embedded = decode_token(cls.algo, token, secret, message)
 
@@ -152,7 +175,6 @@ class TokenKind(object):
     issued_ts = int(issued_ts)
 
     # Discard tokens from the future. Someone is messing with the clock.
-    now = utils.time_time() * 1000
     if issued_ts > now + ALLOWED_CLOCK_DRIFT_SEC * 1000:
       raise InvalidTokenError('Bad token: issued timestamp is in the future')
 
@@ -168,6 +190,10 @@ class TokenKind(object):
     if now > issued_ts + expiration_msec:
       raise InvalidTokenError('Bad token: expired')
 
+    _validated_tokens_cache.add(
+        cache_key,
+        (tuple(secret), issued_ts, issued_ts + expiration_msec,
+         embedded.copy()))
     return embedded
 
   @classmethod
@@ -181,6 +207,68 @@ class TokenKind(object):
         0 <= cls.version <= 255)
 
 
+class _LRUCache(object):
+  """Thread safe LRU cache bounded by the number of items."""
+
+  def __init__(self, max_items):
+    self._max_items = max_items
+    self._lock = threading.Lock()
+    # Ordered from the least to the most recently used.
+    self._items = collections.OrderedDict()
+
+  def get(self, key):
+    """Returns the value for key or None and marks it as the most recently
+    used.
+    """
+    with self._lock:
+      value = self._items.pop(key, None)
+      if value is not None:
+        self._items[key] = value
+      return value
+
+  def add(self, key, value):
+    """Adds a value, evicting the least recently used one if needed."""
+    with self._lock:
+      self._items.pop(key, None)
+      self._items[key] = value
+      if len(self._items) > self._max_items:
+        self._items.popitem(last=False)
+
+
+# (algo, secret) -> HMAC object with the key derived from the secret.
+_mac_cache = _LRUCache(MAC_CACHE_SIZE)
+
+# (TokenKind subclass, token, message) -> (values of the secret, issued_ts,
+# expiration_ts, embedded data) of a valid token.
+_validated_tokens_cache = _LRUCache(VALIDATED_TOKENS_CACHE_SIZE)
+
+# '<cache>_hits' or '<cache>_misses' -> count, see get_token_cache_stats().
+_cache_stats = collections.Counter()
+_cache_stats_lock = threading.Lock()
+
+
+def _count_cache(cache, hit):
+  """Increments hit or miss counter of a process cache."""
+  with _cache_stats_lock:
+    _cache_stats['%s_%s' % (cache, 'hits' if hit else 'misses')] += 1
+
+
+def get_token_cache_stats():
+  """Returns the hit and miss counters of the process caches of this module.
+
+  Returns:
+    Dict with 'mac_hits', 'mac_misses', 'validated_tokens_hits' and
+    'validated_tokens_misses' counters since the process started.
+  """
+  with _cache_stats_lock:
+    stats = dict.fromkeys(
+        ('mac_hits', 'mac_misses', 'validated_tokens_hits',
+         'validated_tokens_misses'),
+        0)
+    stats.update(_cache_stats)
+    return stats
+
+
 def to_encoding(string, encoding):
   """Unicode or str -> str in given |encoding|.
 
@@ -261,7 +349,14 @@ def compute_mac(algo, secret, chunks):
   assert isinstance(chunks, list)
   assert algo in MAC_ALGOS, algo
   hash_algo, digest_size = MAC_ALGOS[algo]
-  mac = hmac.new(secret, digestmod=hash_algo)
+  # Deriving the inner and outer keys from the secret costs two hash updates,
+  # do it once per secret.
+  base_mac = _mac_cache.get((algo, secret))
+  _count_cache('mac', base_mac is not None)
+  if base_mac is None:
+    base_mac = hmac.new(secret, digestmod=hash_algo)
+    _mac_cache.add((algo, secret), base_mac)
+  mac = base_mac.copy()
   for chunk in chunks:
     assert isinstance(chunk, str)
     # Separator '\n' is necessary to guarantee that two different messages
@@ -141,6 +141,17 @@ class ComputeMacTest(test_case.TestCase):
         tokens.MAC_ALGOS[self.algo][1],
         len(tokens.compute_mac(self.algo, 'secret', ['a'])))
 
+  def test_compute_mac_cache(self):
+    before = tokens.get_token_cache_stats()
+    first = tokens.compute_mac(self.algo, 'cached secret', ['1'])
+    self.assertEqual(
+        first, tokens.compute_mac(self.algo, 'cached secret', ['1']))
+    self.assertNotEqual(
+        first, tokens.compute_mac(self.algo, 'cached secret', ['2']))
+    after = tokens.get_token_cache_stats()
+    self.assertEqual(before['mac_misses'] + 1, after['mac_misses'])
+    self.assertEqual(before['mac_hits'] + 2, after['mac_hits'])
+
   def test_compute_mac_uses_secret(self):
     # Different secrets -> different MACs.
     mac1 = tokens.compute_mac(self.algo, 'secret1', ['a', 'b'])
@@ -277,6 +288,38 @@ class TestToken(test_case.TestCase):
     SimpleToken.validate(tok)
     self.assertEqual([SimpleToken.secret_key], calls)
 
+  def test_validate_cache(self):
+    tok = SimpleToken.generate('message', {'embedded': 'some'})
+    before = tokens.get_token_cache_stats()
+    embedded = SimpleToken.validate(tok, 'message')
+    self.assertEqual({'embedded': 'some'}, embedded)
+    # Modifying the returned dict doesn't affect the cache.
+    embedded['embedded'] = 'modified'
+    self.assertEqual({'embedded': 'some'}, SimpleToken.validate(tok, 'message'))
+    after = tokens.get_token_cache_stats()
+    self.assertEqual(
+        before['validated_tokens_misses'] + 1,
+        after['validated_tokens_misses'])
+    self.assertEqual(
+        before['validated_tokens_hits'] + 1, after['validated_tokens_hits'])
+
+    # The cached validation doesn't apply to another message.
+    with self.assertRaises(tokens.InvalidTokenError):
+      SimpleToken.validate(tok, 'message 2')
+
+  def test_validate_cache_secret_rotation(self):
+    tok = SimpleToken.generate()
+    SimpleToken.validate(tok)
+
+    # The token is still valid with a new value of the secret added.
+    self.mock(tokens.api, 'get_secret', lambda _key: ['0', '1', '2'])
+    SimpleToken.validate(tok)
+
+    # The token is rejected once the value used to sign it is gone.
+    self.mock(tokens.api, 'get_secret', lambda _key: ['0'])
+    with self.assertRaises(tokens.InvalidTokenError):
+      SimpleToken.validate(tok)
+
   def test_checks_version(self):
     class TokenV1(tokens.TokenKind):
       secret_key = api.SecretKey('secret', 'local')
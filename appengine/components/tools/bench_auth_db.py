@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Copyright 2015 The Swarming Authors. All rights reserved.
+# Use of this source code is governed by the Apache v2.0 license that can be
+# found in the LICENSE file.
+
+"""Benchmarks AuthDB.is_group_member() against group size and nesting depth.
+
+For each shape, builds a chain of |depth| nested groups where the innermost
+group has |members| members and a few globs, then reports the time to build the
+AuthDB and the average time of a membership check for a member of the innermost
+group, for an identity matching a glob and for a non-member.
+"""
+
+import optparse
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from test_support import test_env
+test_env.setup_test_env()
+
+from components.auth import api
+from components.auth import model
+
+
+def gen_groups(members, depth):
+  """Returns a chain of |depth| groups, 'group0' nesting all the others."""
+  groups = []
+  for i in xrange(depth):
+    group = model.AuthGroup(id='group%d' % i)
+    if i + 1 < depth:
+      group.nested.append('group%d' % (i + 1))
+    groups.append(group)
+  groups[-1].members = [
+    model.Identity(model.IDENTITY_USER, 'user%d@example.com' % i)
+    for i in xrange(members)
+  ]
+  groups[-1].globs = [
+    model.IdentityGlob(model.IDENTITY_USER, '*@glob%d.example.com' % i)
+    for i in xrange(5)
+  ]
+  return groups
+
+
+def measure(func, repeat):
+  """Returns the average duration of func() in seconds."""
+  start = time.time()
+  for _ in xrange(repeat):
+    func()
+  return (time.time() - start) / repeat
+
+
+def main():
+  parser = optparse.OptionParser(description=sys.modules[__name__].__doc__)
+  parser.add_option(
+      '--members', type='int', action='append',
+      help='Members of the innermost group, default: 10, 1000, 50000')
+  parser.add_option(
+      '--depth', type='int', action='append',
+      help='Nesting depth, default: 1, 5, 20')
+  parser.add_option(
+      '--repeat', type='int', default=1000,
+      help='Checks per measurement, default: %default')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unknown args passed in; %s' % args)
+
+  member = model.Identity(model.IDENTITY_USER, 'user0@example.com')
+  globbed = model.Identity(model.IDENTITY_USER, 'joe@glob4.example.com')
+  stranger = model.Identity(model.IDENTITY_USER, 'joe@example.com')
+  for members in options.members or (10, 1000, 50000):
+    for depth in options.depth or (1, 5, 20):
+      groups = gen_groups(members, depth)
+      start = time.time()
+      auth_db = api.AuthDB(groups=groups)
+      build_secs = time.time() - start
+      # The first call fills the memoized closure.
+      auth_db.is_group_member('group0', member)
+      results = [
+        measure(
+            lambda: auth_db.is_group_member('group0', identity),
+            options.repeat)
+        for identity in (member, globbed, stranger)
+      ]
+      print(
+          '%5d members, depth %2d: build %7.1fms, member %6.1fus, '
+          'glob %6.1fus, non-member %6.1fus' % (
+            members, depth, build_secs * 1000.,
+            results[0] * 1000000., results[1] * 1000000.,
+            results[2] * 1000000.))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# Copyright 2015 The Swarming Authors. All rights reserved.
+# Use of this source code is governed by the Apache v2.0 license that can be
+# found in the LICENSE file.
+
+"""Benchmarks AuthDB.verify_ip_whitelisted() for anonymous bot requests.
+
+For each number of subnets in the bots IP whitelist, reports the time to build
+the AuthDB and the average time of a check with ipaddr.SubnetSet as done by
+AuthDB, compared with AuthIPWhitelist.is_ip_whitelisted() that parses and scans
+all the subnets.
+"""
+
+import optparse
+import os
+import random
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from test_support import test_env
+test_env.setup_test_env()
+
+from components.auth import api
+from components.auth import ipaddr
+from components.auth import model
+
+
+def gen_subnets(count):
+  """Returns |count| distinct /28 IPv4 subnets in 10.0.0.0/8."""
+  return [
+    ipaddr.subnet_to_string(ipaddr.Subnet(32, (10 << 24) + i * 16, 0xfffffff0))
+    for i in random.sample(xrange(1 << 20), count)
+  ]
+
+
+def measure(func, ips):
+  """Returns the average duration of func(ip) in seconds."""
+  start = time.time()
+  for ip in ips:
+    func(ip)
+  return (time.time() - start) / len(ips)
+
+
+def main():
+  parser = optparse.OptionParser(description=sys.modules[__name__].__doc__)
+  parser.add_option(
+      '--subnets', type='int', action='append',
+      help='Subnets in the bots whitelist, default: 10, 100, 1000, 10000')
+  parser.add_option(
+      '--checks', type='int', default=1000,
+      help='Checks per measurement, default: %default')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unknown args passed in; %s' % args)
+  random.seed(0)
+
+  for count in options.subnets or (10, 100, 1000, 10000):
+    whitelist = model.AuthIPWhitelist(
+        key=model.ip_whitelist_key(model.BOTS_IP_WHITELIST),
+        subnets=gen_subnets(count))
+    start = time.time()
+    auth_db = api.AuthDB(ip_whitelists=[whitelist])
+    build_secs = time.time() - start
+    ips = [
+      ipaddr.IP(32, (10 << 24) + random.getrandbits(24))
+      for _ in xrange(options.checks)
+    ]
+    compiled = measure(
+        lambda ip: auth_db.verify_ip_whitelisted(model.Anonymous, ip), ips)
+    # The linear scan is too slow to do as many checks.
+    linear = measure(whitelist.is_ip_whitelisted, ips[:100])
+    print(
+        '%5d subnets: build %7.1fms, check %6.1fus, linear scan %9.1fus' % (
+          count, build_secs * 1000., compiled * 1000000., linear * 1000000.))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -72,6 +72,12 @@ class RetrieveRequest(messages.Message):
   offset = messages.IntegerField(3, default=0)
 
 
+class RetrieveBatchRequest(messages.Message):
+  """Request to retrieve the content of multiple small entries at once."""
+  digests = messages.StringField(1, repeated=True)
+  namespace = messages.MessageField(Namespace, 2)
+
+
 ### Response Types
 
 
@@ -93,14 +99,30 @@ class RetrievedContent(messages.Message):
   url = messages.StringField(2)
 
 
+class RetrievedEntry(messages.Message):
+  """Content of one entry retrieved from memcache or DB."""
+  digest = messages.StringField(1)
+  content = messages.BytesField(2)
+
+
+class RetrievedEntryCollection(messages.Message):
+  """Entries retrieved by retrieve_batch.
+
+  Entries not found, stored in GS or that didn't fit in the response are
+  omitted, they must be fetched with retrieve.
+  """
+  items = messages.MessageField(RetrievedEntry, 1, repeated=True)
+
+
 class PushPing(messages.Message):
   """Indicates whether data storage executed successfully."""
   ok = messages.BooleanField(1)
 
 
 class ServerDetails(messages.Message):
-  """Reports the current API version."""
+  """Reports the current API version and the optional endpoints supported."""
   server_version = messages.StringField(1)
+  retrieve_batch = messages.BooleanField(2)
 
 
 ### Utility
@@ -114,6 +136,15 @@ DEFAULT_LINK_EXPIRATION = datetime.timedelta(hours=4)
 UPLOAD_MESSAGES = ['datastore', 'gs']
 
 
+# maximum number of digests accepted by retrieve_batch
+MAX_RETRIEVE_BATCH_ITEMS = 1000
+
+
+# maximum cumulated size of the content returned by retrieve_batch, to stay well
+# below the response size limit once base64 encoded
+MAX_RETRIEVE_BATCH_SIZE = 16 * 1024 * 1024
+
+
 class TokenSigner(auth.TokenKind):
   """Used to create upload tickets."""
   expiration_sec = DEFAULT_LINK_EXPIRATION.total_seconds()
@@ -272,9 +303,53 @@ class IsolateService(remote.Service):
         filename=key.id(),
         expiration=DEFAULT_LINK_EXPIRATION))
 
+  @auth.endpoints_method(RetrieveBatchRequest, RetrievedEntryCollection)
+  def retrieve_batch(self, request):
+    """Retrieves the content of multiple small entries in a single call.
+
+    Looks up all the entries in memcache at once, then all the remaining ones in
+    the DB at once. Only the content stored inline is returned.
+    """
+    if len(request.digests) > MAX_RETRIEVE_BATCH_ITEMS:
+      raise endpoints.BadRequestException(
+          'Can\'t retrieve more than %d entries at once.' %
+          MAX_RETRIEVE_BATCH_ITEMS)
+    namespace = request.namespace.namespace
+    # Validate all the digests before doing any lookup.
+    keys = [entry_key_or_error(namespace, digest) for digest in request.digests]
+
+    found = {}
+    for digest, content in memcache.get_multi(
+        request.digests, namespace='table_%s' % namespace).iteritems():
+      found[digest] = (content, 'memcache')
+    missing = [
+      (digest, key) for digest, key in zip(request.digests, keys)
+      if digest not in found
+    ]
+    if missing:
+      entities = ndb.get_multi([key for _, key in missing])
+      for (digest, _), stored in zip(missing, entities):
+        # content is None if the entity is in GCS.
+        if stored is not None and stored.content is not None:
+          found[digest] = (stored.content, 'inline')
+
+    items = []
+    total = 0
+    for digest in request.digests:
+      if digest not in found:
+        continue
+      content, where = found.pop(digest)
+      total += len(content)
+      if total > MAX_RETRIEVE_BATCH_SIZE:
+        break
+      stats.add_entry(stats.RETURN, len(content), where)
+      items.append(RetrievedEntry(digest=digest, content=content))
+    return RetrievedEntryCollection(items=items)
+
   @auth.endpoints_method(message_types.VoidMessage, ServerDetails)
   def server_details(self, _request):
-    return ServerDetails(server_version=utils.get_app_version())
+    return ServerDetails(
+        server_version=utils.get_app_version(), retrieve_batch=True)
 
   ### Utility
 
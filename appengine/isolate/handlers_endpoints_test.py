@@ -526,10 +526,69 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
       self.call_api(
           'retrieve', self.message_to_dict(retrieve_request), 200)
 
+  def test_retrieve_batch_ok(self):
+    """Assert that multiple entries are retrieved from memcache and DB."""
+    contents = ['Endymion', 'Hyperion', 'Lamia']
+    digests = []
+    for content in contents:
+      request = self.store_request(content)
+      digests.append(validate(
+          request.upload_ticket, handlers_endpoints.UPLOAD_MESSAGES[0])['d'])
+      self.call_api('store_inline', self.message_to_dict(request), 200)
+    # Only the first entry is left in memcache.
+    memcache.delete(digests[1], namespace='table_default')
+    memcache.delete(digests[2], namespace='table_default')
+    # The last digest is not stored.
+    missing = hash_content('Otho the Great', 'default')
+
+    retrieve_request = handlers_endpoints.RetrieveBatchRequest(
+        digests=digests + [missing], namespace=handlers_endpoints.Namespace())
+    response = self.call_api(
+        'retrieve_batch', self.message_to_dict(retrieve_request), 200)
+    actual = [
+      (i[u'digest'], base64.b64decode(i[u'content']))
+      for i in response.json[u'items']
+    ]
+    self.assertEqual(zip(digests, contents), actual)
+
+  def test_retrieve_batch_skips_gs(self):
+    """Assert that entries stored in GS are not returned inline."""
+    content = pad_string('Lycidas')
+    collection = generate_collection([content])
+    preupload_status = self.call_api(
+        'preupload', self.message_to_dict(collection), 200)
+    message = preupload_status.json.get(u'items', [{}])[0]
+    request = preupload_status_to_request(message, content)
+    embedded = validate(
+        request.upload_ticket, handlers_endpoints.UPLOAD_MESSAGES[1])
+    self.mock(gcs, 'get_file_info', get_file_info_factory(content))
+    self.call_api(
+        'finalize_gs_upload', self.message_to_dict(request), 200)
+
+    retrieve_request = handlers_endpoints.RetrieveBatchRequest(
+        digests=[embedded['d']], namespace=handlers_endpoints.Namespace())
+    response = self.call_api(
+        'retrieve_batch', self.message_to_dict(retrieve_request), 200)
+    self.assertEqual([], response.json.get(u'items', []))
+
+    # clear the taskqueue
+    self.assertEqual(1, self.execute_tasks())
+
+  def test_retrieve_batch_too_many(self):
+    """Assert that retrieve_batch rejects too large batches."""
+    self.mock(handlers_endpoints, 'MAX_RETRIEVE_BATCH_ITEMS', 1)
+    digests = [hash_content(c, 'default') for c in ('a', 'b')]
+    retrieve_request = handlers_endpoints.RetrieveBatchRequest(
+        digests=digests, namespace=handlers_endpoints.Namespace())
+    with self.call_should_fail('400'):
+      self.call_api(
+          'retrieve_batch', self.message_to_dict(retrieve_request), 200)
+
   def test_server_details_ok(self):
     """Assert that server_details returns the correct version."""
     response = self.call_api('server_details', {}, 200).json
     self.assertEqual(utils.get_app_version(), response['server_version'])
+    self.assertEqual(True, response['retrieve_batch'])
 
 
 if __name__ == '__main__':
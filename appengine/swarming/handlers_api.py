@@ -106,6 +106,7 @@ class ClientHandshakeHandler(auth.ApiHandler):
 
   Response body is a JSON dict:
     {
+      "max_shards": 1000,
       "server_version": "138-193f1f3",
       "xsrf_token": "......",
     }
@@ -123,6 +124,8 @@ class ClientHandshakeHandler(auth.ApiHandler):
     log_unexpected_keys(
         self.EXPECTED_KEYS, request, self.request, 'client', 'keys')
     data = {
+      # Maximum number of shards accepted by /swarming/api/v1/client/shards.
+      'max_shards': task_request.MAXIMUM_SHARDS,
       # This access token will be used to validate each subsequent request.
       'server_version': utils.get_app_version(),
       'xsrf_token': self.generate_xsrf_token(),
@@ -177,19 +180,44 @@ class ClientTaskResultRequestHandler(ClientTaskResultBase):
 
 
 class ClientTaskResultOutputHandler(ClientTaskResultBase):
-  """Task's output for a single command"""
+  """Task's output for a single command.
+
+  The optional 'offset' and 'length' arguments select a range of the output, in
+  bytes. The response then also contains 'next_offset', the offset to use to
+  fetch the data that follows.
+  """
 
   @auth.require(acl.is_bot_or_user)
   def get(self, task_id, command_index):
+    offset = self.request.get('offset')
+    length = self.request.get('length')
+    ranged = bool(offset or length)
+    try:
+      offset = int(offset or 0)
+      length = int(length) if length else None
+    except ValueError:
+      self.abort_with_error(400, error='offset and length must be integers')
+    if offset < 0 or (length is not None and length <= 0):
+      self.abort_with_error(400, error='Invalid offset or length')
+
     result = self.get_result_entity(task_id)
-    output = result.get_command_output_async(int(command_index)).get_result()
+    output = result.get_command_output_async(
+        int(command_index), offset, length).get_result()
+    data = {}
+    if ranged:
+      output = output or ''
+      if (result.state in task_result.State.STATES_RUNNING or
+          (length is not None and len(output) == length)):
+        # Do not return a partial character, it will be part of the next range.
+        # Once the task is done and the end of the output was read, nothing
+        # will ever complete it so it is returned as is.
+        output = task_result.trim_partial_utf8(output)
+      data['next_offset'] = offset + len(output)
     if output:
       output = output.decode('utf-8', 'replace')
     # JSON then reencodes to ascii compatible encoded strings, which explodes
     # the size.
-    data = {
-      'output': output,
-    }
+    data['output'] = output
     self.send_response(utils.to_json_encodable(data))
 
 
@@ -363,6 +391,69 @@ class ClientRequestHandler(auth.ApiHandler):
     self.send_response(utils.to_json_encodable(data))
 
 
+class ClientRequestShardsHandler(auth.ApiHandler):
+  """Creates the new requests of all the shards of a sharded task at once.
+
+  Request body is a JSON dict:
+    {
+      "request": <same as for /swarming/api/v1/client/request>,
+      "shards": [
+        {
+          "env": <dict of environment variables to add, optional>,
+          "name": "...",
+        },
+        ...
+      ],
+    }
+
+  Response body is a JSON dict:
+    {
+      "priority": 100,
+      "tasks": [
+        {
+          "name": "...",
+          "task_id": "...",
+        },
+        ...
+      ],
+    }
+  The tasks are in the same order as the shards.
+  """
+  EXPECTED_KEYS = frozenset(['request', 'shards'])
+
+  @auth.require(acl.is_bot_or_user)
+  def post(self):
+    body = self.parse_body()
+    log_unexpected_keys(
+        self.EXPECTED_KEYS, body, self.request, 'client', 'keys')
+    request_data = body.get('request')
+    if not isinstance(request_data, dict):
+      self.abort_with_error(400, error='Expected request')
+    # If the priority is below 100, make the the user has right to do so.
+    if request_data.get('priority', 255) < 100 and not acl.is_bot_or_admin():
+      # Silently drop the priority of normal users.
+      request_data['priority'] = 100
+
+    try:
+      requests = task_request.make_request_shards(
+          request_data, body.get('shards'))
+    except (datastore_errors.BadValueError, TypeError, ValueError) as e:
+      self.abort_with_error(400, error=str(e))
+
+    result_summaries = task_scheduler.schedule_requests(requests)
+    data = {
+      'priority': requests[0].priority,
+      'tasks': [
+        {
+          'name': request.name,
+          'task_id': task_pack.pack_result_summary_key(result_summary.key),
+        }
+        for request, result_summary in zip(requests, result_summaries)
+      ],
+    }
+    self.send_response(utils.to_json_encodable(data))
+
+
 class ClientCancelHandler(auth.ApiHandler):
   """Cancels a task."""
 
@@ -392,6 +483,7 @@ def get_routes():
       ('/swarming/api/v1/client/list', ClientApiListHandler),
       ('/swarming/api/v1/client/request', ClientRequestHandler),
       ('/swarming/api/v1/client/server', ClientApiServer),
+      ('/swarming/api/v1/client/shards', ClientRequestShardsHandler),
       ('/swarming/api/v1/client/task/<task_id:[0-9a-f]+>',
           ClientTaskResultHandler),
       ('/swarming/api/v1/client/task/<task_id:[0-9a-f]+>/request',
@@ -73,7 +73,7 @@ class ClientApiTest(test_env_handlers.AppTestBase):
         '/swarming/api/v1/client/handshake',
         headers=headers, params=params).json
     self.assertEqual(
-        [u'server_version', u'xsrf_token'], sorted(response))
+        [u'max_shards', u'server_version', u'xsrf_token'], sorted(response))
     self.assertTrue(response['xsrf_token'])
     self.assertEqual(u'v1a', response['server_version'])
 
@@ -93,7 +93,7 @@ class ClientApiTest(test_env_handlers.AppTestBase):
         '/swarming/api/v1/client/handshake',
         headers=headers, params=params).json
     self.assertEqual(
-        [u'server_version', u'xsrf_token'], sorted(response))
+        [u'max_shards', u'server_version', u'xsrf_token'], sorted(response))
     self.assertTrue(response['xsrf_token'])
     self.assertEqual(u'v1a', response['server_version'])
     expected = [
@@ -206,6 +206,70 @@ class ClientApiTest(test_env_handlers.AppTestBase):
     }
     self.assertEqual(expected, response)
 
+  def test_request_shards(self):
+    self.mock(random, 'getrandbits', lambda _: 0x88)
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5)
+    self.mock_now(now)
+    headers = {'X-XSRF-Token-Request': '1'}
+    response = self.app.post_json(
+        '/swarming/api/v1/client/handshake', headers=headers, params={}).json
+    self.assertEqual(1000, response['max_shards'])
+    params = {
+      'request': {
+        'name': 'job1',
+        'priority': 20,
+        'properties': {
+          'commands': [['rm', '-rf', '/']],
+          'data': [],
+          'dimensions': {},
+          'env': {},
+          'execution_timeout_secs': 30,
+          'io_timeout_secs': 30,
+        },
+        'scheduling_expiration_secs': 30,
+        'tags': ['foo:bar'],
+        'user': 'joe@localhost',
+      },
+      'shards': [
+        {
+          'env': {'GTEST_SHARD_INDEX': str(i), 'GTEST_TOTAL_SHARDS': '3'},
+          'name': 'job1:%d:3' % i,
+        }
+        for i in xrange(3)
+      ],
+    }
+    headers = {'X-XSRF-Token': str(response['xsrf_token'])}
+    response = self.app.post_json(
+        '/swarming/api/v1/client/shards',
+        headers=headers, params=params).json
+    expected = {
+      # The priority was silently dropped.
+      u'priority': 100,
+      u'tasks': [
+        {u'name': u'job1:0:3', u'task_id': u'5cee488008810'},
+        {u'name': u'job1:1:3', u'task_id': u'5cee488008910'},
+        {u'name': u'job1:2:3', u'task_id': u'5cee488008a10'},
+      ],
+    }
+    self.assertEqual(expected, response)
+    response = self.app.get(
+        '/swarming/api/v1/client/task/5cee488008a10/request').json
+    self.assertEqual(
+        {u'GTEST_SHARD_INDEX': u'2', u'GTEST_TOTAL_SHARDS': u'3'},
+        response['properties']['env'])
+
+  def test_request_shards_invalid(self):
+    headers = {'X-XSRF-Token-Request': '1'}
+    response = self.app.post_json(
+        '/swarming/api/v1/client/handshake', headers=headers, params={}).json
+    headers = {'X-XSRF-Token': str(response['xsrf_token'])}
+    response = self.app.post_json(
+        '/swarming/api/v1/client/shards',
+        headers=headers, params={'request': {}, 'shards': []},
+        status=400).json
+    self.assertEqual(
+        {u'error': u'shards (0) must be between 1 and 1000'}, response)
+
   def test_cancel(self):
     self.mock(random, 'getrandbits', lambda _: 0x88)
     now = datetime.datetime(2010, 1, 2, 3, 4, 5)
@@ -354,6 +418,40 @@ class ClientApiTest(test_env_handlers.AppTestBase):
         '/swarming/api/v1/client/task/%s/output/1' % run_id).json
     self.assertEqual({'output': None}, response)
 
+  def test_get_task_output_range(self):
+    self.client_create_task()
+    self.set_as_bot()
+    task_id = self.bot_run_task()
+
+    self.set_as_privileged_user()
+    url = '/swarming/api/v1/client/task/%s/output/0' % task_id
+    # The partial 'É' is left for the next range.
+    response = self.app.get(url + '?offset=0&length=2').json
+    self.assertEqual({'next_offset': 1, 'output': u'r'}, response)
+    response = self.app.get(url + '?offset=1').json
+    self.assertEqual({'next_offset': 14, 'output': u'Ésult string'}, response)
+    response = self.app.get(url + '?offset=14').json
+    self.assertEqual({'next_offset': 14, 'output': u''}, response)
+    self.app.get(url + '?offset=-1', status=400)
+    self.app.get(url + '?length=a', status=400)
+
+  def test_get_task_output_range_partial_end(self):
+    self.client_create_task()
+    self.set_as_bot()
+    token, _ = self.get_bot_token()
+    task_id = self.bot_poll()['manifest']['task_id']
+    self.bot_complete_task(
+        token, task_id=task_id, output=base64.b64encode('r\xc3'))
+
+    self.set_as_privileged_user()
+    url = '/swarming/api/v1/client/task/%s/output/0' % task_id
+    # The task is done, the trailing partial character is not held back.
+    response = self.app.get(url + '?offset=0').json
+    self.assertEqual({'next_offset': 2, 'output': u'r\ufffd'}, response)
+    # Unless the range stopped before the end of the output.
+    response = self.app.get(url + '?offset=0&length=2').json
+    self.assertEqual({'next_offset': 1, 'output': u'r'}, response)
+
   def test_get_task_output_empty(self):
     _, task_id = self.client_create_task()
     response = self.app.get(
@@ -4,20 +4,101 @@
 
 """Main entry point for Swarming backend handlers."""
 
+import json
+import logging
+
 import webapp2
 from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 
 import mapreduce_jobs
 from components import decorators
+from components import utils
 from server import stats
+from server import task_result
 from server import task_scheduler
+from server import task_to_run
+
+
+# Maximum duration of the query of a cron job fanning out batches. Past this,
+# the query continues in a task queue task from its cursor. The cron jobs run
+# every minute.
+CRON_QUERY_SECS = 50
+
+# Duration of the lease held by a fanout, including its continuations. The next
+# cron jobs are skipped while it is held so the same keys are not handed out
+# twice. Each continuation renews it.
+FANOUT_LEASE_SECS = 5*60
+
+
+def fanout_batches(name, pages, batch_url, query_url, process_batch, resumed):
+  """Enqueues one task queue task per page of keys to process.
+
+  Only one fanout of a given name runs at a time.
+
+  Arguments:
+    name: name of the fanout, used as the memcache key of its lease.
+    pages: iterator of tuple(list of ndb.Key, urlsafe cursor after the page).
+    batch_url: task queue url processing a batch of keys.
+    query_url: task queue url resuming the query from a cursor.
+    process_batch: function processing a batch of keys inline, in case the task
+        queue is acting up.
+    resumed: True when continuing the query of a previous fanout, which already
+        holds the lease.
+
+  Returns:
+    Number of keys handed out, None if the previous fanout is still running.
+  """
+  if resumed:
+    memcache.set(name, True, time=FANOUT_LEASE_SECS, namespace='cron_fanout')
+  elif not memcache.add(
+      name, True, time=FANOUT_LEASE_SECS, namespace='cron_fanout'):
+    logging.info('Skipping %s, the previous fanout is still running', name)
+    return None
+
+  start = utils.time_time()
+  continued = False
+  total = 0
+  batches = 0
+  for keys, cursor in pages:
+    if keys:
+      payload = utils.encode_to_json({'keys': [k.urlsafe() for k in keys]})
+      if not utils.enqueue_task(
+          batch_url, 'cron-batches', payload=payload,
+          use_dedicated_module=False):
+        process_batch(keys)
+      total += len(keys)
+      batches += 1
+    if cursor and utils.time_time() - start > CRON_QUERY_SECS:
+      payload = utils.encode_to_json({'cursor': cursor})
+      if utils.enqueue_task(
+          query_url, 'cron-batches', payload=payload,
+          use_dedicated_module=False):
+        continued = True
+        break
+  if not continued:
+    # The continuation keeps the lease.
+    memcache.delete(name, namespace='cron_fanout')
+  duration = utils.time_time() - start
+  logging.info(
+      'Enqueued %d items in %d batches in %.1fs', total, batches, duration)
+  stats.add_entry(
+      action='cron_fanout', items=total, duration_ms=int(duration * 1000))
+  return total
 
 
 class CronBotDiedHandler(webapp2.RequestHandler):
   @decorators.require_cronjob
   def get(self):
-    task_scheduler.cron_handle_bot_died()
+    fanout_batches(
+        'handle_bot_died',
+        task_result.yield_run_result_keys_with_dead_bot(),
+        '/internal/taskqueue/handle_bot_died',
+        '/internal/taskqueue/handle_bot_died/query',
+        task_scheduler.handle_dead_bots,
+        False)
     self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
     self.response.out.write('Success.')
 
@@ -25,7 +106,13 @@ class CronBotDiedHandler(webapp2.RequestHandler):
 class CronAbortExpiredShardToRunHandler(webapp2.RequestHandler):
   @decorators.require_cronjob
   def get(self):
-    task_scheduler.cron_abort_expired_task_to_run()
+    fanout_batches(
+        'abort_expired_task_to_run',
+        task_to_run.yield_expired_task_to_run_keys(),
+        '/internal/taskqueue/abort_expired_task_to_run',
+        '/internal/taskqueue/abort_expired_task_to_run/query',
+        task_scheduler.abort_expired_task_to_run,
+        False)
     self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
     self.response.out.write('Success.')
 
@@ -52,6 +139,62 @@ class TaskCleanupDataHandler(webapp2.RequestHandler):
     self.response.out.write('Success.')
 
 
+class TaskBotDiedHandler(webapp2.RequestHandler):
+  """Aborts or retries a batch of TaskRunResult where the bot died."""
+
+  @decorators.require_taskqueue('cron-batches')
+  def post(self):
+    keys = json.loads(self.request.body)['keys']
+    task_scheduler.handle_dead_bots([ndb.Key(urlsafe=k) for k in keys])
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
+class TaskBotDiedQueryHandler(webapp2.RequestHandler):
+  """Resumes the fanout of the cron job finding the tasks where the bot died."""
+
+  @decorators.require_taskqueue('cron-batches')
+  def post(self):
+    cursor = json.loads(self.request.body)['cursor']
+    fanout_batches(
+        'handle_bot_died',
+        task_result.yield_run_result_keys_with_dead_bot(cursor),
+        '/internal/taskqueue/handle_bot_died',
+        '/internal/taskqueue/handle_bot_died/query',
+        task_scheduler.handle_dead_bots,
+        True)
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
+class TaskAbortExpiredTaskToRunHandler(webapp2.RequestHandler):
+  """Aborts a batch of expired TaskToRun."""
+
+  @decorators.require_taskqueue('cron-batches')
+  def post(self):
+    keys = json.loads(self.request.body)['keys']
+    task_scheduler.abort_expired_task_to_run([ndb.Key(urlsafe=k) for k in keys])
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
+class TaskAbortExpiredTaskToRunQueryHandler(webapp2.RequestHandler):
+  """Resumes the fanout of the cron job finding the expired TaskToRun."""
+
+  @decorators.require_taskqueue('cron-batches')
+  def post(self):
+    cursor = json.loads(self.request.body)['cursor']
+    fanout_batches(
+        'abort_expired_task_to_run',
+        task_to_run.yield_expired_task_to_run_keys(cursor),
+        '/internal/taskqueue/abort_expired_task_to_run',
+        '/internal/taskqueue/abort_expired_task_to_run/query',
+        task_scheduler.abort_expired_task_to_run,
+        True)
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
 ### Mapreduce related handlers
 
 
@@ -80,7 +223,13 @@ def get_routes():
     ('/internal/cron/trigger_cleanup_data', CronTriggerCleanupDataHandler),
 
     # Task queues.
+    ('/internal/taskqueue/abort_expired_task_to_run',
+        TaskAbortExpiredTaskToRunHandler),
+    ('/internal/taskqueue/abort_expired_task_to_run/query',
+        TaskAbortExpiredTaskToRunQueryHandler),
     ('/internal/taskqueue/cleanup_data', TaskCleanupDataHandler),
+    ('/internal/taskqueue/handle_bot_died', TaskBotDiedHandler),
+    ('/internal/taskqueue/handle_bot_died/query', TaskBotDiedQueryHandler),
 
     # Mapreduce related urls.
     (r'/internal/taskqueue/mapreduce/launch/<job_id:[^\/]+>',
@@ -8,6 +8,8 @@ import base64
 import json
 import logging
 import textwrap
+import time
+import zlib
 
 import webapp2
 
@@ -23,12 +25,21 @@ from components import utils
 from server import acl
 from server import bot_code
 from server import bot_management
+from server import config
 from server import stats
 from server import task_pack
 from server import task_scheduler
 from server import task_to_run
 
 
+# Delay between checks of the wake up counters while a bot poll is held.
+LONG_POLL_INTERVAL_SECS = 1.
+
+# Minimum number of seconds left to look for a task for a held poll to look
+# again once woken up.
+LONG_POLL_MIN_REAP_SECS = 10
+
+
 def has_unexpected_subset_keys(expected_keys, minimum_keys, actual_keys, name):
   """Returns an error if unexpected keys are present or expected keys are
   missing.
@@ -322,15 +333,43 @@ class BotPollHandler(_BotBaseHandler):
       self._cmd_restart(restart_message)
       return
 
-    # The bot is in good shape. Try to grab a task.
+    # The bot is in good shape. Try to grab a task. When long polling, the
+    # request is held for up to the duration the bot would otherwise sleep, and
+    # the bot tries again as soon as a task it may run is enqueued.
+    sleep_duration = task_scheduler.exponential_backoff(sleep_streak)
+    long_poll_secs = min(
+        config.settings().bot_long_poll_secs, config.MAX_BOT_LONG_POLL_SECS,
+        sleep_duration)
+    start = utils.time_time()
+    # All the searches for a task share the time budget of a single one, so the
+    # request completes within its deadline.
+    reap_deadline = start + task_to_run.DISPATCH_TIMEOUT_SECS
+    wakeup = None
+    reap_stats = {}
     try:
-      # This is a fairly complex function call, exceptions are expected.
-      request, run_result = task_scheduler.bot_reap_task(
-          dimensions, bot_id, version)
+      while True:
+        if long_poll_secs:
+          # Read the counters before looking for a task, so a task enqueued in
+          # the meantime is not missed.
+          wakeup = task_to_run.get_wakeup_counters(dimensions)
+        # This is a fairly complex function call, exceptions are expected.
+        request, run_result = task_scheduler.bot_reap_task(
+            dimensions, bot_id, version, reap_deadline - utils.time_time(),
+            reap_stats)
+        if request or not long_poll_secs or not self._wait_for_task(
+            dimensions, wakeup, start + long_poll_secs):
+          break
+        if reap_deadline - utils.time_time() < LONG_POLL_MIN_REAP_SECS:
+          # Not enough time left to look for the task.
+          break
       if not request:
         # No task found, tell it to sleep a bit.
         bot_event('request_sleep')
-        self._cmd_sleep(sleep_streak, quarantined)
+        if long_poll_secs:
+          # Only sleep for the remainder of the backoff.
+          sleep_duration = max(
+              sleep_duration - (utils.time_time() - start), 0.)
+        self._cmd_sleep(sleep_streak, quarantined, sleep_duration, reap_stats)
         return
 
       try:
@@ -339,7 +378,7 @@ class BotPollHandler(_BotBaseHandler):
         bot_event(
             'request_task', task_id=run_result.key_packed,
             task_name=request.name)
-        self._cmd_run(request, run_result.key, bot_id)
+        self._cmd_run(request, run_result.key, bot_id, reap_stats)
       except:
         logging.exception('Dang, exception after reaping')
         raise
@@ -353,7 +392,16 @@ class BotPollHandler(_BotBaseHandler):
       # https://code.google.com/p/swarming/issues/detail?id=130
       self.abort(500, 'Deadline')
 
-  def _cmd_run(self, request, run_result_key, bot_id):
+  @staticmethod
+  def _add_reap_stats(out, reap_stats):
+    """Adds the reap conflicts to the response, for load tests.
+
+    Only present when nonzero, so the bots can ignore it.
+    """
+    if reap_stats and any(reap_stats.itervalues()):
+      out['reap_stats'] = reap_stats
+
+  def _cmd_run(self, request, run_result_key, bot_id, reap_stats):
     out = {
       'cmd': 'run',
       'manifest': {
@@ -369,16 +417,36 @@ class BotPollHandler(_BotBaseHandler):
         'task_id': task_pack.pack_run_result_key(run_result_key),
       },
     }
+    self._add_reap_stats(out, reap_stats)
     self.send_response(out)
 
-  def _cmd_sleep(self, sleep_streak, quarantined):
+  def _cmd_sleep(
+      self, sleep_streak, quarantined, duration=None, reap_stats=None):
+    if duration is None:
+      duration = task_scheduler.exponential_backoff(sleep_streak)
     out = {
       'cmd': 'sleep',
-      'duration': task_scheduler.exponential_backoff(sleep_streak),
+      'duration': duration,
       'quarantined': quarantined,
     }
+    self._add_reap_stats(out, reap_stats)
     self.send_response(out)
 
+  @staticmethod
+  def _wait_for_task(dimensions, wakeup, deadline):
+    """Waits until a task the bot may run may have been enqueued.
+
+    Returns True if the wake up counters changed from |wakeup| before
+    |deadline|, False on timeout.
+    """
+    while True:
+      remaining = deadline - utils.time_time()
+      if remaining <= 0:
+        return False
+      time.sleep(min(LONG_POLL_INTERVAL_SECS, remaining))
+      if task_to_run.get_wakeup_counters(dimensions) != wakeup:
+        return True
+
   def _cmd_update(self, expected_version):
     out = {
       'cmd': 'update',
@@ -464,7 +532,8 @@ class BotTaskUpdateHandler(auth.ApiHandler):
   """
   ACCEPTED_KEYS = {
     u'cost_usd', u'duration', u'exit_code', u'hard_timeout',
-    u'id', u'io_timeout', u'output', u'output_chunk_start', u'task_id',
+    u'id', u'io_timeout', u'output', u'output_chunk_start', u'output_encoding',
+    u'task_id',
   }
   REQUIRED_KEYS = {u'id', u'task_id'}
 
@@ -489,6 +558,10 @@ class BotTaskUpdateHandler(auth.ApiHandler):
     io_timeout = request.get('io_timeout')
     output = request.get('output')
     output_chunk_start = request.get('output_chunk_start')
+    output_encoding = request.get('output_encoding')
+    if output_encoding not in (None, 'zlib'):
+      self.abort_with_error(
+          400, error='Unsupported output_encoding %r' % output_encoding)
 
     run_result_key = task_pack.unpack_run_result_key(task_id)
     if output is not None:
@@ -502,6 +575,13 @@ class BotTaskUpdateHandler(auth.ApiHandler):
         # and returning a HTTP 500 would only force the bot to stay in a retry
         # loop.
         logging.error('Failed to decode output\n%s\n%r', e, output)
+      if output_encoding == 'zlib':
+        try:
+          output = zlib.decompress(output)
+        except zlib.error as e:
+          # Unlike base64, there's no sane way to save a corrupted stream.
+          logging.error('Failed to decompress output\n%s', e)
+          self.abort_with_error(400, error='Failed to decompress output')
 
     try:
       success, completed = task_scheduler.bot_update_task(
@@ -13,6 +13,7 @@ import StringIO
 import sys
 import unittest
 import zipfile
+import zlib
 
 # Setups environment.
 import test_env_handlers
@@ -29,7 +30,9 @@ from components import ereporter2
 from components import utils
 from server import bot_archive
 from server import bot_management
+from server import config
 from server import task_result
+from server import task_scheduler
 
 
 class BotApiTest(test_env_handlers.AppTestBase):
@@ -185,6 +188,64 @@ class BotApiTest(test_env_handlers.AppTestBase):
     }
     self.assertEqual(expected, response)
 
+  def test_poll_reap_stats(self):
+    # The tasks lost to other bots are reported for load tests.
+    self.client_create_task()
+    self.set_as_bot()
+    self.mock(handlers_bot.task_to_run, 'claim_task_to_run', lambda *_: False)
+    token, params = self.get_bot_token()
+    response = self.post_with_token('/swarming/api/v1/bot/poll', params, token)
+    self.assertTrue(response.pop(u'duration'))
+    expected = {
+      u'cmd': u'sleep',
+      u'quarantined': False,
+      u'reap_stats': {u'claims_lost': 1, u'failures': 0},
+    }
+    self.assertEqual(expected, response)
+
+  def test_poll_long_poll_sleep(self):
+    # The poll is held until the long poll deadline, then the bot sleeps for the
+    # remainder of its backoff.
+    self.mock(
+        config, 'settings', lambda: config.GlobalConfig(bot_long_poll_secs=15))
+    self.mock(task_scheduler, 'exponential_backoff', lambda _: 60.)
+    now = [1000.]
+    self.mock(utils, 'time_time', lambda: now[0])
+    def sleep(duration):
+      self.assertEqual(handlers_bot.LONG_POLL_INTERVAL_SECS, duration)
+      now[0] += duration
+    self.mock(handlers_bot.time, 'sleep', sleep)
+
+    token, params = self.get_bot_token()
+    response = self.post_with_token('/swarming/api/v1/bot/poll', params, token)
+    expected = {
+      u'cmd': u'sleep',
+      u'duration': 45.,
+      u'quarantined': False,
+    }
+    self.assertEqual(expected, response)
+    self.assertEqual(1015., now[0])
+
+  def test_poll_long_poll_task(self):
+    # The held poll is woken up by a task enqueued while waiting.
+    self.mock(
+        config, 'settings', lambda: config.GlobalConfig(bot_long_poll_secs=15))
+    self.mock(task_scheduler, 'exponential_backoff', lambda _: 60.)
+    now = [1000.]
+    self.mock(utils, 'time_time', lambda: now[0])
+    task_ids = []
+    def sleep(duration):
+      now[0] += duration
+      if now[0] == 1005.:
+        task_ids.append(self.client_create_task()[1])
+    self.mock(handlers_bot.time, 'sleep', sleep)
+
+    token, params = self.get_bot_token()
+    response = self.post_with_token('/swarming/api/v1/bot/poll', params, token)
+    self.assertEqual(u'run', response[u'cmd'])
+    self.assertEqual(task_ids[0][:-1] + '1', response[u'manifest'][u'task_id'])
+    self.assertEqual(1005., now[0])
+
   def test_poll_update(self):
     token, params = self.get_bot_token()
     old_version = params['version']
@@ -491,6 +552,41 @@ class BotApiTest(test_env_handlers.AppTestBase):
         '/swarming/api/v1/bot/task_update', params, token, status=500)
     self.assertEqual({u'error': u'Sorry!'}, response)
 
+  def test_task_update_compressed(self):
+    self.client_create_task(
+        properties=dict(commands=[['python', 'runtest.py']]))
+    token, params = self.get_bot_token()
+    response = self.post_with_token(
+        '/swarming/api/v1/bot/poll', params, token)
+    task_id = response['manifest']['task_id']
+
+    params = {
+      'cost_usd': 0.1,
+      'id': 'bot1',
+      'output': base64.b64encode(zlib.compress('result string')),
+      'output_chunk_start': 0,
+      'output_encoding': 'zlib',
+      'task_id': task_id,
+    }
+    response = self.post_with_token(
+        '/swarming/api/v1/bot/task_update', params, token)
+    self.assertEqual({u'ok': True}, response)
+    response = self.app.get(
+        '/swarming/api/v1/client/task/%s/output/0' % task_id).json
+    self.assertEqual({u'output': u'result string'}, response)
+
+    # A corrupted stream is refused.
+    self.mock(logging, 'error', lambda *_: None)
+    params['output'] = base64.b64encode('not zlib')
+    response = self.post_with_token(
+        '/swarming/api/v1/bot/task_update', params, token, status=400)
+    self.assertEqual({u'error': u'Failed to decompress output'}, response)
+    params['output_encoding'] = 'bz2'
+    response = self.post_with_token(
+        '/swarming/api/v1/bot/task_update', params, token, status=400)
+    self.assertEqual(
+        {u'error': u"Unsupported output_encoding u'bz2'"}, response)
+
   def test_task_failure(self):
     self.mock(random, 'getrandbits', lambda _: 0x88)
     now = datetime.datetime(2010, 1, 2, 3, 4, 5)
@@ -126,15 +126,30 @@ class SwarmingTaskService(remote.Service):
     ok, was_running = task_scheduler.cancel_task(summary_key)
     return swarming_rpcs.CancelResponse(ok=ok, was_running=was_running)
 
-  @auth.endpoints_method(swarming_rpcs.TaskId, swarming_rpcs.TaskOutput)
+  @auth.endpoints_method(
+      swarming_rpcs.TaskOutputRequest, swarming_rpcs.TaskOutput)
   @auth.require(acl.is_bot_or_user)
   def result_output(self, request):
-    """Reports the output of the task corresponding to a task ID."""
+    """Reports the output of the task corresponding to a task ID.
+
+    When offset or length is specified, only this range of the output is
+    returned along the offset of the data that follows.
+    """
+    offset = request.offset or 0
+    if offset < 0 or (request.length is not None and request.length <= 0):
+      raise endpoints.BadRequestException('Invalid offset or length')
     result = get_result_entity(request.task_id)
-    output = result.get_command_output_async(0).get_result()
+    output = result.get_command_output_async(
+        0, offset, request.length).get_result()
+    next_offset = None
+    if request.offset is not None or request.length is not None:
+      # Do not return a partial character, it will be part of the next range.
+      output = task_result.trim_partial_utf8(output or '')
+      next_offset = offset + len(output)
     if output:
       output = output.decode('utf-8', 'replace')
-    return swarming_rpcs.TaskOutput(output=output)
+    return swarming_rpcs.TaskOutput(
+        output=output or None, next_offset=next_offset)
 
   @auth.endpoints_method(
       swarming_rpcs.TaskRequest, swarming_rpcs.TaskRequestMetadata,
@@ -245,6 +245,26 @@ class TaskApiTest(BaseTest):
           'result_output', message_to_dict(request), 200)
       self.assertEqual(expected, response.json)
 
+  def test_result_output_range(self):
+    """Asserts that result_output reports a range of a task's output."""
+    self.client_create_task()
+    self.set_as_bot()
+    task_id = self.bot_run_task()
+
+    self.set_as_privileged_user()
+    # The partial 'É' is left for the next range.
+    request = swarming_rpcs.TaskOutputRequest(
+        task_id=task_id, offset=0, length=2)
+    response = self.call_api('result_output', message_to_dict(request), 200)
+    self.assertEqual({u'next_offset': u'1', u'output': u'r'}, response.json)
+    request = swarming_rpcs.TaskOutputRequest(task_id=task_id, offset=1)
+    response = self.call_api('result_output', message_to_dict(request), 200)
+    self.assertEqual(
+        {u'next_offset': u'14', u'output': u'Ésult string'}, response.json)
+    request = swarming_rpcs.TaskOutputRequest(task_id=task_id, offset=14)
+    response = self.call_api('result_output', message_to_dict(request), 200)
+    self.assertEqual({u'next_offset': u'14'}, response.json)
+
   def test_result_output_empty(self):
     """Asserts that incipient tasks produce no output."""
     _, task_id = self.client_create_task()
@@ -17,6 +17,7 @@ import re
 import webapp2
 
 from google.appengine import runtime
+from google.appengine.api import datastore_errors
 from google.appengine.api import search
 from google.appengine.api import users
 from google.appengine.datastore import datastore_query
@@ -65,19 +66,29 @@ class RestrictedConfigHandler(auth.AuthenticatingHandler):
       if k not in ('keyid', 'xsrf_token')
     }
     params['bot_death_timeout_secs'] = int(params['bot_death_timeout_secs'])
+    params['bot_long_poll_secs'] = int(params['bot_long_poll_secs'])
     params['reusable_task_age_secs'] = int(params['reusable_task_age_secs'])
+    # Unchecked checkboxes are not sent.
+    params['use_dispatch_index'] = bool(params.get('use_dispatch_index'))
+    params['use_expiration_index'] = bool(params.get('use_expiration_index'))
+    params['use_output_segments'] = bool(params.get('use_output_segments'))
     cfg = config.settings(fresh=True)
     keyid = int(self.request.get('keyid', '0'))
     if cfg.key.integer_id() != keyid:
       self.common('Update conflict %s != %s' % (cfg.key.integer_id(), keyid))
       return
-    cfg.populate(**params)
+    try:
+      cfg.populate(**params)
+    except datastore_errors.BadValueError as e:
+      self.common('Invalid settings: %s' % e)
+      return
     cfg.store()
     self.common('Settings updated')
 
   def common(self, note):
     params = {
       'cfg': config.settings(fresh=True),
+      'max_bot_long_poll_secs': config.MAX_BOT_LONG_POLL_SECS,
       'note': note,
       'path': self.request.path,
       'xsrf_token': self.generate_xsrf_token(),
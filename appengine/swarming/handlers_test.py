@@ -17,8 +17,10 @@ import test_env_handlers
 
 import webtest
 
+from google.appengine.api import memcache
 from google.appengine.ext import deferred
 
+import handlers_backend
 import handlers_frontend
 from components import template
 from server import bot_management
@@ -398,15 +400,33 @@ class FrontendAdminTest(AppTestBase):
     # TODO(maruel): Use beautifulsoup?
     params = {
       'bot_death_timeout_secs': 10*60,
+      'bot_long_poll_secs': 0,
       'google_analytics': 'foobar',
       'keyid': str(config.settings().key.integer_id()),
       'reusable_task_age_secs': 30,
+      'use_dispatch_index': '1',
+      'use_expiration_index': '1',
+      'use_output_segments': '1',
       'xsrf_token': self.get_xsrf_token(),
     }
     self.assertEqual('', config.settings().google_analytics)
     resp = self.app.post('/restricted/config', params)
     self.assertNotIn('Update conflict', resp)
     self.assertEqual('foobar', config.settings().google_analytics)
+    self.assertEqual(True, config.settings().use_dispatch_index)
+    self.assertEqual(True, config.settings().use_expiration_index)
+    self.assertEqual(True, config.settings().use_output_segments)
+
+    # Unchecked checkboxes are not sent.
+    del params['use_dispatch_index']
+    del params['use_expiration_index']
+    del params['use_output_segments']
+    params['keyid'] = str(config.settings().key.integer_id())
+    resp = self.app.post('/restricted/config', params)
+    self.assertNotIn('Update conflict', resp)
+    self.assertEqual(False, config.settings().use_dispatch_index)
+    self.assertEqual(False, config.settings().use_expiration_index)
+    self.assertEqual(False, config.settings().use_output_segments)
     self.assertIn('foobar', self.app.get('/').body)
 
   def test_config_conflict(self):
@@ -415,6 +435,7 @@ class FrontendAdminTest(AppTestBase):
     # TODO(maruel): Use beautifulsoup?
     params = {
       'bot_death_timeout_secs': 10*60,
+      'bot_long_poll_secs': 0,
       'google_analytics': 'foobar',
       'keyid': str(config.settings().key.integer_id() - 1),
       'reusable_task_age_secs': 30,
@@ -425,6 +446,22 @@ class FrontendAdminTest(AppTestBase):
     self.assertIn('Update conflict', resp)
     self.assertEqual('', config.settings().google_analytics)
 
+  def test_config_invalid(self):
+    self.set_as_admin()
+    self.app.get('/restricted/config')
+    params = {
+      'bot_death_timeout_secs': 10*60,
+      'bot_long_poll_secs': config.MAX_BOT_LONG_POLL_SECS + 1,
+      'google_analytics': 'foobar',
+      'keyid': str(config.settings().key.integer_id()),
+      'reusable_task_age_secs': 30,
+      'xsrf_token': self.get_xsrf_token(),
+    }
+    resp = self.app.post('/restricted/config', params)
+    self.assertIn('Invalid settings', resp)
+    self.assertEqual(0, config.settings().bot_long_poll_secs)
+    self.assertEqual('', config.settings().google_analytics)
+
 
 class BackendTest(AppTestBase):
   def _GetRoutes(self):
@@ -454,6 +491,34 @@ class BackendTest(AppTestBase):
     # The actual number doesn't matter, just make sure they are unqueued.
     self.execute_tasks()
 
+  def testFanoutBatchesLease(self):
+    now = [0.]
+    self.mock(handlers_backend.utils, 'time_time', lambda: now[0])
+    def pages(cursor):
+      now[0] += handlers_backend.CRON_QUERY_SECS + 1
+      yield [], cursor
+    def fanout(cursor, resumed):
+      return handlers_backend.fanout_batches(
+          'test', pages(cursor), '/internal/taskqueue/test',
+          '/internal/taskqueue/test/query', None, resumed)
+    def lease():
+      return memcache.get('test', namespace='cron_fanout')
+
+    # The query continues in a task queue task, which keeps the lease.
+    self.assertEqual(0, fanout('cursor', False))
+    self.assertEqual(True, lease())
+    tasks = self._taskqueue_stub.GetTasks('cron-batches')
+    self.assertEqual(
+        ['/internal/taskqueue/test/query'], [t['url'] for t in tasks])
+    self._taskqueue_stub.FlushQueue('cron-batches')
+    # The next cron jobs are skipped.
+    self.assertEqual(None, fanout(None, False))
+    # The continuation completes the query and releases the lease.
+    self.assertEqual(0, fanout(None, True))
+    self.assertEqual(None, lease())
+    self.assertEqual(0, fanout(None, False))
+    self.assertEqual(None, lease())
+
   def testCronTriggerTask(self):
     triggers = (
       '/internal/cron/trigger_cleanup_data',
@@ -473,13 +538,20 @@ class BackendTest(AppTestBase):
       if r != '/internal/taskqueue/mapreduce/launch/<job_id:[^\\/]+>'
     )
     task_queues = [
-      ('cleanup', '/internal/taskqueue/cleanup_data'),
+      ('cron-batches', '/internal/taskqueue/abort_expired_task_to_run',
+        '{"keys": []}'),
+      ('cron-batches', '/internal/taskqueue/abort_expired_task_to_run/query',
+        '{"cursor": null}'),
+      ('cleanup', '/internal/taskqueue/cleanup_data', ''),
+      ('cron-batches', '/internal/taskqueue/handle_bot_died', '{"keys": []}'),
+      ('cron-batches', '/internal/taskqueue/handle_bot_died/query',
+        '{"cursor": null}'),
     ]
     self.assertEqual(sorted(zip(*task_queues)[1]), task_queue_urls)
 
-    for task_name, url in task_queues:
+    for task_name, url, body in task_queues:
       response = self.app.post(
-          url, headers={'X-AppEngine-QueueName': task_name}, status=200)
+          url, body, headers={'X-AppEngine-QueueName': task_name}, status=200)
       self.assertEqual('Success.', response.body)
 
 
@@ -4,11 +4,26 @@
 
 """Instance specific settings."""
 
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 
 from components import config
 
 
+# Upper bound of GlobalConfig.bot_long_poll_secs. A held poll must leave enough
+# of the 60s request deadline to look for a task again once woken up.
+MAX_BOT_LONG_POLL_SECS = 15
+
+
+def _validate_long_poll(prop, value):
+  """Validates GlobalConfig.bot_long_poll_secs."""
+  if not (0 <= value <= MAX_BOT_LONG_POLL_SECS):
+    # pylint: disable=W0212
+    raise datastore_errors.BadValueError(
+        '%s (%ds) must be between 0s and %ds' %
+            (prop._name, value, MAX_BOT_LONG_POLL_SECS))
+
+
 class GlobalConfig(config.GlobalConfig):
   """Application wide settings."""
   # id to inject into pages if applicable.
@@ -21,6 +36,29 @@ class GlobalConfig(config.GlobalConfig):
   # The amount of time that has to pass before a machine is considered dead.
   bot_death_timeout_secs = ndb.IntegerProperty(default=10*60)
 
+  # Query only the queues of the dimensions a bot can satisfy when looking for
+  # a task to dispatch, instead of all the queued tasks. Only enable once the
+  # TaskToRun enqueued before the dimensions_hash property was added have
+  # drained, as they are not part of the per-dimensions queues. Since a task
+  # expires after at most one day, it is one day after the upgrade.
+  use_dispatch_index = ndb.BooleanProperty(indexed=False, default=False)
+
+  # Find the expired tasks through the TaskToRun.queued_expiration_ts index
+  # instead of scanning all the queued tasks. Only enable once the TaskToRun
+  # enqueued before this property was added have drained, i.e. one day after the
+  # upgrade.
+  use_expiration_index = ndb.BooleanProperty(indexed=False, default=False)
+
+  # Store the tasks output as immutable segments written outside of the task
+  # result transaction instead of chunks rewritten on each update. Only affects
+  # the tasks reaped afterward.
+  use_output_segments = ndb.BooleanProperty(indexed=False, default=False)
+
+  # Maximum number of seconds a bot poll is held waiting for a task to be
+  # enqueued before the bot is told to sleep. 0 disables long polling.
+  bot_long_poll_secs = ndb.IntegerProperty(
+      indexed=False, default=0, validator=_validate_long_poll)
+
 
 def settings(fresh=False):
   """Loads GlobalConfig or a default one if not present.
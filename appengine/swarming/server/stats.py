@@ -145,6 +145,11 @@ class _Snapshot(ndb.Model):
   # wil be a useful metric.
   bot_ids_bad = ndb.StringProperty(repeated=True)
 
+  # Keys handed out by the cron jobs fanning out batches and the time spent
+  # querying them.
+  cron_items_enqueued = ndb.IntegerProperty(default=0)
+  cron_fanout_secs = ndb.FloatProperty(default=0)
+
   # Buckets the statistics per dimensions.
   buckets = ndb.LocalStructuredProperty(_SnapshotForDimensions, repeated=True)
   # Per user statistics.
@@ -158,6 +163,12 @@ class _Snapshot(ndb.Model):
   def bots_inactive(self):
     return len(self.bot_ids_bad)
 
+  @property
+  def cron_items_per_sec(self):
+    if self.cron_fanout_secs:
+      return round(self.cron_items_enqueued / self.cron_fanout_secs, 3)
+    return 0.
+
   # Sums.
 
   @property
@@ -285,6 +296,9 @@ class _Snapshot(ndb.Model):
     return {
       'bots_active': self.bots_active,
       'bots_inactive': self.bots_inactive,
+      'cron_fanout_secs': self.cron_fanout_secs,
+      'cron_items_enqueued': self.cron_items_enqueued,
+      'cron_items_per_sec': self.cron_items_per_sec,
       'http_failures': self.http_failures,
       'http_requests': self.http_requests,
       'tasks_active': self.tasks_active,
@@ -308,6 +322,8 @@ _VALID_ACTIONS = frozenset(
   [
     'bot_active',
     'bot_inactive',
+    # A cron job fanned out batches of keys to process.
+    'cron_fanout',
     # run_* relates to a TaskRunResult. It can happen multiple time for a single
     # task, when the task is retried automatically.
     'run_bot_died',
@@ -326,6 +342,8 @@ _KEY_MAPPING = {
   'action': 'a',
   'bot_id': 'bid',
   'dimensions': 'd',
+  'duration_ms': 'dms',
+  'items': 'i',
   'pending_ms': 'pms',
   'run_id': 'rid',
   'runtime_ms': 'rms',
@@ -426,6 +444,12 @@ def _parse_line(line, values, bots_active, bots_inactive, tasks_active):
       bots_inactive[extras.get('bot_id') or 'unknown'] = extras['dimensions']
       return True
 
+    if action == 'cron_fanout':
+      _assert_list(extras, ['duration_ms', 'items'])
+      values.cron_items_enqueued += int(extras['items'])
+      values.cron_fanout_secs += _ms_to_secs(extras['duration_ms'])
+      return True
+
     if action == 'run_bot_died':
       _assert_list(extras, ['bot_id', 'dimensions', 'run_id', 'user'])
       d.tasks_bot_died += 1
@@ -33,6 +33,7 @@ class StatsPrivateTest(test_case.TestCase):
     data = (
       stats._pack_entry(action='bot_active', bot_id='host3', dimensions={}),
       stats._pack_entry(action='bot_inactive', bot_id='failed1', dimensions={}),
+      stats._pack_entry(action='cron_fanout', items=30, duration_ms=1500),
 
       stats._pack_entry(
           action='task_enqueued', task_id='100', dimensions={}, user='me'),
@@ -78,6 +79,9 @@ class StatsPrivateTest(test_case.TestCase):
     expected = {
       'bots_active': 3,
       'bots_inactive': 1,
+      'cron_fanout_secs': 1.5,
+      'cron_items_enqueued': 30,
+      'cron_items_per_sec': 20.0,
       'http_failures': 0,
       'http_requests': 0,
       'tasks_active': 2,
@@ -60,6 +60,11 @@ from server import task_pack
 MAXIMUM_PRIORITY = 255
 
 
+# Maximum number of shards that can be triggered at once with
+# make_request_shards().
+MAXIMUM_SHARDS = 1000
+
+
 # One day in seconds. Add 10s to account for small jitter.
 _ONE_DAY_SECS = 24*60*60 + 10
 
@@ -93,6 +98,9 @@ _REQUIRED_PROPERTIES_KEYS = frozenset(
 _EXPECTED_PROPERTIES_KEYS = frozenset(
     ['commands', 'data', 'dimensions', 'env', 'execution_timeout_secs',
     'grace_period_secs', 'idempotent', 'io_timeout_secs'])
+# The content of each item of the 'shards' parameter of make_request_shards().
+_REQUIRED_SHARD_KEYS = frozenset(['name'])
+_EXPECTED_SHARD_KEYS = frozenset(['env', 'name'])
 
 
 ### Properties validators must come before the models.
@@ -357,6 +365,23 @@ def _new_request_key():
   return request_id_to_key(int(request_id_base | (suffix << 4) | 0x1))
 
 
+def _new_request_keys(count):
+  """Returns |count| distinct valid ndb.Key for this entity, allocated at once.
+
+  The keys share the same timestamp and have consecutive values for the 16 bits
+  suffix, starting at a random value. See _new_request_key() for details.
+  """
+  assert 0 < count <= 1 << 16, count
+  request_id_base = datetime_to_request_base_id(utils.utcnow())
+  # TODO(maruel): Use real randomness.
+  start = random.getrandbits(16)
+  return [
+    request_id_to_key(
+        int(request_id_base | (((start + i) & 0xFFFF) << 4) | 0x1))
+    for i in xrange(count)
+  ]
+
+
 def _put_request(request):
   """Puts the new TaskRequest in the DB.
 
@@ -369,6 +394,46 @@ def _put_request(request):
   return datastore_utils.insert(request, _new_request_key)
 
 
+@ndb.tasklet
+def _insert_request_async(request):
+  """Asynchronous version of datastore_utils.insert() for a TaskRequest.
+
+  request.key must already be set. A new key is selected if it is already used.
+  """
+  def run():
+    if request.key.get():
+      return False
+    request.put()
+    return True
+
+  while True:
+    try:
+      if (yield datastore_utils.transaction_async(run, retries=0)):
+        break
+    except datastore_utils.CommitError:
+      # Retry with the same key.
+      continue
+    request.key = _new_request_key()
+  raise ndb.Return(request.key)
+
+
+def _put_requests(requests):
+  """Puts new TaskRequest in the DB, concurrently.
+
+  The keys are allocated in bulk and there is one transaction per TaskRequest,
+  as each is its own entity group. All the transactions are in flight at the
+  same time.
+  """
+  for request, key in zip(requests, _new_request_keys(len(requests))):
+    assert not request.key
+    request.key = key
+  futures = [_insert_request_async(r) for r in requests]
+  ndb.Future.wait_all(futures)
+  # Surface exceptions, if any.
+  for future in futures:
+    future.get_result()
+
+
 def _assert_keys(expected_keys, minimum_keys, actual_keys, name):
   """Raise an exception if expected keys are not present."""
   actual_keys = frozenset(actual_keys)
@@ -385,6 +450,65 @@ def _assert_keys(expected_keys, minimum_keys, actual_keys, name):
     raise ValueError(message)
 
 
+def _new_request(data):
+  """Constructs a TaskRequest out of a yet-to-be-specified API.
+
+  The TaskRequest is not saved. See make_request() for the format of data.
+  """
+  # Save ourself headaches with typos and refuses unexpected values.
+  _assert_keys(_EXPECTED_DATA_KEYS, _REQUIRED_DATA_KEYS, data, 'request keys')
+  data_properties = data['properties']
+  _assert_keys(
+      _EXPECTED_PROPERTIES_KEYS, _REQUIRED_PROPERTIES_KEYS, data_properties,
+      'request properties keys')
+
+  parent_task_id = data.get('parent_task_id') or None
+  if parent_task_id:
+    data = data.copy()
+    run_result_key = task_pack.unpack_run_result_key(parent_task_id)
+    result_summary_key = task_pack.run_result_key_to_result_summary_key(
+        run_result_key)
+    request_key = task_pack.result_summary_key_to_request_key(
+        result_summary_key)
+    parent = request_key.get()
+    if not parent:
+      raise ValueError('parent_task_id is not a valid task')
+    data['priority'] = max(min(data['priority'], parent.priority - 1), 0)
+    # Drop the previous user.
+    data['user'] = parent.user
+
+  # Can't be a validator yet as we wouldn't be able to load previous task
+  # requests.
+  if len(data_properties.get('commands') or []) > 1:
+    raise datastore_errors.BadValueError('Only one command is supported')
+
+  # Class TaskProperties takes care of making everything deterministic.
+  properties = TaskProperties(
+      commands=data_properties['commands'],
+      data=data_properties['data'],
+      dimensions=data_properties['dimensions'],
+      env=data_properties['env'],
+      execution_timeout_secs=data_properties['execution_timeout_secs'],
+      grace_period_secs=data_properties.get('grace_period_secs', 30),
+      idempotent=data_properties.get('idempotent', False),
+      io_timeout_secs=data_properties['io_timeout_secs'])
+
+  now = utils.utcnow()
+  expiration_ts = now + datetime.timedelta(
+      seconds=data['scheduling_expiration_secs'])
+
+  return TaskRequest(
+      authenticated=auth.get_current_identity(),
+      created_ts=now,
+      expiration_ts=expiration_ts,
+      name=data['name'],
+      parent_task_id=parent_task_id,
+      priority=data['priority'],
+      properties=properties,
+      tags=data['tags'],
+      user=data['user'] or '')
+
+
 ### Public API.
 
 
@@ -481,60 +605,46 @@ def make_request(data):
   Returns:
     The newly created TaskRequest.
   """
-  # Save ourself headaches with typos and refuses unexpected values.
-  _assert_keys(_EXPECTED_DATA_KEYS, _REQUIRED_DATA_KEYS, data, 'request keys')
-  data_properties = data['properties']
-  _assert_keys(
-      _EXPECTED_PROPERTIES_KEYS, _REQUIRED_PROPERTIES_KEYS, data_properties,
-      'request properties keys')
+  request = _new_request(data)
+  _put_request(request)
+  return request
 
-  parent_task_id = data.get('parent_task_id') or None
-  if parent_task_id:
-    data = data.copy()
-    run_result_key = task_pack.unpack_run_result_key(parent_task_id)
-    result_summary_key = task_pack.run_result_key_to_result_summary_key(
-        run_result_key)
-    request_key = task_pack.result_summary_key_to_request_key(
-        result_summary_key)
-    parent = request_key.get()
-    if not parent:
-      raise ValueError('parent_task_id is not a valid task')
-    data['priority'] = max(min(data['priority'], parent.priority - 1), 0)
-    # Drop the previous user.
-    data['user'] = parent.user
 
-  # Can't be a validator yet as we wouldn't be able to load previous task
-  # requests.
-  if len(data_properties.get('commands') or []) > 1:
-    raise datastore_errors.BadValueError('Only one command is supported')
+def make_request_shards(data, shards):
+  """Constructs and stores one TaskRequest per shard of a sharded task.
 
-  # Class TaskProperties takes care of making everything deterministic.
-  properties = TaskProperties(
-      commands=data_properties['commands'],
-      data=data_properties['data'],
-      dimensions=data_properties['dimensions'],
-      env=data_properties['env'],
-      execution_timeout_secs=data_properties['execution_timeout_secs'],
-      grace_period_secs=data_properties.get('grace_period_secs', 30),
-      idempotent=data_properties.get('idempotent', False),
-      io_timeout_secs=data_properties['io_timeout_secs'])
+  Argument:
+  - data: dict as for make_request(), common to all the shards.
+  - shards: list of dict with the values specific to each shard:
+    - name
+    - env*: updates properties.env.
 
-  now = utils.utcnow()
-  expiration_ts = now + datetime.timedelta(
-      seconds=data['scheduling_expiration_secs'])
+  * are optional.
 
-  request = TaskRequest(
-      authenticated=auth.get_current_identity(),
-      created_ts=now,
-      expiration_ts=expiration_ts,
-      name=data['name'],
-      parent_task_id=parent_task_id,
-      priority=data['priority'],
-      properties=properties,
-      tags=data['tags'],
-      user=data['user'] or '')
-  _put_request(request)
-  return request
+  The keys are allocated in bulk and the TaskRequest are stored concurrently,
+  so the latency is mostly independent of the number of shards.
+
+  Returns:
+    list of the newly created TaskRequest, in the same order as shards.
+  """
+  if not shards or len(shards) > MAXIMUM_SHARDS:
+    raise ValueError(
+        'shards (%d) must be between 1 and %d' % (
+          len(shards or []), MAXIMUM_SHARDS))
+  requests = []
+  for shard in shards:
+    _assert_keys(
+        _EXPECTED_SHARD_KEYS, _REQUIRED_SHARD_KEYS, shard, 'shard keys')
+    shard_data = data.copy()
+    shard_data['name'] = shard['name']
+    if shard.get('env'):
+      shard_data['properties'] = (data.get('properties') or {}).copy()
+      env = (shard_data['properties'].get('env') or {}).copy()
+      env.update(shard['env'])
+      shard_data['properties']['env'] = env
+    requests.append(_new_request(shard_data))
+  _put_requests(requests)
+  return requests
 
 
 def make_request_clone(original_request):
@@ -120,6 +120,39 @@ class TaskRequestPrivateTest(TestCase):
     #               rand
     self.assertEqual('0x7ffffffffff77661', '0x%016x' % key_id)
 
+  def test_new_request_keys(self):
+    self.mock(random, 'getrandbits', lambda _: 0xfffe)
+    self.mock_now(task_request._BEGINING_OF_THE_WORLD)
+    keys = task_request._new_request_keys(3)
+    # Remove the XOR. The suffix wraps around.
+    actual = [
+      '0x%016x' % (k.integer_id() ^ task_pack.TASK_REQUEST_KEY_ID_MASK)
+      for k in keys
+    ]
+    expected = [
+      '0x00000000000fffe1', '0x00000000000ffff1', '0x0000000000000001',
+    ]
+    self.assertEqual(expected, actual)
+
+  def test_put_requests_collision(self):
+    self.mock(random, 'getrandbits', lambda _: 0x88)
+    self.mock_now(datetime.datetime(2010, 1, 2, 3, 4, 5))
+    existing = task_request.make_request(_gen_request_data())
+    requests = [
+      task_request._new_request(_gen_request_data(name='Shard %d' % i))
+      for i in xrange(2)
+    ]
+    # The first key is already used, the next one is selected with
+    # _new_request_key().
+    keys = iter([ndb.Key(task_request.TaskRequest, 1)])
+    self.mock(task_request, '_new_request_key', lambda: next(keys))
+    task_request._put_requests(requests)
+    self.assertNotEqual(existing.key, requests[0].key)
+    self.assertEqual(ndb.Key(task_request.TaskRequest, 1), requests[0].key)
+    self.assertEqual(u'Request name', existing.key.get().name)
+    self.assertEqual(
+        [u'Shard 0', u'Shard 1'], [r.key.get().name for r in requests])
+
   def test_validate_task_run_id(self):
     class P(object):
       _name = 'foo'
@@ -219,6 +252,40 @@ class TaskRequestApiTest(TestCase):
     with self.assertRaises(ValueError):
       task_request.make_request(data)
 
+  def test_make_request_shards(self):
+    data = _gen_request_data()
+    shards = [
+      {'env': {u'GTEST_SHARD_INDEX': unicode(i), u'GTEST_TOTAL_SHARDS': u'3'},
+       'name': 'Request name:%d:3' % i}
+      for i in xrange(3)
+    ]
+    requests = task_request.make_request_shards(data, shards)
+    self.assertEqual(3, len(set(r.key for r in requests)))
+    for i, request in enumerate(requests):
+      self.assertEqual(request, request.key.get())
+      self.assertEqual('Request name:%d:3' % i, request.name)
+      expected_env = {
+        u'GTEST_SHARD_INDEX': unicode(i),
+        u'GTEST_TOTAL_SHARDS': u'3',
+        u'foo': u'bar',
+        u'joe': u'2',
+      }
+      self.assertEqual(expected_env, request.properties.env)
+    # The common data is not modified.
+    self.assertEqual({u'foo': u'bar', u'joe': u'2'}, data['properties']['env'])
+
+  def test_make_request_shards_invalid(self):
+    with self.assertRaises(ValueError):
+      task_request.make_request_shards(_gen_request_data(), [])
+    with self.assertRaises(ValueError):
+      task_request.make_request_shards(
+          _gen_request_data(), [{'name': 'a', 'foo': 'bar'}])
+    with self.assertRaises(ValueError):
+      task_request.make_request_shards(
+          _gen_request_data(),
+          [{'name': 'a'}] * (task_request.MAXIMUM_SHARDS + 1))
+    self.assertEqual([], task_request.TaskRequest.query().fetch())
+
   def test_make_request_idempotent(self):
     request = task_request.make_request(
         _gen_request_data(properties=dict(idempotent=True)))
@@ -13,7 +13,8 @@ store tasks results.
   be multiple tries for one job, for example if a bot dies.
 - The stdout of each command in TaskResult.properties.commands is saved inside
   TaskOutput.
-- It is chunked in TaskOutputChunk to fit the entity size limit.
+- It is chunked in TaskOutputChunk to fit the entity size limit, or stored as
+  immutable TaskOutputSegment when TaskRunResult.stdout_segmented is set.
 
 Graph of schema:
 
@@ -50,6 +51,11 @@ Graph of schema:
     |TaskOutputChunk|  |TaskOutputChunk| ...
     |id=1           |  |id=2           |
     +---------------+  +---------------+
+            or
+    +-----------------+  +-----------------+
+    |TaskOutputSegment|  |TaskOutputSegment| ...
+    |id=<offset+1>    |  |id=<offset+1>    |
+    +-----------------+  +-----------------+
 """
 
 import datetime
@@ -61,6 +67,7 @@ from google.appengine.datastore import datastore_query
 from google.appengine.ext import ndb
 
 from components import utils
+from server import config
 from server import task_pack
 from server import task_request
 
@@ -69,6 +76,10 @@ from server import task_request
 BOT_PING_TOLERANCE = datetime.timedelta(seconds=5*60)
 
 
+# Number of keys fetched per page when looking for the tasks with a dead bot.
+DEAD_BOT_PAGE_SIZE = 100
+
+
 class State(object):
   """States in which a task can be.
 
@@ -177,13 +188,23 @@ class TaskOutput(ndb.Model):
 
   @classmethod
   @ndb.tasklet
-  def get_output_async(cls, output_key, number_chunks):
-    """Returns the stdout for a single command as a ndb.Future."""
+  def get_output_async(
+      cls, output_key, number_chunks, segmented=False, offset=0, length=None):
+    """Returns the stdout for a single command as a ndb.Future.
+
+    Only the chunks overlapping the range [offset, offset+length) are fetched.
+    length is capped to FETCH_MAX_CONTENT.
+    """
     # TODO(maruel): Save number_chunks locally in this entity.
     if not number_chunks:
       raise ndb.Return(None)
+    length = min(length or cls.FETCH_MAX_CONTENT, cls.FETCH_MAX_CONTENT)
+    if segmented:
+      out = yield _get_output_segments_async(output_key, offset, length)
+      raise ndb.Return(out)
 
-    number_chunks = min(number_chunks, cls.FETCH_MAX_CHUNKS)
+    first_chunk = offset / cls.CHUNK_SIZE
+    end_chunk = min(number_chunks, (offset + length - 1) / cls.CHUNK_SIZE + 1)
 
     # TODO(maruel): Always get one more than necessary, in case number_chunks
     # is invalid. If there's an unexpected TaskOutputChunk entity present,
@@ -191,7 +212,7 @@ class TaskOutput(ndb.Model):
     parts = []
     for f in ndb.get_multi_async(
         _output_key_to_output_chunk_key(output_key, i)
-        for i in xrange(number_chunks)):
+        for i in xrange(first_chunk, end_chunk)):
       chunk = yield f
       parts.append(chunk.chunk if chunk else None)
 
@@ -200,11 +221,11 @@ class TaskOutput(ndb.Model):
       parts.pop()
 
     # parts is now guaranteed to not end with an empty chunk.
-    # Replace any missing chunk.
-    for i in xrange(len(parts)):
-      if not parts[i]:
-        parts[i] = '\x00' * cls.CHUNK_SIZE
-    raise ndb.Return(''.join(parts))
+    # Replace any missing chunk and fill incomplete ones.
+    for i in xrange(len(parts) - 1):
+      parts[i] = (parts[i] or '').ljust(cls.CHUNK_SIZE, '\x00')
+    start = offset - first_chunk * cls.CHUNK_SIZE
+    raise ndb.Return(''.join(parts)[start:start+length])
 
 
 class TaskOutputChunk(ndb.Model):
@@ -227,6 +248,24 @@ class TaskOutputChunk(ndb.Model):
     return self.key.integer_id() - 1
 
 
+class TaskOutputSegment(ndb.Model):
+  """Represents an immutable part of a command output.
+
+  Parent is TaskOutput. Key id is the offset of the segment in the output + 1,
+  since 0 is not a valid id.
+
+  Unlike TaskOutputChunk, it is never read back before being written so it is
+  saved outside of the transaction updating the task results. Writing the same
+  data again is idempotent. Missing ranges between segments are the gaps and
+  are read as zeros.
+  """
+  segment = ndb.BlobProperty(compressed=True)
+
+  @property
+  def offset(self):
+    return self.key.integer_id() - 1
+
+
 class _TaskResultCommon(ndb.Model):
   """Contains properties that is common to both TaskRunResult and
   TaskResultSummary.
@@ -258,9 +297,13 @@ class _TaskResultCommon(ndb.Model):
 
   # Number of TaskOutputChunk entities for each output for each command. Set to
   # 0 when no output has been collected for a specific index. Ordered by
-  # command.
+  # command. When stdout_segmented is set, it is the number of CHUNK_SIZE ranges
+  # covered by the TaskOutputSegment entities instead.
   stdout_chunks = ndb.IntegerProperty(repeated=True, indexed=False)
 
+  # The output is stored as TaskOutputSegment instead of TaskOutputChunk.
+  stdout_segmented = ndb.BooleanProperty(default=False, indexed=False)
+
   # Aggregated exit codes. Ordered by command.
   exit_codes = ndb.IntegerProperty(repeated=True, indexed=False)
 
@@ -369,8 +412,9 @@ class _TaskResultCommon(ndb.Model):
 
   def to_dict(self):
     out = super(_TaskResultCommon, self).to_dict()
-    # stdout_chunks is an implementation detail.
+    # stdout_chunks and stdout_segmented are implementation details.
     out.pop('stdout_chunks')
+    out.pop('stdout_segmented')
     out['id'] = self.key_packed
     return out
 
@@ -394,11 +438,12 @@ class _TaskResultCommon(ndb.Model):
     return (future.get_result() for future in futures)
 
   @ndb.tasklet
-  def get_command_output_async(self, command_index):
+  def get_command_output_async(self, command_index, offset=0, length=None):
     """Returns the stdout for a single command as a ndb.Future.
 
     Use out.get_result() to get the data as a str or None if no output is
-    present.
+    present. offset and length select a range of the output, see
+    TaskOutput.get_output_async().
     """
     assert isinstance(command_index, int), command_index
     if (not self.run_result_key or
@@ -412,7 +457,8 @@ class _TaskResultCommon(ndb.Model):
 
     output_key = _run_result_key_to_output_key(
         self.run_result_key, command_index)
-    out = yield TaskOutput.get_output_async(output_key, number_chunks)
+    out = yield TaskOutput.get_output_async(
+        output_key, number_chunks, self.stdout_segmented, offset, length)
     raise ndb.Return(out)
 
   def _pre_put_hook(self):
@@ -503,13 +549,17 @@ class TaskRunResult(_TaskResultCommon):
   def append_output(self, command_index, output, output_chunk_start):
     """Appends output to the stdout of the command.
 
-    Returns the entities to save.
+    Returns the entities to save. When stdout_segmented is set, they are
+    TaskOutputSegment and do not need to be saved in the same transaction as
+    this entity.
     """
     while len(self.stdout_chunks) <= command_index:
       # The reason for this to be a loop is that items could be handled out of
       # order.
       self.stdout_chunks.append(0)
-    entities, self.stdout_chunks[command_index] = _output_append(
+    append = (
+        _output_append_segments if self.stdout_segmented else _output_append)
+    entities, self.stdout_chunks[command_index] = append(
         _run_result_key_to_output_key(self.key, command_index),
         self.stdout_chunks[command_index],
         output,
@@ -804,6 +854,72 @@ def _output_append(output_key, number_chunks, output, output_chunk_start):
   return entities, number_chunks
 
 
+def _output_append_segments(
+    output_key, number_chunks, output, output_chunk_start):
+  """Appends output to a TaskOutput as TaskOutputSegment entities.
+
+  Same as _output_append() except that it does no DB operation and the cost is
+  linear to the size of |output|, independently of the data already saved.
+
+  Returns:
+    A tuple of (list of entities to save, number_chunks). The number_chunks is
+    the number of TaskOutput.CHUNK_SIZE ranges covered by the output.
+  """
+  assert output and isinstance(output, str), output
+  assert output_key.kind() == 'TaskOutput', output_key
+
+  entities = []
+  offset = 0
+  while offset < len(output):
+    start = output_chunk_start + offset
+    if start >= TaskOutput.PUT_MAX_CONTENT:
+      # TODO(maruel): Log into TaskOutput that data was dropped.
+      logging.error(
+          'Dropping output\n%d bytes were lost', len(output) - offset)
+      break
+    # Segments are cut at CHUNK_SIZE boundaries to stay well below the entity
+    # size limit.
+    size = min(
+        TaskOutput.CHUNK_SIZE - start % TaskOutput.CHUNK_SIZE,
+        TaskOutput.PUT_MAX_CONTENT - start)
+    segment = output[offset:offset+size]
+    entities.append(
+        TaskOutputSegment(
+            key=ndb.Key(TaskOutputSegment, start + 1, parent=output_key),
+            segment=segment))
+    offset += len(segment)
+    number_chunks = max(
+        number_chunks,
+        (start + len(segment) - 1) / TaskOutput.CHUNK_SIZE + 1)
+  return entities, number_chunks
+
+
+@ndb.tasklet
+def _get_output_segments_async(output_key, offset, length):
+  """Returns the range [offset, offset+length) of the output stored as
+  TaskOutputSegment.
+
+  Gaps are filled with zeros. Overlapping segments are applied in offset order.
+  """
+  # Segments never cross a CHUNK_SIZE boundary, so the ones overlapping offset
+  # start at or after this.
+  base = offset - offset % TaskOutput.CHUNK_SIZE
+  min_key = ndb.Key(TaskOutputSegment, base + 1, parent=output_key)
+  max_key = ndb.Key(TaskOutputSegment, offset + length + 1, parent=output_key)
+  q = TaskOutputSegment.query(ancestor=output_key).filter(
+      TaskOutputSegment.key >= min_key).filter(
+          TaskOutputSegment.key < max_key).order(TaskOutputSegment.key)
+  segments = yield q.fetch_async()
+  out = bytearray()
+  for segment in segments:
+    start = segment.offset - base
+    if len(out) < start:
+      out.extend('\x00' * (start - len(out)))
+    out[start:start+len(segment.segment)] = segment.segment
+  start = offset - base
+  raise ndb.Return(str(out[start:start+length]) or None)
+
+
 def _sort_property(sort):
   """Returns a datastore_query.PropertyOrder based on 'sort'."""
   if sort == 'created_ts':
@@ -816,6 +932,25 @@ def _sort_property(sort):
 ### Public API.
 
 
+def trim_partial_utf8(data):
+  """Returns data without a trailing incomplete UTF-8 sequence.
+
+  Used to cut a range of the output so it can be decoded without mangling a
+  character whose remaining bytes will be part of the next range.
+  """
+  for i in xrange(1, min(4, len(data)) + 1):
+    c = ord(data[-i])
+    if c & 0xC0 == 0x80:
+      # Continuation byte, look further back for the leading byte.
+      continue
+    if c >= 0xC0:
+      expected = 2 if c < 0xE0 else 3 if c < 0xF0 else 4
+      if expected > i:
+        return data[:-i]
+    break
+  return data
+
+
 def state_to_string(state_obj):
   """Returns a user-readable string representing a State."""
   if state_obj.deduped_from:
@@ -853,18 +988,30 @@ def new_run_result(request, try_number, bot_id, bot_version):
       bot_id=bot_id,
       started_ts=utils.utcnow(),
       bot_version=bot_version,
-      server_versions=[utils.get_app_version()])
+      server_versions=[utils.get_app_version()],
+      stdout_segmented=config.settings().use_output_segments)
 
 
-def yield_run_result_keys_with_dead_bot():
-  """Yields all the TaskRunResult ndb.Key where the bot died recently.
+def yield_run_result_keys_with_dead_bot(cursor=None):
+  """Yields pages of the TaskRunResult ndb.Key where the bot died recently.
+
+  Arguments:
+    cursor: urlsafe cursor to resume a previous query from, if any.
 
-  In practice it is returning a ndb.QueryIterator but this is equivalent.
+  Yields:
+    tuple(list of TaskRunResult ndb.Key, urlsafe cursor after this page or None
+    if it is the last one).
   """
   # If a bot didn't ping recently, it is considered dead.
   deadline = utils.utcnow() - BOT_PING_TOLERANCE
   q = TaskRunResult.query().filter(TaskRunResult.modified_ts < deadline)
-  return q.filter(TaskRunResult.state == State.RUNNING).iter(keys_only=True)
+  q = q.filter(TaskRunResult.state == State.RUNNING)
+  cursor = datastore_query.Cursor(urlsafe=cursor) if cursor else None
+  more = True
+  while more:
+    keys, cursor, more = q.fetch_page(
+        DEAD_BOT_PAGE_SIZE, start_cursor=cursor, keys_only=True)
+    yield keys, (cursor.urlsafe() if more and cursor else None)
 
 
 def get_tasks(task_name, task_tags, cursor_str, limit, sort, state):
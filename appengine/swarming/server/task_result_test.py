@@ -22,6 +22,7 @@ from components import auth_testing
 from components import utils
 from test_support import test_case
 
+from server import config
 from server import task_pack
 from server import task_request
 from server import task_result
@@ -112,6 +113,16 @@ class TaskResultApiTest(TestCase):
         task_result.State.STATES_RUNNING + task_result.State.STATES_NOT_RUNNING,
         task_result.State.STATES)
 
+  def test_trim_partial_utf8(self):
+    data = 'a\xc3\x89\xe2\x82\xac\xf0\x9d\x84\x9e'
+    self.assertEqual(10, len(data))
+    # Map of the length of the prefix to the length of the trimmed prefix.
+    expected = [0, 1, 1, 3, 3, 3, 6, 6, 6, 6, 10]
+    actual = [
+      len(task_result.trim_partial_utf8(data[:i])) for i in xrange(len(data)+1)
+    ]
+    self.assertEqual(expected, actual)
+
   def test_state_to_string(self):
     # Same code as State.to_string() except that it works for
     # TaskResultSummary too.
@@ -339,11 +350,11 @@ class TaskResultApiTest(TestCase):
 
     self.mock_now(self.now + task_result.BOT_PING_TOLERANCE)
     self.assertEqual(
-        [], list(task_result.yield_run_result_keys_with_dead_bot()))
+        [([], None)], list(task_result.yield_run_result_keys_with_dead_bot()))
 
     self.mock_now(self.now + task_result.BOT_PING_TOLERANCE, 1)
     self.assertEqual(
-        [run_result.key],
+        [([run_result.key], None)],
         list(task_result.yield_run_result_keys_with_dead_bot()))
 
   def test_set_from_run_result(self):
@@ -494,6 +505,24 @@ class TestOutput(TestCase):
     self.assertEqual(
         None, self.run_result.get_command_output_async(2).get_result())
 
+  def test_append_output_range(self):
+    ndb.put_multi(self.run_result.append_output(0, 'FooBar', 0))
+    ndb.put_multi(self.run_result.append_output(
+        0, 'Baz', task_result.TaskOutput.CHUNK_SIZE))
+    self.assertEqual(
+        'oBa', self.run_result.get_command_output_async(0, 2, 3).get_result())
+    self.assertEqual(
+        'r' + '\x00' * (task_result.TaskOutput.CHUNK_SIZE - 6) + 'Baz',
+        self.run_result.get_command_output_async(0, 5).get_result())
+    self.assertEqual(
+        'az',
+        self.run_result.get_command_output_async(
+            0, task_result.TaskOutput.CHUNK_SIZE + 1).get_result())
+    self.assertEqual(
+        '',
+        self.run_result.get_command_output_async(
+            0, task_result.TaskOutput.CHUNK_SIZE * 3).get_result())
+
   def test_append_output_large(self):
     self.mock(logging, 'error', lambda *_: None)
     one_mb = '<3Google' * (1024*1024/8)
@@ -622,6 +651,103 @@ class TestOutput(TestCase):
         [{'chunk': 'Baz\x00Bar\x00FooWow', 'gaps': [3, 4, 7, 8]}])
 
 
+
+class TestOutputSegments(TestCase):
+  APP_DIR = test_env.APP_DIR
+
+  def setUp(self):
+    super(TestOutputSegments, self).setUp()
+    self.mock(
+        config, 'settings',
+        lambda: config.GlobalConfig(use_output_segments=True))
+    request = task_request.make_request(_gen_request_data())
+    self.run_result = task_result.new_run_result(request, 1, 'localhost', 'abc')
+    self.run_result.modified_ts = utils.utcnow()
+    self.assertEqual(True, self.run_result.stdout_segmented)
+    ndb.transaction(self.run_result.put)
+    self.run_result = self.run_result.key.get()
+
+  def append(self, *args):
+    entities = self.run_result.append_output(*args)
+    ndb.put_multi(entities)
+    return entities
+
+  def get_output(self, command_index=0):
+    return self.run_result.get_command_output_async(command_index).get_result()
+
+  def get_output_range(self, offset, length=None):
+    return self.run_result.get_command_output_async(
+        0, offset, length).get_result()
+
+  def test_append_output(self):
+    self.assertEqual(1, len(self.append(0, 'Part1\n', 0)))
+    self.append(1, 'Part2\n', 0)
+    self.append(1, 'Part3\n', len('Part2\n'))
+    self.assertEqual([1, 1], self.run_result.stdout_chunks)
+    self.assertEqual(
+        ['Part1\n', 'Part2\nPart3\n'], list(self.run_result.get_outputs()))
+    self.assertEqual(None, self.get_output(2))
+    # No TaskOutputChunk was used.
+    self.assertEqual(0, task_result.TaskOutputChunk.query().count())
+
+  def test_append_output_split(self):
+    # Segments are cut at CHUNK_SIZE boundaries.
+    entities = self.append(0, 'FooBar', task_result.TaskOutput.CHUNK_SIZE - 3)
+    self.assertEqual(
+        [task_result.TaskOutput.CHUNK_SIZE - 3,
+          task_result.TaskOutput.CHUNK_SIZE],
+        [e.offset for e in entities])
+    self.assertEqual([2], self.run_result.stdout_chunks)
+    self.assertEqual(
+        '\x00' * (task_result.TaskOutput.CHUNK_SIZE - 3) + 'FooBar',
+        self.get_output())
+
+  def test_append_output_gaps(self):
+    # Write the data in reverse order in multiple calls, leaving gaps.
+    self.append(0, 'Wow', 11)
+    self.append(0, 'Foo', 8)
+    self.append(0, 'Baz', 0)
+    self.append(0, 'Bar', 4)
+    self.assertEqual('Baz\x00Bar\x00FooWow', self.get_output())
+
+  def test_append_output_overwrite(self):
+    self.append(0, 'FooBar', 0)
+    self.append(0, 'X', 3)
+    self.assertEqual('FooXar', self.get_output())
+    # Resending the same data is idempotent.
+    self.append(0, 'FooBar', 0)
+    self.assertEqual('FooXar', self.get_output())
+
+  def test_append_output_range(self):
+    self.append(0, 'FooBar', 0)
+    self.append(0, 'Baz', task_result.TaskOutput.CHUNK_SIZE)
+    self.assertEqual('oBa', self.get_output_range(2, 3))
+    self.assertEqual(
+        'r' + '\x00' * (task_result.TaskOutput.CHUNK_SIZE - 6) + 'Baz',
+        self.get_output_range(5))
+    self.assertEqual(
+        'az', self.get_output_range(task_result.TaskOutput.CHUNK_SIZE + 1))
+    self.assertEqual(
+        None, self.get_output_range(task_result.TaskOutput.CHUNK_SIZE * 3))
+
+  def test_append_output_max(self):
+    self.mock(
+        task_result.TaskOutput, 'PUT_MAX_CONTENT',
+        task_result.TaskOutput.CHUNK_SIZE * 2)
+    self.mock(
+        task_result.TaskOutput, 'FETCH_MAX_CONTENT',
+        task_result.TaskOutput.CHUNK_SIZE)
+    calls = []
+    self.mock(logging, 'error', lambda *args: calls.append(args))
+    data = 'x' * (task_result.TaskOutput.CHUNK_SIZE * 2 + 1)
+    self.assertEqual(2, len(self.append(0, data, 0)))
+    self.assertEqual(1, len(calls))
+    self.assertEqual(1, calls[0][1])
+    self.assertEqual([2], self.run_result.stdout_chunks)
+    self.assertEqual(
+        task_result.TaskOutput.CHUNK_SIZE, len(self.get_output()))
+
+
 if __name__ == '__main__':
   if '-v' in sys.argv:
     unittest.TestCase.maxDiff = None
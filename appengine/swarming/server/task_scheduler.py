@@ -9,6 +9,7 @@ This is the interface closest to the HTTP handlers.
 
 import contextlib
 import datetime
+import functools
 import logging
 import math
 import random
@@ -42,16 +43,13 @@ def _secs_to_ms(value):
 def _expire_task(to_run_key, request):
   """Expires a TaskResultSummary and unschedules the TaskToRun.
 
+  The caller is expected to have checked that the TaskToRun is reapable once
+  before. This reduces the likelihood of failing this check inside the
+  transaction, which is an order of magnitude more costly.
+
   Returns:
     True on success.
   """
-  # Look if the TaskToRun is reapable once before doing the check inside the
-  # transaction. This reduces the likelihood of failing this check inside the
-  # transaction, which is an order of magnitude more costly.
-  if not to_run_key.get().is_reapable:
-    logging.info('Not reapable anymore')
-    return None
-
   result_summary_key = task_pack.request_key_to_result_summary_key(request.key)
   now = utils.utcnow()
 
@@ -156,7 +154,20 @@ def _update_stats(run_result, bot_id, request, completed):
         dimensions=request.properties.dimensions)
 
 
-def _handle_dead_bot(run_result_key):
+def _can_append_segments(run_result, result_summary):
+  """Returns True if TaskOutputSegment can be saved for this TaskRunResult.
+
+  Only the try currently running accepts output, so a bot still sending output
+  after its task was killed, timed out or retried doesn't leave segments behind.
+  """
+  if run_result.state != task_result.State.RUNNING:
+    return False
+  return not (
+      result_summary and result_summary.try_number and
+      result_summary.try_number > run_result.try_number)
+
+
+def _handle_dead_bot(run_result_key, request):
   """Handles TaskRunResult where its bot has stopped showing sign of life.
 
   Transactionally updates the entities depending on the state of this task. The
@@ -168,12 +179,9 @@ def _handle_dead_bot(run_result_key):
   """
   result_summary_key = task_pack.run_result_key_to_result_summary_key(
       run_result_key)
-  request_key = task_pack.result_summary_key_to_request_key(result_summary_key)
-  request_future = request_key.get_async()
   now = utils.utcnow()
   server_version = utils.get_app_version()
   packed = task_pack.pack_run_result_key(run_result_key)
-  request = request_future.get_result()
   to_run_key = task_to_run.request_to_task_to_run_key(request)
 
   def run():
@@ -232,6 +240,7 @@ def _handle_dead_bot(run_result_key):
           dimensions=request.properties.dimensions,
           user=request.user)
     else:
+      task_to_run.notify_task_to_run(to_run_key)
       logging.info('Retried %s', packed)
   else:
     logging.info('Ignored %s', packed)
@@ -283,29 +292,50 @@ def schedule_request(request):
   Returns:
     TaskResultSummary. TaskToRun is not returned.
   """
-  dupe_future = None
-  if request.properties.idempotent:
-    # Find a previously run task that is also idempotent and completed. Start a
-    # query to fetch items that can be used to dedupe the task. See the comment
-    # for this property for more details.
-    #
-    # Do not use "cls.created_ts > oldest" here because this would require a
-    # composite index. It's unnecessary because TaskRequest.key is mostly
-    # equivalent to decreasing TaskRequest.created_ts, ordering by key works as
-    # well and doesn't require a composite index.
-    cls = task_result.TaskResultSummary
-    h = request.properties.properties_hash
-    dupe_future = cls.query(cls.properties_hash==h).order(cls.key).get_async()
-
-  # At this point, the request is now in the DB but not yet in a mode where it
-  # can be triggered or visible. Index it right away so it is searchable. If any
-  # of remaining calls in this function fail, the TaskRequest and Search
-  # Document will simply point to an incomplete task, which will be ignored.
+  return schedule_requests([request])[0]
+
+
+def schedule_requests(requests):
+  """Creates and stores all the entities to schedule new task requests.
+
+  It is the bulk version of schedule_request(), e.g. for the shards of a sharded
+  task. Each step is done for all the requests at once and the DB RPCs are in
+  flight concurrently, so the latency is mostly independent of the number of
+  requests.
+
+  Arguments:
+  - requests: list of TaskRequest entities saved in the DB.
+
+  Returns:
+    list of TaskResultSummary, in the same order as requests.
+  """
+  dupe_futures = []
+  for request in requests:
+    dupe_future = None
+    if request.properties.idempotent:
+      # Find a previously run task that is also idempotent and completed. Start
+      # a query to fetch items that can be used to dedupe the task. See the
+      # comment for this property for more details.
+      #
+      # Do not use "cls.created_ts > oldest" here because this would require a
+      # composite index. It's unnecessary because TaskRequest.key is mostly
+      # equivalent to decreasing TaskRequest.created_ts, ordering by key works
+      # as well and doesn't require a composite index.
+      cls = task_result.TaskResultSummary
+      h = request.properties.properties_hash
+      dupe_future = cls.query(cls.properties_hash==h).order(cls.key).get_async()
+    dupe_futures.append(dupe_future)
+
+  # At this point, the requests are now in the DB but not yet in a mode where
+  # they can be triggered or visible. Index them right away so they are
+  # searchable. If any of remaining calls in this function fail, the TaskRequest
+  # and Search Document will simply point to an incomplete task, which will be
+  # ignored.
   #
   # Creates the entities TaskToRun and TaskResultSummary but do not save them
   # yet. TaskRunResult will be created once a bot starts it.
-  task = task_to_run.new_task_to_run(request)
-  result_summary = task_result.new_result_summary(request)
+  tasks = [task_to_run.new_task_to_run(r) for r in requests]
+  result_summaries = [task_result.new_result_summary(r) for r in requests]
 
   # Do not specify a doc_id, as they are guaranteed to be monotonically
   # increasing and searches are done in reverse order, which fits exactly the
@@ -313,18 +343,28 @@ def schedule_request(request):
   # (!) and NumberField is signed 32 bits so the best it could do with EPOCH is
   # second resolution up to year 2038.
   index = search.Index(name='requests')
-  packed = task_pack.pack_result_summary_key(result_summary.key)
-  doc = search.Document(
-      fields=[
-        search.TextField(name='name', value=request.name),
-        search.AtomField(name='id', value=packed),
-      ])
+  docs = [
+    search.Document(
+        fields=[
+          search.TextField(name='name', value=request.name),
+          search.AtomField(
+              name='id',
+              value=task_pack.pack_result_summary_key(result_summary.key)),
+        ])
+    for request, result_summary in zip(requests, result_summaries)
+  ]
   # Even if it fails here, we're still fine, as the task is not "alive" yet.
-  search_future = index.put_async([doc])
+  search_futures = [
+    index.put_async(docs[i:i+search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST])
+    for i in xrange(0, len(docs), search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST)
+  ]
 
   now = utils.utcnow()
 
-  if dupe_future:
+  for dupe_future, task, result_summary in zip(
+      dupe_futures, tasks, result_summaries):
+    if not dupe_future:
+      continue
     # Reuse the results!
     dupe_summary = dupe_future.get_result()
     # Refuse tasks older than X days. This is due to the isolate server dropping
@@ -345,98 +385,120 @@ def schedule_request(request):
       result_summary.deduped_from = task_pack.pack_run_result_key(
           dupe_summary.run_result_key)
 
-  # Get parent task details if applicable.
-  parent_task_keys = None
-  if request.parent_task_id:
-    parent_run_key = task_pack.unpack_run_result_key(request.parent_task_id)
-    parent_task_keys = [
-      parent_run_key,
-      task_pack.run_result_key_to_result_summary_key(parent_run_key),
-    ]
+  # Get parent task details if applicable. Shards of a task usually share the
+  # same parent, so it is updated once for all of them.
+  children = {}
+  for request, result_summary in zip(requests, result_summaries):
+    if request.parent_task_id:
+      children.setdefault(request.parent_task_id, []).append(
+          result_summary.key_packed)
 
-  result_summary.modified_ts = now
+  for result_summary in result_summaries:
+    result_summary.modified_ts = now
 
-  # Storing these entities makes this task live. It is important at this point
-  # that the HTTP handler returns as fast as possible, otherwise the task will
-  # be run but the client will not know about it.
-  def run():
-    ndb.put_multi([result_summary, task])
+  for task in tasks:
+    if task.queue_number:
+      # Make the dimensions visible to the bots before the task is live,
+      # otherwise it could be skipped by the dispatch index.
+      task_to_run.register_task_to_run(task)
+
+  # Storing these entities makes these tasks live. It is important at this point
+  # that the HTTP handler returns as fast as possible, otherwise the tasks will
+  # be run but the client will not know about them.
+  def run(result_summary, task):
+    return ndb.put_multi_async([result_summary, task])
 
-  def run_parent():
+  def run_parent(parent_task_keys, children_task_ids):
     # This one is slower.
     items = ndb.get_multi(parent_task_keys)
-    k = result_summary.key_packed
     for item in items:
-      item.children_task_ids.append(k)
+      item.children_task_ids.extend(children_task_ids)
       item.modified_ts = now
     ndb.put_multi(items)
 
-  # Raising will abort to the caller.
-  futures = [datastore_utils.transaction_async(run)]
-  if parent_task_keys:
-    futures.append(datastore_utils.transaction_async(run_parent))
-
-  try:
-    search_future.get_result()
-  except search.Error:
-    # Do not abort the task, for now search is best effort.
-    logging.exception('Put failed')
-
+  # Raising will abort to the caller. Each request is its own entity group so
+  # there is one transaction per request, all in flight at the same time.
+  futures = [
+    datastore_utils.transaction_async(
+        functools.partial(run, result_summary, task))
+    for result_summary, task in zip(result_summaries, tasks)
+  ]
+  for parent_task_id, children_task_ids in sorted(children.iteritems()):
+    parent_run_key = task_pack.unpack_run_result_key(parent_task_id)
+    parent_task_keys = [
+      parent_run_key,
+      task_pack.run_result_key_to_result_summary_key(parent_run_key),
+    ]
+    futures.append(
+        datastore_utils.transaction_async(
+            functools.partial(run_parent, parent_task_keys, children_task_ids)))
+
+  for search_future in search_futures:
+    try:
+      search_future.get_result()
+    except search.Error:
+      # Do not abort the task, for now search is best effort.
+      logging.exception('Put failed')
+
+  ndb.Future.wait_all(futures)
   for future in futures:
     # Check for failures, it would raise in this case, aborting the call.
     future.get_result()
 
-  stats.add_task_entry(
-      'task_enqueued', result_summary.key,
-      dimensions=request.properties.dimensions,
-      user=request.user)
-  return result_summary
+  for request, task, result_summary in zip(requests, tasks, result_summaries):
+    if task.queue_number:
+      task_to_run.notify_task_to_run(task.key)
+    stats.add_task_entry(
+        'task_enqueued', result_summary.key,
+        dimensions=request.properties.dimensions,
+        user=request.user)
+  return result_summaries
 
 
-def bot_reap_task(dimensions, bot_id, bot_version):
+def bot_reap_task(
+    dimensions, bot_id, bot_version, timeout_secs=None, reap_stats=None):
   """Reaps a TaskToRun if one is available.
 
   The process is to find a TaskToRun where its .queue_number is set, then
-  create a TaskRunResult for it.
+  create a TaskRunResult for it. The search stops after timeout_secs, which
+  defaults to task_to_run.DISPATCH_TIMEOUT_SECS.
+
+  If reap_stats is a dict, the number of tasks that failed to be reaped and of
+  claims lost to other bots are added to its 'failures' and 'claims_lost'
+  keys.
 
   Returns:
     tuple of (TaskRequest, TaskRunResult) for the task that was reaped.
     The TaskToRun involved is not returned.
   """
   assert bot_id
-  q = task_to_run.yield_next_available_task_to_dispatch(dimensions)
+  q = task_to_run.yield_next_available_task_to_dispatch(
+      dimensions, timeout_secs)
   # When a large number of bots try to reap hundreds of tasks simultaneously,
-  # they'll constantly fail to call reap_task_to_run() as they'll get preempted
-  # by other bots. So randomly jump farther in the queue when the number of
-  # failures is too large.
+  # they'd constantly fail to call _reap_task() as they'd get preempted by other
+  # bots on the tasks at the head of the queue. So claim a task before trying to
+  # reap it; the other bots skip it and try the next ones instead.
+  claims_lost = 0
   failures = 0
-  to_skip = 0
-  total_skipped = 0
+  def update_reap_stats():
+    if reap_stats is not None:
+      reap_stats['claims_lost'] = reap_stats.get('claims_lost', 0) + claims_lost
+      reap_stats['failures'] = reap_stats.get('failures', 0) + failures
+
   for request, to_run in q:
-    if to_skip:
-      to_skip -= 1
-      total_skipped += 1
+    if not task_to_run.claim_task_to_run(to_run.key, bot_id):
+      claims_lost += 1
       continue
 
     run_result = _reap_task(to_run.key, request, bot_id, bot_version)
     if not run_result:
       failures += 1
-      # Every 3 failures starting on the very first one, jump randomly ahead of
-      # the pack. This reduces the contention where hundreds of bots fight for
-      # exactly the same task while there's many ready to be run waiting in the
-      # queue.
-      if (failures % 3) == 1:
-        # TODO(maruel): Choose curve that makes the most sense. The tricky part
-        # is finding a good heuristic to guess the load without much information
-        # available in this content. When 'failures' is high, this means a lot
-        # of bots are reaping tasks like crazy, which means there is a good flow
-        # of tasks going on. On the other hand, skipping too much is useless. So
-        # it should have an initial bump but then slow down on skipping.
-        to_skip = min(int(round(random.gammavariate(3, 1))), 30)
+      task_to_run.release_task_to_run_claim(to_run.key)
       continue
 
     # Try to optimize these values but do not add as formal stats (yet).
-    logging.info('failed %d, skipped %d', failures, total_skipped)
+    logging.info('failed %d, lost %d claims', failures, claims_lost)
+    update_reap_stats()
 
     pending_time = run_result.started_ts - request.created_ts
     stats.add_run_entry(
@@ -446,9 +508,10 @@ def bot_reap_task(dimensions, bot_id, bot_version):
         pending_ms=_secs_to_ms(pending_time.total_seconds()),
         user=request.user)
     return request, run_result
-  if failures:
+  if failures or claims_lost:
     logging.info(
-        'Chose nothing (failed %d, skipped %d)', failures, total_skipped)
+        'Chose nothing (failed %d, lost %d claims)', failures, claims_lost)
+  update_reap_stats()
   return None, None
 
 
@@ -484,11 +547,27 @@ def bot_update_task(
       run_result_key)
   request_key = task_pack.result_summary_key_to_request_key(result_summary_key)
   request_future = request_key.get_async()
+  run_result_future = None
+  result_summary_future = None
+  if output:
+    run_result_future = run_result_key.get_async()
+    result_summary_future = result_summary_key.get_async()
   server_version = utils.get_app_version()
   packed = task_pack.pack_run_result_key(run_result_key)
   request = request_future.get_result()
   now = utils.utcnow()
 
+  if run_result_future:
+    # TaskOutputSegment are immutable so they are saved before the transaction,
+    # which then only has to record how much output there is. If the
+    # transaction fails, the bot retries and the same segments are written
+    # again. Only the output of the running try is saved, the transaction
+    # ignores the segmented output of the others.
+    current = run_result_future.get_result()
+    if (current and current.bot_id == bot_id and current.stdout_segmented and
+        _can_append_segments(current, result_summary_future.get_result())):
+      ndb.put_multi(current.append_output(0, output, output_chunk_start or 0))
+
   def run():
     # 2 consecutive GETs, one PUT.
     run_result_future = run_result_key.get_async()
@@ -517,6 +596,13 @@ def bot_update_task(
           'had unexpected duration; expected iff a command completes; index %d'
           % len(run_result.exit_codes))
 
+    # Same check as the one done before saving the segments, so it must be
+    # done before the state is updated below.
+    append_output = bool(output)
+    if output and run_result.stdout_segmented:
+      append_output = _can_append_segments(
+          run_result, result_summary_future.get_result())
+
     if exit_code is not None:
       # The command completed.
       run_result.durations.append(duration)
@@ -534,10 +620,13 @@ def bot_update_task(
 
     run_result.signal_server_version(server_version)
     to_put = [run_result]
-    if output:
-      # This does 1 multi GETs. This also modifies run_result in place.
-      to_put.extend(
-          run_result.append_output(0, output, output_chunk_start or 0))
+    if append_output:
+      # This modifies run_result in place.
+      entities = run_result.append_output(0, output, output_chunk_start or 0)
+      if not run_result.stdout_segmented:
+        # This did 1 multi GETs. TaskOutputChunk are read and rewritten so they
+        # must be saved in the transaction.
+        to_put.extend(entities)
 
     run_result.cost_usd = max(cost_usd, run_result.cost_usd or 0.)
     run_result.modified_ts = now
@@ -654,8 +743,12 @@ def cancel_task(result_summary_key):
 ### Cron job.
 
 
-def cron_abort_expired_task_to_run():
-  """Aborts expired TaskToRun requests to execute a TaskRequest on a bot.
+def abort_expired_task_to_run(to_run_keys):
+  """Aborts a batch of expired TaskToRun requests to execute a TaskRequest on a
+  bot.
+
+  The TaskToRun and their TaskRequest are fetched in two batched GETs, then one
+  transaction is run per TaskToRun still reapable.
 
   Three reasons can cause this situation:
   - Higher throughput of task requests incoming than the rate task requests
@@ -667,12 +760,20 @@ def cron_abort_expired_task_to_run():
     reconnect them.
   - Server has internal failures causing it to fail to either distribute the
     tasks or properly receive results from the bots.
+
+  Returns:
+    tuple(number of tasks killed, number of tasks skipped).
   """
+  start = utils.time_time()
   killed = 0
   skipped = 0
   try:
-    for to_run in task_to_run.yield_expired_task_to_run():
-      request = to_run.request_key.get()
+    to_runs = [
+      t for t in ndb.get_multi(to_run_keys) if t and t.is_reapable
+    ]
+    skipped = len(to_run_keys) - len(to_runs)
+    requests = ndb.get_multi(t.request_key for t in to_runs)
+    for to_run, request in zip(to_runs, requests):
       if _expire_task(to_run.key, request):
         killed += 1
         stats.add_task_entry(
@@ -685,22 +786,37 @@ def cron_abort_expired_task_to_run():
         skipped += 1
   finally:
     # TODO(maruel): Use stats_framework.
-    logging.info('Killed %d task, skipped %d', killed, skipped)
-  return killed
+    duration = utils.time_time() - start
+    logging.info(
+        'Killed %d task, skipped %d in %.1fs (%.1f/s)', killed, skipped,
+        duration, (killed + skipped) / duration if duration else 0.)
+  return killed, skipped
 
 
-def cron_handle_bot_died():
-  """Aborts or retry stale TaskRunResult where the bot stopped sending updates.
+def handle_dead_bots(run_result_keys):
+  """Aborts or retry a batch of stale TaskRunResult where the bot stopped
+  sending updates.
+
+  The TaskRequest are fetched in one batched GET, then one transaction is run
+  per TaskRunResult.
 
   If the task was at its first try, it'll be retried. Otherwise the task will be
   canceled.
+
+  Returns:
+    tuple(number of tasks killed, number retried, number ignored).
   """
+  start = utils.time_time()
   ignored = 0
   killed = 0
   retried = 0
   try:
-    for run_result_key in task_result.yield_run_result_keys_with_dead_bot():
-      result = _handle_dead_bot(run_result_key)
+    requests = ndb.get_multi(
+        task_pack.result_summary_key_to_request_key(
+            task_pack.run_result_key_to_result_summary_key(k))
+        for k in run_result_keys)
+    for run_result_key, request in zip(run_result_keys, requests):
+      result = _handle_dead_bot(run_result_key, request)
       if result is True:
         retried += 1
       elif result is False:
@@ -709,5 +825,41 @@ def cron_handle_bot_died():
         ignored += 1
   finally:
     # TODO(maruel): Use stats_framework.
-    logging.info('Killed %d; retried %d; ignored: %d', killed, retried, ignored)
+    duration = utils.time_time() - start
+    logging.info(
+        'Killed %d; retried %d; ignored: %d in %.1fs (%.1f/s)',
+        killed, retried, ignored, duration,
+        len(run_result_keys) / duration if duration else 0.)
   return killed, retried, ignored
+
+
+def cron_abort_expired_task_to_run():
+  """Aborts all the expired TaskToRun inline, in batches.
+
+  Synchronous equivalent of the cron job, which fans the batches out to a task
+  queue instead.
+
+  Returns:
+    Number of tasks killed.
+  """
+  killed = 0
+  for to_run_keys, _cursor in task_to_run.yield_expired_task_to_run_keys():
+    killed += abort_expired_task_to_run(to_run_keys)[0]
+  return killed
+
+
+def cron_handle_bot_died():
+  """Aborts or retry all the stale TaskRunResult inline, in batches.
+
+  Synchronous equivalent of the cron job, which fans the batches out to a task
+  queue instead.
+
+  Returns:
+    tuple(number of tasks killed, number retried, number ignored).
+  """
+  totals = (0, 0, 0)
+  for run_result_keys, _cursor in (
+      task_result.yield_run_result_keys_with_dead_bot()):
+    totals = tuple(
+        a + b for a, b in zip(totals, handle_dead_bots(run_result_keys)))
+  return totals
@@ -139,6 +139,34 @@ class TaskSchedulerApiTest(test_case.TestCase):
     self.assertEqual('localhost', run_result.bot_id)
     self.assertEqual(None, task_to_run.TaskToRun.query().get().queue_number)
 
+  def test_bot_reap_task_claimed(self):
+    # A task claimed by another bot is skipped.
+    requests = []
+    for i in xrange(2):
+      self.mock_now(self.now, i)
+      data = _gen_request_data(
+          properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+      requests.append(task_request.make_request(data))
+      task_scheduler.schedule_request(requests[-1])
+    to_run_key = task_to_run.request_to_task_to_run_key(requests[0])
+    self.assertEqual(
+        True, task_to_run.claim_task_to_run(to_run_key, 'localhost2'))
+
+    bot_dimensions = {u'OS': u'Windows-3.1.1', u'hostname': u'localhost'}
+    reap_stats = {}
+    actual_request, _run_result = task_scheduler.bot_reap_task(
+        bot_dimensions, 'localhost', 'abc', reap_stats=reap_stats)
+    self.assertEqual(requests[1], actual_request)
+    self.assertEqual({'claims_lost': 1, 'failures': 0}, reap_stats)
+
+    # Once released, the first task can be reaped.
+    task_to_run.release_task_to_run_claim(to_run_key)
+    actual_request, _run_result = task_scheduler.bot_reap_task(
+        bot_dimensions, 'localhost', 'abc', reap_stats=reap_stats)
+    self.assertEqual(requests[0], actual_request)
+    # The counts accumulate.
+    self.assertEqual({'claims_lost': 1, 'failures': 0}, reap_stats)
+
   def test_exponential_backoff(self):
     self.mock(
         task_scheduler.random, 'random',
@@ -555,6 +583,27 @@ class TaskSchedulerApiTest(test_case.TestCase):
     request = task_request.make_request(data)
     self.assertTrue(task_scheduler.schedule_request(request))
 
+  def test_schedule_requests(self):
+    parent_id = self._task_ran_successfully()
+    data = _gen_request_data(
+        parent_task_id=parent_id,
+        properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+    shards = [{'name': 'Request name:%d:3' % i} for i in xrange(3)]
+    requests = task_request.make_request_shards(data, shards)
+    result_summaries = task_scheduler.schedule_requests(requests)
+    self.assertEqual(
+        [r.key for r in requests], [r.request_key for r in result_summaries])
+    self.assertEqual(
+        [task_result.State.PENDING] * 3, [r.state for r in result_summaries])
+    for request in requests:
+      to_run = task_to_run.request_to_task_to_run_key(request).get()
+      self.assertTrue(to_run.is_reapable)
+
+    # The parent is updated once with all its children.
+    parent_run_result_key = task_pack.unpack_run_result_key(parent_id)
+    expected = [r.key_packed for r in result_summaries]
+    self.assertEqual(expected, parent_run_result_key.get().children_task_ids)
+
   def test_bot_update_task(self):
     run_result = _quick_reap()
     self.assertEqual(
@@ -568,6 +617,40 @@ class TaskSchedulerApiTest(test_case.TestCase):
             0.1))
     self.assertEqual(['hihey'], list(run_result.key.get().get_outputs()))
 
+  def test_bot_update_task_segmented(self):
+    self.mock(
+        config, 'settings',
+        lambda: config.GlobalConfig(use_output_segments=True))
+    run_result = _quick_reap()
+    self.assertEqual(True, run_result.stdout_segmented)
+    self.assertEqual(
+        (True, False),
+        task_scheduler.bot_update_task(
+            run_result.key, 'localhost', 'hi', 0, None, None, False, False,
+            0.1))
+    # An update from another bot is ignored.
+    self.mock(logging, 'error', lambda *_: None)
+    self.assertEqual(
+        (True, False),
+        task_scheduler.bot_update_task(
+            run_result.key, 'localhost2', 'xx', 0, None, None, False, False,
+            0.1))
+    self.assertEqual(
+        (True, True),
+        task_scheduler.bot_update_task(
+            run_result.key, 'localhost', 'hey', 2, 0, 0.1, False, False, 0.1))
+    # Output sent once the task is not running anymore is ignored.
+    self.assertEqual(
+        (True, True),
+        task_scheduler.bot_update_task(
+            run_result.key, 'localhost', 'late', 5, None, None, False, False,
+            0.1))
+    self.assertEqual(['hihey'], list(run_result.key.get().get_outputs()))
+    self.assertEqual(
+        ['hihey'], list(run_result.result_summary_key().get().get_outputs()))
+    self.assertEqual(0, task_result.TaskOutputChunk.query().count())
+    self.assertEqual(2, task_result.TaskOutputSegment.query().count())
+
   def test_bot_update_task_new_overwrite(self):
     run_result = _quick_reap()
     self.assertEqual(
@@ -751,6 +834,41 @@ class TaskSchedulerApiTest(test_case.TestCase):
     result_summary = result_summary.key.get()
     self.assertEqual(task_result.State.RUNNING, result_summary.state)
 
+  def test_abort_expired_task_to_run(self):
+    data = _gen_request_data(
+        properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+    request = task_request.make_request(data)
+    result_summary = task_scheduler.schedule_request(request)
+    to_run_key = task_to_run.request_to_task_to_run_key(request)
+    self.mock_now(self.now, data['scheduling_expiration_secs']+1)
+    # A second time is a no-op, so duplicate batches are harmless.
+    self.assertEqual(
+        (1, 0), task_scheduler.abort_expired_task_to_run([to_run_key]))
+    self.assertEqual(
+        (0, 1), task_scheduler.abort_expired_task_to_run([to_run_key]))
+    self.assertEqual(
+        task_result.State.EXPIRED, result_summary.key.get().state)
+
+  def test_handle_dead_bots(self):
+    data = _gen_request_data(
+        properties=dict(dimensions={u'OS': u'Windows-3.1.1'}),
+        scheduling_expiration_secs=600)
+    request = task_request.make_request(data)
+    task_scheduler.schedule_request(request)
+    bot_dimensions = {
+      u'OS': [u'Windows', u'Windows-3.1.1'],
+      u'hostname': u'localhost',
+      u'foo': u'bar',
+    }
+    _request, run_result = task_scheduler.bot_reap_task(
+        bot_dimensions, 'localhost', 'abc')
+    self.mock_now(self.now + task_result.BOT_PING_TOLERANCE, 1)
+    self.assertEqual(
+        (0, 1, 0), task_scheduler.handle_dead_bots([run_result.key]))
+    self.assertEqual(
+        (0, 0, 1), task_scheduler.handle_dead_bots([run_result.key]))
+    self.assertEqual(task_result.State.BOT_DIED, run_result.key.get().state)
+
   def test_cron_abort_expired_task_to_run(self):
     self.mock(random, 'getrandbits', lambda _: 0x88)
     data = _gen_request_data(
@@ -23,18 +23,29 @@ Graph of the schema:
     |TaskToRun              |
     |id=<hash of dimensions>|
     +-----------------------+
+
+    +-----------------------+
+    |TaskDimensionsQueue    |
+    |id=<hash of dimensions>|
+    +-----------------------+
 """
 
+import collections
 import datetime
 import hashlib
+import heapq
 import itertools
 import logging
 import struct
+import threading
 
 from google.appengine.api import memcache
+from google.appengine.datastore import datastore_query
 from google.appengine.ext import ndb
 
+from components import datastore_utils
 from components import utils
+from server import config
 from server import task_request
 
 
@@ -42,6 +53,56 @@ from server import task_request
 MAX_DIMENSIONS = 16384
 
 
+# Lifetime of the claim a bot takes on a TaskToRun before trying to reap it. It
+# only needs to cover the reap transaction; if the HTTP handler dies in the
+# meantime, the task becomes available to the other bots after this delay.
+CLAIM_LIFETIME_SECS = 15
+
+
+# Maximum number of dimensions hashes kept in the process wide cache of the
+# hashes accepted by a bot, summed over all the cached bots. According to
+# tools/bench_powerset.py, each hash costs 56 bytes on 64 bits (a 24 bytes int
+# and its slot in the frozenset), so this is about 5.6Mb per instance. It holds
+# at least 6 bots at MAX_DIMENSIONS and 390 bots with 4 keys of 3 values each.
+ACCEPTED_HASHES_CACHE_SIZE = 100000
+
+
+# Maximum number of TaskToRun keys fetched per query page while looking for a
+# task to dispatch. Each page costs a constant number of batched RPCs. The
+# pages grow from 1 to this size by a factor of DISPATCH_PAGE_GROWTH, since
+# the first candidate is usually the one reaped and the entities fetched for
+# the rest of the page would be wasted.
+# - 100/200 gives 2s~40s of query time for 1275 items.
+# - 250/500 gives 2s~50s of query time for 1275 items.
+# - 50/500 gives 3s~20s of query time for 1275 items. (Slower but less
+#   variance). Spikes in 20s~40s are rarer.
+# These numbers were measured with one serial RPC per candidate, before the
+# pages were processed in batches.
+DISPATCH_PAGE_SIZE = 100
+DISPATCH_PAGE_GROWTH = 4
+
+
+# Default number of seconds spent looking for a task to dispatch. The handlers
+# are given 60s to complete, this leaves 20s to reap the task and complete the
+# HTTP request.
+DISPATCH_TIMEOUT_SECS = 40
+
+
+# Number of seconds the set of dimensions_hash with queued tasks is cached in
+# memcache. A new dimensions set invalidates it right away.
+DISPATCH_INDEX_CACHE_SECS = 10
+
+
+# Number of keys fetched per page when looking for expired TaskToRun.
+EXPIRED_PAGE_SIZE = 100
+
+
+# TaskDimensionsQueue.valid_until_ts is rounded up to this number of seconds, so
+# it is updated at most once per period for each dimensions set, whatever the
+# rate of new tasks.
+DISPATCH_INDEX_ROUNDING_SECS = 60*60
+
+
 class TaskToRun(ndb.Model):
   """Defines a TaskRequest ready to be scheduled on a bot.
 
@@ -62,6 +123,10 @@ class TaskToRun(ndb.Model):
   # TaskRequest.expiration_ts to enable queries when cleaning up stale jobs.
   expiration_ts = ndb.DateTimeProperty(required=True)
 
+  # Copy of the key id, so the queued tasks with a specific set of dimensions
+  # can be queried in queue_number order.
+  dimensions_hash = ndb.ComputedProperty(lambda self: self.key.integer_id())
+
   # Everything above is immutable, everything below is mutable.
 
   # priority and request creation timestamp are mixed together to allow queries
@@ -72,6 +137,11 @@ class TaskToRun(ndb.Model):
   # If this task it not ready to be scheduled, it must be None.
   queue_number = ndb.IntegerProperty()
 
+  # Copy of expiration_ts while the task is queued, None otherwise. It permits
+  # querying the expired tasks still queued with a single inequality filter.
+  queued_expiration_ts = ndb.ComputedProperty(
+      lambda self: self.expiration_ts if self.queue_number else None)
+
   @property
   def is_reapable(self):
     """Returns True if the task is ready to be scheduled."""
@@ -84,10 +154,25 @@ class TaskToRun(ndb.Model):
 
   def to_dict(self):
     out = super(TaskToRun, self).to_dict()
-    out['dimensions_hash'] = self.key.integer_id()
+    out.pop('queued_expiration_ts')
     return out
 
 
+class TaskDimensionsQueue(ndb.Model):
+  """Dispatch index entry for the TaskToRun with a specific dimensions_hash.
+
+  Its presence means TaskToRun with this dimensions_hash may be queued until
+  valid_until_ts. It lets a bot query only the queues of the dimensions it can
+  satisfy instead of scanning all the queued tasks.
+
+  The key id is the dimensions_hash. It is a root entity so each set of
+  dimensions is updated independently.
+  """
+  # Latest TaskToRun.expiration_ts of the tasks registered with these
+  # dimensions, rounded up to DISPATCH_INDEX_ROUNDING_SECS.
+  valid_until_ts = ndb.DateTimeProperty(required=True)
+
+
 def _gen_queue_number(
     timestamp, priority, scale_factor_us=365*24*60*60*1000*1000):
   """Generates a 64 bit packed value used for TaskToRun.queue_number.
@@ -174,12 +259,166 @@ def _hash_dimensions(dimensions_json):
   return int(struct.unpack('<L', digest[:4])[0]) or 1
 
 
+class _LRUCache(object):
+  """Thread safe LRU cache bounded by the total size of its values."""
+
+  def __init__(self, max_size):
+    self._max_size = max_size
+    self._lock = threading.Lock()
+    # Ordered from the least to the most recently used.
+    self._items = collections.OrderedDict()
+    self._size = 0
+
+  def get(self, key):
+    """Returns the value for key or None and marks it as the most recently
+    used.
+    """
+    with self._lock:
+      item = self._items.pop(key, None)
+      if item is None:
+        return None
+      self._items[key] = item
+      return item[0]
+
+  def add(self, key, value, size):
+    """Adds a value, evicting the least recently used ones as needed."""
+    with self._lock:
+      old = self._items.pop(key, None)
+      if old is not None:
+        self._size -= old[1]
+      self._items[key] = (value, size)
+      self._size += size
+      while self._size > self._max_size and len(self._items) > 1:
+        _, (_, evicted_size) = self._items.popitem(last=False)
+        self._size -= evicted_size
+
+
+_accepted_hashes_cache = _LRUCache(ACCEPTED_HASHES_CACHE_SIZE)
+
+
+def _get_accepted_dimensions_hashes(bot_dimensions):
+  """Returns the frozenset of dimensions_hash a bot with bot_dimensions can
+  run.
+
+  The powerset is exponential in the number of dimensions and bots poll
+  continuously with the same dimensions, so the result is cached per process.
+  """
+  fingerprint = hashlib.md5(utils.encode_to_json(bot_dimensions)).digest()
+  accepted = _accepted_hashes_cache.get(fingerprint)
+  if accepted is None:
+    accepted = frozenset(
+        _hash_dimensions(utils.encode_to_json(i))
+        for i in _powerset(bot_dimensions))
+    _accepted_hashes_cache.add(fingerprint, accepted, len(accepted))
+  return accepted
+
+
+def _round_up_ts(timestamp, resolution_secs):
+  """Rounds up a datetime.datetime to a multiple of resolution_secs since
+  EPOCH.
+  """
+  secs = (timestamp - utils.EPOCH).total_seconds()
+  secs = (int(secs) / resolution_secs + 1) * resolution_secs
+  return utils.EPOCH + datetime.timedelta(seconds=secs)
+
+
+def _get_active_dimensions_hashes():
+  """Returns the frozenset of dimensions_hash that may have queued tasks."""
+  active = memcache.get('active', namespace='task_to_run_index')
+  if active is None:
+    q = TaskDimensionsQueue.query(
+        TaskDimensionsQueue.valid_until_ts > utils.utcnow())
+    active = frozenset(k.integer_id() for k in q.iter(keys_only=True))
+    memcache.add(
+        'active', active, time=DISPATCH_INDEX_CACHE_SECS,
+        namespace='task_to_run_index')
+  return active
+
+
+def _yield_queued_task_keys(accepted_dimensions_hash):
+  """Yields the keys of the queued TaskToRun in queue_number order.
+
+  When the dispatch index is enabled, only the tasks with a dimensions_hash in
+  |accepted_dimensions_hash| are yielded. One query is run concurrently per
+  queue and their results are merged.
+  """
+  if not config.settings().use_dispatch_index:
+    # Interestingly, the filter on .queue_number>0 is required otherwise all the
+    # None items are returned first.
+    q = TaskToRun.query().order(
+        TaskToRun.queue_number).filter(TaskToRun.queue_number > 0)
+    for task_key in q.iter(keys_only=True, batch_size=DISPATCH_PAGE_SIZE):
+      yield task_key
+    return
+
+  def iter_queue(index, it):
+    # |index| breaks ties in the merge, instead of comparing keys.
+    for to_run in it:
+      yield to_run.queue_number, index, to_run.key
+
+  hashes = accepted_dimensions_hash.intersection(
+      _get_active_dimensions_hashes())
+  # Start all the queries before waiting for any.
+  iterators = [
+    TaskToRun.query(
+        TaskToRun.dimensions_hash == h, TaskToRun.queue_number > 0).order(
+            TaskToRun.queue_number).iter(
+                projection=[TaskToRun.queue_number],
+                batch_size=DISPATCH_PAGE_SIZE)
+    for h in sorted(hashes)
+  ]
+  for _queue_number, _index, task_key in heapq.merge(
+      *[iter_queue(i, it) for i, it in enumerate(iterators)]):
+    yield task_key
+
+
+def _iter_pages(items, max_size):
+  """Yields lists of items from the iterable |items|.
+
+  The first list has a single item, each following one is DISPATCH_PAGE_GROWTH
+  times larger, up to |max_size| items.
+  """
+  page = []
+  size = 1
+  for item in items:
+    page.append(item)
+    if len(page) == size:
+      yield page
+      page = []
+      size = min(size * DISPATCH_PAGE_GROWTH, max_size)
+  if page:
+    yield page
+
+
+def _memcache_wakeup_key(dimensions_hash):
+  """Returns the memcache key of the wake up counter of a dimensions_hash.
+
+  There is one counter per dimensions_hash, so a bot is only woken up by the
+  tasks it can run, baring a hash collision.
+  """
+  return 'wakeup:%d' % dimensions_hash
+
+
 def _memcache_to_run_key(task_key):
   """Functional equivalent of task_result.pack_result_summary_key()."""
   request_key = task_to_run_key_to_request_key(task_key)
   return '%x' % request_key.integer_id()
 
 
+def _memcache_claim_key(task_key):
+  """Returns the memcache key of the claim on a TaskToRun."""
+  return 'claim:' + _memcache_to_run_key(task_key)
+
+
+def _is_taken(task_key, taken):
+  """Returns True if the TaskToRun is reaped or claimed according to the result
+  of _lookup_cache_is_taken_async().
+  """
+  return (
+      _memcache_to_run_key(task_key) in taken or
+      _memcache_claim_key(task_key) in taken)
+
+
 def _lookup_cache_is_taken(task_key):
   """Queries the quick lookup cache to reduce DB operations."""
   assert not ndb.in_transaction()
@@ -187,6 +426,21 @@ def _lookup_cache_is_taken(task_key):
   return bool(memcache.get(key, namespace='task_to_run'))
 
 
+def _lookup_cache_is_taken_async(task_keys):
+  """Queries the quick lookup cache and the claims for multiple TaskToRun in a
+  single RPC.
+
+  Returns:
+    RPC whose get_result() is a dict to pass to _is_taken().
+  """
+  assert not ndb.in_transaction()
+  keys = []
+  for k in task_keys:
+    keys.append(_memcache_to_run_key(k))
+    keys.append(_memcache_claim_key(k))
+  return memcache.Client().get_multi_async(keys, namespace='task_to_run')
+
+
 ### Public API.
 
 
@@ -222,6 +476,99 @@ def new_task_to_run(request):
       expiration_ts=request.expiration_ts)
 
 
+def claim_task_to_run(task_key, bot_id):
+  """Takes a short lived claim on a TaskToRun before trying to reap it.
+
+  When many bots with similar dimensions poll simultaneously, they all see the
+  same tasks at the head of the queue. The claim makes the other bots skip the
+  task instead of colliding in the reap transaction, so they spread over the
+  queue. The claim is only advisory, the reap transaction is still the
+  authority.
+
+  Returns:
+    False if another bot holds a claim on this task, True otherwise.
+  """
+  assert not ndb.in_transaction()
+  key = _memcache_claim_key(task_key)
+  if memcache.add(key, bot_id, time=CLAIM_LIFETIME_SECS,
+                  namespace='task_to_run'):
+    return True
+  # add() also returns False when memcache is unavailable. Do not stop all the
+  # reaping in this case, the transaction will arbitrate.
+  return memcache.get(key, namespace='task_to_run') in (None, bot_id)
+
+
+def release_task_to_run_claim(task_key):
+  """Releases the claim on a TaskToRun that could not be reaped.
+
+  This makes the task available to the other bots right away instead of after
+  CLAIM_LIFETIME_SECS.
+  """
+  assert not ndb.in_transaction()
+  memcache.delete(_memcache_claim_key(task_key), namespace='task_to_run')
+
+
+def register_task_to_run(to_run):
+  """Adds the dimensions of a queued TaskToRun to the dispatch index.
+
+  Must be called when a TaskToRun is stored with a queue_number, so bots can
+  find it when the dispatch index is enabled. It is cheap to call repeatedly.
+  """
+  assert not ndb.in_transaction()
+  dimensions_hash = to_run.key.integer_id()
+  valid_until_ts = _round_up_ts(
+      to_run.expiration_ts, DISPATCH_INDEX_ROUNDING_SECS)
+  cache_key = '%x' % dimensions_hash
+  cached = memcache.get(cache_key, namespace='task_to_run_index')
+  if cached and cached >= valid_until_ts:
+    return
+
+  now = utils.utcnow()
+  def run():
+    """Returns tuple(valid_until_ts, was_active)."""
+    queue = TaskDimensionsQueue.get_by_id(dimensions_hash)
+    if queue and queue.valid_until_ts >= valid_until_ts:
+      return queue.valid_until_ts, True
+    was_active = bool(queue and queue.valid_until_ts > now)
+    TaskDimensionsQueue(id=dimensions_hash, valid_until_ts=valid_until_ts).put()
+    return valid_until_ts, was_active
+
+  stored_ts, was_active = datastore_utils.transaction(run)
+  memcache.set(
+      cache_key, stored_ts, time=DISPATCH_INDEX_ROUNDING_SECS,
+      namespace='task_to_run_index')
+  if not was_active:
+    # Make the new queue visible to the bots right away.
+    memcache.delete('active', namespace='task_to_run_index')
+
+
+def notify_task_to_run(task_key):
+  """Wakes up the bots long polling for a task the TaskToRun may be run by.
+
+  Must be called once a TaskToRun was stored with a queue_number.
+  """
+  memcache.incr(
+      _memcache_wakeup_key(task_key.integer_id()), initial_value=0,
+      namespace='task_to_run_wakeup')
+
+
+def get_wakeup_counters(bot_dimensions):
+  """Returns the state of the wake up counters watched by a bot.
+
+  The value is opaque; if it changed between two calls, a task the bot may run
+  may have been enqueued in between, see notify_task_to_run().
+
+  Only the counters of the dimensions_hash in the dispatch index are watched,
+  instead of the whole powerset of the bot dimensions. A dimensions_hash added
+  to the index, see register_task_to_run(), also changes the value.
+  """
+  hashes = _get_active_dimensions_hashes().intersection(
+      _get_accepted_dimensions_hashes(bot_dimensions))
+  keys = [_memcache_wakeup_key(h) for h in sorted(hashes)]
+  values = memcache.get_multi(keys, namespace='task_to_run_wakeup')
+  return tuple((k, values.get(k)) for k in keys)
+
+
 def validate_to_run_key(task_key):
   """Validates a ndb.Key to a TaskToRun entity. Raises ValueError if invalid."""
   # This also validates the key kind.
@@ -289,23 +636,29 @@ def set_lookup_cache(task_key, is_available_to_schedule):
     memcache.set(key, True, time=cache_lifetime, namespace='task_to_run')
 
 
-def yield_next_available_task_to_dispatch(bot_dimensions):
+def yield_next_available_task_to_dispatch(bot_dimensions, timeout_secs=None):
   """Yields next available (TaskRequest, TaskToRun) in decreasing order of
   priority.
 
   Once the caller determines the task is suitable to execute, it must use
   reap_task_to_run(task.key) to mark that it is not to be scheduled anymore.
 
-  Performance is the top most priority here.
+  Performance is the top most priority here. The TaskToRun keys are fetched
+  by pages of growing size, up to DISPATCH_PAGE_SIZE, and each page is
+  processed with a constant number of batched RPCs, while the next page is
+  being fetched. When the dispatch index is enabled, only the queues of the
+  dimensions the bot can satisfy are queried.
 
   Arguments:
   - bot_dimensions: dimensions (as a dict) defined by the bot that can be
       matched.
+  - timeout_secs: stop looking after this number of seconds. Defaults to
+      DISPATCH_TIMEOUT_SECS.
   """
+  if timeout_secs is None:
+    timeout_secs = DISPATCH_TIMEOUT_SECS
   # List of all the valid dimensions hashed.
-  accepted_dimensions_hash = frozenset(
-      _hash_dimensions(utils.encode_to_json(i))
-      for i in _powerset(bot_dimensions))
+  accepted_dimensions_hash = _get_accepted_dimensions_hashes(bot_dimensions)
   now = utils.utcnow()
   broken = 0
   cache_lookup = 0
@@ -313,104 +666,109 @@ def yield_next_available_task_to_dispatch(bot_dimensions):
   hash_mismatch = 0
   ignored = 0
   no_queue = 0
+  pages = 0
   real_mismatch = 0
   total = 0
-  # Be very aggressive in fetching the largest amount of items as possible. Note
-  # that we use the default ndb.EVENTUAL_CONSISTENCY so stale items may be
+  # Note that we use the default ndb.EVENTUAL_CONSISTENCY so stale items may be
   # returned. It's handled specifically.
-  # - 100/200 gives 2s~40s of query time for 1275 items.
-  # - 250/500 gives 2s~50s of query time for 1275 items.
-  # - 50/500 gives 3s~20s of query time for 1275 items. (Slower but less
-  #   variance). Spikes in 20s~40s are rarer.
-  # The problem here are:
-  # - Outliers, some shards are simply slower at executing the query.
-  # - Median time, which we should optimize.
-  # - Abusing batching will slow down this query.
-  #
   # TODO(maruel): Measure query performance with stats_framework!!
-  # TODO(maruel): Use fetch_page_async() + ndb.get_multi_async() +
-  # memcache.get_multi_async() to do pipelined processing. Should greatly reduce
-  # the effect of latency on the total duration of this function. I also suspect
-  # using ndb.get_multi() will return fresher objects than what is returned by
-  # the query.
-  opts = ndb.QueryOptions(batch_size=50, prefetch_size=500, keys_only=True)
   try:
-    # Interestingly, the filter on .queue_number>0 is required otherwise all the
-    # None items are returned first.
-    q = TaskToRun.query(default_options=opts).order(
-        TaskToRun.queue_number).filter(TaskToRun.queue_number > 0)
-    for task_key in q:
-      duration = (utils.utcnow() - now).total_seconds()
-      if duration > 40.:
-        # Stop searching after too long, since the odds of the request blowing
-        # up right after succeeding in reaping a task is not worth the dangling
-        # task request that will stay in limbo until the cron job reaps it and
-        # retry it. The current handlers are given 60s to complete. By using
-        # 40s, it gives 20s to complete the reaping and complete the HTTP
-        # request.
+    for task_keys in _iter_pages(
+        _yield_queued_task_keys(accepted_dimensions_hash), DISPATCH_PAGE_SIZE):
+      pages += 1
+      if (utils.utcnow() - now).total_seconds() > timeout_secs:
+        # See the comment below.
         return
 
-      total += 1
-      # Verify TaskToRun is what is expected. Play defensive here.
-      try:
-        validate_to_run_key(task_key)
-      except ValueError as e:
-        logging.error(str(e))
-        broken += 1
-        continue
-
-      # integer_id() == dimensions_hash.
-      if task_key.integer_id() not in accepted_dimensions_hash:
-        hash_mismatch += 1
+      candidates = []
+      for task_key in task_keys:
+        total += 1
+        # Verify TaskToRun is what is expected. Play defensive here.
+        try:
+          validate_to_run_key(task_key)
+        except ValueError as e:
+          logging.error(str(e))
+          broken += 1
+          continue
+        # integer_id() == dimensions_hash.
+        if task_key.integer_id() not in accepted_dimensions_hash:
+          hash_mismatch += 1
+          continue
+        candidates.append(task_key)
+      if not candidates:
         continue
 
-      # Do this after the basic weeding out but before fetching TaskRequest.
-      if _lookup_cache_is_taken(task_key):
-        cache_lookup += 1
+      # Do this after the basic weeding out but before fetching the entities.
+      taken = _lookup_cache_is_taken_async(candidates).get_result() or {}
+      not_taken = [
+        k for k in candidates if not _is_taken(k, taken)
+      ]
+      cache_lookup += len(candidates) - len(not_taken)
+      candidates = not_taken
+      if not candidates:
         continue
 
-      # Ok, it's now worth taking a real look at the entity.
-      task = task_key.get(use_cache=False)
+      # Ok, it's now worth taking a real look at the entities. Fetch the
+      # TaskRequest along the TaskToRun to save a round trip, even if some will
+      # not be needed. The reason use_cache=False is otherwise it'll create a
+      # buffer bloat.
+      task_futures = ndb.get_multi_async(candidates, use_cache=False)
+      request_futures = ndb.get_multi_async(
+          [task_to_run_key_to_request_key(k) for k in candidates],
+          use_cache=False)
 
       # DB operations are slow, double check memcache again.
-      if _lookup_cache_is_taken(task_key):
-        cache_lookup += 1
-        continue
-
-      # It is possible for the index to be inconsistent since it is not executed
-      # in a transaction, no problem.
-      if not task.queue_number:
-        no_queue += 1
-        continue
-
-      # It expired. A cron job will cancel it eventually. Since 'now' is saved
-      # before the query, an expired task may still be reaped even if
-      # technically expired if the query is very slow. This is on purpose so
-      # slow queries do not cause exagerate expirations.
-      if task.expiration_ts < now:
-        expired += 1
-        continue
-
-      # The hash may have conflicts. Ensure the dimensions actually match by
-      # verifying the TaskRequest. There's a probability of 2**-31 of conflicts,
-      # which is low enough for our purpose. The reason use_cache=False is
-      # otherwise it'll create a buffer bloat.
-      request = task.request_key.get(use_cache=False)
-      if not match_dimensions(request.properties.dimensions, bot_dimensions):
-        real_mismatch += 1
-        continue
-
-      # It's a valid task! Note that in the meantime, another bot may have
-      # reaped it.
-      yield request, task
-      ignored += 1
+      taken = _lookup_cache_is_taken_async(candidates).get_result() or {}
+
+      for task_key, task_future, request_future in zip(
+          candidates, task_futures, request_futures):
+        duration = (utils.utcnow() - now).total_seconds()
+        if duration > timeout_secs:
+          # Stop searching after too long, since the odds of the request
+          # blowing up right after succeeding in reaping a task is not worth
+          # the dangling task request that will stay in limbo until the cron
+          # job reaps it and retry it. See DISPATCH_TIMEOUT_SECS.
+          return
+
+        if _is_taken(task_key, taken):
+          cache_lookup += 1
+          continue
+
+        # It is possible for the index to be inconsistent since it is not
+        # executed in a transaction, no problem.
+        task = task_future.get_result()
+        if not task or not task.queue_number:
+          no_queue += 1
+          continue
+
+        # It expired. A cron job will cancel it eventually. Since 'now' is saved
+        # before the query, an expired task may still be reaped even if
+        # technically expired if the query is very slow. This is on purpose so
+        # slow queries do not cause exagerate expirations.
+        if task.expiration_ts < now:
+          expired += 1
+          continue
+
+        # The hash may have conflicts. Ensure the dimensions actually match by
+        # verifying the TaskRequest. There's a probability of 2**-31 of
+        # conflicts, which is low enough for our purpose.
+        request = request_future.get_result()
+        if not match_dimensions(request.properties.dimensions, bot_dimensions):
+          real_mismatch += 1
+          continue
+
+        # It's a valid task! Note that in the meantime, another bot may have
+        # reaped it.
+        yield request, task
+        ignored += 1
   finally:
     duration = (utils.utcnow() - now).total_seconds()
     logging.info(
-        '%d/%s in %5.2fs: %d total, %d exp %d no_queue, %d hash mismatch, '
-        '%d cache negative, %d dimensions mismatch, %d ignored, %d broken',
-        opts.batch_size,
-        opts.prefetch_size,
+        '%d pages of up to %d in %5.2fs: %d total, %d exp %d no_queue, '
+        '%d hash mismatch, %d cache negative, %d dimensions mismatch, '
+        '%d ignored, %d broken',
+        pages,
+        DISPATCH_PAGE_SIZE,
         duration,
         total,
         expired,
@@ -422,9 +780,33 @@ def yield_next_available_task_to_dispatch(bot_dimensions):
         broken)
 
 
-def yield_expired_task_to_run():
-  """Yields all the expired TaskToRun still marked as available."""
+def yield_expired_task_to_run_keys(cursor=None):
+  """Yields pages of the keys of the expired TaskToRun still marked as
+  available.
+
+  Arguments:
+    cursor: urlsafe cursor to resume a previous query from, if any.
+
+  Yields:
+    tuple(list of TaskToRun ndb.Key, urlsafe cursor after this page or None if
+    it is the last one).
+  """
   now = utils.utcnow()
-  for task in TaskToRun.query().filter(TaskToRun.queue_number > 0):
-    if task.expiration_ts < now:
-      yield task
+  if config.settings().use_expiration_index:
+    q = TaskToRun.query(
+        TaskToRun.queued_expiration_ts > datetime.datetime(1970, 1, 1),
+        TaskToRun.queued_expiration_ts < now)
+    filtered = False
+  else:
+    # Scans all the queued tasks; the ones enqueued before queued_expiration_ts
+    # was added are not in its index.
+    q = TaskToRun.query(TaskToRun.queue_number > 0)
+    filtered = True
+  cursor = datastore_query.Cursor(urlsafe=cursor) if cursor else None
+  more = True
+  while more:
+    items, cursor, more = q.fetch_page(
+        EXPIRED_PAGE_SIZE, start_cursor=cursor, keys_only=not filtered)
+    if filtered:
+      items = [i.key for i in items if i.expiration_ts < now]
+    yield items, (cursor.urlsafe() if more and cursor else None)
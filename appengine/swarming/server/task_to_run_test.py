@@ -20,6 +20,7 @@ from components import auth_testing
 from components import utils
 from test_support import test_case
 
+from server import config
 from server import task_request
 from server import task_to_run
 
@@ -244,6 +245,43 @@ class TaskToRunPrivateTest(TestCase):
         for i in task_to_run._powerset(dimensions)))
     self.assertEqual(16384, len(items))
 
+  def test_get_accepted_dimensions_hashes(self):
+    self.mock(task_to_run, '_accepted_hashes_cache', task_to_run._LRUCache(10))
+    dimensions = {u'OS': [u'Windows', u'Windows-3.1.1'], u'id': [u'bot1']}
+    expected = frozenset(
+        _hash_dimensions(i) for i in task_to_run._powerset(dimensions))
+    actual = task_to_run._get_accepted_dimensions_hashes(dimensions)
+    self.assertEqual(expected, actual)
+    self.assertEqual(6, len(actual))
+
+    # The second call is served from the cache.
+    self.mock(task_to_run, '_powerset', lambda _: self.fail())
+    self.assertIs(
+        actual, task_to_run._get_accepted_dimensions_hashes(dict(dimensions)))
+
+  def test_lru_cache(self):
+    cache = task_to_run._LRUCache(4)
+    cache.add('a', 1, 2)
+    cache.add('b', 2, 2)
+    self.assertEqual(1, cache.get('a'))
+    # 'b' is the least recently used.
+    cache.add('c', 3, 2)
+    self.assertEqual(None, cache.get('b'))
+    self.assertEqual(1, cache.get('a'))
+    self.assertEqual(3, cache.get('c'))
+    # A value larger than the cache is still kept, alone.
+    cache.add('d', 4, 5)
+    self.assertEqual(None, cache.get('a'))
+    self.assertEqual(None, cache.get('c'))
+    self.assertEqual(4, cache.get('d'))
+
+  def test_iter_pages(self):
+    # The pages grow up to the maximum size.
+    actual = list(task_to_run._iter_pages(xrange(40), 10))
+    self.assertEqual([1, 4, 10, 10, 10, 5], [len(p) for p in actual])
+    self.assertEqual(range(40), sum(actual, []))
+    self.assertEqual([], list(task_to_run._iter_pages([], 10)))
+
 
 class TaskToRunApiTest(TestCase):
   def setUp(self):
@@ -571,11 +609,92 @@ class TaskToRunApiTest(TestCase):
     actual = _yield_next_available_task_to_dispatch(bot_dimensions)
     self.assertEqual(expected, actual)
 
-  def test_yield_expired_task_to_run(self):
-    _gen_new_task_to_run(scheduling_expiration_secs=60)
+  def test_yield_next_available_task_to_dispatch_pages(self):
+    # Tasks spanning multiple pages are returned in order, skipping the ones
+    # that do not match and the ones already taken.
+    self.mock(task_to_run, 'DISPATCH_PAGE_SIZE', 2)
+    to_runs = []
+    for i in xrange(5):
+      self.mock_now(self.now, i)
+      dimensions = {u'OS': u'Windows-3.1.1'} if i != 1 else {u'OS': u'Amiga'}
+      to_runs.append(
+          _gen_new_task_to_run(properties=dict(dimensions=dimensions)))
+    task_to_run.set_lookup_cache(to_runs[3].key, False)
+
+    bot_dimensions = {u'OS': u'Windows-3.1.1', u'hostname': u'localhost'}
+    actual = [
+      to_run.key for _request, to_run in
+      task_to_run.yield_next_available_task_to_dispatch(bot_dimensions)
+    ]
+    self.assertEqual([to_runs[i].key for i in (0, 2, 4)], actual)
+
+  def test_yield_next_available_task_to_dispatch_index(self):
+    # With the dispatch index, only the queues of the bot's dimensions are
+    # queried and they are merged in queue_number order.
+    self.mock(
+        config, 'settings',
+        lambda: config.GlobalConfig(use_dispatch_index=True))
+    self.mock(task_to_run, 'DISPATCH_PAGE_SIZE', 2)
+    all_dimensions = [
+      {u'OS': u'Windows-3.1.1'},
+      {u'OS': u'Windows-3.1.1', u'hostname': u'localhost'},
+      {u'OS': u'Amiga'},
+    ]
+    to_runs = []
+    for i in xrange(6):
+      self.mock_now(self.now, i)
+      to_run = _gen_new_task_to_run(
+          properties=dict(dimensions=all_dimensions[i % 3]))
+      task_to_run.register_task_to_run(to_run)
+      to_runs.append(to_run)
+    self.assertEqual(
+        frozenset(_hash_dimensions(d) for d in all_dimensions),
+        task_to_run._get_active_dimensions_hashes())
+
+    bot_dimensions = {u'OS': u'Windows-3.1.1', u'hostname': u'localhost'}
+    actual = [
+      t.key for _request, t in
+      task_to_run.yield_next_available_task_to_dispatch(bot_dimensions)
+    ]
+    self.assertEqual([to_runs[i].key for i in (0, 1, 3, 4)], actual)
+
+    # A task whose dimensions were not registered is not found.
+    _gen_new_task_to_run(
+        properties=dict(dimensions={u'hostname': u'localhost'}))
+    self.assertEqual(
+        4, len(_yield_next_available_task_to_dispatch(bot_dimensions)))
+
+  def test_register_task_to_run(self):
+    to_run = _gen_new_task_to_run(
+        properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+    self.assertEqual(frozenset(), task_to_run._get_active_dimensions_hashes())
+    task_to_run.register_task_to_run(to_run)
+    # The cached set of active queues was invalidated.
+    self.assertEqual(
+        frozenset([to_run.dimensions_hash]),
+        task_to_run._get_active_dimensions_hashes())
+    queue = task_to_run.TaskDimensionsQueue.get_by_id(to_run.dimensions_hash)
+    self.assertEqual(
+        datetime.datetime(2014, 1, 2, 4, 0, 0), queue.valid_until_ts)
+
+    # A task with a later expiration within the same period is a no-op.
+    self.mock_now(self.now, 60)
+    later = _gen_new_task_to_run(
+        properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+    task_to_run.register_task_to_run(later)
+    self.assertEqual(
+        datetime.datetime(2014, 1, 2, 4, 0, 0), queue.key.get().valid_until_ts)
+
+    # Once it expires, the queue is not active anymore.
+    self.mock_now(self.now, 60*60)
+    task_to_run.memcache.flush_all()
+    self.assertEqual(frozenset(), task_to_run._get_active_dimensions_hashes())
+
+  def test_yield_expired_task_to_run_keys(self):
+    to_run = _gen_new_task_to_run(scheduling_expiration_secs=60)
     self.assertEqual(1, len(_yield_next_available_task_to_dispatch({})))
     self.assertEqual(
-        0, len(list(task_to_run.yield_expired_task_to_run())))
+        [([], None)], list(task_to_run.yield_expired_task_to_run_keys()))
 
     # All tasks are now expired. Note that even if they still have .queue_number
     # set because the cron job wasn't run, they are still not yielded by
@@ -583,7 +702,44 @@ class TaskToRunApiTest(TestCase):
     self.mock_now(self.now, 61)
     self.assertEqual(0, len(_yield_next_available_task_to_dispatch({})))
     self.assertEqual(
-        1, len(list(task_to_run.yield_expired_task_to_run())))
+        [([to_run.key], None)],
+        list(task_to_run.yield_expired_task_to_run_keys()))
+
+    # Once it is not queued anymore, it is not yielded.
+    to_run.queue_number = None
+    to_run.put()
+    self.assertEqual(
+        [([], None)], list(task_to_run.yield_expired_task_to_run_keys()))
+
+  def test_yield_expired_task_to_run_keys_index(self):
+    self.mock(
+        config, 'settings',
+        lambda: config.GlobalConfig(use_expiration_index=True))
+    self.mock(task_to_run, 'EXPIRED_PAGE_SIZE', 2)
+    to_runs = [
+      _gen_new_task_to_run(
+          scheduling_expiration_secs=60,
+          properties=dict(dimensions={u'OS': u'Windows-%d' % i}))
+      for i in xrange(5)
+    ]
+    later = _gen_new_task_to_run(
+        scheduling_expiration_secs=120,
+        properties=dict(dimensions={u'OS': u'Amiga'}))
+    pages = list(task_to_run.yield_expired_task_to_run_keys())
+    self.assertEqual([], sum((k for k, _ in pages), []))
+
+    self.mock_now(self.now, 61)
+    pages = list(task_to_run.yield_expired_task_to_run_keys())
+    self.assertEqual(
+        sorted(t.key for t in to_runs), sorted(sum((k for k, _ in pages), [])))
+    self.assertTrue(all(len(k) <= 2 for k, _ in pages))
+    self.assertEqual(None, pages[-1][1])
+    self.assertNotIn(later.key, sum((k for k, _ in pages), []))
+
+    # The query resumes from the cursor of a page.
+    resumed = list(task_to_run.yield_expired_task_to_run_keys(pages[0][1]))
+    self.assertEqual(
+        sum((k for k, _ in pages[1:]), []), sum((k for k, _ in resumed), []))
 
   def test_is_reapable(self):
     req_dimensions = {u'OS': u'Windows-3.1.1'}
@@ -597,6 +753,68 @@ class TaskToRunApiTest(TestCase):
     to_run.put()
     self.assertEqual(False, to_run.is_reapable)
 
+  def test_claim_task_to_run(self):
+    to_run = _gen_new_task_to_run(
+        properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+    self.assertEqual(True, task_to_run.claim_task_to_run(to_run.key, 'bot1'))
+    # Claiming again is idempotent for the same bot.
+    self.assertEqual(True, task_to_run.claim_task_to_run(to_run.key, 'bot1'))
+    self.assertEqual(False, task_to_run.claim_task_to_run(to_run.key, 'bot2'))
+    # The claimed task is skipped while dispatching.
+    bot_dimensions = {u'OS': u'Windows-3.1.1', u'hostname': u'localhost'}
+    self.assertEqual([], _yield_next_available_task_to_dispatch(bot_dimensions))
+
+  def test_release_task_to_run_claim(self):
+    to_run = _gen_new_task_to_run(
+        properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+    self.assertEqual(True, task_to_run.claim_task_to_run(to_run.key, 'bot1'))
+    task_to_run.release_task_to_run_claim(to_run.key)
+    self.assertEqual(True, task_to_run.claim_task_to_run(to_run.key, 'bot2'))
+    bot_dimensions = {u'OS': u'Windows-3.1.1', u'hostname': u'localhost'}
+    self.assertEqual([], _yield_next_available_task_to_dispatch(bot_dimensions))
+    task_to_run.release_task_to_run_claim(to_run.key)
+    self.assertEqual(
+        1, len(_yield_next_available_task_to_dispatch(bot_dimensions)))
+
+  def test_get_wakeup_counters(self):
+    bot_dimensions = {u'OS': u'Windows-3.1.1', u'hostname': u'localhost'}
+    # No counter is watched until there are queued tasks.
+    self.assertEqual((), task_to_run.get_wakeup_counters(bot_dimensions))
+
+    # Tasks the bot can't run don't wake it up.
+    for dimensions in (
+        {u'OS': u'Amiga'},
+        {u'OS': u'Windows-3.1.1', u'foo': u'bar'},
+        {u'hostname': u'remotehost'}):
+      to_run = _gen_new_task_to_run(properties=dict(dimensions=dimensions))
+      task_to_run.register_task_to_run(to_run)
+      task_to_run.notify_task_to_run(to_run.key)
+    self.assertEqual((), task_to_run.get_wakeup_counters(bot_dimensions))
+
+    # A new queue the bot can take tasks from changes the value.
+    to_run = _gen_new_task_to_run(
+        properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+    task_to_run.register_task_to_run(to_run)
+    initial = task_to_run.get_wakeup_counters(bot_dimensions)
+    # Only the counter of the queued dimensions is watched.
+    self.assertEqual(1, len(initial))
+    self.assertEqual(initial, task_to_run.get_wakeup_counters(bot_dimensions))
+
+    task_to_run.notify_task_to_run(to_run.key)
+    self.assertNotEqual(
+        initial, task_to_run.get_wakeup_counters(bot_dimensions))
+
+  def test_notify_task_to_run(self):
+    to_run = _gen_new_task_to_run(
+        properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+    key = task_to_run._memcache_wakeup_key(to_run.dimensions_hash)
+    self.assertEqual(
+        None, task_to_run.memcache.get(key, namespace='task_to_run_wakeup'))
+    task_to_run.notify_task_to_run(to_run.key)
+    task_to_run.notify_task_to_run(to_run.key)
+    self.assertEqual(
+        2, task_to_run.memcache.get(key, namespace='task_to_run_wakeup'))
+
   def test_set_lookup_cache(self):
     to_run = _gen_new_task_to_run(
         properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
@@ -24,8 +24,10 @@ import optparse
 import os
 import subprocess
 import sys
+import threading
 import time
 import zipfile
+import zlib
 
 import xsrf_client
 from utils import net
@@ -45,6 +47,16 @@ MAX_PACKET_INTERVAL = 30
 MIN_PACKET_INTERNAL = 10
 
 
+# Minimum size of stdout to compress in a task_update packet. Smaller outputs
+# are not worth it.
+MIN_COMPRESS_SIZE = 1024
+
+
+# Maximum amount of stdout buffered while waiting for the server. Reading from
+# the child process is paused when it is reached.
+MAX_BUFFER_SIZE = 10*MAX_CHUNK_SIZE
+
+
 # Exit code used to indicate the task failed. Keep in sync with bot_main.py. The
 # reason for its existance is that if an exception occurs, task_runner's exit
 # code will be 1. If the process is killed, it'll likely be -9. In these cases,
@@ -151,7 +163,13 @@ def post_update(swarming_server, params, exit_code, stdout, output_chunk_start):
     params['exit_code'] = exit_code
   if stdout:
     # The output_chunk_start is used by the server to make sure that the stdout
-    # chunks are processed and saved in the DB in order.
+    # chunks are processed and saved in the DB in order. It is always an offset
+    # in the uncompressed output.
+    if len(stdout) >= MIN_COMPRESS_SIZE:
+      compressed = zlib.compress(stdout)
+      if len(compressed) < len(stdout):
+        stdout = compressed
+        params['output_encoding'] = 'zlib'
     params['output'] = base64.b64encode(stdout)
     params['output_chunk_start'] = output_chunk_start
   # TODO(maruel): Support early cancellation.
@@ -177,17 +195,109 @@ def should_post_update(stdout, now, last_packet):
   return len(stdout) >= MAX_CHUNK_SIZE or (now - last_packet) > packet_interval
 
 
-def calc_yield_wait(task_details, start, last_io, timed_out, stdout):
+class OutputUploader(object):
+  """Sends the output of the child process to the server from a thread.
+
+  The output is appended to a bounded buffer that a background thread drains
+  by sending task_update packets via post_update(), so a slow server doesn't
+  stall the reading of the child process pipe. append() blocks when
+  MAX_BUFFER_SIZE is buffered. Since a single thread sends the packets, they
+  are sent in order of output_chunk_start.
+  """
+
+  def __init__(self, swarming_server, params, cost_usd_hour, task_start):
+    self._swarming_server = swarming_server
+    self._params = params.copy()
+    self._cost_usd_hour = cost_usd_hour
+    self._task_start = task_start
+    self._lock = threading.Lock()
+    self._cond = threading.Condition(self._lock)
+    # Output not sent yet and the offset of its first byte.
+    self._buffer = bytearray()
+    self._output_chunk_start = 0
+    self._last_packet = monotonic_time()
+    self._closed = False
+    self._error = None
+    self._thread = threading.Thread(target=self._run, name='OutputUploader')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def append(self, data):
+    """Buffers data to be sent. Blocks while the buffer is full.
+
+    Raises the exception that caused the uploader thread to fail, if any.
+    """
+    with self._cond:
+      while len(self._buffer) >= MAX_BUFFER_SIZE and not self._error:
+        self._cond.wait()
+      if self._error:
+        raise self._error
+      self._buffer.extend(data)
+      self._cond.notify_all()
+
+  def close(self):
+    """Stops the uploader thread.
+
+    Returns:
+      tuple(remaining output not sent yet, its output_chunk_start), to be sent
+      along the final packet. The remaining output is at most MAX_CHUNK_SIZE.
+    """
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+    self._thread.join()
+    if self._error:
+      raise self._error
+    return str(self._buffer), self._output_chunk_start
+
+  def _should_post(self):
+    """Returns True if a packet shall be sent now."""
+    if self._closed:
+      return len(self._buffer) > MAX_CHUNK_SIZE
+    return should_post_update(
+        self._buffer, monotonic_time(), self._last_packet)
+
+  def _run(self):
+    try:
+      while True:
+        with self._cond:
+          while not self._should_post():
+            if self._closed:
+              return
+            interval = (
+                MIN_PACKET_INTERNAL if self._buffer else MAX_PACKET_INTERVAL)
+            self._cond.wait(
+                max(self._last_packet + interval - monotonic_time(), 0.1))
+          stdout = str(self._buffer[:MAX_CHUNK_SIZE])
+          del self._buffer[:len(stdout)]
+          output_chunk_start = self._output_chunk_start
+          self._output_chunk_start += len(stdout)
+          self._cond.notify_all()
+        # Do not hold the lock while waiting for the server.
+        self._last_packet = monotonic_time()
+        self._params['cost_usd'] = (
+            self._cost_usd_hour * (self._last_packet - self._task_start) /
+            60. / 60.)
+        post_update(
+            self._swarming_server, self._params, None, stdout,
+            output_chunk_start)
+    except Exception as e:
+      logging.exception('Failed to send the task output')
+      with self._cond:
+        self._error = e
+        self._cond.notify_all()
+
+
+def calc_yield_wait(task_details, start, last_io, timed_out):
   """Calculates the maximum number of seconds to wait in yield_any()."""
   now = monotonic_time()
   if timed_out:
     # Give a |grace_period| seconds delay.
     return max(now - timed_out - task_details.grace_period, 0.)
 
-  packet_interval = MIN_PACKET_INTERNAL if stdout else MAX_PACKET_INTERVAL
   hard_timeout = start + task_details.hard_timeout - now
   io_timeout = last_io + task_details.io_timeout - now
-  out = max(min(min(packet_interval, hard_timeout), io_timeout), 0)
+  out = max(min(hard_timeout, io_timeout), 0)
   logging.debug('calc_yield_wait() = %d', out)
   return out
 
@@ -198,13 +308,14 @@ def run_command(
   """Runs a command and sends packets to the server to stream results back.
 
   Implements both I/O and hard timeouts. Sends the packets numbered, so the
-  server can ensure they are processed in order.
+  server can ensure they are processed in order. The output is sent by an
+  OutputUploader so the child process is read while packets are in flight.
 
   Returns:
     Child process exit code.
   """
   # Signal the command is about to be started.
-  last_packet = start = now = monotonic_time()
+  start = now = monotonic_time()
   params = {
     'cost_usd': cost_usd_hour * (now - task_start) / 60. / 60.,
     'id': task_details.bot_id,
@@ -238,32 +349,21 @@ def run_command(
     post_update(swarming_server, params, 1, stdout, 0)
     return 1
 
-  output_chunk_start = 0
-  stdout = ''
+  uploader = OutputUploader(swarming_server, params, cost_usd_hour, task_start)
   exit_code = None
   had_hard_timeout = False
   had_io_timeout = False
   timed_out = None
   try:
-    calc = lambda: calc_yield_wait(
-        task_details, start, last_io, timed_out, stdout)
-    maxsize = lambda: MAX_CHUNK_SIZE - len(stdout)
+    calc = lambda: calc_yield_wait(task_details, start, last_io, timed_out)
     last_io = monotonic_time()
-    for _, new_data in proc.yield_any(maxsize=maxsize, soft_timeout=calc):
+    for _, new_data in proc.yield_any(
+        maxsize=MAX_CHUNK_SIZE, soft_timeout=calc):
       now = monotonic_time()
       if new_data:
-        stdout += new_data
+        uploader.append(new_data)
         last_io = now
 
-      # Post update if necessary.
-      if should_post_update(stdout, now, last_packet):
-        last_packet = monotonic_time()
-        params['cost_usd'] = (
-            cost_usd_hour * (last_packet - task_start) / 60. / 60.)
-        post_update(swarming_server, params, None, stdout, output_chunk_start)
-        output_chunk_start += len(stdout)
-        stdout = ''
-
       # Send signal on timeout if necessary. Both are failures, not
       # internal_failures.
       # Eventually kill but return 0 so bot_main.py doesn't cancel the task.
@@ -311,6 +411,9 @@ def run_command(
       exit_code = proc.wait()
       logging.info('Waiting for proces exit in finally - done')
 
+    # At worst, it'll re-throw if a packet failed to be sent.
+    stdout, output_chunk_start = uploader.close()
+
     # This is the very last packet for this command.
     now = monotonic_time()
     params['cost_usd'] = cost_usd_hour * (now - task_start) / 60. / 60.
@@ -319,14 +422,11 @@ def run_command(
     params['hard_timeout'] = had_hard_timeout
     # At worst, it'll re-throw, which will be caught by bot_main.py.
     post_update(swarming_server, params, exit_code, stdout, output_chunk_start)
-    output_chunk_start += len(stdout)
-    stdout = ''
 
     with open(json_file, 'w') as fd:
       json.dump({'exit_code': exit_code, 'version': 1}, fd)
 
   logging.info('run_command() = %s', exit_code)
-  assert not stdout
   return exit_code
 
 
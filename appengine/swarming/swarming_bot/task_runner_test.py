@@ -17,6 +17,7 @@ import tempfile
 import time
 import unittest
 import zipfile
+import zlib
 
 import test_env
 test_env.setup_test_env()
@@ -347,8 +348,9 @@ class TestTaskRunner(TestTaskRunnerBase):
               'hard_timeout': False,
               'id': 'localhost',
               'io_timeout': False,
-              'output': base64.b64encode('hi!\n'),
-              'output_chunk_start': 100002*4,
+              'output': base64.b64encode(zlib.compress('hi!\n' * 23203)),
+              'output_chunk_start': 3 * task_runner.MAX_CHUNK_SIZE,
+              'output_encoding': 'zlib',
               'task_id': 23,
             },
             'headers': {'X-XSRF-Token': 'token'},
@@ -373,26 +375,32 @@ class TestTaskRunner(TestTaskRunnerBase):
         },
         {},
       ),
-      (
-        'https://localhost:1/swarming/api/v1/bot/task_update/23',
-        {
-          'data': {
-            'cost_usd': 10.,
-            'id': 'localhost',
-            'output': base64.b64encode('hi!\n' * 100002),
-            'output_chunk_start': 0,
-            'task_id': 23,
-          },
-          'headers': {'X-XSRF-Token': 'token'},
-        },
-        {},
-      ),
-      (
-        'https://localhost:1/swarming/api/v1/bot/task_update/23',
-        check_final,
-        {},
-      ),
     ]
+    # The output is sent in packets of MAX_CHUNK_SIZE, the remainder along the
+    # final packet.
+    for i in xrange(3):
+      requests.append(
+          (
+            'https://localhost:1/swarming/api/v1/bot/task_update/23',
+            {
+              'data': {
+                'cost_usd': 10.,
+                'id': 'localhost',
+                'output': base64.b64encode(zlib.compress('hi!\n' * 25600)),
+                'output_chunk_start': i * task_runner.MAX_CHUNK_SIZE,
+                'output_encoding': 'zlib',
+                'task_id': 23,
+              },
+              'headers': {'X-XSRF-Token': 'token'},
+            },
+            {},
+          ))
+    requests.append(
+        (
+          'https://localhost:1/swarming/api/v1/bot/task_update/23',
+          check_final,
+          {},
+        ))
     self.expected_requests(requests)
     server = xsrf_client.XsrfRemote('https://localhost:1/')
     task_details = task_runner.TaskDetails(
@@ -413,6 +421,22 @@ class TestTaskRunner(TestTaskRunnerBase):
         os.path.join(self.work_dir, 'task_summary.json'))
     self.assertEqual(0, r)
 
+  def test_output_uploader_error(self):
+    def post_update(*_):
+      raise ValueError('Sorry!')
+    self.mock(task_runner, 'post_update', post_update)
+    self.mock(task_runner, 'MAX_BUFFER_SIZE', 3)
+    self.mock(logging, 'exception', lambda *_: None)
+    uploader = task_runner.OutputUploader(
+        None, {'id': 'localhost', 'task_id': 23}, 3600., time.time())
+    # A packet is sent once MAX_CHUNK_SIZE is buffered. The buffer is still full
+    # afterward so the next append blocks until the uploader thread failed.
+    uploader.append('a' * 2 * task_runner.MAX_CHUNK_SIZE)
+    with self.assertRaises(ValueError):
+      uploader.append('b')
+    with self.assertRaises(ValueError):
+      uploader.close()
+
   def test_main(self):
     def load_and_run(
         manifest, swarming_server, cost_usd_hour, start, json_file):
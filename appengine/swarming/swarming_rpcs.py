@@ -50,6 +50,13 @@ class TaskId(messages.Message):
   task_id = messages.StringField(1)
 
 
+class TaskOutputRequest(messages.Message):
+  """Provides the task ID and optionally a range in bytes of its output."""
+  task_id = messages.StringField(1)
+  offset = messages.IntegerField(2)
+  length = messages.IntegerField(3)
+
+
 class TaskProperty(messages.Message):
   """Important metadata about a particular task."""
   command = messages.StringField(1, repeated=True)
@@ -102,6 +109,8 @@ class ServerDetails(messages.Message):
 class TaskOutput(messages.Message):
   """A task's output as a string."""
   output = messages.StringField(1)
+  # Offset to fetch the data that follows, only set when a range was requested.
+  next_offset = messages.IntegerField(2)
 
 
 class TaskResultSummary(messages.Message):
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# Copyright 2015 The Swarming Authors. All rights reserved.
+# Use of this source code is governed by the Apache v2.0 license that can be
+# found in the LICENSE file.
+
+"""Benchmarks the cost of the bot dimensions powerset used for dispatching.
+
+For each shape of bot dimensions, prints the time to hash the whole powerset,
+as done on a cache miss, the time of a cache hit, as done on the following
+polls of the same bot, and the memory used by the cached hashes.
+"""
+
+import optparse
+import os
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import test_env
+test_env.setup_test_env()
+
+from server import task_to_run
+
+
+def gen_dimensions(keys, values):
+  """Returns bot dimensions with |keys| keys of |values| values each."""
+  return {
+    u'key%d' % k: [u'value%d' % v for v in xrange(values)]
+    for k in xrange(keys)
+  }
+
+
+def measure(func, repeat):
+  """Returns the average duration of func() in seconds."""
+  start = time.time()
+  for _ in xrange(repeat):
+    func()
+  return (time.time() - start) / repeat
+
+
+def get_memory(accepted):
+  """Returns the memory used by a frozenset of dimensions_hash, in bytes."""
+  return sys.getsizeof(accepted) + sum(sys.getsizeof(i) for i in accepted)
+
+
+def main():
+  parser = optparse.OptionParser(description=sys.modules[__name__].__doc__)
+  parser.add_option(
+      '--keys', type='int', action='append',
+      help='Number of dimension keys, default: 2, 4, 7, 10, 14')
+  parser.add_option(
+      '--values', type='int', action='append',
+      help='Number of values per dimension key, default: 1, 3')
+  parser.add_option(
+      '--repeat', type='int', default=5,
+      help='Measurements per shape, default: %default')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unknown args passed in; %s' % args)
+
+  for keys in options.keys or (2, 4, 7, 10, 14):
+    for values in options.values or (1, 3):
+      dimensions = gen_dimensions(keys, values)
+      count = task_to_run.dimensions_powerset_count(dimensions)
+      if count > task_to_run.MAX_DIMENSIONS:
+        print('%2d keys x %d values: %8d combinations, refused' % (
+            keys, values, count))
+        continue
+
+      def miss():
+        task_to_run._accepted_hashes_cache = task_to_run._LRUCache(
+            task_to_run.ACCEPTED_HASHES_CACHE_SIZE)
+        task_to_run._get_accepted_dimensions_hashes(dimensions)
+
+      def hit():
+        task_to_run._get_accepted_dimensions_hashes(dimensions)
+
+      miss_secs = measure(miss, options.repeat)
+      hit_secs = measure(hit, options.repeat * 100)
+      accepted = task_to_run._get_accepted_dimensions_hashes(dimensions)
+      memory = get_memory(accepted)
+      print(
+          '%2d keys x %d values: %8d combinations, miss %9.3fms, hit %7.3fms, '
+          '%8.1fkb (%d bytes/hash)' %
+          (keys, values, count, miss_secs * 1000., hit_secs * 1000.,
+           memory / 1024., memory / len(accepted)))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# Copyright 2015 The Swarming Authors. All rights reserved.
+# Use of this source code is governed by the Apache v2.0 license that can be
+# found in the LICENSE file.
+
+"""Benchmarks task_scheduler.bot_update_task() streaming a large task output.
+
+Replays a log sent by a bot in one update per second of simulated time, with
+the output stored as TaskOutputChunk and as TaskOutputSegment, and reports the
+latency of the updates and the datastore RPCs done.
+"""
+
+import collections
+import datetime
+import logging
+import optparse
+import os
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import test_env
+test_env.setup_test_env()
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from components import auth_testing
+from components import utils
+from components.auth import api as auth_api
+from server import config
+from server import task_request
+from server import task_result
+from server import task_scheduler
+
+
+def new_run_result():
+  """Returns a running TaskRunResult saved in the DB."""
+  request = task_request.make_request({
+    'name': 'Bench',
+    'user': 'bench',
+    'properties': {
+      'commands': [[u'command1']],
+      'data': [],
+      'dimensions': {u'os': u'Amiga'},
+      'env': {},
+      'execution_timeout_secs': 24*60*60,
+      'io_timeout_secs': None,
+    },
+    'priority': 50,
+    'scheduling_expiration_secs': 60,
+    'tags': [],
+  })
+  result_summary = task_result.new_result_summary(request)
+  run_result = task_result.new_run_result(request, 1, 'bot1', 'abc')
+  run_result.modified_ts = utils.utcnow()
+  result_summary.set_from_run_result(run_result, request)
+  ndb.transaction(lambda: ndb.put_multi((result_summary, run_result)))
+  return run_result
+
+
+def replay(size, updates, rpcs):
+  """Sends |size| bytes of output in |updates| updates.
+
+  Returns the sorted list of the update durations.
+  """
+  run_result = new_run_result()
+  update_size = size / updates
+  data = ('Some log line %d\n' * (update_size / 16 + 1))[:update_size]
+  start_ts = utils.utcnow()
+  durations = []
+  rpcs.clear()
+  for i in xrange(updates):
+    # Each update is one second later.
+    now = start_ts + datetime.timedelta(seconds=i)
+    utils.utcnow = lambda: now
+    start = time.time()
+    success, _ = task_scheduler.bot_update_task(
+        run_result.key, 'bot1', data, i * update_size, None, None, False,
+        False, 0.)
+    durations.append(time.time() - start)
+    assert success
+  out = run_result.key.get().get_command_output_async(0).get_result()
+  assert len(out) == min(size, task_result.TaskOutput.FETCH_MAX_CONTENT), (
+      len(out))
+  return sorted(durations)
+
+
+def main():
+  parser = optparse.OptionParser(description=sys.modules[__name__].__doc__)
+  parser.add_option(
+      '--size', type='int', default=100*1024*1024,
+      help='Size of the log in bytes, default: %default')
+  parser.add_option(
+      '--updates', type='int', default=1000,
+      help='Number of updates, one per second, default: %default')
+  parser.add_option('-v', '--verbose', action='store_true')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unknown args passed in; %s' % args)
+  logging.basicConfig(level=logging.DEBUG if options.verbose else logging.ERROR)
+
+  bed = testbed.Testbed()
+  bed.activate()
+  try:
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    auth_api._get_current_identity = (
+        lambda: auth_testing.DEFAULT_MOCKED_IDENTITY)
+
+    rpcs = collections.Counter()
+    def count_rpc(service, call, *_args):
+      rpcs['%s.%s' % (service, call)] += 1
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('bench', count_rpc)
+
+    utcnow = utils.utcnow
+    for segmented in (False, True):
+      config.settings = (
+          lambda: config.GlobalConfig(use_output_segments=segmented))
+      durations = replay(options.size, options.updates, rpcs)
+      utils.utcnow = utcnow
+      print(
+          '%s: %d updates of %d bytes: total %.1fs, median %.1fms, 90th '
+          '%.1fms, max %.1fms' % (
+            'TaskOutputSegment' if segmented else 'TaskOutputChunk',
+            options.updates, options.size / options.updates,
+            sum(durations),
+            durations[len(durations) / 2] * 1000.,
+            durations[len(durations) * 9 / 10] * 1000.,
+            durations[-1] * 1000.))
+      for name, count in sorted(rpcs.iteritems()):
+        print('  %-28s %8.1f per update' % (
+            name, float(count) / options.updates))
+  finally:
+    bed.deactivate()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
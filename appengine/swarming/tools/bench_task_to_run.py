@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# Copyright 2015 The Swarming Authors. All rights reserved.
+# Use of this source code is governed by the Apache v2.0 license that can be
+# found in the LICENSE file.
+
+"""Benchmarks task_to_run.yield_next_available_task_to_dispatch().
+
+Fills a local datastore stub with queued tasks and polls it with bots of
+various dimension profiles, reporting the latency and the number of RPCs done
+per poll.
+"""
+
+import collections
+import logging
+import optparse
+import os
+import random
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import test_env
+test_env.setup_test_env()
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import testbed
+
+from components import auth_testing
+from components.auth import api as auth_api
+from server import task_request
+from server import task_to_run
+
+
+# Dimensions a bot profile is made of. Each bot has one value of each.
+DIMENSIONS = {
+  u'cpu': [u'x86', u'x86-64', u'arm'],
+  u'gpu': [u'none'] + [u'gpu%d' % i for i in xrange(9)],
+  u'os': [u'Linux', u'Mac', u'Windows', u'Android', u'iOS'],
+  u'pool': [u'pool%d' % i for i in xrange(20)],
+}
+
+
+def gen_bot_dimensions(index):
+  """Returns the dimensions of the bot profile |index|."""
+  out = {k: random.choice(v) for k, v in DIMENSIONS.iteritems()}
+  out[u'id'] = u'bot%d' % index
+  return out
+
+
+def gen_request_dimensions(bot_dimensions):
+  """Returns dimensions of a task that |bot_dimensions| can run."""
+  keys = random.sample(sorted(DIMENSIONS), random.randint(1, len(DIMENSIONS)))
+  return {k: bot_dimensions[k] for k in keys}
+
+
+def fill_queue(tasks, bots):
+  """Enqueues |tasks| TaskToRun runnable by the profiles in |bots|."""
+  for i in xrange(tasks):
+    request = task_request.make_request({
+      'name': 'Request %d' % i,
+      'user': 'bench',
+      'properties': {
+        'commands': [[u'command1']],
+        'data': [],
+        'dimensions': gen_request_dimensions(random.choice(bots)),
+        'env': {},
+        'execution_timeout_secs': 3600,
+        'io_timeout_secs': None,
+      },
+      'priority': random.randint(10, 200),
+      'scheduling_expiration_secs': 24*60*60,
+      'tags': [],
+    })
+    task_to_run.new_task_to_run(request).put()
+
+
+def poll(bot_dimensions):
+  """Returns the first task that would be reaped by the bot, if any."""
+  for request, _to_run in task_to_run.yield_next_available_task_to_dispatch(
+      bot_dimensions):
+    return request
+  return None
+
+
+def main():
+  parser = optparse.OptionParser(description=sys.modules[__name__].__doc__)
+  parser.add_option(
+      '--tasks', type='int', default=10000,
+      help='Queued tasks, default: %default')
+  parser.add_option(
+      '--bots', type='int', default=1000,
+      help='Bot dimension profiles, default: %default')
+  parser.add_option(
+      '--polls', type='int', default=200,
+      help='Polls to benchmark, each from a random profile, default: %default')
+  parser.add_option(
+      '--page-size', type='int', default=task_to_run.DISPATCH_PAGE_SIZE,
+      help='DISPATCH_PAGE_SIZE to use, default: %default')
+  parser.add_option('-v', '--verbose', action='store_true')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unknown args passed in; %s' % args)
+  logging.basicConfig(level=logging.DEBUG if options.verbose else logging.ERROR)
+  random.seed(0)
+  task_to_run.DISPATCH_PAGE_SIZE = options.page_size
+
+  bed = testbed.Testbed()
+  bed.activate()
+  try:
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    auth_api._get_current_identity = (
+        lambda: auth_testing.DEFAULT_MOCKED_IDENTITY)
+
+    rpcs = collections.Counter()
+    def count_rpc(service, call, *_args):
+      rpcs['%s.%s' % (service, call)] += 1
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('bench', count_rpc)
+
+    bots = [gen_bot_dimensions(i) for i in xrange(options.bots)]
+    start = time.time()
+    fill_queue(options.tasks, bots)
+    print('Enqueued %d tasks in %.1fs' % (options.tasks, time.time() - start))
+
+    rpcs.clear()
+    durations = []
+    found = 0
+    for _ in xrange(options.polls):
+      start = time.time()
+      if poll(random.choice(bots)):
+        found += 1
+      durations.append(time.time() - start)
+    durations.sort()
+    print(
+        '%d polls, %d found a task: median %.1fms, 90th %.1fms, max %.1fms' % (
+          options.polls, found,
+          durations[len(durations) / 2] * 1000.,
+          durations[len(durations) * 9 / 10] * 1000.,
+          durations[-1] * 1000.))
+    print('RPCs per poll:')
+    for name, count in sorted(rpcs.iteritems()):
+      print('  %-28s %8.1f' % (name, float(count) / options.polls))
+  finally:
+    bed.deactivate()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
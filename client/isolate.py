@@ -568,20 +568,25 @@ class CompleteState(object):
     """Updates self.saved_state.files with the files' mode and hash.
 
     If |subdir| is specified, filters to a subdirectory. The resulting .isolated
-    file is tainted.
+    file is tainted. Hashes not found in the saved state are looked up in the
+    persistent hash cache shared with other trees.
 
     See isolated_format.file_to_metadata() for more information.
     """
-    for infile in sorted(self.saved_state.files):
-      if subdir and not infile.startswith(subdir):
-        self.saved_state.files.pop(infile)
-      else:
-        filepath = os.path.join(self.root_dir, infile)
-        self.saved_state.files[infile] = isolated_format.file_to_metadata(
-            filepath,
-            self.saved_state.files[infile],
-            self.saved_state.read_only,
-            self.saved_state.algo)
+    if subdir:
+      for infile in self.saved_state.files.keys():
+        if not infile.startswith(subdir):
+          self.saved_state.files.pop(infile)
+    # The files are hashed in parallel.
+    with isolated_format.get_hash_cache() as hash_cache:
+      for infile, metadata in isolated_format.iter_files_metadata(
+          self.root_dir,
+          sorted(self.saved_state.files),
+          self.saved_state.files,
+          self.saved_state.read_only,
+          self.saved_state.algo,
+          hash_cache):
+        self.saved_state.files[infile] = metadata
 
   def save_files(self):
     """Saves self.saved_state and creates a .isolated file."""
@@ -779,40 +784,39 @@ def isolate_and_archive(trees, isolate_server, namespace):
   if not trees:
     return {}
 
-  # Helper generator to avoid materializing the full (huge) list of files until
-  # the very end (in upload_tree).
-  def emit_files(root_dir, files):
-    for path, meta in files.iteritems():
-      yield (os.path.join(root_dir, path), meta)
-
   # Process all *.isolate files, it involves parsing, file system traversal and
-  # hashing. The result is a list of generators that produce files to upload
-  # and the mapping {target name -> hash of *.isolated file} to return from
-  # this function.
-  files_generators = []
+  # hashing. It is done lazily as the files are uploaded, so the files of a tree
+  # are uploaded while the next tree is being isolated. Fills the mapping
+  # {target name -> hash of *.isolated file} to return from this function.
   isolated_hashes = {}
-  with tools.Profiler('Isolate'):
+  def emit_files():
     for opts, cwd in trees:
       target_name = os.path.splitext(os.path.basename(opts.isolated))[0]
       try:
         complete_state, files, isolated_hash = prepare_for_archival(opts, cwd)
-        files_generators.append(emit_files(complete_state.root_dir, files))
         isolated_hashes[target_name] = isolated_hash[0]
         print('%s  %s' % (isolated_hash[0], target_name))
       except Exception:
         logging.exception('Exception when isolating %s', target_name)
         isolated_hashes[target_name] = None
+        continue
+      for path, meta in files.iteritems():
+        yield (os.path.join(complete_state.root_dir, path), meta)
 
-  # All bad? Nothing to upload.
-  if all(v is None for v in isolated_hashes.itervalues()):
+  # Isolate until the first file to upload is found. All bad? Nothing to
+  # upload, so don't even contact the server.
+  infiles = emit_files()
+  with tools.Profiler('Isolate'):
+    first = next(infiles, None)
+  if first is None:
     return isolated_hashes
 
-  # Now upload all necessary files at once.
-  with tools.Profiler('Upload'):
+  # Upload all necessary files as they are produced.
+  with tools.Profiler('IsolateAndUpload'):
     try:
       isolateserver.upload_tree(
           base_url=isolate_server,
-          infiles=itertools.chain(*files_generators),
+          infiles=itertools.chain([first], infiles),
           namespace=namespace)
     except Exception:
       logging.exception('Exception while uploading files')
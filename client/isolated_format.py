@@ -11,8 +11,17 @@ import os
 import re
 import stat
 import sys
+import threading
+import time
+
+try:
+  import sqlite3
+except ImportError:
+  # The hash cache is disabled without sqlite.
+  sqlite3 = None
 
 from utils import file_path
+from utils import threading_utils
 from utils import tools
 
 
@@ -24,6 +33,33 @@ ISOLATED_FILE_VERSION = '1.4'
 DISK_FILE_CHUNK = 1024 * 1024
 
 
+# File name of the persistent cache of the file digests, shared across runs and
+# trees by the current user, in the user cache directory. The path can be
+# overridden with ISOLATE_HASH_CACHE environment variable, an empty value
+# disables the cache.
+HASH_CACHE_FILE = u'isolated_hash_cache.sqlite'
+
+
+# Files modified less than this number of seconds ago are not recorded in the
+# hash cache, since they could still be modified without their timestamp
+# changing.
+HASH_CACHE_RACY_DELAY = 2.
+
+
+# Number of new hash cache entries to accumulate before committing them.
+HASH_CACHE_COMMIT_SIZE = 1000
+
+
+# Maximum number of entries in the hash cache, the least recently used ones are
+# evicted beyond it. An entry takes about 200 bytes on disk.
+HASH_CACHE_MAX_ENTRIES = 200000
+
+
+# Number of the least recently used hash cache entries checked for a deleted
+# file each time the cache is closed.
+HASH_CACHE_PRUNE_CHECKS = 1000
+
+
 # Sadly, hashlib uses 'sha1' instead of the standard 'sha-1' so explicitly
 # specify the names here.
 SUPPORTED_ALGOS = {
@@ -64,6 +100,32 @@ def is_namespace_with_compression(namespace):
   return namespace.endswith(('-gzip', '-deflate'))
 
 
+def get_user_cache_dir():
+  """Returns the directory where the current user's caches are stored."""
+  if sys.platform == 'win32':
+    return os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+  if sys.platform == 'darwin':
+    return os.path.join(os.path.expanduser('~'), 'Library', 'Caches')
+  return (
+      os.environ.get('XDG_CACHE_HOME') or
+      os.path.join(os.path.expanduser('~'), '.cache'))
+
+
+def get_hash_cache():
+  """Returns the HashCache to use, as configured by the environment."""
+  db_path = os.environ.get('ISOLATE_HASH_CACHE')
+  if db_path is None:
+    cache_dir = get_user_cache_dir()
+    try:
+      if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    except OSError as e:
+      logging.warning('Failed to create %s: %s', cache_dir, e)
+      return HashCache(None)
+    db_path = os.path.join(cache_dir, HASH_CACHE_FILE)
+  return HashCache(db_path)
+
+
 def hash_file(filepath, algo):
   """Calculates the hash of a file without reading it all in memory at once.
 
@@ -79,6 +141,180 @@ def hash_file(filepath, algo):
   return digest.hexdigest()
 
 
+class HashCache(object):
+  """Persistent mapping of files to their digest, keyed by the file stat.
+
+  An entry is reused only if the path, inode, size and modification time of the
+  file are unchanged. It is backed by a sqlite database so it can be shared
+  between concurrent processes. Any failure to access the database disables
+  the cache instead of failing the caller.
+
+  The database is kept bounded to HASH_CACHE_MAX_ENTRIES entries, evicting the
+  least recently used ones, and entries of deleted files are pruned.
+
+  Can be used by multiple threads at once.
+  """
+
+  def __init__(self, db_path):
+    """Opens the database at |db_path|. If None or empty, the cache is no-op."""
+    self._lock = threading.Lock()
+    self._db = None
+    self._pending = 0
+    # (path, algo) of the entries used since the last commit.
+    self._used = set()
+    self.hits = 0
+    self.misses = 0
+    if not db_path or not sqlite3:
+      return
+    try:
+      self._db = sqlite3.connect(db_path, timeout=10, check_same_thread=False)
+      self._db.execute('PRAGMA synchronous=OFF')
+      self._db.execute(
+          'CREATE TABLE IF NOT EXISTS digests_v2 ('
+          'path TEXT, algo TEXT, inode INTEGER, size INTEGER, '
+          'mtime_ns INTEGER, digest TEXT, last_used INTEGER, '
+          'PRIMARY KEY (path, algo))')
+      self._db.execute(
+          'CREATE INDEX IF NOT EXISTS digests_v2_last_used '
+          'ON digests_v2 (last_used)')
+      self._db.commit()
+    except sqlite3.Error as e:
+      logging.warning('Failed to open hash cache %s: %s', db_path, e)
+      self._db = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, _exc_type, _exc_value, _traceback):
+    self.close()
+    return False
+
+  def close(self):
+    """Commits the new entries, trims and closes the database."""
+    with self._lock:
+      if self._db:
+        self._commit()
+      if self._db:
+        self._trim()
+        if self._db:
+          self._db.close()
+          self._db = None
+    if self.hits or self.misses:
+      logging.debug(
+          'Hash cache: %d hits, %d misses', self.hits, self.misses)
+
+  def hash_file(self, filepath, algo, filestats=None):
+    """Returns the digest of |filepath|, hashing it only on cache miss.
+
+    |filestats| is the result of os.stat(filepath) if already known.
+    """
+    if filestats is None:
+      filestats = os.stat(filepath)
+    key = self._key(filepath, filestats, algo)
+    digest = self._get(key)
+    if digest:
+      return digest
+    digest = hash_file(filepath, algo)
+    # Do not trust the timestamp of a file that was just modified, it could be
+    # modified again within the filesystem timestamp granularity.
+    if time.time() - filestats.st_mtime >= HASH_CACHE_RACY_DELAY:
+      self._set(key, digest)
+    return digest
+
+  @staticmethod
+  def _key(filepath, filestats, algo):
+    mtime_ns = getattr(filestats, 'st_mtime_ns', None)
+    if mtime_ns is None:
+      mtime_ns = int(filestats.st_mtime * 1000000000)
+    return (
+        os.path.abspath(filepath), SUPPORTED_ALGOS_REVERSE[algo],
+        filestats.st_ino, filestats.st_size, mtime_ns)
+
+  def _get(self, key):
+    with self._lock:
+      row = None
+      if self._db:
+        try:
+          row = self._db.execute(
+              'SELECT digest FROM digests_v2 WHERE path=? AND algo=? AND '
+              'inode=? AND size=? AND mtime_ns=?', key).fetchone()
+        except sqlite3.Error as e:
+          self._disable(e)
+      if row:
+        self.hits += 1
+        self._used.add(key[:2])
+        if len(self._used) >= HASH_CACHE_COMMIT_SIZE:
+          self._commit()
+        return str(row[0])
+      self.misses += 1
+      return None
+
+  def _set(self, key, digest):
+    with self._lock:
+      if not self._db:
+        return
+      try:
+        self._db.execute(
+            'INSERT OR REPLACE INTO digests_v2 VALUES (?, ?, ?, ?, ?, ?, ?)',
+            key + (digest, int(time.time())))
+      except sqlite3.Error as e:
+        self._disable(e)
+        return
+      self._pending += 1
+      # Do not keep the database locked for other processes for too long.
+      if self._pending >= HASH_CACHE_COMMIT_SIZE:
+        self._commit()
+
+  def _commit(self):
+    """Commits the pending entries and the last use of the entries that were
+    used. Must be called with the lock held.
+    """
+    if self._pending or self._used:
+      try:
+        if self._used:
+          now = int(time.time())
+          self._db.executemany(
+              'UPDATE digests_v2 SET last_used=? WHERE path=? AND algo=?',
+              ((now,) + used for used in self._used))
+        self._db.commit()
+      except sqlite3.Error as e:
+        self._disable(e)
+        return
+      self._pending = 0
+      self._used.clear()
+
+  def _trim(self):
+    """Deletes the entries of deleted files among the least recently used ones
+    and the entries beyond HASH_CACHE_MAX_ENTRIES. Must be called with the lock
+    held.
+    """
+    try:
+      rows = self._db.execute(
+          'SELECT path, algo FROM digests_v2 ORDER BY last_used LIMIT ?',
+          (HASH_CACHE_PRUNE_CHECKS,)).fetchall()
+      self._db.executemany(
+          'DELETE FROM digests_v2 WHERE path=? AND algo=?',
+          (row for row in rows if not os.path.isfile(row[0])))
+      count = self._db.execute('SELECT COUNT(*) FROM digests_v2').fetchone()[0]
+      if count > HASH_CACHE_MAX_ENTRIES:
+        self._db.execute(
+            'DELETE FROM digests_v2 WHERE rowid IN (SELECT rowid FROM '
+            'digests_v2 ORDER BY last_used LIMIT ?)',
+            (count - HASH_CACHE_MAX_ENTRIES,))
+      self._db.commit()
+    except sqlite3.Error as e:
+      self._disable(e)
+
+  def _disable(self, error):
+    """Stops using the database. Must be called with the lock held."""
+    logging.warning('Disabling hash cache: %s', error)
+    try:
+      self._db.close()
+    except sqlite3.Error:
+      pass
+    self._db = None
+
+
 class IsolatedFile(object):
   """Represents a single parsed .isolated file."""
 
@@ -204,7 +440,18 @@ def expand_symlinks(indir, relfile):
 def expand_directory_and_symlink(indir, relfile, blacklist, follow_symlinks):
   """Expands a single input. It can result in multiple outputs.
 
-  This function is recursive when relfile is a directory.
+  Returns the list of iter_directory_and_symlink() results.
+  """
+  return list(
+      iter_directory_and_symlink(indir, relfile, blacklist, follow_symlinks))
+
+
+def iter_directory_and_symlink(indir, relfile, blacklist, follow_symlinks):
+  """Expands a single input lazily. It can result in multiple outputs.
+
+  This function is recursive when relfile is a directory. Yields the relative
+  paths as the tree is walked, so the files can be processed before the walk
+  completes.
 
   Note: this code doesn't properly handle recursive symlink like one created
   with:
@@ -258,7 +505,8 @@ def expand_directory_and_symlink(indir, relfile, blacklist, follow_symlinks):
     # Special case './'.
     if relfile.startswith('.' + os.path.sep):
       relfile = relfile[2:]
-    outfiles = symlinks
+    for symlink in symlinks:
+      yield symlink
     try:
       for filename in file_path.listdir(infile):
         inner_relfile = os.path.join(relfile, filename)
@@ -266,10 +514,9 @@ def expand_directory_and_symlink(indir, relfile, blacklist, follow_symlinks):
           continue
         if os.path.isdir(os.path.join(indir, inner_relfile)):
           inner_relfile += os.path.sep
-        outfiles.extend(
-            expand_directory_and_symlink(indir, inner_relfile, blacklist,
-                                         follow_symlinks))
-      return outfiles
+        for outfile in iter_directory_and_symlink(
+            indir, inner_relfile, blacklist, follow_symlinks):
+          yield outfile
     except OSError as e:
       raise MappingError(
           'Unable to iterate over directory %s.\n%s' % (infile, e))
@@ -282,7 +529,9 @@ def expand_directory_and_symlink(indir, relfile, blacklist, follow_symlinks):
     if not os.path.isfile(infile):
       raise MappingError('Input file %s doesn\'t exist' % infile)
 
-    return symlinks + [relfile]
+    for symlink in symlinks:
+      yield symlink
+    yield relfile
 
 
 def expand_directories_and_symlinks(
@@ -306,7 +555,7 @@ def expand_directories_and_symlinks(
 
 
 @tools.profile
-def file_to_metadata(filepath, prevdict, read_only, algo):
+def file_to_metadata(filepath, prevdict, read_only, algo, hash_cache=None):
   """Processes an input file, a dependency, and return meta data about it.
 
   Behaviors:
@@ -323,6 +572,8 @@ def file_to_metadata(filepath, prevdict, read_only, algo):
                windows, mode is not set since all files are 'executable' by
                default.
     algo:      Hashing algorithm used.
+    hash_cache: HashCache to look the hash up into when it can't be reused from
+                prevdict. Optional.
 
   Returns:
     The necessary dict to create a entry in the 'files' section of an .isolated
@@ -371,7 +622,10 @@ def file_to_metadata(filepath, prevdict, read_only, algo):
       # Reuse the previous hash if available.
       out['h'] = prevdict.get('h')
     if not out.get('h'):
-      out['h'] = hash_file(filepath, algo)
+      if hash_cache:
+        out['h'] = hash_cache.hash_file(filepath, algo, filestats)
+      else:
+        out['h'] = hash_file(filepath, algo)
   else:
     # If the timestamp wasn't updated, carry on the link destination.
     if prevdict.get('t') == out['t']:
@@ -390,6 +644,46 @@ def file_to_metadata(filepath, prevdict, read_only, algo):
   return out
 
 
+def iter_files_metadata(
+    indir, relfiles, prevdicts, read_only, algo, hash_cache=None):
+  """Yields (relfile, metadata) for each of |relfiles|, in completion order.
+
+  Runs file_to_metadata() on a pool of threads, one per core, since hashlib
+  releases the GIL while hashing. |relfiles| is consumed on one of the pool's
+  threads so it can be a generator walking the tree, like
+  iter_directory_and_symlink(), and the first results are yielded before the
+  walk completes.
+
+  Arguments:
+    indir: root directory of |relfiles|.
+    relfiles: iterable of file paths relative to |indir|.
+    prevdicts: dict of relfile to the previous metadata, see file_to_metadata().
+    read_only, algo, hash_cache: see file_to_metadata().
+  """
+  threads = threading_utils.num_processors()
+  pool = threading_utils.ThreadPool(1, threads + 1, 0, 'hash')
+  try:
+    def process(relfile):
+      return relfile, file_to_metadata(
+          os.path.join(indir, relfile), prevdicts.get(relfile, {}), read_only,
+          algo, hash_cache)
+
+    def walk():
+      for relfile in relfiles:
+        pool.add_task(0, process, relfile)
+
+    # Tasks are started in FIFO order so the walk is started first. It is
+    # pending until all the files are enqueued so iter_results() can't return
+    # early.
+    pool.add_task(0, walk)
+    for result in pool.iter_results():
+      yield result
+  finally:
+    # Cancel the files not yet processed on failure.
+    pool.abort()
+    pool.close()
+
+
 def save_isolated(isolated, data):
   """Writes one or multiple .isolated files.
 
@@ -9,16 +9,19 @@ __version__ = '0.4.3'
 
 import base64
 import functools
+import itertools
 import logging
 import optparse
 import os
 import re
 import signal
+import stat
+import struct
+import subprocess
 import sys
 import tempfile
 import threading
 import time
-import types
 import urllib
 import urlparse
 import zlib
@@ -67,6 +70,21 @@ DEADLOCK_TIMEOUT = 5 * 60
 ITEMS_PER_CONTAINS_QUERIES = (20, 20, 50, 50, 50, 100)
 
 
+# Maximum number of '/pre-upload' queries and of pushes Storage.upload_items()
+# keeps in flight. When reached, it stops consuming the items to upload until
+# some complete, so a fast producer doesn't queue an unbounded amount of work.
+MAX_PENDING_CONTAINS_QUERIES = 16
+MAX_PENDING_PUSHES = 256
+
+
+# Items whose size is known and at most MAX_BATCH_FETCH_SIZE are fetched by
+# FetchQueue in batches of up to ITEMS_PER_FETCH_BATCH with a single
+# '/retrieve_batch' query instead of one '/retrieve' query each. Small files
+# dominate typical trees, so this saves most of the HTTP round trips.
+MAX_BATCH_FETCH_SIZE = 16 * 1024
+ITEMS_PER_FETCH_BATCH = 100
+
+
 # A list of already compressed extension types that should not receive any
 # compression before being uploaded.
 ALREADY_COMPRESSED_TYPES = [
@@ -75,6 +93,26 @@ ALREADY_COMPRESSED_TYPES = [
 ]
 
 
+# The compressibility of an item is estimated by compressing at most
+# ZIP_SAMPLE_SIZE bytes of its first chunk at level 1, if the chunk is at least
+# ZIP_SAMPLE_MIN_SIZE bytes. Items whose sample compresses to more than
+# ZIP_INCOMPRESSIBLE_RATIO of its size are stored uncompressed. Items whose
+# sample compresses to more than ZIP_POOR_RATIO use level 1, since higher levels
+# cost a lot more CPU for little gain on them.
+ZIP_SAMPLE_SIZE = 64 * 1024
+ZIP_SAMPLE_MIN_SIZE = 4 * 1024
+ZIP_INCOMPRESSIBLE_RATIO = 0.9
+ZIP_POOR_RATIO = 0.6
+
+
+# Items of at least ZIP_PARALLEL_MIN_SIZE bytes are compressed in blocks of
+# ZIP_BLOCK_SIZE bytes on Storage.cpu_thread_pool, keeping at most
+# ZIP_MAX_PENDING_BLOCKS blocks per item in memory.
+ZIP_PARALLEL_MIN_SIZE = 8 * 1024 * 1024
+ZIP_BLOCK_SIZE = 1024 * 1024
+ZIP_MAX_PENDING_BLOCKS = 8
+
+
 # Chunk size to use when reading from network stream.
 NET_IO_FILE_CHUNK = 16 * 1024
 
@@ -166,6 +204,72 @@ def zip_compress(content_generator, level=7):
     yield tail
 
 
+def zip_compress_parallel(content_generator, level, thread_pool):
+  """Reads chunks from |content_generator| and yields zip compressed chunks.
+
+  Compresses blocks of ZIP_BLOCK_SIZE bytes concurrently on |thread_pool|. Each
+  block is a raw deflate segment ending with a sync flush so the concatenation
+  is a single valid zlib stream, decompressible with zip_decompress(). Matches
+  across block boundaries are lost, which costs a negligible amount of size at
+  this block size.
+  """
+  def compress_block(block):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+  def iter_blocks():
+    buf = []
+    buf_size = 0
+    for chunk in content_generator:
+      buf.append(chunk)
+      buf_size += len(chunk)
+      if buf_size >= ZIP_BLOCK_SIZE:
+        yield ''.join(buf)
+        buf = []
+        buf_size = 0
+    if buf:
+      yield ''.join(buf)
+
+  # zlib header for the default window size and compression level.
+  yield '\x78\x9c'
+  adler = 1
+  # Channels of the blocks being compressed, in order.
+  pending = []
+  for block in iter_blocks():
+    adler = zlib.adler32(block, adler)
+    channel = threading_utils.TaskChannel()
+    thread_pool.add_task(
+        threading_utils.PRIORITY_MED, channel.wrap_task(compress_block), block)
+    pending.append(channel)
+    if len(pending) >= ZIP_MAX_PENDING_BLOCKS:
+      yield pending.pop(0).pull()
+  for channel in pending:
+    yield channel.pull()
+  # An empty final block, then the checksum of the uncompressed data.
+  yield zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS).flush(
+      zlib.Z_FINISH)
+  yield struct.pack('>I', adler & 0xffffffff)
+
+
+def zip_compress_adaptive(content_generator, level=7, thread_pool=None):
+  """Reads chunks from |content_generator| and yields zip compressed chunks.
+
+  Lowers |level| according to the compressibility of the first chunk, see
+  get_adaptive_zip_compression_level(). If |thread_pool| is provided, blocks
+  are compressed in parallel on it, see zip_compress_parallel().
+  """
+  content_generator = iter(content_generator)
+  first = next(content_generator, '')
+  level = get_adaptive_zip_compression_level(first, level)
+  content_generator = itertools.chain([first], content_generator)
+  if thread_pool and level:
+    compressed = zip_compress_parallel(content_generator, level, thread_pool)
+  else:
+    compressed = zip_compress(content_generator, level)
+  for chunk in compressed:
+    yield chunk
+
+
 def zip_decompress(
     content_generator, chunk_size=isolated_format.DISK_FILE_CHUNK):
   """Reads zipped data from |content_generator| and yields decompressed data.
@@ -200,11 +304,28 @@ def zip_decompress(
 
 def get_zip_compression_level(filename):
   """Given a filename calculates the ideal zip compression level to use."""
-  file_ext = os.path.splitext(filename)[1].lower()
-  # TODO(csharp): Profile to find what compression level works best.
+  file_ext = os.path.splitext(filename)[1].lower().lstrip('.')
+  # Use tools/zip_profiler.py to revisit the levels.
   return 0 if file_ext in ALREADY_COMPRESSED_TYPES else 7
 
 
+def get_adaptive_zip_compression_level(sample, level):
+  """Returns the zip compression level to use for content starting with
+  |sample|, at most |level|.
+
+  Returns |level| as-is if |sample| is too small to be significant.
+  """
+  if not level or len(sample) < ZIP_SAMPLE_MIN_SIZE:
+    return level
+  sample = sample[:ZIP_SAMPLE_SIZE]
+  ratio = float(len(zlib.compress(sample, 1))) / len(sample)
+  if ratio > ZIP_INCOMPRESSIBLE_RATIO:
+    return 0
+  if ratio > ZIP_POOR_RATIO:
+    return min(level, 1)
+  return level
+
+
 def create_directories(base_directory, files):
   """Creates the directory structure needed by the given list of files."""
   logging.debug('create_directories(%s, %d)', base_directory, len(files))
@@ -240,7 +361,11 @@ def is_valid_file(filepath, size):
   """
   if size == UNKNOWN_FILE_SIZE:
     return os.path.isfile(filepath)
-  actual_size = os.stat(filepath).st_size
+  try:
+    actual_size = os.stat(filepath).st_size
+  except OSError:
+    logging.warning('Missing item %s', os.path.basename(filepath))
+    return False
   if size != actual_size:
     logging.warning(
         'Found invalid item %s; %d != %d',
@@ -342,6 +467,9 @@ class Storage(object):
     self._net_thread_pool = None
     self._aborted = False
     self._prev_sig_handlers = {}
+    # Set once fetch_batch() reported it is not supported, e.g. on a server
+    # without '/retrieve_batch', to not try it again.
+    self._fetch_batch_unsupported = False
 
   @property
   def hash_algo(self):
@@ -425,37 +553,65 @@ class Storage(object):
 
     It figures out what items are missing from the server and uploads only them.
 
+    It runs as a pipeline: |items| can be a generator, its items are batched
+    for lookup as they are produced, the lookups run concurrently and each
+    missing item is pushed as soon as its lookup returns. The number of lookups
+    and pushes in flight is bounded by MAX_PENDING_CONTAINS_QUERIES and
+    MAX_PENDING_PUSHES.
+
     Arguments:
-      items: list of Item instances that represents data to upload.
+      items: iterable of Item instances that represents data to upload.
 
     Returns:
       List of items that were uploaded. All other items are already there.
     """
-    logging.info('upload_items(items=%d)', len(items))
-
-    # Ensure all digests are calculated.
-    for item in items:
-      item.prepare(self._hash_algo)
+    logging.info('upload_items()')
 
     # For each digest keep only first Item that matches it. All other items
     # are just indistinguishable copies from the point of view of isolate
     # server (it doesn't care about paths at all, only content and digests).
     seen = {}
-    duplicates = 0
-    for item in items:
-      if seen.setdefault(item.digest, item) is not item:
-        duplicates += 1
-    items = seen.values()
-    if duplicates:
-      logging.info('Skipped %d files with duplicated content', duplicates)
+    duplicates = [0]
+    def iter_unique_items():
+      for item in items:
+        # Ensure the digest is calculated.
+        item.prepare(self._hash_algo)
+        if seen.setdefault(item.digest, item) is item:
+          yield item
+        else:
+          duplicates[0] += 1
 
-    # Enqueue all upload tasks.
     missing = set()
     uploaded = []
     channel = threading_utils.TaskChannel()
-    for missing_item, push_state in self.get_missing_items(items):
-      missing.add(missing_item)
-      self.async_push(channel, missing_item, push_state)
+    lookups = threading_utils.TaskChannel()
+    pending_lookups = 0
+    batches = iter_batches_for_check(iter_unique_items())
+    while True:
+      batch = next(batches, None)
+      if batch:
+        self._async_contains(lookups, batch)
+        pending_lookups += 1
+      # Push the missing items of the lookups that completed. Block when too
+      # many are in flight or when there's no more items to look up.
+      while pending_lookups:
+        block = pending_lookups >= MAX_PENDING_CONTAINS_QUERIES or not batch
+        try:
+          result = lookups.pull(timeout=None if block else 0)
+        except threading_utils.TaskChannel.Timeout:
+          break
+        pending_lookups -= 1
+        for missing_item, push_state in result.iteritems():
+          missing.add(missing_item)
+          self.async_push(channel, missing_item, push_state)
+        while len(missing) - len(uploaded) > MAX_PENDING_PUSHES:
+          uploaded.append(channel.pull())
+      if not batch:
+        break
+
+    items = seen.values()
+    if duplicates[0]:
+      logging.info('Skipped %d files with duplicated content', duplicates[0])
 
     # No need to spawn deadlock detector thread if there's nothing to upload.
     if missing:
@@ -482,7 +638,7 @@ class Storage(object):
         'cache hit:  %6d, %9.1fkb, %6.2f%% files, %6.2f%% size',
         len(cache_hit),
         cache_hit_size / 1024.,
-        len(cache_hit) * 100. / total,
+        len(cache_hit) * 100. / total if total else 0,
         cache_hit_size * 100. / total_size if total_size else 0)
     cache_miss = missing
     cache_miss_size = sum(f.size for f in cache_miss)
@@ -490,7 +646,7 @@ class Storage(object):
         'cache miss: %6d, %9.1fkb, %6.2f%% files, %6.2f%% size',
         len(cache_miss),
         cache_miss_size / 1024.,
-        len(cache_miss) * 100. / total,
+        len(cache_miss) * 100. / total if total else 0,
         cache_miss_size * 100. / total_size if total_size else 0)
 
     return uploaded
@@ -530,7 +686,21 @@ class Storage(object):
         threading_utils.PRIORITY_HIGH if item.high_priority
         else threading_utils.PRIORITY_MED)
 
-    def push(content):
+    def content():
+      """Returns a new generator of the data to upload, compressed as needed.
+
+      Each retry gets a fresh generator that rereads the item from its source,
+      so no more than a few chunks of the item are kept in memory at a time.
+      """
+      if self._use_zip:
+        thread_pool = None
+        if item.size >= ZIP_PARALLEL_MIN_SIZE:
+          thread_pool = self.cpu_thread_pool
+        return zip_compress_adaptive(
+            item.content(), item.compression_level, thread_pool)
+      return item.content()
+
+    def push():
       """Pushes an Item and returns it to |channel|."""
       if self._aborted:
         raise Aborted()
@@ -538,28 +708,7 @@ class Storage(object):
       self._storage_api.push(item, push_state, content)
       return item
 
-    # If zipping is not required, just start a push task.
-    if not self._use_zip:
-      self.net_thread_pool.add_task_with_channel(
-          channel, priority, push, item.content())
-      return
-
-    # If zipping is enabled, zip in a separate thread.
-    def zip_and_push():
-      # TODO(vadimsh): Implement streaming uploads. Before it's done, assemble
-      # content right here. It will block until all file is zipped.
-      try:
-        if self._aborted:
-          raise Aborted()
-        stream = zip_compress(item.content(), item.compression_level)
-        data = ''.join(stream)
-      except Exception as exc:
-        logging.error('Failed to zip \'%s\': %s', item, exc)
-        channel.send_exception()
-        return
-      self.net_thread_pool.add_task_with_channel(
-          channel, priority, push, [data])
-    self.cpu_thread_pool.add_task(priority, zip_and_push)
+    self.net_thread_pool.add_task_with_channel(channel, priority, push)
 
   def push(self, item, push_state):
     """Synchronously pushes a single item to the server.
@@ -610,6 +759,62 @@ class Storage(object):
     # really fast and most probably IO bound anyway.
     self.net_thread_pool.add_task_with_channel(channel, priority, fetch)
 
+  def async_fetch_batch(self, channel, priority, items, sink_factory):
+    """Starts asynchronous fetch of multiple small items in a parallel thread.
+
+    Items the server doesn't return inline or that fail verification are
+    fetched one by one with async_fetch(), as are all the items of a batch query
+    that failed. Once the storage reports it doesn't support batches, all the
+    items are fetched one by one from then on.
+
+    Arguments:
+      channel: TaskChannel that receives back each digest when its download
+          ends.
+      priority: thread pool task priority for the fetch.
+      items: dict digest -> expected size of the item (after decompression).
+      sink_factory: function that returns the sink for a digest, as
+          sink_factory(digest)(generator).
+    """
+    def store_or_fetch(fetched):
+      for digest, size in sorted(items.iteritems()):
+        content = fetched.get(digest)
+        if content is None:
+          self.async_fetch(channel, priority, digest, size,
+              sink_factory(digest))
+          continue
+        try:
+          stream = [content]
+          if self._use_zip:
+            stream = zip_decompress(stream, isolated_format.DISK_FILE_CHUNK)
+          verifier = FetchStreamVerifier(stream, size)
+          sink_factory(digest)(verifier.run())
+        except Exception as err:
+          # Not fatal, it may have been corrupted in transit.
+          logging.warning('Failed to verify %s, fetching it again: %s',
+              digest, err)
+          self.async_fetch(channel, priority, digest, size,
+              sink_factory(digest))
+          continue
+        channel.send_result(digest)
+
+    def fetch_batch():
+      fetched = {}
+      if not self._fetch_batch_unsupported:
+        try:
+          fetched = self._storage_api.fetch_batch(sorted(items))
+        except NotImplementedError:
+          self._fetch_batch_unsupported = True
+        except Exception as err:
+          # Not fatal, the items of this batch will be fetched individually.
+          logging.warning('Failed to fetch a batch of %d items: %s',
+              len(items), err)
+      store_or_fetch(fetched)
+
+    if self._fetch_batch_unsupported:
+      store_or_fetch({})
+    else:
+      self.net_thread_pool.add_task(priority, fetch_batch)
+
   def get_missing_items(self, items):
     """Yields items that are missing from the server.
 
@@ -633,15 +838,9 @@ class Storage(object):
     for item in items:
       item.prepare(self._hash_algo)
 
-    def contains(batch):
-      if self._aborted:
-        raise Aborted()
-      return self._storage_api.contains(batch)
-
     # Enqueue all requests.
     for batch in batch_items_for_check(items):
-      self.net_thread_pool.add_task_with_channel(
-          channel, threading_utils.PRIORITY_HIGH, contains, batch)
+      self._async_contains(channel, batch)
       pending += 1
 
     # Yield results as they come in.
@@ -649,6 +848,20 @@ class Storage(object):
       for missing_item, push_state in channel.pull().iteritems():
         yield missing_item, push_state
 
+  def _async_contains(self, channel, batch):
+    """Starts an asynchronous lookup of |batch| on the server.
+
+    Sends to |channel| the dict {missing item -> push_state} returned by
+    StorageApi's 'contains' method.
+    """
+    def contains():
+      if self._aborted:
+        raise Aborted()
+      return self._storage_api.contains(batch)
+
+    self.net_thread_pool.add_task_with_channel(
+        channel, threading_utils.PRIORITY_HIGH, contains)
+
 
 def batch_items_for_check(items):
   """Splits list of items to check for existence on the server into batches.
@@ -659,6 +872,23 @@ def batch_items_for_check(items):
   Arguments:
     items: a list of Item objects.
 
+  Yields:
+    Batches of items to query for existence in a single operation,
+    each batch is a list of Item objects.
+  """
+  return iter_batches_for_check(
+      sorted(items, key=lambda x: x.size, reverse=True))
+
+
+def iter_batches_for_check(items):
+  """Splits a stream of items to check for existence into batches.
+
+  Same as batch_items_for_check() except that |items| is not sorted, so each
+  batch is yielded as soon as it is full, before |items| is exhausted.
+
+  Arguments:
+    items: an iterable of Item objects.
+
   Yields:
     Batches of items to query for existence in a single operation,
     each batch is a list of Item objects.
@@ -666,7 +896,7 @@ def batch_items_for_check(items):
   batch_count = 0
   batch_size_limit = ITEMS_PER_CONTAINS_QUERIES[0]
   next_queries = []
-  for item in sorted(items, key=lambda x: x.size, reverse=True):
+  for item in items:
     next_queries.append(item)
     if len(next_queries) == batch_size_limit:
       yield next_queries
@@ -693,16 +923,21 @@ class FetchQueue(object):
     self._pending = set()
     self._accessed = set()
     self._fetched = cache.cached_set()
+    # priority -> dict digest -> size of small items not yet sent to Storage.
+    self._batches = {}
 
   def add(
       self,
       digest,
       size=UNKNOWN_FILE_SIZE,
       priority=threading_utils.PRIORITY_MED):
-    """Starts asynchronous fetch of item |digest|."""
+    """Starts asynchronous fetch of item |digest|.
+
+    Returns True if the item is already in the cache, False otherwise.
+    """
     # Fetching it now?
     if digest in self._pending:
-      return
+      return False
 
     # Mark this file as in use, verify_all_cached will later ensure it is still
     # in cache.
@@ -712,7 +947,7 @@ class FetchQueue(object):
     if digest in self._fetched:
       # 'touch' returns True if item is in cache and not corrupted.
       if self.cache.touch(digest, size):
-        return
+        return True
       # Item is corrupted, remove it from cache and fetch it again.
       self._fetched.remove(digest)
       self.cache.evict(digest)
@@ -725,16 +960,27 @@ class FetchQueue(object):
     # - Make sure there's enough free disk space to fit all dependencies of
     #   this run! If not, abort early.
 
-    # Start fetching.
+    # Start fetching. Small items are coalesced in batches, sent either when
+    # full or before blocking on a retrieval.
     self._pending.add(digest)
+    if size != UNKNOWN_FILE_SIZE and size <= MAX_BATCH_FETCH_SIZE:
+      batch = self._batches.setdefault(priority, {})
+      batch[digest] = size
+      if len(batch) >= ITEMS_PER_FETCH_BATCH:
+        self._flush_batch(priority)
+      return False
     self.storage.async_fetch(
         self._channel, priority, digest, size,
         functools.partial(self.cache.write, digest))
+    return False
 
   def wait(self, digests):
     """Starts a loop that waits for at least one of |digests| to be retrieved.
 
     Returns the first digest retrieved.
+
+    Each call scans |digests|, use iter_fetched() or wait_fetching() to wait
+    on a large set.
     """
     # Flush any already fetched items.
     for digest in digests:
@@ -744,18 +990,47 @@ class FetchQueue(object):
     # Ensure all requested items are being fetched now.
     assert all(digest in self._pending for digest in digests), (
         digests, self._pending)
+    return self.wait_fetching(digests)
+
+  def wait_fetching(self, digests):
+    """Waits for at least one of |digests| to be retrieved.
+
+    Unlike wait(), all |digests| must be in the process of being fetched, this
+    is not verified. Costs O(1) per retrieved item.
 
-    # Wait for some requested item to finish fetching.
+    Returns the first digest retrieved.
+    """
     while self._pending:
-      digest = self._channel.pull()
-      self._pending.remove(digest)
-      self._fetched.add(digest)
+      digest = self._pull()
       if digest in digests:
         return digest
 
-    # Should never reach this point due to assert above.
+    # Should never reach this point if all |digests| are being fetched.
     raise RuntimeError('Impossible state')
 
+  def iter_fetched(self, digests):
+    """Yields each of |digests| as soon as it is retrieved.
+
+    Digests already fetched are yielded first. Then each retrieved item costs
+    O(1), independently of the number of digests still waited for.
+
+    |digests| is copied so the caller can remove yielded items from it.
+    """
+    waiting = set()
+    for digest in list(digests):
+      if digest in self._fetched:
+        yield digest
+      else:
+        # Ensure all requested items are being fetched now.
+        assert digest in self._pending, digest
+        waiting.add(digest)
+
+    while waiting:
+      digest = self._pull()
+      if digest in waiting:
+        waiting.remove(digest)
+        yield digest
+
   def inject_local_file(self, path, algo):
     """Adds local file to the cache as if it was fetched from storage."""
     with open(path, 'rb') as f:
@@ -770,6 +1045,23 @@ class FetchQueue(object):
     """Returns number of items to be fetched."""
     return len(self._pending)
 
+  def _pull(self):
+    """Blocks until any pending item is retrieved and returns its digest."""
+    for priority in self._batches.keys():
+      self._flush_batch(priority)
+    digest = self._channel.pull()
+    self._pending.remove(digest)
+    self._fetched.add(digest)
+    return digest
+
+  def _flush_batch(self, priority):
+    """Starts fetching the small items batched at |priority|."""
+    batch = self._batches.pop(priority, None)
+    if batch:
+      self.storage.async_fetch_batch(
+          self._channel, priority, batch,
+          lambda digest: functools.partial(self.cache.write, digest))
+
   def verify_all_cached(self):
     """True if all accessed items are in cache."""
     return self._accessed.issubset(self.cache.cached_set())
@@ -870,8 +1162,23 @@ class StorageApi(object):
     """
     raise NotImplementedError()
 
+  def fetch_batch(self, digests):
+    """Fetches multiple small objects at once.
+
+    Arguments:
+      digests: list of hash digests of items to download.
+
+    Returns:
+      A dict digest -> content (as str object). Digests the storage couldn't
+      return this way are absent and must be fetched with 'fetch'.
+
+    Raises:
+      NotImplementedError if the storage doesn't support batches.
+    """
+    raise NotImplementedError()
+
   def push(self, item, push_state, content=None):
-    """Uploads an |item| with content generated by |content| generator.
+    """Uploads an |item| with content generated by |content| callable.
 
     |item| MUST go through 'contains' call to get |push_state| before it can
     be pushed to the storage.
@@ -883,14 +1190,18 @@ class StorageApi(object):
 
     When pushing to a namespace with compression, data that should be pushed
     and data provided by the item is not the same. In that case |content| is
-    not None and it yields chunks of compressed data (using item.content() as
-    a source of original uncompressed data). This is implemented by Storage
-    class.
+    not None and it returns a generator of chunks of compressed data (using
+    item.content() as a source of original uncompressed data). This is
+    implemented by Storage class.
+
+    |content| may be called multiple times, once per upload attempt. Each call
+    must return a new generator that starts from the beginning of the data.
 
     Arguments:
       item: Item object that holds information about an item being pushed.
       push_state: push state object as returned by 'contains' call.
-      content: a generator that yields chunks to push, item.content() if None.
+      content: a callable that returns a generator that yields chunks to push,
+          item.content if None.
 
     Returns:
       None.
@@ -950,7 +1261,6 @@ class IsolateServer(StorageApi):
     }
     self._lock = threading.Lock()
     self._server_caps = None
-    self._memory_use = 0
 
   @property
   def _server_capabilities(self):
@@ -1033,6 +1343,29 @@ class IsolateServer(StorageApi):
 
     return stream_read(connection, NET_IO_FILE_CHUNK)
 
+  def fetch_batch(self, digests):
+    caps = self._server_capabilities
+    if caps is not None and not caps.get('retrieve_batch'):
+      # The server predates '/retrieve_batch'.
+      raise NotImplementedError()
+    source_url = '%s/_ah/api/isolateservice/v1/retrieve_batch' % (
+        self._base_url)
+    logging.debug('fetch_batch(%s, %d)', source_url, len(digests))
+    data = {
+        'digests': [d.encode('utf-8') for d in digests],
+        'namespace': self._namespace_dict,
+    }
+    response = net.url_read_json(
+        url=source_url,
+        data=data,
+        read_timeout=DOWNLOAD_READ_TIMEOUT)
+    if response is None:
+      raise IOError('Attempted to fetch from %s; no response.' % source_url)
+    return {
+      i['digest']: base64.b64decode(i['content'])
+      for i in response.get('items', [])
+    }
+
   def push(self, item, push_state, content=None):
     assert isinstance(item, Item)
     assert item.digest is not None
@@ -1041,80 +1374,40 @@ class IsolateServer(StorageApi):
     assert not push_state.finalized
 
     # Default to item.content().
-    content = item.content() if content is None else content
+    content = item.content if content is None else content
+    assert callable(content), repr(content)
     logging.info('Push state size: %d', push_state.size)
-    if isinstance(content, (basestring, list)):
-      # Memory is already used, too late.
-      with self._lock:
-        self._memory_use += push_state.size
-    else:
-      # TODO(vadimsh): Do not read from |content| generator when retrying push.
-      # If |content| is indeed a generator, it can not be re-winded back to the
-      # beginning of the stream. A retry will find it exhausted. A possible
-      # solution is to wrap |content| generator with some sort of caching
-      # restartable generator. It should be done alongside streaming support
-      # implementation.
-      #
-      # In theory, we should keep the generator, so that it is not serialized in
-      # memory. Sadly net.HttpService.request() requires the body to be
-      # serialized.
-      assert isinstance(content, types.GeneratorType), repr(content)
-      slept = False
-      # HACK HACK HACK. Please forgive me for my sins but OMG, it works!
-      # One byte less than 512mb. This is to cope with incompressible content.
-      max_size = int(sys.maxsize * 0.25)
-      while True:
-        with self._lock:
-          # This is due to 32 bits python when uploading very large files. The
-          # problem is that it's comparing uncompressed sizes, while we care
-          # about compressed sizes since it's what is serialized in memory.
-          # The first check assumes large files are compressible and that by
-          # throttling one upload at once, we can survive. Otherwise, kaboom.
-          memory_use = self._memory_use
-          if ((push_state.size >= max_size and not memory_use) or
-              (memory_use + push_state.size <= max_size)):
-            self._memory_use += push_state.size
-            memory_use = self._memory_use
-            break
-        time.sleep(0.1)
-        slept = True
-      if slept:
-        logging.info('Unblocked: %d %d', memory_use, push_state.size)
 
-    try:
-      # This push operation may be a retry after failed finalization call below,
-      # no need to reupload contents in that case.
-      if not push_state.uploaded:
-        # PUT file to |upload_url|.
-        success = self.do_push(push_state, content)
-        if not success:
-          raise IOError('Failed to upload file with hash %s to URL %s' % (
-              item.digest, push_state.upload_url))
-        push_state.uploaded = True
-      else:
-        logging.info(
-            'A file %s already uploaded, retrying finalization only',
-            item.digest)
-
-      # Optionally notify the server that it's done.
-      if push_state.finalize_url:
-        # TODO(vadimsh): Calculate MD5 or CRC32C sum while uploading a file and
-        # send it to isolated server. That way isolate server can verify that
-        # the data safely reached Google Storage (GS provides MD5 and CRC32C of
-        # stored files).
-        # TODO(maruel): Fix the server to accept properly data={} so
-        # url_read_json() can be used.
-        response = net.url_read_json(
-            url='%s/%s' % (self._base_url, push_state.finalize_url),
-            data={
-                'upload_ticket': push_state.preupload_status['upload_ticket'],
-            })
-        if not response or not response['ok']:
-          raise IOError('Failed to finalize file with hash %s.' % item.digest)
-      push_state.finalized = True
-    finally:
-      with self._lock:
-        self._memory_use -= push_state.size
+    # This push operation may be a retry after failed finalization call below,
+    # no need to reupload contents in that case.
+    if not push_state.uploaded:
+      # PUT file to |upload_url|.
+      success = self.do_push(push_state, content)
+      if not success:
+        raise IOError('Failed to upload file with hash %s to URL %s' % (
+            item.digest, push_state.upload_url))
+      push_state.uploaded = True
+    else:
+      logging.info(
+          'A file %s already uploaded, retrying finalization only',
+          item.digest)
+
+    # Optionally notify the server that it's done.
+    if push_state.finalize_url:
+      # TODO(vadimsh): Calculate MD5 or CRC32C sum while uploading a file and
+      # send it to isolated server. That way isolate server can verify that
+      # the data safely reached Google Storage (GS provides MD5 and CRC32C of
+      # stored files).
+      # TODO(maruel): Fix the server to accept properly data={} so
+      # url_read_json() can be used.
+      response = net.url_read_json(
+          url='%s/%s' % (self._base_url, push_state.finalize_url),
+          data={
+              'upload_ticket': push_state.preupload_status['upload_ticket'],
+          })
+      if not response or not response['ok']:
+        raise IOError('Failed to finalize file with hash %s.' % item.digest)
+    push_state.finalized = True
 
   def contains(self, items):
     # Ensure all items were initialized with 'prepare' call. Storage does that.
@@ -1188,30 +1481,24 @@ class IsolateServer(StorageApi):
     subclasses.
 
     Args:
-      url: URL to upload the data to.
       push_state: an _IsolateServicePushState instance
-      item: the original Item to be uploaded
-      content: an iterable that yields 'str' chunks.
+      content: a callable that returns a generator that yields 'str' chunks. It
+          is called again on each retry.
     """
-    # A cheezy way to avoid memcpy of (possibly huge) file, until streaming
-    # upload support is implemented.
-    if isinstance(content, list) and len(content) == 1:
-      content = content[0]
-    else:
-      content = ''.join(content)
-
     # DB upload
     if not push_state.finalize_url:
+      # Only small items are stored inline in the DB, it's fine to assemble
+      # them in memory.
       url = '%s/%s' % (self._base_url, push_state.upload_url)
-      content = base64.b64encode(content)
       data = {
           'upload_ticket': push_state.preupload_status['upload_ticket'],
-          'content': content,
+          'content': base64.b64encode(''.join(content())),
       }
       response = net.url_read_json(url=url, data=data)
       return response is not None and response['ok']
 
-    # upload to GS
+    # upload to GS. The content is streamed, the size of the compressed data is
+    # not known in advance.
     url = push_state.upload_url
     response = net.url_read(
         content_type='application/octet-stream',
@@ -1334,29 +1621,52 @@ class CachePolicies(object):
 
 
 class DiskCache(LocalCache):
-  """Stateful LRU cache in a flat hash table in a directory.
+  """Stateful LRU cache in a sharded hash table in a directory.
 
-  Saves its state as json file.
+  Each item is stored as <cache_dir>/<digest[:2]>/<digest[2:4]>/<digest>, so
+  that no single directory grows too large. Saves its state as json file along
+  an append-only journal of the changes done since the json file was written,
+  so that opening and closing the cache doesn't rewrite the whole state.
   """
   STATE_FILE = 'state.json'
-
-  def __init__(self, cache_dir, policies, hash_algo):
+  JOURNAL_FILE = 'state.journal'
+  VERSION_FILE = 'version'
+  # Version of the layout on disk. There was no VERSION_FILE in version 1, all
+  # the items were in a flat directory.
+  LAYOUT_VERSION = 2
+
+  def __init__(
+      self, cache_dir, policies, hash_algo, trim_in_background=False):
     """
     Arguments:
       cache_dir: directory where to place the cache.
       policies: cache retention policies.
       algo: hashing algorithm used.
+      trim_in_background: if True, the files of the items evicted when trimming
+          the cache are deleted in a background thread.
     """
     super(DiskCache, self).__init__()
     self.cache_dir = cache_dir
     self.policies = policies
     self.hash_algo = hash_algo
+    self.trim_in_background = trim_in_background
     self.state_file = os.path.join(cache_dir, self.STATE_FILE)
+    self.journal_file = os.path.join(cache_dir, self.JOURNAL_FILE)
+    self.version_file = os.path.join(cache_dir, self.VERSION_FILE)
 
     # All protected methods (starting with '_') except _path should be called
     # with this lock locked.
     self._lock = threading_utils.LockWithAssert()
     self._lru = lru.LRUDict()
+    # Sum of the sizes of all the items in self._lru.
+    self._total_size = 0
+    # Evicted items whose file is not yet deleted: digest -> size.
+    self._pending_delete = {}
+    # Thread deleting the files in self._pending_delete, if any.
+    self._deleter = None
+    # TreeCache whose trees link the files of this cache, if any. The disk
+    # space only used by its trees counts against the policies.
+    self.tree_cache = None
 
     # Profiling values.
     self._added = []
@@ -1381,7 +1691,7 @@ class DiskCache(LocalCache):
         logging.info(
             '%5d (%8dkb) current',
             len(self._lru),
-            sum(self._lru.itervalues()) / 1024)
+            self._total_size / 1024)
         logging.info(
             '%5d (%8dkb) removed',
             len(self._removed), sum(self._removed) / 1024)
@@ -1415,7 +1725,9 @@ class DiskCache(LocalCache):
 
   def evict(self, digest):
     with self._lock:
-      self._lru.pop(digest)
+      if digest in self._lru:
+        self._total_size -= self._lru.pop(digest)
+      self._pending_delete.pop(digest, None)
       self._delete_file(digest, UNKNOWN_FILE_SIZE)
 
   def read(self, digest):
@@ -1425,6 +1737,10 @@ class DiskCache(LocalCache):
   def write(self, digest, content):
     assert content is not None
     path = self._path(digest)
+    with self._lock:
+      # The file of an evicted item may not be deleted yet, make sure the
+      # background deletion doesn't delete the new file.
+      self._pending_delete.pop(digest, None)
     # A stale broken file may remain. It is possible for the file to have write
     # access bit removed which would cause the file_write() call to fail to open
     # in write mode. Take no chance here.
@@ -1461,39 +1777,65 @@ class DiskCache(LocalCache):
       os.chmod(dest, file_mode & 0500)
 
   def _load(self):
-    """Loads state of the cache from json file."""
+    """Loads state of the cache from json file and its journal.
+
+    Doesn't look at the items on disk, unless the cache has to be migrated from
+    an older layout or its state is lost.
+    """
     self._lock.assert_locked()
 
     if not os.path.isdir(self.cache_dir):
       os.makedirs(self.cache_dir)
-    else:
-      # Make sure the cache is read-only.
-      # TODO(maruel): Calculate the cost and optimize the performance
-      # accordingly.
-      file_path.make_tree_read_only(self.cache_dir)
 
     # Load state of the cache.
+    loaded = False
     if os.path.isfile(self.state_file):
       try:
-        self._lru = lru.LRUDict.load(self.state_file)
+        self._lru = lru.LRUDict.load(self.state_file, self.journal_file)
+        self._total_size = sum(self._lru.itervalues())
+        loaded = True
       except ValueError as err:
         logging.error('Failed to load cache state: %s' % (err,))
         # Don't want to keep broken state file.
         file_path.try_remove(self.state_file)
+        file_path.try_remove(self.journal_file)
+
+    if not loaded or self._read_version() != self.LAYOUT_VERSION:
+      self._scan()
+    self._trim()
+
+  def _read_version(self):
+    """Returns the layout version of the cache on disk."""
+    try:
+      with open(self.version_file, 'rb') as f:
+        return int(f.read())
+    except (IOError, ValueError):
+      return 1
+
+  def _scan(self):
+    """Reconciles the state with the items on disk.
+
+    Moves items stored in the flat layout into their shard directory, adds back
+    untracked items, forgets lost items and deletes anything else. It is slow on
+    large caches so it is only done when migrating the layout or when the state
+    is lost.
+    """
+    self._lock.assert_locked()
+    logging.warning('Scanning the whole cache %s', self.cache_dir)
+    if sys.platform != 'win32':
+      file_path.set_read_only(self.cache_dir, False)
 
     # Ensure that all files listed in the state still exist and add new ones.
     previous = self._lru.keys_set()
     unknown = []
-    for filename in os.listdir(self.cache_dir):
-      if filename == self.STATE_FILE:
-        continue
+    def check(filename, p):
       if filename in previous:
         previous.remove(filename)
-        continue
+        return
       # An untracked file.
-      if not isolated_format.is_valid_hash(filename, self.hash_algo):
-        logging.warning('Removing unknown file %s from cache', filename)
-        p = self._path(filename)
+      if (not isolated_format.is_valid_hash(filename, self.hash_algo) or
+          not os.path.isfile(p)):
+        logging.warning('Removing unknown file %s from cache', p)
         if os.path.isdir(p):
           try:
             file_path.rmtree(p)
@@ -1501,12 +1843,31 @@ class DiskCache(LocalCache):
             pass
         else:
           file_path.try_remove(p)
-        continue
+        return
       # File that's not referenced in 'state.json'.
       # TODO(vadimsh): Verify its SHA1 matches file name.
       logging.warning('Adding unknown file %s to cache', filename)
       unknown.append(filename)
 
+    for filename in os.listdir(self.cache_dir):
+      p = os.path.join(self.cache_dir, filename)
+      if filename in (self.STATE_FILE, self.JOURNAL_FILE, self.VERSION_FILE):
+        continue
+      if self._is_shard(filename) and os.path.isdir(p):
+        for dirpath, _dirnames, filenames in os.walk(p):
+          for name in filenames:
+            check(name, os.path.join(dirpath, name))
+        continue
+      if (isolated_format.is_valid_hash(filename, self.hash_algo) and
+          os.path.isfile(p)):
+        # Item in the flat layout of version 1, move it to its shard.
+        dest = self._path(filename)
+        if not os.path.isdir(os.path.dirname(dest)):
+          os.makedirs(os.path.dirname(dest))
+        os.rename(p, dest)
+        p = dest
+      check(filename, p)
+
     if unknown:
       # Add as oldest files. They will be deleted eventually if not accessed.
       self._add_oldest_list(unknown)
@@ -1516,8 +1877,20 @@ class DiskCache(LocalCache):
       # Filter out entries that were not found.
       logging.warning('Removed %d lost files', len(previous))
       for filename in previous:
-        self._lru.pop(filename)
-    self._trim()
+        self._total_size -= self._lru.pop(filename)
+
+    # Make sure the items in the cache are read-only. It's only done here since
+    # it is as slow as the scan itself, write() makes new items read-only.
+    for digest in self._lru.keys_set():
+      file_path.set_read_only(self._path(digest), True)
+
+    with open(self.version_file, 'wb') as f:
+      f.write(str(self.LAYOUT_VERSION))
+
+  @staticmethod
+  def _is_shard(filename):
+    """Returns True if |filename| is the name of a first level shard."""
+    return len(filename) == 2 and all(c in '0123456789abcdef' for c in filename)
 
   def _save(self):
     """Saves the LRU ordering."""
@@ -1529,63 +1902,132 @@ class DiskCache(LocalCache):
         file_path.set_read_only(d, False)
     if os.path.isfile(self.state_file):
       file_path.set_read_only(self.state_file, False)
-    self._lru.save(self.state_file)
+    self._lru.save(self.state_file, self.journal_file)
 
   def _trim(self):
-    """Trims anything we don't know, make sure enough free space exists."""
+    """Trims anything we don't know, make sure enough free space exists.
+
+    The items to evict are determined upfront from the running total size. Their
+    files are then deleted as a batch, in a background thread if
+    self.trim_in_background is True. The files evicted to free disk space or
+    while there are trees are deleted right away, to measure the space actually
+    freed.
+    """
     self._lock.assert_locked()
 
-    # Ensure maximum cache size.
+    # Ensure maximum cache size. The files only kept by the trees count too.
+    # Evicting files the trees link makes them grow, then the oldest trees are
+    # evicted.
     if self.policies.max_cache_size:
-      total_size = sum(self._lru.itervalues())
-      while total_size > self.policies.max_cache_size:
-        total_size -= self._remove_lru_file()
+      self._remove_lru_files(
+          self._total_size + self._get_tree_size() -
+          self.policies.max_cache_size, 0)
+      while (self.tree_cache and
+             self._total_size + self._get_tree_size() >
+                 self.policies.max_cache_size and
+             self.tree_cache.evict_oldest()):
+        pass
 
     # Ensure maximum number of items in the cache.
-    if self.policies.max_items and len(self._lru) > self.policies.max_items:
-      for _ in xrange(len(self._lru) - self.policies.max_items):
-        self._remove_lru_file()
+    if self.policies.max_items:
+      self._remove_lru_files(0, len(self._lru) - self.policies.max_items)
 
-    # Ensure enough free space.
+    # Ensure enough free space. Deleting a file doesn't free its size if it is
+    # still hardlinked somewhere else, e.g. in a TreeCache or a run directory,
+    # so the free space is queried again after each evicted batch.
     self._free_disk = file_path.get_free_space(self.cache_dir)
-    trimmed_due_to_space = False
-    while (
-        self.policies.min_free_space and
-        self._lru and
-        self._free_disk < self.policies.min_free_space):
-      trimmed_due_to_space = True
-      self._remove_lru_file()
+    trimmed = False
+    while (self.policies.min_free_space and
+           self._free_disk < self.policies.min_free_space):
+      # The trees go first, the space held by their files can't be freed
+      # otherwise.
+      if not (self.tree_cache and self.tree_cache.evict_oldest()):
+        if not self._lru:
+          break
+        self._remove_lru_files(
+            self.policies.min_free_space - self._free_disk, 0)
+        self._delete_pending_files_now()
+      trimmed = True
       self._free_disk = file_path.get_free_space(self.cache_dir)
-    if trimmed_due_to_space:
-      total_usage = sum(self._lru.itervalues())
+    if trimmed:
       usage_percent = 0.
-      if total_usage:
-        usage_percent = 100. * self.policies.max_cache_size / float(total_usage)
+      if self.policies.max_cache_size:
+        usage_percent = (
+            100. * self._total_size / float(self.policies.max_cache_size))
       logging.warning(
           'Trimmed due to not enough free disk space: %.1fkb free, %.1fkb '
           'cache (%.1f%% of its maximum capacity)',
           self._free_disk / 1024.,
-          total_usage / 1024.,
+          self._total_size / 1024.,
           usage_percent)
     self._save()
+    self._delete_pending_files()
 
   def _path(self, digest):
     """Returns the path to one item."""
-    return os.path.join(self.cache_dir, digest)
+    return os.path.join(self.cache_dir, digest[:2], digest[2:4], digest)
 
-  def _remove_lru_file(self):
-    """Removes the last recently used file and returns its size."""
+  def _remove_lru_files(self, min_size, min_count):
+    """Evicts the least recently used items until at least |min_size| bytes and
+    |min_count| items are evicted.
+
+    The files are not deleted, see _delete_pending_files(). Returns the total
+    size of the evicted items.
+    """
     self._lock.assert_locked()
-    digest, size = self._lru.pop_oldest()
-    self._delete_file(digest, size)
+    size = 0
+    count = 0
+    while self._lru and (size < min_size or count < min_count):
+      digest, item_size = self._lru.pop_oldest()
+      self._pending_delete[digest] = item_size
+      self._total_size -= item_size
+      size += item_size
+      count += 1
     return size
 
+  def _delete_pending_files(self):
+    """Deletes the files of the evicted items."""
+    self._lock.assert_locked()
+    if not self._pending_delete:
+      return
+    if not self.trim_in_background:
+      self._delete_pending_files_now()
+    elif not self._deleter:
+      self._deleter = threading.Thread(
+          name='DiskCache deleter', target=self._run_deleter)
+      self._deleter.start()
+
+  def _delete_pending_files_now(self):
+    """Deletes the files of the evicted items in the current thread."""
+    self._lock.assert_locked()
+    while self._pending_delete:
+      self._delete_file(*self._pending_delete.popitem())
+
+  def _get_tree_size(self):
+    """Returns the disk space only used by the trees of self.tree_cache."""
+    if not self.tree_cache:
+      return 0
+    # The evicted files must be gone to know if the trees still link them.
+    self._delete_pending_files_now()
+    return self.tree_cache.get_exclusive_size()
+
+  def _run_deleter(self):
+    """Deletes the files in self._pending_delete until there is none left."""
+    while True:
+      # Take the lock for each file, so write() can reclaim a pending item.
+      with self._lock:
+        if not self._pending_delete:
+          self._deleter = None
+          return
+        self._delete_file(*self._pending_delete.popitem())
+
   def _add(self, digest, size=UNKNOWN_FILE_SIZE):
     """Adds an item into LRU cache marking it as a newest one."""
     self._lock.assert_locked()
     if size == UNKNOWN_FILE_SIZE:
       size = os.stat(self._path(digest)).st_size
     self._added.append(size)
+    self._total_size += size - (self._lru.get(digest) or 0)
     self._lru.add(digest, size)
 
   def _add_oldest_list(self, digests):
@@ -1595,6 +2037,7 @@ class DiskCache(LocalCache):
     for digest in digests:
       size = os.stat(self._path(digest)).st_size
       self._added.append(size)
+      self._total_size += size - (self._lru.get(digest) or 0)
       pairs.append((digest, size))
     self._lru.batch_insert_oldest(pairs)
 
@@ -1610,6 +2053,213 @@ class DiskCache(LocalCache):
       logging.error('Error attempting to delete a file %s:\n%s' % (digest, e))
 
 
+class TreeCache(object):
+  """LRU cache of fully mapped trees, keyed by the hash of their .isolated file.
+
+  Each tree is stored as <tree_dir>/<isolated hash>. It is mapped to its
+  destination with a single 'cp' invocation making copy-on-write clones of the
+  files, instead of one hardlink() call per file. The tasks can't modify the
+  cached files through the clones. On failure, the caller falls back to mapping
+  the files one by one. The cache is disabled on file systems without clones.
+
+  The trees are made of hardlinks to the files in DiskCache, so the content of
+  the files evicted from DiskCache stays on disk until their trees are evicted
+  too. DiskCache accounts for it when set as its tree_cache. Only supported on
+  POSIX.
+  """
+  STATE_FILE = 'state.json'
+
+  # 'cp' command lines to copy the content of a directory to another one,
+  # sharing the content of the files.
+  if sys.platform == 'darwin':
+    CLONE_CMDS = (('cp', '-cpR'),)
+    HARDLINK_CMDS = ()
+  else:
+    CLONE_CMDS = (('cp', '-a', '--reflink=always'),)
+    HARDLINK_CMDS = (('cp', '-al'),)
+
+  def __init__(self, tree_dir, max_items):
+    """
+    Arguments:
+      tree_dir: directory where to place the trees.
+      max_items: maximum number of trees to keep.
+    """
+    self.tree_dir = tree_dir
+    self.max_items = max_items
+    self.state_file = os.path.join(tree_dir, self.STATE_FILE)
+    self._lru = lru.LRUDict()
+    # Whether the file system supports copy-on-write clones, determined on
+    # first use.
+    self._clone_supported = None
+    self._load()
+
+  def __contains__(self, isolated_hash):
+    return isolated_hash in self._lru
+
+  def materialize(self, isolated_hash, dest):
+    """Maps the tree of |isolated_hash| into the existing directory |dest|.
+
+    The files are copy-on-write clones, so the tree can be modified without
+    affecting the cache. Returns True on success; on failure |dest| is left
+    empty.
+    """
+    if isolated_hash not in self._lru or not self._can_clone():
+      return False
+    if not self._copy_tree(self._path(isolated_hash), dest, self.CLONE_CMDS):
+      # The tree may be broken, do not try it again.
+      self._evict(isolated_hash)
+      self._save()
+      return False
+    self._lru.touch(isolated_hash)
+    self._save()
+    return True
+
+  def add(self, isolated_hash, src):
+    """Stores a copy of the tree |src| mapped for |isolated_hash|.
+
+    Must be called before |src| is modified. Failures are only logged.
+    """
+    if (isolated_hash in self._lru or self.max_items <= 0 or
+        not self._can_clone()):
+      return
+    tmp = None
+    try:
+      tmp = tempfile.mkdtemp(prefix=u'tmp', dir=self.tree_dir)
+      if not self._copy_tree(
+          src, tmp, self.HARDLINK_CMDS + self.CLONE_CMDS):
+        file_path.rmtree(tmp)
+        return
+      os.rename(tmp, self._path(isolated_hash))
+    except (IOError, OSError) as e:
+      logging.error('Failed to add tree %s: %s', isolated_hash, e)
+      if tmp and os.path.isdir(tmp):
+        try:
+          file_path.rmtree(tmp)
+        except OSError as e:
+          logging.error('Failed to delete %s: %s', tmp, e)
+      return
+    self._lru.add(isolated_hash, True)
+    self._trim()
+    self._save()
+
+  def evict_oldest(self):
+    """Evicts the least recently used tree. Returns False if there is none."""
+    if not self._lru:
+      return False
+    self._delete_tree(self._lru.pop_oldest()[0])
+    self._save()
+    return True
+
+  def get_exclusive_size(self):
+    """Returns the size of the files that are only linked from the trees.
+
+    These are the files evicted from DiskCache, their disk space is only freed
+    once the trees linking them are evicted.
+    """
+    # (st_dev, st_ino) -> [st_nlink, st_size, links found in the trees].
+    inodes = {}
+    for isolated_hash in self._lru.keys_set():
+      for root, _dirs, files in os.walk(self._path(isolated_hash)):
+        for filename in files:
+          st = os.lstat(os.path.join(root, filename))
+          if not stat.S_ISREG(st.st_mode):
+            continue
+          inodes.setdefault(
+              (st.st_dev, st.st_ino), [st.st_nlink, st.st_size, 0])[2] += 1
+    return sum(size for nlink, size, found in inodes.itervalues()
+               if found >= nlink)
+
+  def _path(self, isolated_hash):
+    return os.path.join(self.tree_dir, isolated_hash)
+
+  def _can_clone(self):
+    """Returns True if copy-on-write clones are supported in self.tree_dir."""
+    if self._clone_supported is None:
+      tmp = tempfile.mkdtemp(prefix=u'tmp', dir=self.tree_dir)
+      try:
+        src = os.path.join(tmp, 'src')
+        dest = os.path.join(tmp, 'dest')
+        os.mkdir(src)
+        os.mkdir(dest)
+        file_write(os.path.join(src, 'file'), ['a'])
+        self._clone_supported = self._copy_tree(src, dest, self.CLONE_CMDS)
+      finally:
+        file_path.rmtree(tmp)
+      if not self._clone_supported:
+        logging.warning(
+            'Disabling the tree cache, %s doesn\'t support copy-on-write '
+            'clones', self.tree_dir)
+    return self._clone_supported
+
+  def _load(self):
+    """Loads the state and removes the directories not listed in it.
+
+    The temporary directories of trees being added are left alone.
+    """
+    if not os.path.isdir(self.tree_dir):
+      os.makedirs(self.tree_dir)
+    if os.path.isfile(self.state_file):
+      try:
+        self._lru = lru.LRUDict.load(self.state_file)
+      except ValueError as err:
+        logging.error('Failed to load tree cache state: %s' % (err,))
+    for isolated_hash in self._lru.keys_set():
+      if not os.path.isdir(self._path(isolated_hash)):
+        self._lru.pop(isolated_hash)
+    for filename in os.listdir(self.tree_dir):
+      if filename == self.STATE_FILE or filename.startswith('tmp'):
+        continue
+      if filename not in self._lru:
+        logging.warning('Removing unknown tree %s', filename)
+        file_path.rmtree(os.path.join(self.tree_dir, filename))
+    self._trim()
+    self._save()
+
+  def _save(self):
+    self._lru.save(self.state_file)
+
+  def _trim(self):
+    """Evicts the oldest trees until there are at most max_items of them."""
+    while len(self._lru) > max(self.max_items, 0):
+      self._delete_tree(self._lru.pop_oldest()[0])
+
+  def _evict(self, isolated_hash):
+    self._lru.pop(isolated_hash)
+    self._delete_tree(isolated_hash)
+
+  def _delete_tree(self, isolated_hash):
+    try:
+      file_path.rmtree(self._path(isolated_hash))
+    except OSError as e:
+      logging.error('Failed to delete tree %s: %s', isolated_hash, e)
+
+  @staticmethod
+  def _copy_tree(src, dest, cmds):
+    """Copies the content of |src| into |dest| with the first working command.
+
+    Returns True on success. On failure, |dest| is left empty.
+    """
+    for cmd in cmds:
+      cmd = list(cmd) + [os.path.join(src, '.'), dest]
+      try:
+        proc = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        if not proc.returncode:
+          return True
+        logging.info('%s failed:\n%s', ' '.join(cmd), output)
+      except OSError as e:
+        logging.warning('Failed to run %s: %s', cmd[0], e)
+      # Empty |dest| before trying the next command.
+      for filename in os.listdir(dest):
+        path = os.path.join(dest, filename)
+        if os.path.isdir(path) and not os.path.islink(path):
+          file_path.rmtree(path)
+        else:
+          file_path.try_remove(path)
+    return False
+
+
 class IsolatedBundle(object):
   """Fetched and parsed .isolated file with all dependencies."""
 
@@ -1621,7 +2271,7 @@ class IsolatedBundle(object):
     # The main .isolated file, a IsolatedFile instance.
     self.root = None
 
-  def fetch(self, fetch_queue, root_isolated_hash, algo):
+  def fetch(self, fetch_queue, root_isolated_hash, algo, fetch_files=True):
     """Fetches the .isolated and all the included .isolated.
 
     It enables support for "included" .isolated files. They are processed in
@@ -1640,8 +2290,8 @@ class IsolatedBundle(object):
     in 'includes' is important.
 
     As a side effect this method starts asynchronous fetch of all data files
-    by adding them to |fetch_queue|. It doesn't wait for data files to finish
-    fetching though.
+    by adding them to |fetch_queue|, unless |fetch_files| is False. It doesn't
+    wait for data files to finish fetching though.
     """
     self.root = isolated_format.IsolatedFile(root_isolated_hash, algo)
 
@@ -1649,8 +2299,15 @@ class IsolatedBundle(object):
     pending = {}
     # Set of hashes of already retrieved items to refuse recursive includes.
     seen = set()
+    # Hashes of isolated files in |pending| that are already in the cache.
+    cached = []
     # Set of IsolatedFile's whose data files have already being fetched.
     processed = set()
+    # Next IsolatedFile's to process in traversal order, the next one last. It
+    # is the resumable state of isolated_format.walk_includes(self.root), so
+    # each loaded *.isolated file is visited once instead of re-walking the
+    # whole tree.
+    to_process = [self.root]
 
     def retrieve_async(isolated_file):
       h = isolated_file.obj_hash
@@ -1660,14 +2317,18 @@ class IsolatedBundle(object):
       assert h not in pending
       seen.add(h)
       pending[h] = isolated_file
-      fetch_queue.add(h, priority=threading_utils.PRIORITY_HIGH)
+      if fetch_queue.add(h, priority=threading_utils.PRIORITY_HIGH):
+        cached.append(h)
 
     # Start fetching root *.isolated file (single file, not the whole bundle).
     retrieve_async(self.root)
 
     while pending:
       # Wait until some *.isolated file is fetched, parse it.
-      item_hash = fetch_queue.wait(pending)
+      if cached:
+        item_hash = cached.pop()
+      else:
+        item_hash = fetch_queue.wait_fetching(pending)
       item = pending.pop(item_hash)
       item.load(fetch_queue.cache.read(item_hash))
 
@@ -1678,14 +2339,11 @@ class IsolatedBundle(object):
       # Always fetch *.isolated files in traversal order, waiting if necessary
       # until next to-be-processed node loads. "Waiting" is done by yielding
       # back to the outer loop, that waits until some *.isolated is loaded.
-      for node in isolated_format.walk_includes(self.root):
-        if node not in processed:
-          # Not visited, and not yet loaded -> wait for it to load.
-          if not node.is_loaded:
-            break
-          # Not visited and loaded -> process it and continue the traversal.
-          self._start_fetching_files(node, fetch_queue)
-          processed.add(node)
+      while to_process and to_process[-1].is_loaded:
+        node = to_process.pop()
+        self._start_fetching_files(node, fetch_queue if fetch_files else None)
+        processed.add(node)
+        to_process.extend(reversed(node.children))
 
     # All *.isolated files should be processed by now and only them.
     all_isolateds = set(isolated_format.walk_includes(self.root))
@@ -1696,10 +2354,17 @@ class IsolatedBundle(object):
       self._update_self(node)
     self.relative_cwd = self.relative_cwd or ''
 
+  def fetch_files(self, fetch_queue):
+    """Starts fetching all the files, when fetch() was told not to."""
+    for properties in self.files.itervalues():
+      if 'h' in properties:
+        fetch_queue.add(
+            properties['h'], properties['s'], threading_utils.PRIORITY_MED)
+
   def _start_fetching_files(self, isolated, fetch_queue):
     """Starts fetching files from |isolated| that are not yet being fetched.
 
-    Modifies self.files.
+    Modifies self.files. Only lists the files if |fetch_queue| is None.
     """
     logging.debug('fetch_files(%s)', isolated.obj_hash)
     for filepath, properties in isolated.data.get('files', {}).iteritems():
@@ -1707,7 +2372,7 @@ class IsolatedBundle(object):
       # overridden files must not be fetched.
       if filepath not in self.files:
         self.files[filepath] = properties
-        if 'h' in properties:
+        if fetch_queue and 'h' in properties:
           # Preemptively request files.
           logging.debug('fetching %s', filepath)
           fetch_queue.add(
@@ -1784,30 +2449,30 @@ def upload_tree(base_url, infiles, namespace):
     infiles:   iterable of pairs (absolute path, metadata dict) of files.
     namespace: The namespace to use on the server.
   """
-  # Convert |infiles| into a list of FileItem objects, skip duplicates.
+  # Convert |infiles| into a stream of FileItem objects, skip duplicates.
   # Filter out symlinks, since they are not represented by items on isolate
-  # server side.
-  items = []
+  # server side. |infiles| is consumed as the items are uploaded.
   seen = set()
-  skipped = 0
-  for filepath, metadata in infiles:
-    if 'l' not in metadata and filepath not in seen:
-      seen.add(filepath)
-      item = FileItem(
-          path=filepath,
-          digest=metadata['h'],
-          size=metadata['s'],
-          high_priority=metadata.get('priority') == '0')
-      items.append(item)
-    else:
-      skipped += 1
+  skipped = [0]
+  def iter_items():
+    for filepath, metadata in infiles:
+      if 'l' not in metadata and filepath not in seen:
+        seen.add(filepath)
+        yield FileItem(
+            path=filepath,
+            digest=metadata['h'],
+            size=metadata['s'],
+            high_priority=metadata.get('priority') == '0')
+      else:
+        skipped[0] += 1
 
-  logging.info('Skipped %d duplicated entries', skipped)
   with get_storage(base_url, namespace) as storage:
-    storage.upload_items(items)
+    storage.upload_items(iter_items())
+  logging.info('Skipped %d duplicated entries', skipped[0])
 
 
-def fetch_isolated(isolated_hash, storage, cache, outdir, require_command):
+def fetch_isolated(
+    isolated_hash, storage, cache, outdir, require_command, tree_cache=None):
   """Aggressively downloads the .isolated file(s), then download all the files.
 
   Arguments:
@@ -1816,6 +2481,9 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, require_command):
     cache: LocalCache class that knows how to store and map files locally.
     outdir: Output directory to map file tree to.
     require_command: Ensure *.isolated specifies a command to run.
+    tree_cache: optional TreeCache. If it holds the tree, it is copied as a
+        whole instead of mapping the files one by one. Otherwise the tree is
+        added to it once mapped.
 
   Returns:
     IsolatedBundle object that holds details about loaded *.isolated file.
@@ -1840,17 +2508,31 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, require_command):
               '%s doesn\'t seem to be a valid file. Did you intent to pass a '
               'valid hash?' % isolated_hash)
 
-      # Load all *.isolated and start loading rest of the files.
-      bundle.fetch(fetch_queue, isolated_hash, algo)
+      # Load all *.isolated and start loading rest of the files, unless the
+      # whole tree is cached.
+      tree_cached = tree_cache is not None and isolated_hash in tree_cache
+      bundle.fetch(fetch_queue, isolated_hash, algo, not tree_cached)
       if require_command and not bundle.command:
         # TODO(vadimsh): All fetch operations are already enqueue and there's no
         # easy way to cancel them.
         raise isolated_format.IsolatedError('No command to run')
 
+    if not os.path.isdir(outdir):
+      os.makedirs(outdir)
+    if tree_cached:
+      with tools.Profiler('GetTree'):
+        # The files are clones, they don't depend on the items in |cache|.
+        if tree_cache.materialize(isolated_hash, outdir):
+          # Ensure working directory exists.
+          cwd = os.path.normpath(os.path.join(outdir, bundle.relative_cwd))
+          if not os.path.isdir(cwd):
+            os.makedirs(cwd)
+          return bundle
+        logging.warning('Failed to copy tree %s, mapping it', isolated_hash)
+        bundle.fetch_files(fetch_queue)
+
     with tools.Profiler('GetRest'):
       # Create file system hierarchy.
-      if not os.path.isdir(outdir):
-        os.makedirs(outdir)
       create_directories(outdir, bundle.files)
       create_symlinks(outdir, bundle.files.iteritems())
 
@@ -1870,12 +2552,9 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, require_command):
           fetch_queue.pending_count)
       last_update = time.time()
       with threading_utils.DeadlockDetector(DEADLOCK_TIMEOUT) as detector:
-        while remaining:
-          detector.ping()
-
-          # Wait for any item to finish fetching to cache.
-          digest = fetch_queue.wait(remaining)
-
+        detector.ping()
+        # Items are yielded as soon as they are in cache.
+        for digest in fetch_queue.iter_fetched(remaining):
           # Link corresponding files to a fetched item in cache.
           for filepath, props in remaining.pop(digest):
             cache.hardlink(
@@ -1888,45 +2567,64 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, require_command):
             print msg
             logging.info(msg)
             last_update = time.time()
+          detector.ping()
 
   # Cache could evict some items we just tried to fetch, it's a fatal error.
   if not fetch_queue.verify_all_cached():
     raise isolated_format.MappingError(
         'Cache is too small to hold all requested files')
+  if tree_cache is not None:
+    with tools.Profiler('AddTree'):
+      tree_cache.add(isolated_hash, outdir)
   return bundle
 
 
-def directory_to_metadata(root, algo, blacklist):
-  """Returns the FileItem list and .isolated metadata for a directory."""
+def directory_to_metadata(root, algo, blacklist, hash_cache=None):
+  """Returns the FileItem list and .isolated metadata for a directory.
+
+  |hash_cache| is an optional isolated_format.HashCache used to skip hashing
+  unmodified files.
+  """
+  metadata = {}
+  items = list(
+      iter_directory_items(root, algo, blacklist, metadata, hash_cache))
+  return items, metadata
+
+
+def iter_directory_items(root, algo, blacklist, metadata, hash_cache=None):
+  """Yields a FileItem for each file in a directory as soon as it is hashed.
+
+  The tree is walked and hashed in parallel. |metadata| is filled with the
+  .isolated metadata of each entry; it is complete once the generator is
+  exhausted.
+  """
   root = file_path.get_native_path_case(root)
-  paths = isolated_format.expand_directory_and_symlink(
+  paths = isolated_format.iter_directory_and_symlink(
       root, '.' + os.path.sep, blacklist, sys.platform != 'win32')
-  metadata = {
-    relpath: isolated_format.file_to_metadata(
-        os.path.join(root, relpath), {}, 0, algo)
-    for relpath in paths
-  }
-  for v in metadata.itervalues():
-    v.pop('t')
-  items = [
-      FileItem(
+  for relpath, meta in isolated_format.iter_files_metadata(
+      root, paths, {}, 0, algo, hash_cache):
+    meta.pop('t')
+    metadata[relpath] = meta
+    if 'h' in meta:
+      yield FileItem(
           path=os.path.join(root, relpath),
           digest=meta['h'],
           size=meta['s'],
           high_priority=relpath.endswith('.isolated'))
-      for relpath, meta in metadata.iteritems() if 'h' in meta
-  ]
-  return items, metadata
 
 
-def archive_files_to_storage(storage, files, blacklist):
+def archive_files_to_storage(storage, files, blacklist, use_hash_cache=True):
   """Stores every entries and returns the relevant data.
 
+  The files are streamed to the server as they are hashed.
+
   Arguments:
     storage: a Storage object that communicates with the remote object store.
     files: list of file paths to upload. If a directory is specified, a
            .isolated file is created and its hash is returned.
     blacklist: function that returns True if a file should be omitted.
+    use_hash_cache: if False, the persistent hash cache is not used, e.g. for
+           temporary files that will never be archived again.
   """
   assert all(isinstance(i, unicode) for i in files), files
   if len(files) != len(set(map(os.path.abspath, files))):
@@ -1934,22 +2632,28 @@ def archive_files_to_storage(storage, files, blacklist):
 
   results = []
   # The temporary directory is only created as needed.
-  tempdir = None
-  try:
-    # TODO(maruel): Yield the files to a worker thread.
-    items_to_upload = []
+  tempdir = [None]
+  if use_hash_cache:
+    hash_cache = isolated_format.get_hash_cache()
+  else:
+    hash_cache = isolated_format.HashCache(None)
+
+  def iter_items():
     for f in files:
       try:
         filepath = os.path.abspath(f)
         if os.path.isdir(filepath):
           # Uploading a whole directory.
-          items, metadata = directory_to_metadata(
-              filepath, storage.hash_algo, blacklist)
+          metadata = {}
+          for item in iter_directory_items(
+              filepath, storage.hash_algo, blacklist, metadata, hash_cache):
+            yield item
 
           # Create the .isolated file.
-          if not tempdir:
-            tempdir = tempfile.mkdtemp(prefix=u'isolateserver')
-          handle, isolated = tempfile.mkstemp(dir=tempdir, suffix=u'.isolated')
+          if not tempdir[0]:
+            tempdir[0] = tempfile.mkdtemp(prefix=u'isolateserver')
+          handle, isolated = tempfile.mkstemp(
+              dir=tempdir[0], suffix=u'.isolated')
           os.close(handle)
           data = {
               'algo':
@@ -1959,35 +2663,35 @@ def archive_files_to_storage(storage, files, blacklist):
           }
           isolated_format.save_isolated(isolated, data)
           h = isolated_format.hash_file(isolated, storage.hash_algo)
-          items_to_upload.extend(items)
-          items_to_upload.append(
-              FileItem(
-                  path=isolated,
-                  digest=h,
-                  size=os.stat(isolated).st_size,
-                  high_priority=True))
+          yield FileItem(
+              path=isolated,
+              digest=h,
+              size=os.stat(isolated).st_size,
+              high_priority=True)
           results.append((h, f))
 
         elif os.path.isfile(filepath):
-          h = isolated_format.hash_file(filepath, storage.hash_algo)
-          items_to_upload.append(
-            FileItem(
-                path=filepath,
-                digest=h,
-                size=os.stat(filepath).st_size,
-                high_priority=f.endswith('.isolated')))
+          h = hash_cache.hash_file(filepath, storage.hash_algo)
+          yield FileItem(
+              path=filepath,
+              digest=h,
+              size=os.stat(filepath).st_size,
+              high_priority=f.endswith('.isolated'))
           results.append((h, f))
         else:
           raise Error('%s is neither a file or directory.' % f)
       except OSError:
         raise Error('Failed to process %s.' % f)
+
+  try:
     # Technically we would care about which files were uploaded but we don't
     # much in practice.
-    _uploaded_files = storage.upload_items(items_to_upload)
+    _uploaded_files = storage.upload_items(iter_items())
     return results
   finally:
-    if tempdir and os.path.isdir(tempdir):
-      file_path.rmtree(tempdir)
+    hash_cache.close()
+    if tempdir[0] and os.path.isdir(tempdir[0]):
+      file_path.rmtree(tempdir[0])
 
 
 def archive(out, namespace, files, blacklist):
@@ -2163,10 +2867,21 @@ def add_cache_options(parser):
       default=100000,
       help='Trim if more than this number of items are in the cache '
            'default=%default')
+  cache_group.add_option(
+      '--tree-cache', metavar='DIR',
+      help='Directory to keep the last mapped trees, to copy them as a whole '
+           'when they are requested again. Should be on the same file system '
+           'as --cache. Disabled by default. Not supported on Windows')
+  cache_group.add_option(
+      '--max-trees',
+      type='int',
+      metavar='NNN',
+      default=4,
+      help='Number of trees to keep in --tree-cache, default=%default')
   parser.add_option_group(cache_group)
 
 
-def process_cache_options(options):
+def process_cache_options(options, trim_in_background=False):
   if options.cache:
     policies = CachePolicies(
         options.max_cache_size, options.min_free_space, options.max_items)
@@ -2175,11 +2890,26 @@ def process_cache_options(options):
     return DiskCache(
         unicode(os.path.abspath(options.cache)),
         policies,
-        isolated_format.get_hash_algo(options.namespace))
+        isolated_format.get_hash_algo(options.namespace),
+        trim_in_background)
   else:
     return MemoryCache()
 
 
+def process_tree_cache_options(options, cache):
+  """Returns the TreeCache to use, or None if it is disabled.
+
+  The disk space used by the trees counts against the policies of |cache|.
+  """
+  if not options.tree_cache or sys.platform == 'win32':
+    return None
+  tree_cache = TreeCache(
+      unicode(os.path.abspath(options.tree_cache)), options.max_trees)
+  if isinstance(cache, DiskCache):
+    cache.tree_cache = tree_cache
+  return tree_cache
+
+
 class OptionParserIsolateServer(tools.OptionParserWithLogging):
   def __init__(self, **kwargs):
     tools.OptionParserWithLogging.__init__(
@@ -125,7 +125,8 @@ def process_command(command, out_dir):
   return filtered
 
 
-def run_tha_test(isolated_hash, storage, cache, leak_temp_dir, extra_args):
+def run_tha_test(
+    isolated_hash, storage, cache, leak_temp_dir, extra_args, tree_cache=None):
   """Downloads the dependencies in the cache, hardlinks them into a temporary
   directory and runs the executable from there.
 
@@ -146,6 +147,8 @@ def run_tha_test(isolated_hash, storage, cache, leak_temp_dir, extra_args):
                    for later examination.
     extra_args: optional arguments to add to the command stated in the .isolate
                 file.
+    tree_cache: an optional isolateserver.TreeCache to map the whole tree at
+                once when it was already mapped by a previous run.
   """
   run_dir = make_temp_dir(u'run_tha_test', cache.cache_dir)
   out_dir = unicode(make_temp_dir(u'isolated_out', cache.cache_dir))
@@ -157,7 +160,8 @@ def run_tha_test(isolated_hash, storage, cache, leak_temp_dir, extra_args):
           storage=storage,
           cache=cache,
           outdir=run_dir,
-          require_command=True)
+          require_command=True,
+          tree_cache=tree_cache)
     except isolated_format.IsolatedError:
       on_error.report(None)
       return 1
@@ -217,8 +221,10 @@ def run_tha_test(isolated_hash, storage, cache, leak_temp_dir, extra_args):
       # It is only done if files were written in the directory.
       if os.path.isdir(out_dir) and os.listdir(out_dir):
         with tools.Profiler('ArchiveOutput'):
+          # out_dir is a new temporary directory for each task, its files'
+          # hashes would never be reused.
           results = isolateserver.archive_files_to_storage(
-              storage, [out_dir], None)
+              storage, [out_dir], None, use_hash_cache=False)
         # TODO(maruel): Implement side-channel to publish this information.
         output_data = {
           'hash': results[0][0],
@@ -280,13 +286,15 @@ def main(args):
   auth.process_auth_options(parser, options)
   isolateserver.process_isolate_server_options(parser, options, True)
 
-  cache = isolateserver.process_cache_options(options)
+  # Delete the files evicted from the cache while the test runs.
+  cache = isolateserver.process_cache_options(options, trim_in_background=True)
   with isolateserver.get_storage(
       options.isolate_server, options.namespace) as storage:
     # Hashing schemes used by |storage| and |cache| MUST match.
     assert storage.hash_algo == cache.hash_algo
     return run_tha_test(
-        options.isolated, storage, cache, options.leak_temp_dir, args)
+        options.isolated, storage, cache, options.leak_temp_dir, args,
+        isolateserver.process_tree_cache_options(options, cache))
 
 
 if __name__ == '__main__':
@@ -269,7 +269,16 @@ def task_request_to_raw_request(task_request):
 
 
 def swarming_handshake(swarming):
-  """Initiates the connection to the Swarming server."""
+  """Initiates the connection to the Swarming server.
+
+  Returns:
+    {
+      'max_shards': 1000,
+      'server_version': '138-193f1f3',
+      'xsrf_token': '...',
+    }
+    'max_shards' is only returned by servers supporting swarming_trigger_shards.
+  """
   headers = {'X-XSRF-Token-Request': '1'}
   response = net.url_read_json(
       swarming + '/swarming/api/v1/client/handshake',
@@ -279,7 +288,7 @@ def swarming_handshake(swarming):
     logging.error('Failed to handshake with server')
     return None
   logging.info('Connected to server version: %s', response['server_version'])
-  return response['xsrf_token']
+  return response
 
 
 def swarming_trigger(swarming, raw_request, xsrf_token):
@@ -309,6 +318,37 @@ def swarming_trigger(swarming, raw_request, xsrf_token):
   return result
 
 
+def swarming_trigger_shards(swarming, raw_request, shards, xsrf_token):
+  """Triggers all the shards of a request at once and returns the json data.
+
+  It's the low-level function. |shards| is a list of dict with the 'name' and
+  'env' specific to each shard.
+
+  Returns:
+    {
+      'priority': 100,
+      'tasks': [
+        {
+          'name': 'unit_tests:0:2',
+          'task_id': '12300',
+        },
+        ...
+      ],
+    }
+  """
+  logging.info('Triggering %d shards: %s', len(shards), raw_request['name'])
+
+  headers = {'X-XSRF-Token': xsrf_token}
+  result = net.url_read_json(
+      swarming + '/swarming/api/v1/client/shards',
+      data={'request': raw_request, 'shards': shards},
+      headers=headers)
+  if not result:
+    on_error.report('Failed to trigger task %s' % raw_request['name'])
+    return None
+  return result
+
+
 def setup_googletest(env, shards, index):
   """Sets googletest specific environment variables."""
   if shards > 1:
@@ -333,10 +373,14 @@ def trigger_task_shards(swarming, task_request, shards):
           name='%s:%s:%s' % (req.name, index, shards))
     return task_request_to_raw_request(req)
 
-  requests = [convert(index) for index in xrange(shards)]
-  xsrf_token = swarming_handshake(swarming)
-  if not xsrf_token:
+  handshake = swarming_handshake(swarming)
+  if not handshake:
     return None
+  xsrf_token = handshake['xsrf_token']
+  if shards > 1 and handshake.get('max_shards', 0) >= shards:
+    return trigger_task_shards_bulk(swarming, task_request, shards, xsrf_token)
+
+  requests = [convert(index) for index in xrange(shards)]
   tasks = {}
   priority_warning = False
   for index, request in enumerate(requests):
@@ -367,6 +411,40 @@ def trigger_task_shards(swarming, task_request, shards):
   return tasks
 
 
+def trigger_task_shards_bulk(swarming, task_request, shards, xsrf_token):
+  """Triggers all the subtasks of a sharded task in a single request.
+
+  The server allocates and stores all the shards at once, so the latency doesn't
+  grow with the number of shards.
+
+  Returns:
+    Same as trigger_task_shards().
+  """
+  variants = [
+    {
+      'env': setup_googletest({}, shards, index),
+      'name': '%s:%s:%s' % (task_request.name, index, shards),
+    }
+    for index in xrange(shards)
+  ]
+  result = swarming_trigger_shards(
+      swarming, task_request_to_raw_request(task_request), variants,
+      xsrf_token)
+  if not result:
+    return None
+  logging.info('Request result: %s', result)
+  if result['priority'] != task_request.priority:
+    print >> sys.stderr, 'Priority was reset to %s' % result['priority']
+  return {
+    task['name']: {
+      'shard_index': index,
+      'task_id': task['task_id'],
+      'view_url': '%s/user/task/%s' % (swarming, task['task_id']),
+    }
+    for index, task in enumerate(result['tasks'])
+  }
+
+
 ### Collection.
 
 
@@ -583,10 +661,28 @@ def now():
   return time.time()
 
 
+def fetch_output_range(output_url, offset):
+  """Fetches the output of a command past |offset|.
+
+  Returns:
+    (<output>, <next offset>) on success. <output> is empty once the end of the
+    output stored so far is reached.
+    None on failure or if the server doesn't support ranged reads.
+  """
+  out = net.url_read_json(
+      '%s?offset=%d' % (output_url, offset), retry_50x=False)
+  if not out or not isinstance(out.get('next_offset'), int):
+    return None
+  return out.get('output') or u'', out['next_offset']
+
+
 def retrieve_results(
     base_url, shard_index, task_id, timeout, should_stop, output_collector):
   """Retrieves results for a single task ID.
 
+  While the task is running, the output of its first command is tailed so only
+  the new data is fetched on each poll.
+
   Returns:
     <result dict> on success.
     None on failure.
@@ -595,6 +691,13 @@ def retrieve_results(
   result_url = '%s/swarming/api/v1/client/task/%s' % (base_url, task_id)
   output_url = '%s/swarming/api/v1/client/task/%s/output/all' % (
       base_url, task_id)
+  tail_url = '%s/swarming/api/v1/client/task/%s/output/0' % (base_url, task_id)
+  # Output of the first command fetched so far and the offset past it. The
+  # offset is None once tailing is disabled. The output is the one of the try
+  # tail_try_number.
+  tail = []
+  tail_offset = 0
+  tail_try_number = None
   started = now()
   deadline = started + timeout if timeout else None
   attempt = 0
@@ -627,9 +730,29 @@ def retrieve_results(
     result = net.url_read_json(result_url, retry_50x=False)
     if not result:
       continue
+    if result.get('try_number') != tail_try_number:
+      # The task was retried, the output of the new try starts over.
+      tail_try_number = result.get('try_number')
+      tail = []
+      if tail_offset is not None:
+        tail_offset = 0
     if result['state'] in State.STATES_NOT_RUNNING:
-      out = net.url_read_json(output_url)
-      result['outputs'] = (out or {}).get('outputs', [])
+      # Fetch the remainder of the tailed output. Fall back to the whole output
+      # if nothing was tailed, on failure or if there are multiple commands.
+      while tail_offset and len(result.get('exit_codes') or []) <= 1:
+        out = fetch_output_range(tail_url, tail_offset)
+        if not out:
+          tail_offset = None
+        elif not out[0]:
+          break
+        else:
+          tail.append(out[0])
+          tail_offset = out[1]
+      if tail_offset and len(result.get('exit_codes') or []) <= 1:
+        result['outputs'] = [u''.join(tail)]
+      else:
+        out = net.url_read_json(output_url)
+        result['outputs'] = (out or {}).get('outputs', [])
       if not result['outputs']:
         logging.error('No output found for task %s', task_id)
       # Record the result, try to fetch attached output files (if any).
@@ -638,6 +761,17 @@ def retrieve_results(
         output_collector.process_shard_result(shard_index, result)
       return result
 
+    if tail_offset is not None and result['state'] == State.RUNNING:
+      out = fetch_output_range(tail_url, tail_offset)
+      if out:
+        tail.append(out[0])
+        tail_offset = out[1]
+      else:
+        # Do not retry, the server may not support ranged reads; the whole
+        # output is fetched once the task is done.
+        tail = []
+        tail_offset = None
+
 
 def yield_results(
     swarm_base_url, task_ids, timeout, max_threads, print_status_updates,
@@ -1416,6 +1416,23 @@ class IsolateCommand(IsolateBase):
     }
     self.assertEqual(expected_json, tools.read_json('json_output.json'))
 
+  def test_isolate_and_archive_all_failed(self):
+    # When no tree can be isolated, the server is not contacted.
+    self.mock(
+        isolateserver, 'upload_tree',
+        lambda **_kwargs: self.fail('upload_tree() called'))
+    self.mock(sys, 'stdout', cStringIO.StringIO())
+    self.mock(logging, 'exception', lambda *_args: None)
+    trees = []
+    for name in ('x', 'y'):
+      opts = optparse.Values({
+        'isolated': os.path.join(self.cwd, '%s.isolated' % name),
+      })
+      trees.append((opts, self.cwd))
+    self.assertEqual(
+        {'x': None, 'y': None},
+        isolate.isolate_and_archive(trees, 'http://localhost:1', 'default'))
+
   def test_CMDcheck_empty(self):
     isolate_file = os.path.join(self.cwd, 'x.isolate')
     isolated_file = os.path.join(self.cwd, 'x.isolated')
@@ -1611,6 +1628,8 @@ class IsolateCommand(IsolateBase):
 def clear_env_vars():
   for e in ('ISOLATE_DEBUG', 'ISOLATE_SERVER'):
     os.environ.pop(e, None)
+  # Do not use the user's persistent hash cache.
+  os.environ['ISOLATE_HASH_CACHE'] = ''
 
 
 if __name__ == '__main__':
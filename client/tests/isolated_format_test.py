@@ -8,8 +8,10 @@ import json
 import logging
 import os
 import shutil
+import sqlite3
 import sys
 import tempfile
+import time
 import unittest
 
 # net_utils adjusts sys.path.
@@ -144,6 +146,54 @@ class SymlinkTest(unittest.TestCase):
       self.assertEqual((u'out/foo/bar.txt', []), actual)
 
 
+class FilesMetadataTest(unittest.TestCase):
+  def setUp(self):
+    super(FilesMetadataTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'isolated_format')
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+    super(FilesMetadataTest, self).tearDown()
+
+  def test_iter_files_metadata(self):
+    contents = dict(
+        (os.path.join('dir%d' % (i % 3), 'file%d' % i), 'content %d' % i)
+        for i in xrange(20))
+    for relpath, content in contents.iteritems():
+      filepath = os.path.join(self.tempdir, relpath)
+      if not os.path.isdir(os.path.dirname(filepath)):
+        os.mkdir(os.path.dirname(filepath))
+      with open(filepath, 'wb') as f:
+        f.write(content)
+
+    paths = isolated_format.iter_directory_and_symlink(
+        self.tempdir, '.' + os.path.sep, None, False)
+    actual = dict(
+        isolated_format.iter_files_metadata(
+            self.tempdir, paths, {}, 0, ALGO))
+    self.assertEqual(sorted(contents), sorted(actual))
+    for relpath, content in contents.iteritems():
+      self.assertEqual(ALGO(content).hexdigest(), actual[relpath]['h'])
+      self.assertEqual(len(content), actual[relpath]['s'])
+
+  def test_iter_files_metadata_prevdicts(self):
+    filepath = os.path.join(self.tempdir, 'file')
+    with open(filepath, 'wb') as f:
+      f.write('content')
+    mtime = int(round(os.stat(filepath).st_mtime))
+    prevdicts = {'file': {'h': 'cached', 's': 7, 't': mtime}}
+    actual = dict(
+        isolated_format.iter_files_metadata(
+            self.tempdir, ['file'], prevdicts, 0, ALGO))
+    self.assertEqual('cached', actual['file']['h'])
+
+  def test_iter_files_metadata_missing(self):
+    with self.assertRaises(isolated_format.MappingError):
+      list(
+          isolated_format.iter_files_metadata(
+              self.tempdir, ['missing'], {}, 0, ALGO))
+
+
 class TestIsolated(auto_stub.TestCase):
   def test_load_isolated_empty(self):
     m = isolated_format.load_isolated('{}', isolateserver_mock.ALGO)
@@ -239,6 +289,122 @@ class TestIsolated(auto_stub.TestCase):
     self.assertEqual([('foo', data, True)], calls)
 
 
+class HashCacheTest(auto_stub.TestCase):
+  def setUp(self):
+    super(HashCacheTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'isolated_format')
+    self.db_path = os.path.join(self.tempdir, 'hash_cache')
+    self.file = os.path.join(self.tempdir, 'file')
+    self.write_file('content')
+    self.hash_file_calls = []
+    old_hash_file = isolated_format.hash_file
+    def hash_file(filepath, algo):
+      self.hash_file_calls.append(filepath)
+      return old_hash_file(filepath, algo)
+    self.mock(isolated_format, 'hash_file', hash_file)
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+    super(HashCacheTest, self).tearDown()
+
+  def write_file(self, content, mtime=1000000000):
+    with open(self.file, 'wb') as f:
+      f.write(content)
+    os.utime(self.file, (mtime, mtime))
+
+  def test_persistent(self):
+    expected = ALGO('content').hexdigest()
+    for _ in xrange(2):
+      with isolated_format.HashCache(self.db_path) as cache:
+        self.assertEqual(expected, cache.hash_file(self.file, ALGO))
+    self.assertEqual([self.file], self.hash_file_calls)
+    self.assertEqual(1, cache.hits)
+
+  def test_modified(self):
+    with isolated_format.HashCache(self.db_path) as cache:
+      cache.hash_file(self.file, ALGO)
+      self.write_file('other')
+      self.assertEqual(
+          ALGO('other').hexdigest(), cache.hash_file(self.file, ALGO))
+      self.write_file('other', mtime=1000000001)
+      cache.hash_file(self.file, ALGO)
+    self.assertEqual([self.file] * 3, self.hash_file_calls)
+
+  def test_racy(self):
+    # A file just modified is not cached.
+    now = time.time()
+    self.write_file('content', mtime=now)
+    with isolated_format.HashCache(self.db_path) as cache:
+      cache.hash_file(self.file, ALGO)
+      cache.hash_file(self.file, ALGO)
+    self.assertEqual([self.file] * 2, self.hash_file_calls)
+
+  def test_disabled(self):
+    with isolated_format.HashCache('') as cache:
+      cache.hash_file(self.file, ALGO)
+      cache.hash_file(self.file, ALGO)
+    self.assertEqual([self.file] * 2, self.hash_file_calls)
+    self.assertFalse(os.path.exists(self.db_path))
+
+  def test_corrupted(self):
+    with open(self.db_path, 'wb') as f:
+      f.write('not a database' * 100)
+    with isolated_format.HashCache(self.db_path) as cache:
+      self.assertEqual(
+          ALGO('content').hexdigest(), cache.hash_file(self.file, ALGO))
+
+  def count_entries(self):
+    db = sqlite3.connect(self.db_path)
+    try:
+      return db.execute('SELECT COUNT(*) FROM digests_v2').fetchone()[0]
+    finally:
+      db.close()
+
+  def test_prune_deleted(self):
+    with isolated_format.HashCache(self.db_path) as cache:
+      cache.hash_file(self.file, ALGO)
+    self.assertEqual(1, self.count_entries())
+    os.remove(self.file)
+    isolated_format.HashCache(self.db_path).close()
+    self.assertEqual(0, self.count_entries())
+
+  def test_max_entries(self):
+    self.mock(isolated_format, 'HASH_CACHE_MAX_ENTRIES', 2)
+    files = []
+    for i in xrange(3):
+      self.file = os.path.join(self.tempdir, 'file%d' % i)
+      self.write_file('content%d' % i)
+      files.append(self.file)
+    with isolated_format.HashCache(self.db_path) as cache:
+      for i, f in enumerate(files):
+        self.mock(isolated_format.time, 'time', lambda: 1000000010. + i)
+        cache.hash_file(f, ALGO)
+    self.assertEqual(2, self.count_entries())
+    # The least recently used entry was evicted.
+    self.hash_file_calls = []
+    with isolated_format.HashCache(self.db_path) as cache:
+      for f in files:
+        cache.hash_file(f, ALGO)
+    self.assertEqual([files[0]], self.hash_file_calls)
+
+  def test_get_hash_cache_user_cache_dir(self):
+    self.mock(os, 'environ', {})
+    self.mock(
+        isolated_format, 'get_user_cache_dir',
+        lambda: os.path.join(self.tempdir, 'cache'))
+    with isolated_format.get_hash_cache() as cache:
+      cache.hash_file(self.file, ALGO)
+    self.assertTrue(os.path.isfile(os.path.join(
+        self.tempdir, 'cache', isolated_format.HASH_CACHE_FILE)))
+
+  def test_file_to_metadata(self):
+    with isolated_format.HashCache(self.db_path) as cache:
+      for _ in xrange(2):
+        meta = isolated_format.file_to_metadata(self.file, {}, 0, ALGO, cache)
+        self.assertEqual(ALGO('content').hexdigest(), meta['h'])
+    self.assertEqual([self.file], self.hash_file_calls)
+
+
 if __name__ == '__main__':
   if '-v' in sys.argv:
     unittest.TestCase.maxDiff = None
@@ -54,10 +54,27 @@ class IsolateServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
   def _read_body(self):
     """Reads the request body."""
+    if self.headers.get('Transfer-Encoding') == 'chunked':
+      return ''.join(self._read_chunks())
     return self.rfile.read(int(self.headers['Content-Length']))
 
+  def _read_chunks(self):
+    """Yields the chunks of a request body sent with chunked encoding."""
+    while True:
+      size = int(self.rfile.readline().strip(), 16)
+      chunk = self.rfile.read(size)
+      # Trailing '\r\n'.
+      self.rfile.readline()
+      if not size:
+        break
+      yield chunk
+
   def _drop_body(self):
     """Reads the request body."""
+    if self.headers.get('Transfer-Encoding') == 'chunked':
+      for _ in self._read_chunks():
+        pass
+      return
     size = int(self.headers['Content-Length'])
     while size:
       chunk = min(4096, size)
@@ -114,7 +131,11 @@ class IsolateServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     namespace = embedded['n']
     if namespace not in self.server.contents:
       self.server.contents[namespace] = {}
-    self.server.contents[namespace][embedded['d']] = content
+    if gs:
+      # The content was already PUT to the fake Google Storage.
+      self.server.contents[namespace].setdefault(embedded['d'], content)
+    else:
+      self.server.contents[namespace][embedded['d']] = content
     self._json({'ok': True})
 
   ### Mocked HTTP Methods
@@ -134,7 +155,8 @@ class IsolateServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
               'upload_ticket': self._generate_ticket(entry),
           }
           if self._should_push_to_gs(entry['i'], entry['s']):
-            status['gs_upload_url'] = self._generate_signed_url(entry['d'])
+            status['gs_upload_url'] = self._generate_signed_url(
+                entry['d'], entry['n'])
           li.append(status)
         # Don't use finalize url for the mock.
 
@@ -153,13 +175,23 @@ class IsolateServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       self._storage_helper(body)
     elif self.path.startswith('/_ah/api/isolateservice/v1/finalize_gs_upload'):
       self._storage_helper(body, True)
+    elif self.path.startswith('/_ah/api/isolateservice/v1/retrieve_batch'):
+      request = json.loads(body)
+      contents = self.server.contents.get(request['namespace']['namespace'], {})
+      self._json({
+        'items': [
+          {'digest': d, 'content': contents[d]}
+          for d in request['digests'] if d in contents
+        ],
+      })
     elif self.path.startswith('/_ah/api/isolateservice/v1/retrieve'):
       request = json.loads(body)
       namespace = request['namespace']['namespace']
       data = self.server.contents[namespace][request['digest']]
       self._json({'content': data})
     elif self.path.startswith('/_ah/api/isolateservice/v1/server_details'):
-      self._json({'server_version': 'such a good version'})
+      self._json(
+          {'retrieve_batch': True, 'server_version': 'such a good version'})
     else:
       raise NotImplementedError(self.path)
 
@@ -104,6 +104,35 @@ class TestZipCompression(TestCase):
     with self.assertRaises(IOError):
       ''.join(isolateserver.zip_decompress(['Im not a zip file']))
 
+  def test_compress_parallel(self):
+    """Verify blocks compressed in parallel form a single zlib stream."""
+    self.mock(isolateserver, 'ZIP_BLOCK_SIZE', 1000)
+    self.mock(isolateserver, 'ZIP_MAX_PENDING_BLOCKS', 2)
+    original = [str(x) for x in xrange(0, 3000)]
+    with threading_utils.ThreadPool(1, 4, 0, 'zip') as pool:
+      compressed = ''.join(
+          isolateserver.zip_compress_parallel(original, 7, pool))
+    self.assertEqual(''.join(original), zlib.decompress(compressed))
+    self.assertEqual(
+        ''.join(original),
+        ''.join(isolateserver.zip_decompress([compressed])))
+
+  def test_adaptive_level(self):
+    incompressible = os.urandom(10000)
+    self.assertEqual(
+        0, isolateserver.get_adaptive_zip_compression_level(incompressible, 7))
+    self.assertEqual(
+        7, isolateserver.get_adaptive_zip_compression_level('a' * 10000, 7))
+    # Too small to be sampled.
+    self.assertEqual(
+        7, isolateserver.get_adaptive_zip_compression_level('a', 7))
+    compressed = ''.join(isolateserver.zip_compress_adaptive([incompressible]))
+    self.assertEqual(incompressible, zlib.decompress(compressed))
+
+  def test_get_zip_compression_level(self):
+    self.assertEqual(0, isolateserver.get_zip_compression_level('a/b.PNG'))
+    self.assertEqual(7, isolateserver.get_zip_compression_level('a/b.txt'))
+
 
 class FakeItem(isolateserver.Item):
   def __init__(self, data, high_priority=False):
@@ -133,7 +162,7 @@ class MockedStorageApi(isolateserver.StorageApi):
     return self._namespace
 
   def push(self, item, push_state, content=None):
-    content = ''.join(item.content() if content is None else content)
+    content = ''.join((item.content if content is None else content)())
     self.push_calls.append((item, push_state, content))
     if self.push_side_effect:
       self.push_side_effect()
@@ -174,6 +203,79 @@ class StorageTest(TestCase):
     batches = list(isolateserver.batch_items_for_check(items))
     self.assertEqual(batches, expected)
 
+  def test_iter_batches_for_check(self):
+    items = [isolateserver.Item('item %d' % i, i) for i in xrange(50)]
+    produced = []
+    def gen():
+      for item in items:
+        produced.append(item)
+        yield item
+    batches = isolateserver.iter_batches_for_check(gen())
+    # The first batch is yielded as soon as it is full.
+    size = isolateserver.ITEMS_PER_CONTAINS_QUERIES[0]
+    self.assertEqual(items[:size], next(batches))
+    self.assertEqual(size, len(produced))
+    self.assertEqual(items[size:], sum(batches, []))
+
+  def test_async_fetch_batch_failure(self):
+    class FlakyStorageApi(MockedStorageApi):
+      def __init__(self):
+        super(FlakyStorageApi, self).__init__({})
+        self.fetch_batch_calls = 0
+      def fetch_batch(self, digests):
+        self.fetch_batch_calls += 1
+        if self.fetch_batch_calls == 1:
+          raise IOError('Timed out')
+        # The content of 'c' is corrupted.
+        return {'b': 'bb', 'c': 'c'}
+
+    storage_api = FlakyStorageApi()
+    storage = isolateserver.Storage(storage_api)
+    fetched = []
+    def async_fetch(channel, _priority, digest, _size, _sink):
+      fetched.append(digest)
+      channel.send_result(digest)
+    self.mock(storage, 'async_fetch', async_fetch)
+    self.mock(logging, 'warning', lambda *_: None)
+    sinks = {}
+    def sink_factory(digest):
+      return lambda generator: sinks.setdefault(digest, ''.join(generator))
+    channel = threading_utils.TaskChannel()
+    for items in ({'a': 1}, {'b': 2, 'c': 3}):
+      storage.async_fetch_batch(channel, 0, items, sink_factory)
+      for _ in items:
+        channel.pull()
+    # A transient failure doesn't disable '/retrieve_batch'.
+    self.assertEqual(2, storage_api.fetch_batch_calls)
+    self.assertEqual({'b': 'bb'}, sinks)
+    # 'c' failed verification and is fetched again.
+    self.assertEqual(['a', 'c'], fetched)
+
+  def test_async_fetch_batch_unsupported(self):
+    class UnsupportedStorageApi(MockedStorageApi):
+      def __init__(self):
+        super(UnsupportedStorageApi, self).__init__({})
+        self.fetch_batch_calls = 0
+      def fetch_batch(self, digests):
+        self.fetch_batch_calls += 1
+        raise NotImplementedError()
+
+    storage_api = UnsupportedStorageApi()
+    storage = isolateserver.Storage(storage_api)
+    fetched = []
+    def async_fetch(channel, _priority, digest, _size, _sink):
+      fetched.append(digest)
+      channel.send_result(digest)
+    self.mock(storage, 'async_fetch', async_fetch)
+    channel = threading_utils.TaskChannel()
+    for items in ({'a': 1, 'b': 2}, {'c': 3}):
+      storage.async_fetch_batch(channel, 0, items, lambda _digest: None)
+      for _ in items:
+        channel.pull()
+    # '/retrieve_batch' is not tried again once it is known to be unsupported.
+    self.assertEqual(1, storage_api.fetch_batch_calls)
+    self.assertEqual(['a', 'b', 'c'], fetched)
+
   def test_get_missing_items(self):
     items = [
       isolateserver.Item('foo', 12),
@@ -243,10 +345,9 @@ class StorageTest(TestCase):
     def push_side_effect():
       raise IOError('Nope')
 
-    # TODO(vadimsh): Retrying push when fetching data from a generator is
-    # broken now (it reuses same generator instance when retrying).
+    # Each push attempt must restart reading the content from the beginning.
     content_sources = (
-        # generator(),
+        _generator,
         lambda: [chunk],
     )
 
@@ -370,7 +471,7 @@ class IsolateServerStorageApiTest(TestCase):
     return (
         server + '/_ah/api/isolateservice/v1/server_details',
         {'data': {}},
-        {'server_version': 'such a good version'}
+        {'retrieve_batch': True, 'server_version': 'such a good version'}
     )
 
   @staticmethod
@@ -407,7 +508,24 @@ class IsolateServerStorageApiTest(TestCase):
     self.expected_requests([self.mock_server_details_request(server)])
     storage = isolateserver.IsolateServer(server, namespace)
     caps = storage._server_capabilities
-    self.assertEqual({'server_version': 'such a good version'}, caps)
+    self.assertEqual(
+        {'retrieve_batch': True, 'server_version': 'such a good version'},
+        caps)
+
+  def test_fetch_batch_unsupported(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    self.expected_requests(
+        [
+          (
+            server + '/_ah/api/isolateservice/v1/server_details',
+            {'data': {}},
+            {'server_version': 'an old version'},
+          ),
+        ])
+    storage = isolateserver.IsolateServer(server, namespace)
+    with self.assertRaises(NotImplementedError):
+      storage.fetch_batch(['a'])
 
   def test_fetch_success(self):
     server = 'http://example.com'
@@ -507,7 +625,7 @@ class IsolateServerStorageApiTest(TestCase):
     missing = storage.contains([item])
     self.assertEqual([item], missing.keys())
     push_state = missing[item]
-    storage.push(item, push_state, [data])
+    storage.push(item, push_state, lambda: [data])
     self.assertTrue(push_state.uploaded)
     self.assertTrue(push_state.finalized)
 
@@ -534,7 +652,7 @@ class IsolateServerStorageApiTest(TestCase):
     self.assertEqual([item], missing.keys())
     push_state = missing[item]
     with self.assertRaises(IOError):
-      storage.push(item, push_state, [data])
+      storage.push(item, push_state, lambda: [data])
     self.assertFalse(push_state.uploaded)
     self.assertFalse(push_state.finalized)
 
@@ -549,16 +667,18 @@ class IsolateServerStorageApiTest(TestCase):
         {'index': 0,
          'gs_upload_url': server + '/content-gs/whatevs/1234',
          'upload_ticket': 'ticket!'}]}
+    def check_put(kwargs):
+      # The body is streamed, it is passed as a restartable callable.
+      self.assertEqual(data, ''.join(kwargs.pop('data')()))
+      self.assertEqual(
+          {'content_type': 'application/octet-stream', 'method': 'PUT'},
+          kwargs)
     requests = [
       self.mock_contains_request(
           server, namespace, contains_request, contains_response),
       (
         server + '/content-gs/whatevs/1234',
-        {
-          'data': data,
-          'content_type': 'application/octet-stream',
-          'method': 'PUT',
-        },
+        check_put,
         '',
         None,
       ),
@@ -574,7 +694,7 @@ class IsolateServerStorageApiTest(TestCase):
     self.assertEqual([item], missing.keys())
     push_state = missing[item]
     with self.assertRaises(IOError):
-      storage.push(item, push_state, [data])
+      storage.push(item, push_state, lambda: [data])
     self.assertTrue(push_state.uploaded)
     self.assertFalse(push_state.finalized)
 
@@ -694,6 +814,52 @@ class IsolateServerStorageSmokeTest(unittest.TestCase):
   def test_upload_items_gzip(self):
     self.run_upload_items_test('default-gzip')
 
+  def test_upload_items_generator(self):
+    storage = isolateserver.get_storage(self.server.url, 'default')
+    items = [isolateserver.BufferItem('item %d' % i) for i in xrange(10)]
+
+    def gen():
+      for item in items:
+        yield item
+        # Duplicated content is skipped.
+        yield isolateserver.BufferItem(item.buffer)
+
+    # Keep a single lookup and a single push in flight.
+    old_limits = (
+        isolateserver.MAX_PENDING_CONTAINS_QUERIES,
+        isolateserver.MAX_PENDING_PUSHES)
+    isolateserver.MAX_PENDING_CONTAINS_QUERIES = 1
+    isolateserver.MAX_PENDING_PUSHES = 1
+    try:
+      uploaded = storage.upload_items(gen())
+    finally:
+      (isolateserver.MAX_PENDING_CONTAINS_QUERIES,
+       isolateserver.MAX_PENDING_PUSHES) = old_limits
+    self.assertEqual(set(items), set(uploaded))
+    self.assertFalse(dict(storage.get_missing_items(items)))
+
+  def run_upload_large_items_test(self, namespace):
+    storage = isolateserver.get_storage(self.server.url, namespace)
+
+    # Items large enough to be streamed to the fake Google Storage.
+    items = [
+      isolateserver.BufferItem(('item %d' % i) * 10000) for i in xrange(3)
+    ]
+    uploaded = storage.upload_items(items)
+    self.assertEqual(set(items), set(uploaded))
+
+    for item in items:
+      stored = self.server.contents[namespace][item.digest]
+      if namespace.endswith('-gzip'):
+        stored = zlib.decompress(stored)
+      self.assertEqual(item.buffer, stored)
+
+  def test_upload_large_items(self):
+    self.run_upload_large_items_test('default')
+
+  def test_upload_large_items_gzip(self):
+    self.run_upload_large_items_test('default-gzip')
+
   def run_push_and_fetch_test(self, namespace):
     storage = isolateserver.get_storage(self.server.url, namespace)
 
@@ -728,6 +894,29 @@ class IsolateServerStorageSmokeTest(unittest.TestCase):
   def test_push_and_fetch_gzip(self):
     self.run_push_and_fetch_test('default-gzip')
 
+  def test_iter_fetched(self):
+    storage = isolateserver.get_storage(self.server.url, 'default')
+    items = [isolateserver.BufferItem('item %d' % i) for i in xrange(10)]
+    storage.upload_items(items)
+
+    # The first item is already in the cache.
+    cache = isolateserver.MemoryCache()
+    cache.write(items[0].digest, [items[0].buffer])
+    queue = isolateserver.FetchQueue(storage, cache)
+    remaining = {}
+    for item in items:
+      remaining[item.digest] = item
+      queue.add(item.digest, item.size)
+
+    fetched = []
+    for digest in queue.iter_fetched(remaining):
+      fetched.append(remaining.pop(digest))
+    self.assertEqual(items[0], fetched[0])
+    self.assertEqual(set(items), set(fetched))
+    self.assertEqual(0, queue.pending_count)
+    self.assertEqual(
+        [i.buffer for i in items], [cache.read(i.digest) for i in items])
+
   if sys.maxsize == (2**31) - 1:
     def test_archive_multiple_huge_file(self):
       self.server.discard_content()
@@ -854,25 +1043,51 @@ class IsolateServerDownloadTest(TestCase):
     }
     isolated_data = json.dumps(isolated, sort_keys=True, separators=(',',':'))
     isolated_hash = isolateserver_mock.hash_content(isolated_data)
-    requests = [(v['h'], files[k]) for k, v in isolated['files'].iteritems()]
-    requests.append((isolated_hash, isolated_data))
+    namespace = {
+        'namespace': 'default-gzip',
+        'digest_hash': 'sha-1',
+        'compression': 'flate',
+    }
+    # The .isolated file is fetched alone, then all the small files in a
+    # single batch.
     requests = [
       (
         server + '/_ah/api/isolateservice/v1/retrieve',
         {
             'data': {
-                'digest': h.encode('utf-8'),
-                'namespace': {
-                    'namespace': 'default-gzip',
-                    'digest_hash': 'sha-1',
-                    'compression': 'flate',
-                },
+                'digest': isolated_hash.encode('utf-8'),
+                'namespace': namespace,
                 'offset': 0,
             },
             'read_timeout': 60,
         },
-        {'content': base64.b64encode(zlib.compress(v))},
-      ) for h, v in requests
+        {'content': base64.b64encode(zlib.compress(isolated_data))},
+      ),
+      (
+        server + '/_ah/api/isolateservice/v1/server_details',
+        {'data': {}},
+        {'retrieve_batch': True, 'server_version': 'such a good version'},
+      ),
+      (
+        server + '/_ah/api/isolateservice/v1/retrieve_batch',
+        {
+            'data': {
+                'digests': sorted(
+                    v['h'].encode('utf-8')
+                    for v in isolated['files'].itervalues()),
+                'namespace': namespace,
+            },
+            'read_timeout': 60,
+        },
+        {
+          'items': [
+            {
+              'digest': v['h'],
+              'content': base64.b64encode(zlib.compress(files[k])),
+            } for k, v in isolated['files'].iteritems()
+          ],
+        },
+      ),
     ]
     cmd = [
       'download',
@@ -906,10 +1121,293 @@ def get_storage(_isolate_server, namespace):
     @staticmethod
     def upload_items(items):
       # Always returns the second item as not present.
-      return [items[1]]
+      return [list(items)[1]]
   return StorageFake()
 
 
+class DiskCacheTest(TestCase):
+  def setUp(self):
+    super(DiskCacheTest, self).setUp()
+    self.algo = isolated_format.get_hash_algo('default')
+    self.cache_dir = os.path.join(self.tempdir, 'cache')
+    self.policies = isolateserver.CachePolicies(0, 0, 0)
+
+  def get_cache(self):
+    return isolateserver.DiskCache(self.cache_dir, self.policies, self.algo)
+
+  def test_sharded_layout(self):
+    data = 'foo'
+    h = self.algo(data).hexdigest()
+    with self.get_cache() as cache:
+      cache.write(h, [data])
+    self.assertTrue(
+        os.path.isfile(os.path.join(self.cache_dir, h[:2], h[2:4], h)))
+    self.assertEqual(
+        str(isolateserver.DiskCache.LAYOUT_VERSION),
+        open(os.path.join(self.cache_dir, 'version'), 'rb').read())
+
+    # Reopening the cache doesn't need to scan it.
+    self.mock(isolateserver.DiskCache, '_scan', lambda _: self.fail())
+    with self.get_cache() as cache:
+      self.assertEqual(set([h]), cache.cached_set())
+      self.assertEqual(data, cache.read(h))
+
+  def test_migrate_flat_layout(self):
+    contents = ['foo', 'bar']
+    hashes = [self.algo(c).hexdigest() for c in contents]
+    os.mkdir(self.cache_dir)
+    for h, c in zip(hashes, contents):
+      with open(os.path.join(self.cache_dir, h), 'wb') as f:
+        f.write(c)
+    # Only the first item is listed in the state of the version 1 layout.
+    with open(os.path.join(self.cache_dir, 'state.json'), 'wb') as f:
+      json.dump([[hashes[0], len(contents[0])]], f)
+
+    with self.get_cache() as cache:
+      self.assertEqual(set(hashes), cache.cached_set())
+      for h, c in zip(hashes, contents):
+        self.assertEqual(c, cache.read(h))
+    self.assertEqual(
+        sorted([hashes[0][:2], hashes[1][:2], 'state.json', 'version']),
+        sorted(os.listdir(self.cache_dir)))
+
+  def _fill_cache(self, cache, count):
+    """Writes |count| items of 10 bytes in |cache|, oldest first."""
+    hashes = []
+    for i in xrange(count):
+      data = '%10d' % i
+      h = self.algo(data).hexdigest()
+      cache.write(h, [data])
+      hashes.append(h)
+    return hashes
+
+  def test_trim_max_cache_size(self):
+    self.policies.max_cache_size = 25
+    free_space_calls = []
+    def get_free_space(path):
+      free_space_calls.append(path)
+      return 1000
+    self.mock(file_path, 'get_free_space', get_free_space)
+    with self.get_cache() as cache:
+      del free_space_calls[:]
+      hashes = self._fill_cache(cache, 5)
+    # Only the 2 newest items fit.
+    self.assertEqual(1, len(free_space_calls))
+    self.assertEqual(set(hashes[-2:]), cache.cached_set())
+    for h in hashes[:-2]:
+      self.assertFalse(os.path.exists(cache._path(h)))
+
+  def test_trim_min_free_space(self):
+    self.policies.min_free_space = 1000
+    free_space = [1000]
+    self.mock(file_path, 'get_free_space', lambda _: free_space[0])
+    with self.get_cache() as cache:
+      hashes = self._fill_cache(cache, 5)
+      # 25 bytes are missing, the 3 oldest items are evicted at once.
+      free_space[0] = 975
+      real_delete_file = cache._delete_file
+      def delete_file(digest, size):
+        free_space[0] += size
+        real_delete_file(digest, size)
+      self.mock(cache, '_delete_file', delete_file)
+    self.assertEqual(1005, free_space[0])
+    self.assertEqual(set(hashes[3:]), cache.cached_set())
+
+  def test_trim_min_free_space_linked(self):
+    # The evicted files are still hardlinked elsewhere so deleting them frees
+    # less than their size. Items are evicted until enough space is free.
+    self.policies.min_free_space = 1000
+    free_space = [1000]
+    def get_free_space(_path):
+      if len(free_space) > 1:
+        return free_space.pop(0)
+      return free_space[0]
+    self.mock(file_path, 'get_free_space', get_free_space)
+    with self.get_cache() as cache:
+      hashes = self._fill_cache(cache, 6)
+      free_space[:] = [975, 985, 1000]
+    self.assertEqual([1000], free_space)
+    self.assertEqual(set(hashes[5:]), cache.cached_set())
+    for h in hashes[:5]:
+      self.assertFalse(os.path.exists(cache._path(h)))
+
+  def _add_tree(self, tree_cache, cache, isolated_hash, digest):
+    """Adds a tree linking the file of |digest| in |cache|."""
+    src = os.path.join(self.tempdir, 'src')
+    os.mkdir(src)
+    os.link(cache._path(digest), os.path.join(src, 'a'))
+    tree_cache.add(isolated_hash, src)
+    file_path.rmtree(src)
+
+  def test_trim_max_cache_size_trees(self):
+    self.mock(isolateserver.TreeCache, 'CLONE_CMDS', (('cp', '-a'),))
+    self.policies.max_cache_size = 25
+    self.mock(file_path, 'get_free_space', lambda _: 1000)
+    tree_cache = isolateserver.TreeCache(
+        os.path.join(self.tempdir, 'trees'), 2)
+    with self.get_cache() as cache:
+      cache.tree_cache = tree_cache
+      hashes = self._fill_cache(cache, 3)
+      self._add_tree(tree_cache, cache, 'h1', hashes[0])
+      self.assertEqual(0, tree_cache.get_exclusive_size())
+    # The oldest item is evicted but the tree keeps its file, so the tree is
+    # evicted too.
+    self.assertEqual(set(hashes[1:]), cache.cached_set())
+    self.assertNotIn('h1', tree_cache)
+
+  def test_trim_min_free_space_trees(self):
+    self.mock(isolateserver.TreeCache, 'CLONE_CMDS', (('cp', '-a'),))
+    self.policies.min_free_space = 1000
+    free_space = [1000]
+    def get_free_space(_path):
+      if len(free_space) > 1:
+        return free_space.pop(0)
+      return free_space[0]
+    self.mock(file_path, 'get_free_space', get_free_space)
+    tree_cache = isolateserver.TreeCache(
+        os.path.join(self.tempdir, 'trees'), 2)
+    with self.get_cache() as cache:
+      cache.tree_cache = tree_cache
+      hashes = self._fill_cache(cache, 2)
+      self._add_tree(tree_cache, cache, 'h1', hashes[0])
+      free_space[:] = [995, 1000]
+    # The tree is evicted first, which frees enough space.
+    self.assertNotIn('h1', tree_cache)
+    self.assertEqual(set(hashes), cache.cached_set())
+
+  def test_trim_in_background(self):
+    self.policies.max_items = 2
+    cache = isolateserver.DiskCache(
+        self.cache_dir, self.policies, self.algo, trim_in_background=True)
+    with cache:
+      hashes = self._fill_cache(cache, 4)
+    deleter = cache._deleter
+    if deleter:
+      deleter.join()
+    self.assertEqual(set(hashes[2:]), cache.cached_set())
+    for h in hashes:
+      self.assertEqual(h in hashes[2:], os.path.isfile(cache._path(h)))
+
+  def test_write_pending_delete(self):
+    with self.get_cache() as cache:
+      h = self._fill_cache(cache, 1)[0]
+      with cache._lock:
+        cache._remove_lru_files(0, 1)
+      self.assertEqual({h: 10}, cache._pending_delete)
+      # Writing the item again reclaims it, its file must not be deleted.
+      cache.write(h, ['%10d' % 0])
+      self.assertEqual({}, cache._pending_delete)
+    self.assertTrue(os.path.isfile(cache._path(h)))
+
+
+class TreeCacheTest(TestCase):
+  def setUp(self):
+    super(TreeCacheTest, self).setUp()
+    # Copy-on-write clones are not supported everywhere, a plain copy is as
+    # good for the tests.
+    self.mock(isolateserver.TreeCache, 'CLONE_CMDS', (('cp', '-a'),))
+    self.tree_dir = os.path.join(self.tempdir, 'trees')
+    self.src = os.path.join(self.tempdir, 'src')
+    os.makedirs(os.path.join(self.src, 'sub'))
+    with open(os.path.join(self.src, 'sub', 'a'), 'wb') as f:
+      f.write('a')
+    os.chmod(os.path.join(self.src, 'sub', 'a'), 0500)
+    os.symlink('sub/a', os.path.join(self.src, 'link'))
+
+  def make_dest(self, name):
+    dest = os.path.join(self.tempdir, name)
+    os.mkdir(dest)
+    return dest
+
+  def test_add_materialize(self):
+    cache = isolateserver.TreeCache(self.tree_dir, 2)
+    self.assertFalse(cache.materialize('h1', self.make_dest('dest0')))
+    cache.add('h1', self.src)
+    self.assertIn('h1', cache)
+
+    # The state is persisted.
+    cache = isolateserver.TreeCache(self.tree_dir, 2)
+    dest = self.make_dest('dest1')
+    self.assertTrue(cache.materialize('h1', dest))
+    self.assertEqual(['link', 'sub'], sorted(os.listdir(dest)))
+    self.assertEqual('sub/a', os.readlink(os.path.join(dest, 'link')))
+    self.assertEqual('a', open(os.path.join(dest, 'sub', 'a'), 'rb').read())
+    self.assertEqual(
+        0500, os.stat(os.path.join(dest, 'sub', 'a')).st_mode & 0777)
+    # The files are not shared with the cached tree.
+    self.assertNotEqual(
+        os.stat(os.path.join(self.tree_dir, 'h1', 'sub', 'a')).st_ino,
+        os.stat(os.path.join(dest, 'sub', 'a')).st_ino)
+
+  def test_clone_unsupported(self):
+    self.mock(isolateserver.TreeCache, 'CLONE_CMDS', (('false',),))
+    self.mock(logging, 'warning', lambda *_: None)
+    cache = isolateserver.TreeCache(self.tree_dir, 2)
+    cache.add('h1', self.src)
+    self.assertNotIn('h1', cache)
+    self.assertEqual(['state.json'], os.listdir(self.tree_dir))
+
+  def test_get_exclusive_size(self):
+    cache = isolateserver.TreeCache(self.tree_dir, 2)
+    cache.add('h1', self.src)
+    cache.add('h2', self.src)
+    # The file is still linked from |src|.
+    self.assertEqual(0, cache.get_exclusive_size())
+    os.remove(os.path.join(self.src, 'sub', 'a'))
+    self.assertEqual(1, cache.get_exclusive_size())
+    self.assertTrue(cache.evict_oldest())
+    self.assertEqual(1, cache.get_exclusive_size())
+    self.assertTrue(cache.evict_oldest())
+    self.assertEqual(0, cache.get_exclusive_size())
+    self.assertFalse(cache.evict_oldest())
+
+  def test_eviction(self):
+    cache = isolateserver.TreeCache(self.tree_dir, 2)
+    cache.add('h1', self.src)
+    cache.add('h2', self.src)
+    self.assertTrue(cache.materialize('h1', self.make_dest('dest')))
+    cache.add('h3', self.src)
+    # h2 is the least recently used.
+    self.assertEqual(
+        ['h1', 'h3', 'state.json'], sorted(os.listdir(self.tree_dir)))
+
+    # Lowering the limit evicts the oldest trees.
+    cache = isolateserver.TreeCache(self.tree_dir, 1)
+    self.assertEqual(['h3', 'state.json'], sorted(os.listdir(self.tree_dir)))
+
+  def test_unknown_trees_removed(self):
+    os.makedirs(os.path.join(self.tree_dir, 'h1', 'foo'))
+    # Trees being added by another process are kept.
+    os.makedirs(os.path.join(self.tree_dir, 'tmp1234', 'foo'))
+    cache = isolateserver.TreeCache(self.tree_dir, 2)
+    self.assertNotIn('h1', cache)
+    self.assertNotIn('tmp1234', cache)
+    self.assertEqual(
+        ['state.json', 'tmp1234'], sorted(os.listdir(self.tree_dir)))
+
+  def test_add_failure(self):
+    cache = isolateserver.TreeCache(self.tree_dir, 2)
+    def rename(_src, _dst):
+      raise OSError('Oops')
+    self.mock(os, 'rename', rename)
+    self.mock(logging, 'error', lambda *_: None)
+    cache.add('h1', self.src)
+    self.assertNotIn('h1', cache)
+    # The temporary directory is deleted.
+    self.assertEqual(['state.json'], os.listdir(self.tree_dir))
+
+  def test_materialize_failure(self):
+    cache = isolateserver.TreeCache(self.tree_dir, 2)
+    cache.add('h1', self.src)
+    self.mock(isolateserver.TreeCache, 'CLONE_CMDS', (('false',),))
+    dest = self.make_dest('dest')
+    self.assertFalse(cache.materialize('h1', dest))
+    self.assertEqual([], os.listdir(dest))
+    # The broken tree is evicted.
+    self.assertNotIn('h1', cache)
+    self.assertEqual(['state.json'], os.listdir(self.tree_dir))
+
+
 class TestArchive(TestCase):
   @staticmethod
   def get_isolateserver_prog():
@@ -989,6 +1487,8 @@ class TestArchive(TestCase):
 def clear_env_vars():
   for e in ('ISOLATE_DEBUG', 'ISOLATE_SERVER'):
     os.environ.pop(e, None)
+  # Do not use the user's persistent hash cache.
+  os.environ['ISOLATE_HASH_CACHE'] = ''
 
 
 if __name__ == '__main__':
@@ -183,6 +183,83 @@ class LRUDictTest(unittest.TestCase):
     lru_dict = save_and_load(lru_dict)
     self.assert_order(lru_dict, [5, 6] + data + [4])
 
+  def test_load_save_journal(self):
+    tempdir = tempfile.mkdtemp(prefix=u'lru_test')
+    try:
+      state_file = os.path.join(tempdir, 'state.json')
+      journal_file = os.path.join(tempdir, 'state.journal')
+      data = [1, 2, 3]
+
+      # The first save always writes the whole state.
+      lru_dict = self.prepare_lru_dict(data)
+      self.assertTrue(lru_dict.save(state_file, journal_file))
+      self.assertFalse(os.path.isfile(journal_file))
+
+      # Next changes are appended to the journal, state file is left as is.
+      lru_dict = lru.LRUDict.load(state_file, journal_file)
+      self.assertFalse(lru_dict.save(state_file, journal_file))
+      lru_dict.touch(1)
+      lru_dict.pop(2)
+      self.assertTrue(lru_dict.save(state_file, journal_file))
+      self.assertTrue(os.path.isfile(journal_file))
+      self.assert_order(lru.LRUDict.load(state_file), data)
+      self.assert_order(lru.LRUDict.load(state_file, journal_file), [3, 1])
+
+      # An incomplete last entry is ignored.
+      with open(journal_file, 'ab') as f:
+        f.write('["a",4,')
+      self.assert_order(lru.LRUDict.load(state_file, journal_file), [3, 1])
+
+      # The journal is compacted once it is larger than the state.
+      with open(journal_file, 'rb') as f:
+        old_journal = f.read()
+      lru_dict = lru.LRUDict.load(state_file, journal_file)
+      lru_dict.add(4, None)
+      self.assertTrue(lru_dict.save(state_file, journal_file))
+      self.assertFalse(os.path.isfile(journal_file))
+      self.assert_order(lru.LRUDict.load(state_file), [3, 1, 4])
+      # The state is replaced atomically, no temporary file is left behind.
+      self.assertEqual(['state.json'], os.listdir(tempdir))
+
+      # The journal of the previous state, left behind when the process was
+      # killed before deleting it, is ignored and compacted away.
+      with open(journal_file, 'wb') as f:
+        f.write(old_journal)
+      self.assert_order(lru.LRUDict.load(state_file, journal_file), [3, 1, 4])
+      lru_dict = lru.LRUDict.load(state_file, journal_file)
+      lru_dict.touch(3)
+      self.assertTrue(lru_dict.save(state_file, journal_file))
+      self.assertEqual(['state.json'], os.listdir(tempdir))
+      self.assert_order(lru.LRUDict.load(state_file, journal_file), [1, 4, 3])
+
+      # A failed write leaves the previous state and journal intact.
+      lru_dict = lru.LRUDict.load(state_file, journal_file)
+      lru_dict.touch(1)
+      self.assertTrue(lru_dict.save(state_file, journal_file))
+      lru_dict.batch_insert_oldest([(5, None)])
+      def fail_rename(*_args):
+        raise OSError('Disk full')
+      old_rename = lru.os.rename
+      lru.os.rename = fail_rename
+      try:
+        with self.assertRaises(OSError):
+          lru_dict.save(state_file, journal_file)
+      finally:
+        lru.os.rename = old_rename
+      self.assertEqual(
+          ['state.journal', 'state.json'], sorted(os.listdir(tempdir)))
+      self.assert_order(lru.LRUDict.load(state_file, journal_file), [4, 3, 1])
+
+      # Corrupted journal.
+      with open(journal_file, 'wb') as f:
+        f.write('["x",4]\n')
+      with self.assertRaises(ValueError):
+        lru.LRUDict.load(state_file, journal_file)
+    finally:
+      for f in os.listdir(tempdir):
+        os.unlink(os.path.join(tempdir, f))
+      os.rmdir(tempdir)
+
   def test_corrupted_state_file(self):
     def load_from_state(state_text):
       handle, tmp_name = tempfile.mkstemp(prefix=u'lru_test')
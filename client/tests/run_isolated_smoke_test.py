@@ -129,6 +129,11 @@ def list_files_tree(directory):
   return sorted(actual)
 
 
+def cache_item_path(digest):
+  """Returns the relative path of an item in the sharded DiskCache."""
+  return os.path.join(digest[:2], digest[2:4], digest)
+
+
 def read_content(filepath):
   with open(filepath, 'rb') as f:
     return f.read()
@@ -239,10 +244,12 @@ class RunIsolatedTest(unittest.TestCase):
     # different names and ensure both are created.
     isolated_hash = self._store('repeated_files.isolated')
     expected = [
+      'state.journal',
       'state.json',
-      isolated_hash,
-      self._store('file1.txt'),
-      self._store('repeated_files.py'),
+      'version',
+      cache_item_path(isolated_hash),
+      cache_item_path(self._store('file1.txt')),
+      cache_item_path(self._store('repeated_files.py')),
     ]
 
     out, err, returncode = self._run(self._cmd_args(isolated_hash))
@@ -254,7 +261,12 @@ class RunIsolatedTest(unittest.TestCase):
 
   def test_fail_empty_isolated(self):
     isolated_hash = self._store_isolated({})
-    expected = ['state.json', isolated_hash]
+    expected = [
+      'state.journal',
+      'state.json',
+      'version',
+      cache_item_path(isolated_hash),
+    ]
     out, err, returncode = self._run(self._cmd_args(isolated_hash))
     self.assertEqual('', out)
     self.assertIn('No command to run\n', err)
@@ -269,17 +281,22 @@ class RunIsolatedTest(unittest.TestCase):
     # as file2.txt.
     isolated_hash = self._store('check_files.isolated')
     expected = [
+      'state.journal',
       'state.json',
-      isolated_hash,
-      self._store('check_files.py'),
-      self._store('file1.txt'),
-      self._store('file3.txt'),
-      # Maps file1.txt.
-      self._store('manifest1.isolated'),
-      # References manifest1.isolated. Maps file2.txt but it is overriden.
-      self._store('manifest2.isolated'),
-      self._store('repeated_files.py'),
-      self._store('repeated_files.isolated'),
+      'version',
+    ] + [
+      cache_item_path(h) for h in (
+        isolated_hash,
+        self._store('check_files.py'),
+        self._store('file1.txt'),
+        self._store('file3.txt'),
+        # Maps file1.txt.
+        self._store('manifest1.isolated'),
+        # References manifest1.isolated. Maps file2.txt but it is overriden.
+        self._store('manifest2.isolated'),
+        self._store('repeated_files.py'),
+        self._store('repeated_files.isolated'),
+      )
     ]
     out, err, returncode = self._run(self._cmd_args(isolated_hash))
     self.assertEqual('', err)
@@ -297,17 +314,22 @@ class RunIsolatedTest(unittest.TestCase):
     self.assertEqual(0, returncode)
     expected = {
       '.': (040707, 040707, 040777),
+      'state.journal': (0100606, 0100606, 0100666),
       'state.json': (0100606, 0100606, 0100666),
+      'version': (0100606, 0100606, 0100666),
       # The reason for 0100666 on Windows is that the file node had to be
       # modified to delete the hardlinked node. The read only bit is reset on
       # load.
-      file1_hash: (0100400, 0100400, 0100666),
-      isolated_hash: (0100400, 0100400, 0100444),
+      cache_item_path(file1_hash): (0100400, 0100400, 0100666),
+      cache_item_path(isolated_hash): (0100400, 0100400, 0100444),
     }
+    for h in (file1_hash, isolated_hash):
+      expected[h[:2]] = (040707, 040707, 040777)
+      expected[os.path.join(h[:2], h[2:4])] = (040707, 040707, 040777)
     self.assertTreeModes(self.cache, expected)
 
     # Modify one of the files in the cache to be invalid.
-    cached_file_path = os.path.join(self.cache, file1_hash)
+    cached_file_path = os.path.join(self.cache, cache_item_path(file1_hash))
     previous_mode = os.stat(cached_file_path).st_mode
     os.chmod(cached_file_path, 0600)
     write_content(cached_file_path, new_content)
@@ -317,14 +339,11 @@ class RunIsolatedTest(unittest.TestCase):
     self.assertNotEqual(CONTENTS['file1.txt'], read_content(cached_file_path))
 
     # Rerun the test and make sure the cache contains the right file afterwards.
+    # The cache is not scanned again, so the modes are left as is. The journal
+    # grew larger than the state so it was compacted.
     _out, _err, returncode = self._run(self._cmd_args(isolated_hash))
     self.assertEqual(0, returncode)
-    expected = {
-      '.': (040700, 040700, 040777),
-      'state.json': (0100600, 0100600, 0100666),
-      file1_hash: (0100400, 0100400, 0100666),
-      isolated_hash: (0100400, 0100400, 0100444),
-    }
+    del expected['state.journal']
     self.assertTreeModes(self.cache, expected)
     return cached_file_path
 
@@ -58,6 +58,10 @@ class StorageFake(object):
     sink([self._files[digest]])
     channel.send_result(digest)
 
+  def async_fetch_batch(self, channel, priority, items, sink_factory):
+    for digest, size in items.iteritems():
+      self.async_fetch(channel, priority, digest, size, sink_factory(digest))
+
 
 class RunIsolatedTestBase(auto_stub.TestCase):
   def setUp(self):
@@ -306,6 +310,44 @@ class RunIsolatedTest(RunIsolatedTestBase):
         ],
         self.popen_calls)
 
+  def test_run_tha_test_tree_cache(self):
+    isolated = json_dumps({
+        'command': ['invalid', 'command'],
+        'files': {
+          'data.txt': {
+            'h': isolateserver_mock.hash_content('data'),
+            's': 4,
+          },
+        },
+    })
+    isolated_hash = isolateserver_mock.hash_content(isolated)
+    files = {
+      isolated_hash: isolated,
+      isolateserver_mock.hash_content('data'): 'data',
+    }
+    mapped = []
+    def change_tree_read_only(rootdir, _read_only):
+      mapped.append(open(os.path.join(rootdir, 'data.txt'), 'rb').read())
+    self.mock(run_isolated, 'change_tree_read_only', change_tree_read_only)
+    # Copy-on-write clones are not supported everywhere.
+    self.mock(isolateserver.TreeCache, 'CLONE_CMDS', (('cp', '-a'),))
+    tree_cache = isolateserver.TreeCache(
+        os.path.join(self.tempdir, 'trees'), 1)
+
+    for storage_files in (files, {isolated_hash: isolated}):
+      # The second run only needs the .isolated file, the tree is copied from
+      # the tree cache.
+      ret = run_isolated.run_tha_test(
+          isolated_hash,
+          StorageFake(storage_files),
+          isolateserver.MemoryCache(),
+          False,
+          [],
+          tree_cache)
+      self.assertEqual(0, ret)
+    self.assertEqual(['data', 'data'], mapped)
+    self.assertEqual(2, len(self.popen_calls))
+
 
 class RunIsolatedTestRun(RunIsolatedTestBase):
   def test_output(self):
@@ -330,6 +330,77 @@ class TestSwarmingTrigger(NetTestCase):
     }
     self.assertEqual(expected, tasks)
 
+  def test_trigger_task_shards_2_shards_bulk(self):
+    task_request = swarming.TaskRequest(
+        command=['a', 'b'],
+        data=[],
+        dimensions={'foo': 'bar', 'os': 'Mac'},
+        env={},
+        expiration=60*60,
+        hard_timeout=60,
+        idempotent=False,
+        io_timeout=60,
+        name=TEST_NAME,
+        priority=101,
+        tags=['taga', 'tagb'],
+        user='joe@localhost',
+        verbose=False)
+
+    shards = [
+      {
+        'env': {'GTEST_SHARD_INDEX': '0', 'GTEST_TOTAL_SHARDS': '2'},
+        'name': u'unit_tests:0:2',
+      },
+      {
+        'env': {'GTEST_SHARD_INDEX': '1', 'GTEST_TOTAL_SHARDS': '2'},
+        'name': u'unit_tests:1:2',
+      },
+    ]
+    result = {
+      'priority': 101,
+      'tasks': [
+        {'name': u'unit_tests:0:2', 'task_id': '12300'},
+        {'name': u'unit_tests:1:2', 'task_id': '12400'},
+      ],
+    }
+    self.expected_requests(
+        [
+          (
+            'https://localhost:1/swarming/api/v1/client/handshake',
+            {'data': {}, 'headers': {'X-XSRF-Token-Request': '1'}},
+            {'max_shards': 1000, 'server_version': 'v1', 'xsrf_token': 'Token'},
+          ),
+          (
+            'https://localhost:1/swarming/api/v1/client/shards',
+            {
+              'data': {
+                'request': swarming.task_request_to_raw_request(task_request),
+                'shards': shards,
+              },
+              'headers': {'X-XSRF-Token': 'Token'},
+            },
+            result,
+          ),
+        ])
+
+    tasks = swarming.trigger_task_shards(
+        swarming='https://localhost:1',
+        task_request=task_request,
+        shards=2)
+    expected = {
+      u'unit_tests:0:2': {
+        'shard_index': 0,
+        'task_id': '12300',
+        'view_url': 'https://localhost:1/user/task/12300',
+      },
+      u'unit_tests:1:2': {
+        'shard_index': 1,
+        'task_id': '12400',
+        'view_url': 'https://localhost:1/user/task/12400',
+      },
+    }
+    self.assertEqual(expected, tasks)
+
   def test_trigger_task_shards_priority_override(self):
     task_request = swarming.TaskRequest(
         command=['a', 'b'],
@@ -459,6 +530,91 @@ class TestSwarmingCollection(NetTestCase):
     actual = get_results(['10100'])
     self.assertEqual(expected, actual)
 
+  def test_success_tailed(self):
+    # Keep the delay between the two polls short.
+    now = [0., 0., 9.9]
+    self.mock(swarming, 'now', lambda: now.pop(0))
+    url = 'https://host:9001/swarming/api/v1/client/task/10100'
+    self.expected_requests(
+        [
+          (url, {'retry_50x': False}, gen_result_response(state=0x10)),
+          (
+            url + '/output/0?offset=0',
+            {'retry_50x': False},
+            {'next_offset': 4, 'output': u'Foo\n'},
+          ),
+          (url, {'retry_50x': False}, gen_result_response()),
+          (
+            url + '/output/0?offset=4',
+            {'retry_50x': False},
+            {'next_offset': 8, 'output': u'Bar\n'},
+          ),
+          (
+            url + '/output/0?offset=8',
+            {'retry_50x': False},
+            {'next_offset': 8, 'output': u''},
+          ),
+        ])
+    expected = [gen_yielded_data(0, outputs=[u'Foo\nBar\n'])]
+    actual = get_results(['10100'])
+    self.assertEqual(expected, actual)
+
+  def test_success_tailed_retried(self):
+    now = [0., 0., 0., 9.9]
+    self.mock(swarming, 'now', lambda: now.pop(0))
+    url = 'https://host:9001/swarming/api/v1/client/task/10100'
+    self.expected_requests(
+        [
+          (url, {'retry_50x': False}, gen_result_response(state=0x10)),
+          (
+            url + '/output/0?offset=0',
+            {'retry_50x': False},
+            {'next_offset': 4, 'output': u'Foo\n'},
+          ),
+          # The first try died, the output of the second try is fetched from
+          # the start.
+          (
+            url,
+            {'retry_50x': False},
+            gen_result_response(state=0x10, try_number=2),
+          ),
+          (
+            url + '/output/0?offset=0',
+            {'retry_50x': False},
+            {'next_offset': 4, 'output': u'Bar\n'},
+          ),
+          (url, {'retry_50x': False}, gen_result_response(try_number=2)),
+          (
+            url + '/output/0?offset=4',
+            {'retry_50x': False},
+            {'next_offset': 4, 'output': u''},
+          ),
+        ])
+    expected = [
+      gen_yielded_data(0, outputs=[u'Bar\n'], try_number=2),
+    ]
+    actual = get_results(['10100'])
+    self.assertEqual(expected, actual)
+
+  def test_success_tail_unsupported(self):
+    now = [0., 0., 9.9]
+    self.mock(swarming, 'now', lambda: now.pop(0))
+    url = 'https://host:9001/swarming/api/v1/client/task/10100'
+    self.expected_requests(
+        [
+          (url, {'retry_50x': False}, gen_result_response(state=0x10)),
+          (
+            url + '/output/0?offset=0',
+            {'retry_50x': False},
+            {'output': u'Foo\n'},
+          ),
+          (url, {'retry_50x': False}, gen_result_response()),
+          (url + '/output/all', {}, {'outputs': [OUTPUT]}),
+        ])
+    expected = [gen_yielded_data(0, outputs=[OUTPUT])]
+    actual = get_results(['10100'])
+    self.assertEqual(expected, actual)
+
   def test_no_ids(self):
     actual = get_results([])
     self.assertEqual([], actual)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# Copyright 2015 The Swarming Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0 that
+# can be found in the LICENSE file.
+
+"""Profiles the coordinator side of fetching an isolated tree.
+
+Uses an in-memory storage that completes fetches instantly so only the CPU
+spent by IsolatedBundle.fetch() and by waiting on FetchQueue is measured, for
+trees of various include depth, include width and file count.
+"""
+
+import json
+import optparse
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import isolated_format
+import isolateserver
+
+from utils import tools
+
+
+ALGO = isolated_format.get_hash_algo('default')
+
+
+class StorageFake(object):
+  """Storage that completes fetches synchronously from a dict."""
+
+  def __init__(self, contents):
+    self._contents = contents
+
+  def async_fetch(self, channel, _priority, digest, _size, sink):
+    sink([self._contents[digest]])
+    channel.send_result(digest)
+
+  def async_fetch_batch(self, channel, priority, items, sink_factory):
+    for digest, size in items.iteritems():
+      self.async_fetch(channel, priority, digest, size, sink_factory(digest))
+
+
+def add_content(contents, data):
+  digest = ALGO(data).hexdigest()
+  contents[digest] = data
+  return digest
+
+
+def gen_tree(contents, depth, width, files):
+  """Generates a tree of .isolated files, files are spread over the leaves.
+
+  Each .isolated file also lists a unique symlink so none is included twice.
+
+  Returns the hash of the root .isolated file.
+  """
+  leaves = width ** depth
+  counter = [0, 0]
+
+  def gen_node(level):
+    isolated = {
+      'files': {'link%d' % counter[1]: {'l': 'target'}},
+      'version': isolated_format.ISOLATED_FILE_VERSION,
+    }
+    counter[1] += 1
+    if level == depth:
+      start = counter[0] * files / leaves
+      counter[0] += 1
+      end = counter[0] * files / leaves
+      for i in xrange(start, end):
+        data = 'file %d' % i
+        isolated['files']['f%d' % i] = {
+          'h': add_content(contents, data),
+          's': len(data),
+        }
+    else:
+      isolated['includes'] = [gen_node(level + 1) for _ in xrange(width)]
+    return add_content(
+        contents, json.dumps(isolated, sort_keys=True, separators=(',', ':')))
+
+  return gen_node(0)
+
+
+def wait_legacy(fetch_queue, remaining):
+  """The previous way to wait on all the files, for comparison."""
+  while remaining:
+    remaining.pop(fetch_queue.wait(remaining))
+
+
+def wait_indexed(fetch_queue, remaining):
+  for digest in fetch_queue.iter_fetched(remaining):
+    remaining.pop(digest)
+
+
+def profile(depth, width, files, wait_func):
+  contents = {}
+  root = gen_tree(contents, depth, width, files)
+  fetch_queue = isolateserver.FetchQueue(
+      StorageFake(contents), isolateserver.MemoryCache())
+
+  start = time.time()
+  bundle = isolateserver.IsolatedBundle()
+  bundle.fetch(fetch_queue, root, ALGO)
+  fetched_isolated = time.time()
+  remaining = dict(
+      (props['h'], filepath) for filepath, props in bundle.files.iteritems()
+      if 'h' in props)
+  assert len(remaining) == files, (len(remaining), files)
+  wait_func(fetch_queue, remaining)
+  end = time.time()
+  return fetched_isolated - start, end - fetched_isolated
+
+
+def main():
+  tools.disable_buffering()
+  parser = optparse.OptionParser(description=sys.modules[__name__].__doc__)
+  parser.add_option(
+      '--depth', type='int', action='append',
+      help='Include depths to profile, default: 1, 3, 6')
+  parser.add_option(
+      '--width', type='int', action='append',
+      help='Include widths to profile, default: 1, 4')
+  parser.add_option(
+      '--files', type='int', action='append',
+      help='File counts to profile, default: 1000, 10000, 30000')
+  parser.add_option(
+      '--legacy', action='store_true',
+      help='Also profile waiting with FetchQueue.wait() in a loop, it is '
+           'quadratic in the number of files')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unknown args passed in; %s' % args)
+
+  waits = [('indexed', wait_indexed)]
+  if options.legacy:
+    waits.append(('legacy', wait_legacy))
+  for depth in options.depth or (1, 3, 6):
+    for width in options.width or (1, 4):
+      for files in options.files or (1000, 10000, 30000):
+        for name, wait_func in waits:
+          isolated_time, files_time = profile(depth, width, files, wait_func)
+          print(
+              'depth %d, width %d, %6d files, %7s: .isolated %6.3fs, files '
+              '%6.3fs' % (
+                depth, width, files, name, isolated_time, files_time))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -7,20 +7,21 @@
 
 Generates an histogram with the latencies to process the tasks and number of
 retries.
+
+With --no-sleep, the bots poll back to back to measure the contention between
+bots reaping the same tasks.
 """
 
-import hashlib
+import base64
 import json
 import logging
 import optparse
 import os
 import Queue
 import socket
-import StringIO
 import sys
 import threading
 import time
-import zipfile
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -28,8 +29,6 @@ sys.path.insert(0, ROOT_DIR)
 
 from third_party import colorama
 
-import swarming
-
 from utils import graph
 from utils import net
 from utils import threading_utils
@@ -40,6 +39,28 @@ from utils import threading_utils
 OS_NAME = 'Comodore64'
 TASK_OUTPUT = 'This task ran with great success'
 
+# Delay between updates sent while a task is running, in seconds.
+PING_DELAY = 30.
+
+
+def print_reap_rates(results, duration):
+  """Prints the rates of reaped tasks and of reap conflicts.
+
+  The conflicts are the tasks the server lost to other bots while looking for
+  one, as reported in the poll responses: the claims taken by another bot and
+  the reaps that failed.
+  """
+  reaped = len([i for i in results if isinstance(i, float)])
+  claims_lost = results.count('claim_lost')
+  failures = results.count('reap_failure')
+  conflicts = claims_lost + failures
+  print('Reaped tasks   : %.2f/s' % (reaped / duration))
+  print('Reap conflicts : %.2f/s (%d claims lost, %d failed reaps)' % (
+      conflicts / duration, claims_lost, failures))
+  print('Empty polls    : %d' % results.count('sleep'))
+  print('Duplicate tasks: %d' % results.count('duplicate_task'))
+  print('')
+
 
 def print_results(results, columns, buckets):
   delays = [i for i in results if isinstance(i, float)]
@@ -66,29 +87,6 @@ def print_results(results, columns, buckets):
     print('')
 
 
-def generate_version(source):
-  """Generates the sha-1 based on the content of this zip.
-
-  Copied from:
-  https://code.google.com/p/swarming/source/browse/services/swarming/swarm_bot/zipped_archive.py
-  """
-  result = hashlib.sha1()
-  with zipfile.ZipFile(source, 'r') as z:
-    for item in sorted(z.namelist()):
-      with z.open(item) as f:
-        result.update(item)
-        result.update('\x00')
-        result.update(f.read())
-        result.update('\x00')
-  return result.hexdigest()
-
-
-def calculate_version(url):
-  """Retrieves the swarm_bot code and returns the SHA-1 for it."""
-  # Cannot use url_open() since zipfile requires .seek().
-  return generate_version(StringIO.StringIO(net.url_read(url)))
-
-
 def get_hostname():
   return socket.getfqdn().lower().split('.', 1)[0]
 
@@ -100,9 +98,12 @@ class FakeSwarmBot(object):
   It polls for job, acts as if it was processing them and return the fake
   result.
   """
+  # Protects the set of task ids shared by all the bots.
+  _task_ids_lock = threading.Lock()
+
   def __init__(
-      self, swarming_url, dimensions, swarm_bot_version_hash, hostname, index,
-      progress, duration, events, kill_event):
+      self, swarming_url, dimensions, hostname, index, progress, duration,
+      events, kill_event, no_sleep, task_ids):
     self._lock = threading.Lock()
     self._swarming = swarming_url
     self._index = index
@@ -110,14 +111,17 @@ class FakeSwarmBot(object):
     self._duration = duration
     self._events = events
     self._kill_event = kill_event
+    self._no_sleep = no_sleep
+    self._task_ids = task_ids
     self._bot_id = '%s-%d' % (hostname, index)
+    self._xsrf_token = None
     self._attributes = {
-      'dimensions': dimensions,
-      'id': self._bot_id,
-      # TODO(maruel): Use os_utilities.py.
-      'ip': '127.0.0.1',
-      'try_count': 0,
-      'version': swarm_bot_version_hash,
+      'dimensions': dict(dimensions, id=[self._bot_id]),
+      'state': {
+        'running_time': 0.,
+        'sleep_streak': 0,
+      },
+      'version': '',
     }
 
     self._thread = threading.Thread(target=self._run, name='bot%d' % index)
@@ -130,104 +134,117 @@ class FakeSwarmBot(object):
   def is_alive(self):
     return self._thread.is_alive()
 
+  def _post(self, path, data):
+    """Sends a JSON request to the bot API."""
+    return net.url_read_json(
+        self._swarming + '/swarming/api/v1/bot/' + path,
+        data=data,
+        headers={'X-XSRF-Token': self._xsrf_token})
+
+  def _handshake(self):
+    """Retrieves the XSRF token and the expected bot version."""
+    response = net.url_read_json(
+        self._swarming + '/swarming/api/v1/bot/handshake',
+        data=self._attributes,
+        headers={'X-XSRF-Token-Request': '1'})
+    if not response:
+      return False
+    self._xsrf_token = response['xsrf_token']
+    self._attributes['version'] = response['bot_version']
+    return True
+
   def _run(self):
     """Polls the server and fake execution."""
     try:
       self._progress.update_item('%d alive' % self._index, bots=1)
+      if not self._handshake():
+        self._events.put('handshake_fail')
+        return
+      start_time = time.time()
       while True:
         if self._kill_event.is_set():
           return
-        data = {'attributes': json.dumps(self._attributes)}
-        request = net.url_open(self._swarming + '/poll_for_test', data=data)
-        if request is None:
-          self._events.put('poll_for_test_empty')
+        state = self._attributes['state']
+        state['running_time'] = time.time() - start_time
+        manifest = self._post('poll', self._attributes)
+        if not manifest:
+          self._events.put('poll_fail')
           continue
         start = time.time()
-        try:
-          manifest = json.load(request)
-        except ValueError:
-          self._progress.update_item('Failed to poll')
-          self._events.put('poll_for_test_invalid')
-          continue
-
-        commands = [c['function'] for c in manifest.get('commands', [])]
-        if not commands:
+        reap_stats = manifest.get('reap_stats') or {}
+        for _ in xrange(reap_stats.get('claims_lost', 0)):
+          self._events.put('claim_lost')
+        for _ in xrange(reap_stats.get('failures', 0)):
+          self._events.put('reap_failure')
+
+        cmd = manifest.get('cmd')
+        if cmd == 'sleep':
           # Nothing to run.
           self._events.put('sleep')
-          time.sleep(manifest['come_back'])
+          state['sleep_streak'] += 1
+          if not self._no_sleep:
+            time.sleep(manifest['duration'])
           continue
+        state['sleep_streak'] = 0
 
-        if commands == ['UpdateSlave']:
-          # Calculate the proper SHA-1 and loop again.
+        if cmd == 'update':
           # This could happen if the Swarming server is upgraded while this
           # script runs.
-          self._attributes['version'] = calculate_version(
-              manifest['commands'][0]['args'])
+          self._attributes['version'] = manifest['version']
           self._events.put('update_slave')
           continue
 
-        if commands != ['RunManifest']:
+        if cmd == 'restart':
+          # Fake bots are not restarted.
+          self._events.put('restart')
+          continue
+
+        if cmd != 'run':
           self._progress.update_item(
-              'Unexpected RPC call %s\n%s' % (commands, manifest))
+              'Unexpected RPC call %s\n%s' % (cmd, manifest))
           self._events.put('unknown_rpc')
           break
 
-        store_cmd = manifest['commands'][0]
-        if not isinstance(store_cmd['args'], unicode):
-          self._progress.update_item('Unexpected RPC manifest\n%s' % manifest)
-          self._events.put('unknown_args')
-          break
-
-        result_url = manifest['result_url']
-        test_run = json.loads(store_cmd['args'])
-        if result_url != test_run['result_url']:
-          self._progress.update_item(
-              'Unexpected result url: %s != %s' %
-              (result_url, test_run['result_url']))
-          self._events.put('invalid_result_url')
-          break
-        ping_url = test_run['ping_url']
-        ping_delay = test_run['ping_delay']
+        task_id = manifest['manifest']['task_id']
+        with self._task_ids_lock:
+          # Two bots reaping the same task is a server bug.
+          if task_id in self._task_ids:
+            self._events.put('duplicate_task')
+          self._task_ids.add(task_id)
         self._progress.update_item('%d processing' % self._index, processing=1)
 
-        # Fake activity and send pings as requested.
+        # Fake activity and send pings so the task is not considered dead.
+        data = {
+          'cost_usd': 0.,
+          'id': self._bot_id,
+          'task_id': task_id,
+        }
         while True:
           remaining = max(0, (start + self._duration) - time.time())
-          if remaining > ping_delay:
-            # Include empty data to ensure the request is a POST request.
-            result = net.url_read(ping_url, data={})
-            assert result == 'Success.', result
-            remaining = max(0, (start + self._duration) - time.time())
-          if not remaining:
-            break
+          if remaining > PING_DELAY:
+            time.sleep(PING_DELAY)
+            result = self._post('task_update', data)
+            assert result == {u'ok': True}, result
+            continue
           time.sleep(remaining)
+          break
 
-        # In the old API, r=<task_id>&id=<bot_id> is passed as the url.
-        data = {
-          'o': TASK_OUTPUT,
-          'x': '0',
-        }
-        result = net.url_read(manifest['result_url'], data=data)
+        data.update({
+          'duration': time.time() - start,
+          'exit_code': 0,
+          'output': base64.b64encode(TASK_OUTPUT),
+          'output_chunk_start': 0,
+        })
+        result = self._post('task_update', data)
         self._progress.update_item(
             '%d processed' % self._index, processing=-1, processed=1)
         if not result:
           self._events.put('result_url_fail')
         else:
-          assert result == 'Successfully update the runner results.', result
+          assert result == {u'ok': True}, result
           self._events.put(time.time() - start)
     finally:
-      try:
-        # Unregister itself. Otherwise the server will have tons of fake slaves
-        # that the admin will have to remove manually.
-        response = net.url_open(
-            self._swarming + '/delete_machine_stats',
-            data=[('r', self._bot_id)])
-        if not response:
-          self._events.put('failed_unregister')
-        else:
-          response.read()
-      finally:
-        self._progress.update_item('%d quit' % self._index, bots=-1)
+      self._progress.update_item('%d quit' % self._index, bots=-1)
 
 
 def main():
@@ -239,11 +256,14 @@ def main():
       help='Swarming server to use')
   parser.add_option(
       '--suffix', metavar='NAME', default='', help='Bot suffix name to use')
-  swarming.add_filter_options(parser)
+  parser.add_option(
+      '-d', '--dimension', default=[], action='append', nargs=2,
+      dest='dimensions', metavar='FOO bar',
+      help='dimension the bots have')
   # Use improbable values to reduce the chance of interferring with real slaves.
   parser.set_defaults(
       dimensions=[
-        ('cpu', ['arm36']),
+        ('cpu', 'arm36'),
         ('hostname', socket.getfqdn()),
         ('os', OS_NAME),
       ])
@@ -255,6 +275,11 @@ def main():
   group.add_option(
       '-c', '--consume', type='float', default=60., metavar='N',
       help='Duration (s) for consuming a request, default: %default')
+  group.add_option(
+      '--no-sleep', action='store_true',
+      help='Poll again right away instead of sleeping when no task is '
+           'available. Use with a full queue to report the reap conflicts per '
+           'second')
   parser.add_option_group(group)
 
   group = optparse.OptionGroup(parser, 'Display options')
@@ -280,7 +305,9 @@ def main():
     parser.error('--swarming is required.')
   if options.consume <= 0:
     parser.error('Needs --consume > 0. 0.01 is a valid value.')
-  swarming.process_filter_options(parser, options)
+  dimensions = {}
+  for key, value in options.dimensions:
+    dimensions.setdefault(unicode(key), []).append(unicode(value))
 
   print(
       'Running %d slaves, each task lasting %.1fs' % (
@@ -292,14 +319,14 @@ def main():
   events = Queue.Queue()
   start = time.time()
   kill_event = threading.Event()
-  swarm_bot_version_hash = calculate_version(options.swarming + '/bot_code')
   hostname = get_hostname()
   if options.suffix:
     hostname += '-' + options.suffix
+  task_ids = set()
   slaves = [
     FakeSwarmBot(
-      options.swarming, options.dimensions, swarm_bot_version_hash, hostname, i,
-      progress, options.consume, events, kill_event)
+      options.swarming, dimensions, hostname, i, progress, options.consume,
+      events, kill_event, options.no_sleep, task_ids)
     for i in range(options.slaves)
   ]
   try:
@@ -322,9 +349,11 @@ def main():
     slaves = [s for s in slaves if s.is_alive()]
   # At this point, progress is not used anymore.
   print('')
-  print('Ran for %.1fs.' % (time.time() - start))
+  duration = time.time() - start
+  print('Ran for %.1fs.' % duration)
   print('')
   results = list(events.queue)
+  print_reap_rates(results, duration)
   print_results(results, options.columns, options.buckets)
   if options.dump:
     with open(options.dump, 'w') as f:
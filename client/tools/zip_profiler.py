@@ -6,9 +6,14 @@
 """Profiler to compare various compression levels with regards to speed
 and final size when compressing the full set of files from a given
 isolated file.
+
+With --adaptive, compares instead the fixed per-extension level with the
+adaptive and parallel compression used by isolateserver for *-gzip namespaces,
+and verifies that the produced streams decompress to the original content.
 """
 
 import bz2
+import collections
 import optparse
 import os
 import shutil
@@ -21,6 +26,9 @@ import zlib
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, ROOT_DIR)
 
+import isolateserver
+
+from utils import threading_utils
 from utils import tools
 
 
@@ -32,7 +40,7 @@ def zip_file(compressor_constructor, compression_level, filename):
       chunk = f.read(16 * 1024)
       if not chunk:
         break
-      compressed_size += len(compressor.compress(f.read()))
+      compressed_size += len(compressor.compress(chunk))
     compressed_size += len(compressor.flush())
 
   return compressed_size
@@ -58,6 +66,58 @@ def profile_compress(zip_module_name, compressor_constructor,
           (zip_module_name, i, compressed_size, end_time - start_time))
 
 
+def zip_file_isolateserver(filename, size, adaptive, thread_pool):
+  """Compresses a file like isolateserver would, returns the compressed size
+  and the level used.
+  """
+  level = isolateserver.get_zip_compression_level(filename)
+  if adaptive:
+    sample = next(isolateserver.file_read(filename), '')
+    level = isolateserver.get_adaptive_zip_compression_level(sample, level)
+    if size < isolateserver.ZIP_PARALLEL_MIN_SIZE:
+      thread_pool = None
+    compressed = isolateserver.zip_compress_adaptive(
+        isolateserver.file_read(filename),
+        isolateserver.get_zip_compression_level(filename),
+        thread_pool)
+  else:
+    compressed = isolateserver.zip_compress(
+        isolateserver.file_read(filename), level)
+  compressed = ''.join(compressed)
+  original = ''.join(isolateserver.file_read(filename))
+  if ''.join(isolateserver.zip_decompress([compressed])) != original:
+    raise ValueError('%s was not compressed correctly' % filename)
+  return len(compressed), level
+
+
+def profile_adaptive(file_set, parallel):
+  """Compares the static and adaptive zip compression levels on |file_set|."""
+  thread_pool = None
+  if parallel:
+    thread_pool = threading_utils.ThreadPool(
+        2, max(threading_utils.num_processors(), 2), 0, 'zip')
+  try:
+    modes = [('static', False, None), ('adaptive', True, None)]
+    if thread_pool:
+      modes.append(('parallel', True, thread_pool))
+    for name, adaptive, pool in modes:
+      levels = collections.Counter()
+      compressed_size = 0
+      start_time = time.time()
+      for filename, size in file_set.iteritems():
+        file_compressed_size, level = zip_file_isolateserver(
+            filename, size, adaptive, pool)
+        compressed_size += file_compressed_size
+        levels[level] += 1
+      end_time = time.time()
+      print('%8s: total size %11d, time taken %6.3f, files per level %s' % (
+          name, compressed_size, end_time - start_time,
+          ', '.join('%d: %d' % (k, v) for k, v in sorted(levels.iteritems()))))
+  finally:
+    if thread_pool:
+      thread_pool.close()
+
+
 def tree_files(root_dir):
   file_set = {}
   for root, _, files in os.walk(root_dir):
@@ -75,6 +135,12 @@ def main():
   parser.add_option('--largest_files', type='int',
                     help='If this is set, instead of compressing all the '
                     'files, only the large n files will be compressed')
+  parser.add_option('--adaptive', action='store_true',
+                    help='Profile the adaptive compression of isolateserver '
+                    'instead of each zlib and bz2 level')
+  parser.add_option('--no-parallel', action='store_true',
+                    help='With --adaptive, do not profile the parallel '
+                    'compression of large files')
   options, args = parser.parse_args()
 
   if args:
@@ -94,7 +160,11 @@ def main():
 
     file_set = tree_files(temp_dir)
 
-    if options.largest_files:
+    if options.adaptive:
+      print('Number of files: %s' % len(file_set))
+      print('Total size: %s' % sum(file_set.itervalues()))
+      profile_adaptive(file_set, not options.no_parallel)
+    elif options.largest_files:
       sorted_by_size = sorted(file_set.iteritems(),  key=lambda x: x[1],
                               reverse=True)
       files_to_compress = sorted_by_size[:options.largest_files]
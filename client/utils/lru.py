@@ -5,7 +5,10 @@
 """Defines a dictionary that can evict least recently used items."""
 
 import collections
+import hashlib
 import json
+import os
+import sys
 
 
 class LRUDict(object):
@@ -15,7 +18,10 @@ class LRUDict(object):
   (key, value) pairs in order they are inserted and can effectively pop oldest
   items.
 
-  Can also store its state as *.json file on disk.
+  Can also store its state as *.json file on disk, optionally along an append
+  only journal of the changes done since the state file was last written. The
+  first line of the journal identifies the state file it applies to, so that it
+  is never replayed on top of another one.
   """
 
   def __init__(self):
@@ -23,6 +29,14 @@ class LRUDict(object):
     self._items = collections.OrderedDict()
     # True if was modified after loading.
     self._dirty = True
+    # List of changes not yet saved in the journal, or None if the changes
+    # can't be expressed as a journal and the whole state must be saved.
+    self._journal = None
+    # Number of entries in the journal file on disk.
+    self._journal_size = 0
+    # SHA-1 of the content of the state file this dict was loaded from or saved
+    # to, None if unknown.
+    self._state_digest = None
 
   def __nonzero__(self):
     """False if dict is empty."""
@@ -37,13 +51,18 @@ class LRUDict(object):
     return key in self._items
 
   @classmethod
-  def load(cls, state_file):
+  def load(cls, state_file, journal_file=None):
     """Loads previously saved state and returns LRUDict in that state.
 
-    Raises ValueError if state file is corrupted.
+    If |journal_file| is given and exists, the changes it lists are replayed on
+    top of the state.
+
+    Raises ValueError if state file or journal file is corrupted.
     """
     try:
-      state = json.load(open(state_file, 'r'))
+      with open(state_file, 'rb') as f:
+        content = f.read()
+      state = json.loads(content)
     except (IOError, ValueError) as e:
       raise ValueError('Broken state file %s: %s' % (state_file, e))
 
@@ -64,18 +83,44 @@ class LRUDict(object):
       raise ValueError(
           'Broken state file %s, found duplicate keys' % (state_file,))
 
-    # Now state from the file corresponds to state in the memory.
+    lru._state_digest = hashlib.sha1(content).hexdigest()
+    lru._journal = []
+    if journal_file and os.path.isfile(journal_file):
+      lru._journal_size, complete = lru._replay_journal(journal_file)
+      if not complete:
+        # Do not append to a journal that ends with an incomplete entry or that
+        # belongs to another state file.
+        lru._journal = None
+
+    # Now state from the files corresponds to state in the memory.
     lru._dirty = False
     return lru
 
-  def save(self, state_file):
-    """Saves cache state to a file if it was modified."""
+  def save(self, state_file, journal_file=None):
+    """Saves cache state to a file if it was modified.
+
+    If |journal_file| is given, only the changes done since the last save are
+    appended to it. The state file is rewritten and the journal is deleted
+    (i.e. the journal is compacted) only when the journal would grow larger
+    than the state itself.
+    """
     if not self._dirty:
       return False
 
-    with open(state_file, 'wb') as f:
-      json.dump(self._items.items(), f, separators=(',',':'))
-
+    if (journal_file and self._journal is not None and
+        self._state_digest and os.path.isfile(state_file) and
+        self._journal_size + len(self._journal) <= len(self._items)):
+      with open(journal_file, 'ab') as f:
+        if not f.tell():
+          f.write(json.dumps(['s', self._state_digest]) + '\n')
+        for entry in self._journal:
+          f.write(json.dumps(entry, separators=(',',':')) + '\n')
+      self._journal_size += len(self._journal)
+    else:
+      self._write_state(state_file, journal_file)
+      self._journal_size = 0
+
+    self._journal = []
     self._dirty = False
     return True
 
@@ -83,7 +128,7 @@ class LRUDict(object):
     """Adds or replaces a |value| for |key|, marks it as most recently used."""
     self._items.pop(key, None)
     self._items[key] = value
-    self._dirty = True
+    self._log(['a', key, value])
 
   def batch_insert_oldest(self, items):
     """Prepends list of |items| to the dict, marks them as least recently used.
@@ -105,6 +150,8 @@ class LRUDict(object):
 
     self._items = new_items
     self._dirty = True
+    # The journal can only express appends.
+    self._journal = None
 
   def keys_set(self):
     """Set of keys of items in this dict."""
@@ -119,8 +166,9 @@ class LRUDict(object):
 
     Raises KeyError if |key| is not in the dict.
     """
-    self._items[key] = self._items.pop(key)
-    self._dirty = True
+    value = self._items.pop(key)
+    self._items[key] = value
+    self._log(['a', key, value])
 
   def pop(self, key):
     """Removes item from the dict, returns its value.
@@ -128,7 +176,7 @@ class LRUDict(object):
     Raises KeyError if |key| is not in the dict.
     """
     value = self._items.pop(key)
-    self._dirty = True
+    self._log(['d', key])
     return value
 
   def pop_oldest(self):
@@ -137,9 +185,88 @@ class LRUDict(object):
     Raises KeyError if dict is empty.
     """
     pair = self._items.popitem(last=False)
-    self._dirty = True
+    self._log(['d', pair[0]])
     return pair
 
   def itervalues(self):
     """Iterator over stored values in arbitrary order."""
     return self._items.itervalues()
+
+  def _write_state(self, state_file, journal_file):
+    """Replaces |state_file| with the current state and deletes the journal.
+
+    The state is written to a temporary file renamed over |state_file|, so a
+    crash leaves either the old or the new state file. The journal is deleted
+    afterward; if this doesn't happen, it is ignored on load since it doesn't
+    match the new state file.
+    """
+    content = json.dumps(self._items.items(), separators=(',',':'))
+    tmp = state_file + '.tmp'
+    try:
+      # Not using tempfile.mkstemp() so the file mode follows the umask.
+      with open(tmp, 'wb') as f:
+        f.write(content)
+      if sys.platform == 'win32' and os.path.isfile(state_file):
+        # os.rename() doesn't replace an existing file on Windows.
+        os.remove(state_file)
+      os.rename(tmp, state_file)
+    except:  # pylint: disable=W0702
+      if os.path.isfile(tmp):
+        os.remove(tmp)
+      raise
+    self._state_digest = hashlib.sha1(content).hexdigest()
+    if journal_file and os.path.isfile(journal_file):
+      os.remove(journal_file)
+
+  def _log(self, entry):
+    """Marks the dict as modified and records |entry| in the journal."""
+    self._dirty = True
+    if self._journal is not None:
+      self._journal.append(entry)
+
+  def _replay_journal(self, journal_file):
+    """Applies the changes listed in |journal_file|.
+
+    Returns a tuple (number of entries in the journal, True if the journal is
+    complete and can be appended to).
+
+    Raises ValueError if the journal is corrupted. An incomplete last line is
+    ignored, it happens when the process was killed while appending to the
+    journal. A journal written for another state file is ignored, it happens
+    when the process was killed while compacting the journal.
+    """
+    try:
+      with open(journal_file, 'rb') as f:
+        lines = f.read().split('\n')
+    except IOError as e:
+      raise ValueError('Broken journal file %s: %s' % (journal_file, e))
+
+    # The last line is either empty or incomplete.
+    complete = not lines.pop()
+    if lines and lines[0].startswith('["s",'):
+      try:
+        header = json.loads(lines.pop(0))
+      except ValueError as e:
+        raise ValueError('Broken journal file %s: %s' % (journal_file, e))
+      if header != ['s', self._state_digest]:
+        return 0, False
+    for line in lines:
+      try:
+        entry = json.loads(line)
+      except ValueError as e:
+        raise ValueError('Broken journal file %s: %s' % (journal_file, e))
+      if not isinstance(entry, list):
+        raise ValueError(
+            'Broken journal file %s, expecting lists: %s' %
+            (journal_file, entry))
+      if entry[0] == 'a' and len(entry) == 3:
+        self._items.pop(entry[1], None)
+        self._items[entry[1]] = entry[2]
+      elif entry[0] == 'd' and len(entry) == 2:
+        # The journal may be replayed on top of a state file that already
+        # includes some of its changes, ignore unknown keys.
+        self._items.pop(entry[1], None)
+      else:
+        raise ValueError(
+            'Broken journal file %s, unknown entry: %s' % (journal_file, entry))
+    return len(lines), complete
@@ -141,6 +141,7 @@ def url_open(url, **kwargs):  # pylint: disable=W0621
     - str for pre-encoded data
     - list for data to be encoded
     - dict for data to be encoded
+    - callable that returns an iterable of str chunks for streamed data
 
   See HttpService.request for a full list of arguments.
 
@@ -320,8 +321,8 @@ class HttpService(object):
   @staticmethod
   def encode_request_body(body, content_type):
     """Returns request body encoded according to its content type."""
-    # No body or it is already encoded.
-    if body is None or isinstance(body, str):
+    # No body, it is already encoded or it is streamed.
+    if body is None or isinstance(body, str) or callable(body):
       return body
     # Any body should have content type set.
     assert content_type, 'Request has body, but no content type'
@@ -376,6 +377,9 @@ class HttpService(object):
       - str for pre-encoded data
       - list for data to be form-encoded
       - dict for data to be form-encoded
+      - callable that returns an iterable of str chunks. It is called on each
+        attempt so that a retry restarts the body from the beginning instead of
+        buffering it in memory. The body is sent with chunked transfer encoding.
 
     - Optionally retries HTTP 404 and 50x.
     - Retries up to |max_attempts| times. If None or 0, there's no limit in the
@@ -428,7 +432,8 @@ class HttpService(object):
     # Prepare headers.
     headers = get_case_insensitive_dict(headers or {})
     if body is not None:
-      headers['Content-Length'] = len(body)
+      if not callable(body):
+        headers['Content-Length'] = len(body)
       if content_type:
         headers['Content-Type'] = content_type
 
@@ -445,7 +450,8 @@ class HttpService(object):
       try:
         # Prepare and send a new request.
         request = HttpRequest(
-            method, resource_url, query_params, body,
+            method, resource_url, query_params,
+            iter(body()) if callable(body) else body,
             headers, read_timeout, stream, follow_redirects)
         if self.authenticator:
           self.authenticator.authorize(request)
@@ -573,7 +579,7 @@ class HttpRequest(object):
       |method| - HTTP method to use
       |url| - relative URL to the resource, without query parameters
       |params| - list of (key, value) pairs to put into GET parameters
-      |body| - encoded body of the request (None or str)
+      |body| - encoded body of the request (None, str or iterable of str)
       |headers| - dict with request headers
       |timeout| - socket read timeout (None to disable)
       |stream| - True to stream response from socket